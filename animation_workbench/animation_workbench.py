@@ -11,9 +11,11 @@ __revision__ = "$Format:%H$"
 # This will make the QGIS use a world projection and then move the center
 # of the CRS sequentially to create a spinning globe effect
 import os
+import shutil
 import tempfile
+import time
 from functools import partial
-from typing import Optional
+from typing import Callable, List, Optional
 
 from PyQt5.QtMultimedia import QMediaContent, QMediaPlayer
 from PyQt5.QtMultimediaWidgets import QVideoWidget
@@ -33,21 +35,54 @@ from qgis.core import (
     QgsExpressionContextUtils,
     QgsProject,
     QgsMapLayerProxyModel,
+    QgsMapSettings,
     QgsReferencedRectangle,
     QgsApplication,
     QgsPropertyCollection,
+    QgsReadWriteContext,
+    QgsSymbol,
+    QgsSymbolLayerUtils,
     QgsWkbTypes,
 )
 from qgis.gui import QgsExtentWidget, QgsPropertyOverrideButton
 
 from .core import (
     AnimationController,
+    DataPreparation,
+    ExportPreparationTask,
+    FeatureIdCache,
+    GeneralizationCache,
     InvalidAnimationParametersException,
+    LayerProfilingTask,
+    LayerRenderProfiler,
+    LayerSnapshot,
+    MetricsExporter,
+    MovieCommandGenerator,
     MovieCreationTask,
     MovieFormat,
+    RasterWarpCache,
+    SampleFrame,
     set_setting,
     setting,
     MapMode,
+    StageProfiler,
+    TraceRecorder,
+)
+from .core.layer_profiler import sample_evenly, sample_evenly_from
+from .core.raster_cache import frames_extent
+from .core.density import DensityGrids, DensityGridTask
+from .core.frame_stream import (
+    OrderedFrameStream,
+    frame_file_names,
+    reused_frame_files,
+)
+from .core.raster_series import RasterTimeSeries
+from .core.temporal_index import TemporalFeatureIndex
+from .core.trajectory import TrajectoryInterpolator
+from .core.utilities import (
+    human_readable_duration,
+    human_readable_size,
+    memory_usage,
 )
 from .dialog_expression_context_generator import DialogExpressionContextGenerator
 from .utilities import get_ui_class, resources_path
@@ -58,6 +93,11 @@ FORM_CLASS = get_ui_class("animation_workbench_base.ui")
 class AnimationWorkbench(QDialog, FORM_CLASS):
     """Dialog implementation class Animation Workbench class."""
 
+    # Minimum number of seconds between refreshes of the throughput dashboard
+    DASHBOARD_UPDATE_INTERVAL = 0.5
+    # Number of frames rendered by the "Profile Layers" action
+    LAYER_PROFILE_SAMPLE_FRAMES = 10
+
     # pylint: disable=too-many-locals,too-many-statements
     def __init__(
         self,
@@ -95,6 +135,19 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         self.setup_media_widgets()
 
         self.data_defined_properties = QgsPropertyCollection()
+        # Ordered and filtered ids of the animation layer's features
+        self.feature_id_cache = FeatureIdCache()
+        # Time index of the animation layer, for temporal animations
+        self.temporal_index: Optional[TemporalFeatureIndex] = None
+        # Density grids of the animation layer, for temporal animations
+        self.density_grids: Optional[DensityGrids] = None
+        # Computes the density grids before an export is queued
+        self.density_task: Optional[DensityGridTask] = None
+        # Prepares the layers of an export before it is rendered
+        self.preparation_task: Optional[ExportPreparationTask] = None
+        # Precomputed positions of points moving along the animation
+        # layer's tracks, for trajectory animations
+        self.trajectories: Optional[TrajectoryInterpolator] = None
 
         self.extent_group_box.setMapCanvas(self.iface.mapCanvas())
         self.scale_range.setMapCanvas(self.iface.mapCanvas())
@@ -117,6 +170,27 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             self.debug_button.clicked.connect(self.debug_button_clicked)
             self.button_box.addButton(self.debug_button, QDialogButtonBox.ActionRole)
 
+        # Renders a few sample frames layer by layer, to find slow layers
+        # before committing to a long export
+        self.profile_layers_button = QPushButton("Profile Layers")
+        self.profile_layers_button.setToolTip(
+            "Reports the render time of each layer over "
+            f"{AnimationWorkbench.LAYER_PROFILE_SAMPLE_FRAMES} sample frames"
+        )
+        self.profile_layers_button.clicked.connect(self.profile_sample_frames)
+        self.button_box.addButton(
+            self.profile_layers_button, QDialogButtonBox.ActionRole
+        )
+        self.layer_profiling_task: Optional[LayerProfilingTask] = None
+        # Frames to profile once the current export has rendered
+        self.layer_profile_jobs = []
+        # Prepared layer data for the current export, if enabled
+        self.data_preparation: Optional[DataPreparation] = None
+        # Rasters warped to the destination CRS for the current export
+        self.raster_cache: Optional[RasterWarpCache] = None
+        # Generalized heavy layers for the current export
+        self.generalization: Optional[GeneralizationCache] = None
+
         # place where working files are stored
         self.work_directory = tempfile.gettempdir()
         self.frame_filename_prefix = "animation_workbench"
@@ -145,6 +219,8 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             layer = QgsProject.instance().mapLayer(prev_layer_id)
             if layer:
                 self.layer_combo.setLayer(layer)
+        self.feature_filter_widget.setLayer(self.layer_combo.currentLayer())
+        self.feature_order_widget.setLayer(self.layer_combo.currentLayer())
 
         prev_data_defined_properties_xml, _ = QgsProject.instance().readEntry(
             "animation", "data_defined_properties"
@@ -157,6 +233,28 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
                 elem, AnimationController.DYNAMIC_PROPERTIES
             )
 
+        self.highlight_symbol_button.setMapCanvas(self.iface.mapCanvas())
+        prev_highlight_symbol_xml, _ = QgsProject.instance().readEntry(
+            "animation", "highlight_symbol"
+        )
+        if prev_highlight_symbol_xml:
+            doc = QDomDocument()
+            doc.setContent(prev_highlight_symbol_xml.encode())
+            symbol = QgsSymbolLayerUtils.loadSymbol(
+                doc.documentElement(), QgsReadWriteContext()
+            )
+            if symbol:
+                self.highlight_symbol_button.setSymbol(symbol)
+        self.update_highlight_symbol_button(self.layer_combo.currentLayer())
+        self.highlight_check.setChecked(
+            setting(
+                key="highlight_feature",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+
         self.extent_group_box.setOutputCrs(QgsProject.instance().crs())
         self.extent_group_box.setOutputExtentFromUser(
             self.iface.mapCanvas().extent(), QgsProject.instance().crs()
@@ -209,6 +307,120 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             ).lower()
             == "true"
         )
+        self.feature_filter_widget.setExpression(
+            setting(key="feature_filter", default="", prefer_project_setting=True)
+        )
+        self.feature_order_widget.setExpression(
+            setting(key="feature_order_by", default="", prefer_project_setting=True)
+        )
+        self.feature_order_descending_check.setChecked(
+            setting(
+                key="feature_order_descending",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.optimize_tour_check.setChecked(
+            setting(
+                key="optimize_tour",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.scale_travel_check.setChecked(
+            setting(
+                key="scale_travel_to_distance",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.temporal_check.toggled.connect(self.update_extent_frames_label)
+        self.temporal_check.setChecked(
+            setting(
+                key="temporal_animation",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.temporal_check.toggled.connect(self.density_check.setEnabled)
+        self.density_check.setEnabled(self.temporal_check.isChecked())
+        self.density_check.setChecked(
+            setting(
+                key="density_animation",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.trajectory_check.toggled.connect(self.update_extent_frames_label)
+        self.trajectory_check.setChecked(
+            setting(
+                key="trajectory_animation",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.trajectory_style_widget.setFilePath(
+            setting(key="trajectory_style", default="", prefer_project_setting=True)
+        )
+        self.raster_series_combo.setFilters(QgsMapLayerProxyModel.RasterLayer)
+        prev_series_layer_id, _ = QgsProject.instance().readEntry(
+            "animation", "raster_series_layer_id"
+        )
+        if prev_series_layer_id:
+            layer = QgsProject.instance().mapLayer(prev_series_layer_id)
+            if layer:
+                self.raster_series_combo.setLayer(layer)
+        for widget in (
+            self.raster_series_combo,
+            self.raster_series_interpolate_check,
+            self.raster_series_resample_check,
+        ):
+            self.raster_series_check.toggled.connect(widget.setEnabled)
+        self.raster_series_check.setChecked(
+            setting(
+                key="raster_series",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.raster_series_interpolate_check.setChecked(
+            setting(
+                key="raster_series_interpolate",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.raster_series_resample_check.setChecked(
+            setting(
+                key="raster_series_resample",
+                default="false",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        for widget in (
+            self.raster_series_combo,
+            self.raster_series_interpolate_check,
+            self.raster_series_resample_check,
+        ):
+            widget.setEnabled(self.raster_series_check.isChecked())
+        self.sprite_check.setChecked(
+            setting(
+                key="trajectory_sprites",
+                default="true",
+                prefer_project_setting=True,
+            ).lower()
+            == "true"
+        )
+        self.update_extent_frames_label()
         # How many frames to render when we are in static mode
         self.extent_frames_spin.setValue(
             int(
@@ -279,6 +491,22 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         self.render_queue.image_rendered.connect(self.load_image)
 
         self.movie_task = None
+        # Rendered frames in order, while they are encoded during rendering
+        self.frame_stream: Optional[OrderedFrameStream] = None
+        # Timeline of the current export, if trace export is enabled
+        self.trace = TraceRecorder(enabled=False)
+        # Optional Prometheus metrics output, for unattended render hosts
+        self.metrics_exporter: Optional[MetricsExporter] = None
+
+        # Throughput dashboard on the progress tab
+        self.total_frame_count = 0
+        # Number of frames of the animation being exported, which are
+        # numbered from 0
+        self.job_count = 0
+        self.last_dashboard_update = 0
+        self.render_time_chart.hideAxis("bottom")
+        self.render_time_chart.setMouseEnabled(x=False, y=False)
+        self.render_time_chart.setMenuEnabled(False)
 
         self.preview_frame_spin.valueChanged.connect(self.show_preview_for_frame)
 
@@ -409,40 +637,91 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
     def debug_button_clicked(self):
         """Show the different ffmpeg commands that will be run to process the images."""
         self.output_log_text_edit.clear()
-        self.intro_media.set_output_resolution(self.output_mode_name())
-        self.outro_media.set_output_resolution(self.output_mode_name())
-        self.music_media.set_output_resolution(self.output_mode_name())
-        intro_command = self.intro_media.video_command()
-        outro_command = self.outro_media.video_command()
-        music_command = self.music_media.video_command()
-        if intro_command:
-            self.output_log_text_edit.append(" ".join(intro_command))
-        if outro_command:
-            self.output_log_text_edit.append(" ".join(outro_command))
-        if music_command:
-            self.output_log_text_edit.append(" ".join(music_command))
+        generator = MovieCommandGenerator(
+            output_file=self.movie_file_edit.text(),
+            output_mode=self.output_mode_ffmpeg(),
+            intro_inputs=self.intro_media.input_arguments(),
+            outro_inputs=self.outro_media.input_arguments(),
+            music_inputs=self.music_media.input_arguments(),
+            output_format=MovieFormat.MP4,
+            work_directory=self.work_directory,
+            frame_filename_prefix=self.frame_filename_prefix,
+            framerate=self.framerate_spin.value(),
+            temp_dir=tempfile.gettempdir(),
+        )
+        self.output_log_text_edit.append(
+            " ".join(["ffmpeg"] + generator.single_pass_arguments())
+        )
 
     def close(self):  # pylint: disable=missing-function-docstring
         """Handler for the close button."""
         self.save_state()
+        self.stop_metrics_exporter()
         self.reject()
 
     def closeEvent(
         self, event
     ):  # pylint: disable=missing-function-docstring,unused-argument
         self.save_state()
+        self.stop_metrics_exporter()
         self.reject()
 
+    def start_metrics_exporter(self):
+        """
+        Starts the metrics exporter for an export run, if enabled in the
+        workbench settings
+        """
+        self.stop_metrics_exporter()
+        exporter = MetricsExporter(self.render_queue)
+        if not exporter.enabled:
+            return
+        try:
+            exporter.start()
+        except OSError as e:
+            self.output_log_text_edit.append(f"Could not start metrics endpoint: {e}")
+            return
+        self.metrics_exporter = exporter
+        if exporter.port:
+            self.output_log_text_edit.append(
+                f"Serving metrics on http://127.0.0.1:{exporter.port}/metrics"
+            )
+
+    def stop_metrics_exporter(self):
+        """
+        Stops the metrics exporter, if running
+        """
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+
     def _layer_changed(self, layer):
         """
         Triggered when the layer is changed
         """
         self.expression_context_generator.set_layer(layer)
+        self.feature_filter_widget.setLayer(layer)
+        self.feature_order_widget.setLayer(layer)
+        self.update_highlight_symbol_button(layer)
 
         buttons = self.findChildren(QgsPropertyOverrideButton)
         for button in buttons:
             button.setVectorLayer(layer)
 
+    def update_highlight_symbol_button(self, layer):
+        """
+        Matches the highlight symbol to the geometry type of a layer
+        """
+        self.highlight_symbol_button.setLayer(layer)
+        if not layer:
+            return
+        symbol = QgsSymbol.defaultSymbol(layer.geometryType())
+        if not symbol:
+            return
+        self.highlight_symbol_button.setSymbolType(symbol.type())
+        current = self.highlight_symbol_button.symbol()
+        if not current or current.type() != symbol.type():
+            self.highlight_symbol_button.setSymbol(symbol)
+
     def register_data_defined_button(self, button, property_key: int):
         """
         Registers a new data defined button, linked to the given property key (see values in AnimationController)
@@ -499,6 +778,15 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         """
         self.settings_stack.setCurrentIndex(1)
 
+    def update_extent_frames_label(self):
+        """
+        Updates the fixed extent frames label to match the animation type
+        """
+        if self.temporal_check.isChecked() or self.trajectory_check.isChecked():
+            self.extent_frames_label.setText(self.tr("Frames"))
+        else:
+            self.extent_frames_label.setText(self.tr("Frames per feature"))
+
     def show_status(self):
         """
         Display the size of the QgsTaskManager queue.
@@ -516,6 +804,70 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
 
         self.progress_bar.setValue(self.render_queue.total_completed)
 
+        self.update_throughput_dashboard()
+
+    def update_throughput_dashboard(self, force: bool = False):
+        """
+        Refreshes the render throughput, memory and disk use shown in the
+        progress tab. Updates are throttled to DASHBOARD_UPDATE_INTERVAL
+        unless force is True.
+        """
+        now = time.time()
+        if (
+            not force
+            and now - self.last_dashboard_update
+            < AnimationWorkbench.DASHBOARD_UPDATE_INTERVAL
+        ):
+            return
+        self.last_dashboard_update = now
+
+        metrics = self.render_queue.metrics
+        fps = metrics.rolling_frames_per_second()
+        self.fps_value_label.setText(f"{fps:.2f}" if fps else "n/a")
+
+        remaining_frames = (
+            self.render_queue.total_queue_size - self.render_queue.total_completed
+        )
+        if remaining_frames <= 0:
+            self.render_eta_value_label.setText("Done")
+        elif fps:
+            self.render_eta_value_label.setText(
+                human_readable_duration(remaining_frames / fps)
+            )
+        else:
+            self.render_eta_value_label.setText("n/a")
+
+        self.memory_value_label.setText(human_readable_size(memory_usage()))
+
+        try:
+            free_space = human_readable_size(
+                shutil.disk_usage(self.work_directory).free
+            )
+        except OSError:
+            free_space = "n/a"
+        self.disk_value_label.setText(
+            "{} ({} free)".format(
+                human_readable_size(metrics.bytes_written), free_space
+            )
+        )
+
+        self.render_time_chart.plot(
+            metrics.recent_render_times(), clear=True, pen="#2b83ba"
+        )
+
+    def show_encode_progress(self, encoded_frames: int, fps: float):
+        """
+        Shows the estimated time remaining while encoding the movie
+        """
+        remaining_frames = self.total_frame_count - encoded_frames
+        if remaining_frames <= 0:
+            self.encode_eta_value_label.setText("Finishing")
+        elif fps > 0:
+            self.encode_eta_value_label.setText(
+                human_readable_duration(remaining_frames / fps)
+            )
+        self.memory_value_label.setText(human_readable_size(memory_usage()))
+
     def set_output_name(self):
         """
         Asks the user for the output video file path
@@ -611,6 +963,80 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             value="true" if self.check_loop_features.isChecked() else "false",
             store_in_project=True,
         )
+        set_setting(
+            key="feature_filter",
+            value=self.feature_filter_widget.expression(),
+            store_in_project=True,
+        )
+        set_setting(
+            key="feature_order_by",
+            value=self.feature_order_widget.expression(),
+            store_in_project=True,
+        )
+        set_setting(
+            key="feature_order_descending",
+            value="true"
+            if self.feature_order_descending_check.isChecked()
+            else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="optimize_tour",
+            value="true" if self.optimize_tour_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="scale_travel_to_distance",
+            value="true" if self.scale_travel_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="highlight_feature",
+            value="true" if self.highlight_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="temporal_animation",
+            value="true" if self.temporal_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="density_animation",
+            value="true" if self.density_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="trajectory_animation",
+            value="true" if self.trajectory_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="trajectory_style",
+            value=self.trajectory_style_widget.filePath(),
+            store_in_project=True,
+        )
+        set_setting(
+            key="trajectory_sprites",
+            value="true" if self.sprite_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="raster_series",
+            value="true" if self.raster_series_check.isChecked() else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="raster_series_interpolate",
+            value="true"
+            if self.raster_series_interpolate_check.isChecked()
+            else "false",
+            store_in_project=True,
+        )
+        set_setting(
+            key="raster_series_resample",
+            value="true" if self.raster_series_resample_check.isChecked() else "false",
+            store_in_project=True,
+        )
         set_setting(
             key="frames_for_extent",
             value=self.extent_frames_spin.value(),
@@ -659,6 +1085,14 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             )
         else:
             QgsProject.instance().removeEntry("animation", "layer_id")
+        if self.raster_series_combo.currentLayer():
+            QgsProject.instance().writeEntry(
+                "animation",
+                "raster_series_layer_id",
+                self.raster_series_combo.currentLayer().id(),
+            )
+        else:
+            QgsProject.instance().removeEntry("animation", "raster_series_layer_id")
         temp_doc = QDomDocument()
         dd_elem = temp_doc.createElement("data_defined_properties")
         self.data_defined_properties.writeXml(
@@ -668,6 +1102,18 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         QgsProject.instance().writeEntry(
             "animation", "data_defined_properties", temp_doc.toString()
         )
+        if self.highlight_symbol_button.symbol():
+            temp_doc = QDomDocument()
+            symbol_elem = QgsSymbolLayerUtils.saveSymbol(
+                "highlight",
+                self.highlight_symbol_button.symbol(),
+                temp_doc,
+                QgsReadWriteContext(),
+            )
+            temp_doc.appendChild(symbol_elem)
+            QgsProject.instance().writeEntry(
+                "animation", "highlight_symbol", temp_doc.toString()
+            )
 
     # Prevent the slot being called twize
     @pyqtSlot()
@@ -676,6 +1122,9 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
 
         .. note:: This is called on OK click.
         """
+        if self.density_task or self.preparation_task:
+            return
+
         # Enable progress page on accept
         self.main_tab.setCurrentIndex(5)
         # Image preview page
@@ -697,6 +1146,7 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             return
 
         controller.reuse_cache = self.reuse_cache.isChecked()
+        controller.cull_layers = bool(int(setting(key="cull_layers", default=0)))
 
         self.render_queue.set_annotations(
             QgsProject.instance().annotationManager().annotations()
@@ -708,6 +1158,8 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         )
         self.progress_bar.setMaximum(controller.total_frame_count)
         self.progress_bar.setValue(0)
+        self.total_frame_count = controller.total_frame_count
+        self.encode_eta_value_label.setText("n/a")
 
         def log_message(message):
             self.output_log_text_edit.append(message)
@@ -716,6 +1168,39 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
         if int(setting(key="verbose_mode", default=0)):
             controller.verbose_message.connect(log_message)
 
+        if controller.density_grids and controller.density_grids.grids is None:
+            self.compute_density_grids(controller)
+        else:
+            self.queue_jobs(controller)
+
+    def compute_density_grids(self, controller: AnimationController):
+        """
+        Computes the density grids of an animation in a background task,
+        then queues its jobs
+        """
+        self.output_log_text_edit.append("Computing density grids")
+        self.density_task = DensityGridTask(
+            controller.density_grids,
+            controller.total_frame_count,
+            os.path.join(self.work_directory, "density"),
+        )
+
+        def cleanup_density_task():
+            self.density_task = None
+
+        self.density_task.message.connect(self.show_message)
+        self.density_task.grids_computed.connect(
+            lambda _: self.queue_jobs(controller)
+        )
+        self.density_task.taskCompleted.connect(cleanup_density_task)
+        self.density_task.taskTerminated.connect(cleanup_density_task)
+        QgsApplication.taskManager().addTask(self.density_task)
+
+    def queue_jobs(self, controller: AnimationController):
+        """
+        Queues the render jobs of an animation, prepares their layers and
+        starts rendering
+        """
         self.render_queue.total_feature_count = controller.total_feature_count
 
         # this needs reworking!
@@ -723,19 +1208,350 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             controller.travel_duration + controller.hover_duration
         ) * controller.frame_rate
 
-        for job in controller.create_jobs():
-            self.output_log_text_edit.append(job.file_name)
-            self.render_queue.add_job(job)
+        self.trace = TraceRecorder()
+        self.render_queue.trace = self.trace
+        self.job_count = controller.job_count()
+
+        job_profiler = StageProfiler("job_generation")
+        try:
+            with job_profiler, self.trace.span("job_generation", "controller"):
+                for job in controller.create_jobs():
+                    self.output_log_text_edit.append(job.file_name)
+                    self.render_queue.add_job(job)
+        except ValueError as e:
+            # e.g. features of the animation layer were deleted
+            self.output_log_text_edit.append(f"Processing halted: {e}")
+            self.render_queue.reset()
+            return
+        finally:
+            self.log_profile_files(
+                job_profiler.write(self.work_directory, self.frame_filename_prefix)
+            )
+
+        self.release_prepared_layers()
+        steps = []
+        if controller.raster_series:
+            steps.append(self.prepare_raster_series(controller.raster_series))
+        if int(setting(key="prepare_data", default=0)):
+            steps.append(self.prepare_data())
+        if int(setting(key="raster_warp_cache", default=0)):
+            steps.append(self.warp_rasters())
+        if int(setting(key="generalize_layers", default=0)):
+            steps.append(self.generalize_layers())
+        steps = [step for step in steps if step]
+        if steps:
+            self.start_preparation(controller, steps)
+        else:
+            self.finish_preparation(controller)
+
+    def release_prepared_layers(self):
+        """
+        Releases the layers prepared for the last export
+        """
+        if self.data_preparation:
+            self.data_preparation.release()
+            self.data_preparation = None
+        if self.raster_cache:
+            self.raster_cache.release()
+            self.raster_cache = None
+        if self.generalization:
+            self.generalization.release()
+            self.generalization = None
+
+    def start_preparation(
+        self, controller: AnimationController, steps: List[Callable[..., None]]
+    ):
+        """
+        Starts a background task running the steps which prepare the layers
+        of the queued jobs, then starts rendering
+        """
+        self.preparation_task = ExportPreparationTask(steps)
+
+        def cleanup_preparation_task():
+            self.preparation_task = None
+
+        def preparation_terminated():
+            # canceled or failed, so nothing is rendered. The task reports
+            # which.
+            cleanup_preparation_task()
+            self.release_prepared_layers()
+            self.render_queue.reset()
+            self.progress_bar.setMaximum(100)
+            self.progress_bar.setValue(0)
+            self.button_box.button(QDialogButtonBox.Cancel).setEnabled(False)
+
+        self.preparation_task.message.connect(self.show_message)
+        self.preparation_task.preparation_completed.connect(
+            lambda: self.finish_preparation(controller)
+        )
+        self.preparation_task.taskCompleted.connect(cleanup_preparation_task)
+        self.preparation_task.taskTerminated.connect(preparation_terminated)
+        self.button_box.button(QDialogButtonBox.Cancel).setEnabled(True)
+        QgsApplication.taskManager().addTask(self.preparation_task)
+
+    def finish_preparation(self, controller: AnimationController):
+        """
+        Swaps the prepared layers into the queued jobs, then starts
+        rendering
+        """
+        if controller.raster_series:
+            self.report_raster_series(controller.raster_series)
+        # generalized levels replace the original layers, which memory
+        # copies then replace at scales without a level
+        if self.generalization:
+            self.apply_generalization()
+        if self.data_preparation:
+            self.apply_data_preparation()
+        if self.raster_cache:
+            self.apply_raster_warps()
+        self.start_rendering()
+
+    def start_rendering(self):
+        """
+        Starts rendering the queued jobs
+        """
+        layer_profile_frames = int(setting(key="layer_profile_frames", default=0))
+        self.layer_profile_jobs = (
+            sample_evenly(self.render_queue.job_queue, layer_profile_frames)
+            if layer_profile_frames
+            else []
+        )
 
         self.button_box.button(QDialogButtonBox.Cancel).setEnabled(True)
+        self.start_metrics_exporter()
+        if int(setting(key="pipelined_encoding", default=0)):
+            self.start_pipelined_encoding()
         # Now all the tasks are prepared, start the render_queue processing
         self.render_queue.start_processing()
 
+    def start_pipelined_encoding(self):
+        """
+        Starts encoding the movie while the frames are rendered, feeding the
+        encoder each frame once all earlier frames have been rendered
+        """
+        if self.radio_gif.isChecked():
+            self.output_log_text_edit.append(
+                "GIF animations are created after rendering, as they cannot "
+                "be encoded while the frames are rendered"
+            )
+            return
+
+        queued = [str(job.file_name) for job in self.render_queue.job_queue]
+        # frames reused from an earlier export are not queued, but are
+        # part of the movie
+        reused = (
+            reused_frame_files(
+                frame_file_names(
+                    self.work_directory, self.frame_filename_prefix, self.job_count
+                ),
+                queued,
+            )
+            if self.reuse_cache.isChecked()
+            else []
+        )
+        self.frame_stream = OrderedFrameStream(
+            queued + reused,
+            delete_consumed=bool(int(setting(key="delete_encoded_frames", default=0))),
+        )
+        for file_name in reused:
+            self.frame_stream.frame_rendered(file_name)
+        self.render_queue.image_rendered.connect(self.frame_stream.frame_rendered)
+        self.render_queue.image_failed.connect(self.frame_stream.frame_failed)
+
+        self.output_log_text_edit.append("Encoding the movie while rendering")
+        self.start_movie_task(self.frame_stream)
+
+    def stop_pipelined_encoding(self, success: bool):
+        """
+        Ends the frame stream of a pipelined encode, so the encoder finishes
+        with the last rendered frame, or stops if rendering was canceled
+        """
+        self.render_queue.image_rendered.disconnect(self.frame_stream.frame_rendered)
+        self.render_queue.image_failed.disconnect(self.frame_stream.frame_failed)
+        if success:
+            self.frame_stream.finish()
+        elif self.movie_task:
+            self.movie_task.cancel()
+        else:
+            self.frame_stream.cancel()
+        self.frame_stream = None
+
+    def prepare_data(self) -> Optional[Callable[[], None]]:
+        """
+        Returns a preparation step preparing the layer data of the queued
+        jobs for fast rendering
+        """
+        jobs = self.render_queue.job_queue
+        if not jobs:
+            return None
+
+        self.output_log_text_edit.append("Preparing layer data")
+        # a frame from the middle of the animation is rendered before and
+        # after preparing the data, to estimate the saving per frame. Its
+        # per-frame layers are only created when it is rendered, so the
+        # layers shared by all frames are sampled.
+        sample_job = jobs[len(jobs) // 2]
+        self.data_preparation = DataPreparation()
+        self.data_preparation.normal_message.connect(self.show_message)
+        return partial(
+            self.data_preparation.prepare,
+            [LayerSnapshot(layer) for layer in self.render_queue.queued_layers()],
+            SampleFrame(sample_job.frame_settings, sample_job.feature_ids),
+        )
+
+    def apply_data_preparation(self):
+        """
+        Renders the prepared layer data in the queued jobs, and reports the
+        time taken and estimated saving per frame
+        """
+        self.data_preparation.reload_indexed_layers(self.render_queue.queued_layers())
+        self.render_queue.replace_layers(dict(self.data_preparation.memory_layers))
+
+        saving = self.data_preparation.saving or 0
+        self.output_log_text_edit.append(
+            "Data preparation took {}. Estimated saving: {:.3f}s per frame, "
+            "{} for the whole animation".format(
+                human_readable_duration(self.data_preparation.elapsed),
+                saving,
+                human_readable_duration(
+                    max(saving, 0) * len(self.render_queue.job_queue)
+                ),
+            )
+        )
+
+    def warp_rasters(self) -> Optional[Callable[[], None]]:
+        """
+        Returns a preparation step warping the raster layers which are not
+        in the destination CRS to that CRS, so they are reprojected once
+        per export instead of once per frame
+        """
+        jobs = self.render_queue.job_queue
+        if not jobs:
+            return None
+
+        map_settings = jobs[0].frame_settings
+        if any(
+            job.frame_settings.destinationCrs() != map_settings.destinationCrs()
+            for job in jobs
+        ):
+            self.output_log_text_edit.append(
+                "Rasters were not pre-warped, because the map CRS changes "
+                "during the animation"
+            )
+            return None
+
+        self.raster_cache = RasterWarpCache(
+            os.path.join(self.work_directory, "raster_cache")
+        )
+        self.raster_cache.normal_message.connect(self.show_message)
+        return partial(
+            self.raster_cache.prepare,
+            [LayerSnapshot(layer) for layer in self.render_queue.queued_layers()],
+            map_settings.destinationCrs(),
+            frames_extent(jobs),
+        )
+
+    def apply_raster_warps(self):
+        """
+        Renders the warped copies of rasters in the queued jobs
+        """
+        self.render_queue.replace_layers(dict(self.raster_cache.warped_layers))
+        if self.raster_cache.warped_layers:
+            self.output_log_text_edit.append(
+                "Warping {} raster layers took {}".format(
+                    len(self.raster_cache.warped_layers),
+                    human_readable_duration(self.raster_cache.elapsed),
+                )
+            )
+
+    def prepare_raster_series(
+        self, raster_series: RasterTimeSeries
+    ) -> Optional[Callable[[], None]]:
+        """
+        Returns a preparation step caching the steps of a raster time
+        series over the extent of the queued jobs, so that each frame's
+        step is read from the cache
+        """
+        jobs = self.render_queue.job_queue
+        if not jobs:
+            return None
+
+        resolution = None
+        if self.raster_series_resample_check.isChecked():
+            resolution = min(job.frame_settings.mapUnitsPerPixel() for job in jobs)
+        raster_series.normal_message.connect(self.show_message)
+        return partial(
+            raster_series.prepare,
+            jobs[0].frame_settings.destinationCrs(),
+            frames_extent(jobs),
+            resolution,
+        )
+
+    def report_raster_series(self, raster_series: RasterTimeSeries):
+        """
+        Reports whether the steps of a raster time series were cached
+        """
+        if raster_series.cube is not None:
+            self.output_log_text_edit.append(
+                "Caching {} steps of the raster series took {}".format(
+                    len(raster_series.steps),
+                    human_readable_duration(raster_series.elapsed),
+                )
+            )
+        else:
+            self.output_log_text_edit.append(
+                "The raster series could not be cached, so the series layer "
+                "is rendered in every frame instead"
+            )
+
+    def generalize_layers(self) -> Optional[Callable[[], None]]:
+        """
+        Returns a preparation step simplifying the geometries of heavy line
+        and polygon layers for the scales the animation visits
+        """
+        jobs = self.render_queue.job_queue
+        if not jobs:
+            return None
+
+        scales = [job.frame_settings.scale() for job in jobs]
+        self.generalization = GeneralizationCache(
+            os.path.join(self.work_directory, "generalized")
+        )
+        self.generalization.normal_message.connect(self.show_message)
+        return partial(
+            self.generalization.prepare,
+            [LayerSnapshot(layer) for layer in self.render_queue.queued_layers()],
+            min(scales),
+            max(scales),
+        )
+
+    def apply_generalization(self):
+        """
+        Renders heavy line and polygon layers with simplified geometries
+        matching each frame's scale
+        """
+        if not self.generalization.levels:
+            return
+
+        for job in self.render_queue.job_queue:
+            self.generalization.apply(job)
+        self.output_log_text_edit.append(
+            "Generalizing {} layers took {}".format(
+                len(self.generalization.levels),
+                human_readable_duration(self.generalization.elapsed),
+            )
+        )
+
     def cancel_processing(self):
         """
         Cancels current processing
         """
         self.button_box.button(QDialogButtonBox.Cancel).setEnabled(False)
+        if self.preparation_task:
+            # rendering has not started yet, the task resets the dialog
+            # when it terminates
+            self.preparation_task.cancel()
+            return
         self.render_queue.cancel_processing()
         # Enable progress page
         self.main_tab.setCurrentIndex(0)
@@ -766,6 +1582,47 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
                 "Generating flight path for %s layer: %s" % (layer_type, layer_name)
             )
 
+        feature_ids = None
+        if self.layer_combo.currentLayer():
+            try:
+                feature_ids = self.feature_id_cache.feature_ids(
+                    self.layer_combo.currentLayer(),
+                    filter_expression=self.feature_filter_widget.expression(),
+                    order_by=self.feature_order_widget.expression(),
+                    descending=self.feature_order_descending_check.isChecked(),
+                )
+            except ValueError as e:
+                self.output_log_text_edit.append(f"Processing halted: {e}")
+                return None
+
+        temporal_index = None
+        if map_mode == MapMode.FIXED_EXTENT and self.temporal_check.isChecked():
+            temporal_index = self.create_temporal_index()
+            if not temporal_index:
+                return None
+
+        highlight_symbol = None
+        if self.highlight_check.isChecked() and self.highlight_symbol_button.symbol():
+            highlight_symbol = self.highlight_symbol_button.symbol().clone()
+
+        trajectories = None
+        if map_mode == MapMode.FIXED_EXTENT and self.trajectory_check.isChecked():
+            if temporal_index:
+                self.output_log_text_edit.append(
+                    "Processing halted: temporal and trajectory animations "
+                    "cannot be combined"
+                )
+                return None
+            trajectories = self.create_trajectories()
+            if not trajectories:
+                return None
+
+        raster_series = None
+        if map_mode == MapMode.FIXED_EXTENT and self.raster_series_check.isChecked():
+            raster_series = self.create_raster_series()
+            if not raster_series:
+                return None
+
         if map_mode == MapMode.FIXED_EXTENT:
             controller = AnimationController.create_fixed_extent_controller(
                 map_settings=self.iface.mapCanvas().mapSettings(),
@@ -777,6 +1634,11 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
                 ),
                 total_frames=self.extent_frames_spin.value(),
                 frame_rate=self.framerate_spin.value(),
+                feature_ids=feature_ids,
+                temporal_index=temporal_index,
+                trajectories=trajectories,
+                draw_sprites=self.sprite_check.isChecked(),
+                highlight_symbol=highlight_symbol,
             )
         else:
             try:
@@ -797,47 +1659,197 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
                     if self.zoom_easing_widget.is_enabled()
                     else None,
                     frame_rate=self.framerate_spin.value(),
+                    feature_ids=feature_ids,
+                    optimize_tour=self.optimize_tour_check.isChecked(),
+                    scale_travel_to_distance=self.scale_travel_check.isChecked(),
+                    highlight_symbol=highlight_symbol,
                 )
             except InvalidAnimationParametersException as e:
                 self.output_log_text_edit.append(f"Processing halted: {e}")
                 return None
 
+        if temporal_index and self.density_check.isChecked():
+            controller.density_grids = self.create_density_grids(controller)
+        controller.raster_series = raster_series
+
         controller.data_defined_properties = QgsPropertyCollection(
             self.data_defined_properties
         )
         return controller
 
+    def create_temporal_index(self) -> Optional[TemporalFeatureIndex]:
+        """
+        Returns the time index of the animation layer, reusing the last
+        index while the layer and its temporal settings are unchanged
+        """
+        layer = self.layer_combo.currentLayer()
+        if not layer:
+            self.output_log_text_edit.append(
+                "Cannot generate a temporal animation without choosing a layer"
+            )
+            return None
+        if (
+            self.temporal_index
+            and self.temporal_index.layer == layer
+            and self.temporal_index.is_current()
+        ):
+            return self.temporal_index
+
+        try:
+            self.temporal_index = TemporalFeatureIndex.from_layer(layer)
+        except ValueError as e:
+            self.output_log_text_edit.append(f"Processing halted: {e}")
+            return None
+        return self.temporal_index
+
+    def create_density_grids(self, controller: AnimationController) -> DensityGrids:
+        """
+        Returns the density grids of the temporal layer for each frame of
+        an animation, reusing the last grids while the layer, its style
+        and the frames are unchanged. New grids are only computed when
+        exporting, see compute_density_grids().
+        """
+        map_settings = QgsMapSettings(controller.map_settings)
+        map_settings.setOutputSize(controller.size)
+        frames = controller.total_frame_count
+        if (
+            self.density_grids
+            and self.density_grids.index == controller.temporal_index
+            and self.density_grids.is_current(frames, map_settings)
+        ):
+            return self.density_grids
+
+        self.density_grids = DensityGrids(controller.temporal_index, map_settings)
+        return self.density_grids
+
+    def create_raster_series(self) -> Optional[RasterTimeSeries]:
+        """
+        Returns the raster time series of the chosen raster layer
+        """
+        layer = self.raster_series_combo.currentLayer()
+        if not layer:
+            self.output_log_text_edit.append(
+                "Cannot generate a raster series animation without choosing "
+                "a raster layer"
+            )
+            return None
+        try:
+            return RasterTimeSeries(
+                layer,
+                os.path.join(self.work_directory, "raster_series"),
+                interpolate=self.raster_series_interpolate_check.isChecked(),
+            )
+        except ValueError as e:
+            self.output_log_text_edit.append(f"Processing halted: {e}")
+            return None
+
+    def create_trajectories(self) -> Optional[TrajectoryInterpolator]:
+        """
+        Returns the positions of points moving along the animation layer's
+        tracks for every frame, reusing the last positions while the layer,
+        style and frame count are unchanged
+        """
+        layer = self.layer_combo.currentLayer()
+        if not layer or layer.geometryType() != QgsWkbTypes.LineGeometry:
+            self.output_log_text_edit.append(
+                "Cannot generate a trajectory animation without choosing a line layer"
+            )
+            return None
+        frames = self.extent_frames_spin.value()
+        style_file = self.trajectory_style_widget.filePath() or None
+        if (
+            self.trajectories
+            and self.trajectories.layer == layer
+            and self.trajectories.style_file == style_file
+            and self.trajectories.is_current(frames)
+        ):
+            return self.trajectories
+
+        self.trajectories = TrajectoryInterpolator(layer, style_file)
+        self.trajectories.precompute(
+            frames, os.path.join(self.work_directory, "trajectories")
+        )
+        return self.trajectories
+
     def processing_completed(self, success: bool):
         """Run after all processing is done to generate gif or mp4.
 
         .. note:: This called by process_more_tasks when all tasks are complete.
         """
+        # Write the per-frame render timings next to the frames
+        try:
+            timing_files = self.render_queue.metrics.export(
+                self.work_directory, self.frame_filename_prefix
+            )
+            self.output_log_text_edit.append(
+                "Render timings written to: {}".format(", ".join(timing_files))
+            )
+        except OSError as e:
+            self.output_log_text_edit.append(f"Could not write render timings: {e}")
+
+        self.log_profile_files(
+            self.render_queue.profiler.write(
+                self.work_directory, self.frame_filename_prefix
+            )
+        )
+
+        self.trace.add_frame_timings(self.render_queue.metrics)
+
+        pipelined = self.frame_stream is not None
+        if pipelined:
+            self.stop_pipelined_encoding(success)
+
         if not success:
+            self.write_trace()
             self.output_log_text_edit.append("Canceled by user")
             self.progress_bar.setMaximum(100)
             self.progress_bar.setValue(0)
             self.button_box.button(QDialogButtonBox.Cancel).setEnabled(False)
             return
-        # We assemble first commands needed to make the pieces of the movie
-        self.intro_media.set_output_resolution(self.output_mode_name())
-        self.outro_media.set_output_resolution(self.output_mode_name())
-        self.music_media.set_output_resolution(self.output_mode_name())
-        intro_command = self.intro_media.video_command()
-        outro_command = self.outro_media.video_command()
-        music_command = self.music_media.video_command()
-        output_mode = self.output_mode_ffmpeg()
+
+        self.output_log_text_edit.append(self.render_queue.metrics.summary_text())
+        self.update_throughput_dashboard(force=True)
+
+        if self.layer_profile_jobs:
+            self.start_layer_profiling(self.layer_profile_jobs)
+            self.layer_profile_jobs = []
+
+        if pipelined:
+            self.output_log_text_edit.append(
+                "Rendering complete, finishing the movie encoding"
+            )
+        else:
+            self.start_movie_task()
+
+        self.button_box.button(QDialogButtonBox.Cancel).setEnabled(False)
+        self.main_tab.setCurrentIndex(5)
+
+    def start_movie_task(self, frame_stream: Optional[OrderedFrameStream] = None):
+        """
+        Starts a background task creating the movie from the rendered frames
+
+        :param frame_stream: if set, the frames are encoded from the stream
+            as they are rendered
+        """
+        # The intro, outro and music are inputs of the same ffmpeg pass
+        # as the frames
         self.movie_task = MovieCreationTask(
             output_file=self.movie_file_edit.text(),
-            output_mode=output_mode,
-            intro_command=intro_command,
-            outro_command=outro_command,
-            music_command=music_command,
+            output_mode=self.output_mode_ffmpeg(),
+            intro_inputs=self.intro_media.input_arguments(),
+            outro_inputs=self.outro_media.input_arguments(),
+            music_inputs=self.music_media.input_arguments(),
             output_format=MovieFormat.GIF
             if self.radio_gif.isChecked()
             else MovieFormat.MP4,
             work_directory=self.work_directory,
             frame_filename_prefix=self.frame_filename_prefix,
             framerate=self.framerate_spin.value(),
+            total_frames=self.total_frame_count,
+            trace=self.trace,
+            frame_stream=frame_stream,
+            segment_count=int(setting(key="encoding_segments", default=1)),
+            frame_count=self.job_count,
         )
 
         def log_message(message):
@@ -853,12 +1865,18 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
 
         def cleanup_movie_task():
             self.movie_task = None
+            self.write_trace()
 
             self.progress_bar.setMaximum(100)
             self.progress_bar.setValue(0)
 
         self.movie_task.message.connect(log_message)
         self.movie_task.movie_created.connect(show_movie)
+        self.movie_task.encode_progress.connect(self.show_encode_progress)
+        if self.metrics_exporter:
+            self.movie_task.encode_progress.connect(
+                self.metrics_exporter.set_encode_progress
+            )
 
         # todo - show a message based on success/fail
         self.movie_task.taskCompleted.connect(cleanup_movie_task)
@@ -866,8 +1884,105 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
 
         QgsApplication.taskManager().addTask(self.movie_task)
 
-        self.button_box.button(QDialogButtonBox.Cancel).setEnabled(False)
+    def profile_sample_frames(self):
+        """
+        Profiles the per-layer render times of evenly spaced sample frames
+        from the current animation settings, without exporting
+        """
+        if self.layer_profiling_task:
+            return
+
+        self.save_state()
+        controller = self.create_controller()
+        if not controller:
+            return
+
         self.main_tab.setCurrentIndex(5)
+        self.output_log_text_edit.append("Generating frames to profile")
+        try:
+            jobs = sample_evenly_from(
+                controller.create_jobs(),
+                controller.job_count(),
+                AnimationWorkbench.LAYER_PROFILE_SAMPLE_FRAMES,
+            )
+        except ValueError as e:
+            self.output_log_text_edit.append(f"Profiling halted: {e}")
+            return
+        self.start_layer_profiling(jobs)
+
+    def start_layer_profiling(self, jobs):
+        """
+        Starts a background task profiling the layer render times of jobs
+        """
+        self.output_log_text_edit.append(
+            f"Profiling layer render times for {len(jobs)} frames"
+        )
+        self.profile_layers_button.setEnabled(False)
+        self.start_layer_profiling_task(LayerProfilingTask(jobs))
+
+    def start_layer_profiling_task(self, task: LayerProfilingTask):
+        """
+        Starts a task profiling the next frame, continuing with the
+        remaining frames once it completes
+        """
+        self.layer_profiling_task = task
+
+        def cleanup_layer_profiling_task():
+            self.layer_profiling_task = None
+            self.profile_layers_button.setEnabled(True)
+
+        def profile_next_frame():
+            next_task = task.next_task()
+            if next_task:
+                self.start_layer_profiling_task(next_task)
+            else:
+                cleanup_layer_profiling_task()
+
+        task.message.connect(self.show_message)
+        task.profiling_completed.connect(self.show_layer_profile)
+        task.taskCompleted.connect(profile_next_frame)
+        task.taskTerminated.connect(cleanup_layer_profiling_task)
+        QgsApplication.taskManager().addTask(task)
+
+    def show_layer_profile(self, profiler: LayerRenderProfiler):
+        """
+        Logs the per-layer render time report and writes it to the
+        working directory
+        """
+        self.output_log_text_edit.append(profiler.report_text())
+        try:
+            for report_file in profiler.export(
+                self.work_directory, self.frame_filename_prefix
+            ):
+                self.output_log_text_edit.append(
+                    f"Layer render times written to: {report_file}"
+                )
+        except OSError as e:
+            self.output_log_text_edit.append(
+                f"Could not write layer render times: {e}"
+            )
+
+    def write_trace(self):
+        """
+        Writes the export trace to the working directory, if enabled
+        """
+        try:
+            for trace_file in self.trace.write(
+                self.work_directory, self.frame_filename_prefix
+            ):
+                self.output_log_text_edit.append(
+                    f"Trace written to: {trace_file} "
+                    "(open in https://ui.perfetto.dev)"
+                )
+        except OSError as e:
+            self.output_log_text_edit.append(f"Could not write trace: {e}")
+
+    def log_profile_files(self, profile_files: List[str]):
+        """
+        Logs the paths of profile files written for an export stage
+        """
+        for profile_file in profile_files:
+            self.output_log_text_edit.append(f"Profile written to: {profile_file}")
 
     def output_mode_ffmpeg(self):
         """Get the output mode (resolution) in ffmpeg format.
@@ -887,22 +2002,6 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             output_mode = "%s:%s" % (size.width(), size.height())
         return output_mode
 
-    def output_mode_name(self):
-        """Return the output mode name like 1080p, 720p etc."""
-        output_mode = None
-        if self.radio_low_res.isChecked():
-            output_mode = "720p"
-        elif self.radio_medium_res.isChecked():
-            output_mode = "1080p"
-        elif self.radio_high_res.isChecked():
-            output_mode = "4k"
-        else:  # Map canvas size
-            map_settings = self.iface.mapCanvas().mapSettings()
-            size = map_settings.outputSize()
-            output_mode = "%s:%s" % (size.width(), size.height())
-
-        return output_mode
-
     def show_preview_for_frame(self, frame: int):
         """
         Shows a preview image for a specific frame
@@ -918,7 +2017,11 @@ class AnimationWorkbench(QDialog, FORM_CLASS):
             self.current_preview_frame_render_job = None
 
         controller = self.create_controller()
-        job = controller.create_job_for_frame(frame)
+        try:
+            job = controller.create_job_for_frame(frame)
+        except ValueError as e:
+            self.output_log_text_edit.append(f"Cannot preview frame: {e}")
+            return
         if not job:
             return
 
@@ -11,5 +11,19 @@ from .animation_controller import (
     InvalidAnimationParametersException,
 )
 from .default_settings import default_settings
+from .profiling import StageProfiler
+from .trace_recorder import TraceRecorder
 from .movie_creator import MovieFormat, MovieCommandGenerator, MovieCreationTask
+from .render_metrics import FrameTiming, RenderMetrics
 from .render_queue import RenderJob, RenderQueue
+from .metrics_exporter import MetricsExporter
+from .layer_profiler import LayerRenderProfiler, LayerProfilingTask
+from .data_preparation import (
+    DataPreparation,
+    ExportPreparationTask,
+    LayerSnapshot,
+    SampleFrame,
+)
+from .raster_cache import RasterWarpCache
+from .generalization import GeneralizationCache
+from .feature_source import FeatureIdCache
@@ -8,8 +8,9 @@ __revision__ = "$Format:%H$"
 
 import tempfile
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import Optional, Iterator, List
+from typing import Optional, Iterator, List, Sequence
 
 from qgis.PyQt.QtCore import QObject, pyqtSignal, QEasingCurve, QSize
 from qgis.core import (
@@ -30,9 +31,20 @@ from qgis.core import (
     QgsPropertyCollection,
     QgsExpressionContext,
     QgsExpressionContextUtils,
+    QgsDateTimeRange,
+    QgsSymbol,
 )
 
+from .density import DensityGrids
+from .feature_source import FeatureStore, WindowedFeatureSource
+from .highlight import FeatureHighlighter
+from .layer_culling import LayerCullingIndex
+from .raster_series import RasterTimeSeries
 from .render_queue import RenderJob
+from .sprite_renderer import SpriteCompositor
+from .temporal_index import TemporalFeatureIndex, to_date_time
+from .tour_optimizer import TourOptimizer, distance_scaled_travel_frames
+from .trajectory import TrajectoryInterpolator
 
 
 class MapMode(Enum):
@@ -82,9 +94,24 @@ class AnimationController(QObject):
         output_extent: QgsReferencedRectangle,
         total_frames: int,
         frame_rate: float,
+        feature_ids: Optional[Sequence[int]] = None,
+        temporal_index: Optional[TemporalFeatureIndex] = None,
+        trajectories: Optional[TrajectoryInterpolator] = None,
+        draw_sprites: bool = False,
+        highlight_symbol: Optional[QgsSymbol] = None,
     ) -> "AnimationController":
         """
         Creates an animation controller for a fixed extent animation
+
+        :param temporal_index: if set, the frames step through the time
+            range of the indexed layer, instead of through its features
+        :param trajectories: if set, each frame shows points moving along
+            the tracks of the animation layer, instead of stepping through
+            its features. Positions must be precomputed for total_frames.
+        :param draw_sprites: if True, the moving points are drawn as sprites
+            over a background rendered once, when their symbology allows it
+        :param highlight_symbol: if set, the feature of each frame is drawn
+            over the frame with this symbol
         """
         transformed_output_extent = QgsRectangle(output_extent)
         if output_extent.crs() != map_settings.destinationCrs():
@@ -100,8 +127,14 @@ class AnimationController(QObject):
         controller = AnimationController(
             MapMode.FIXED_EXTENT, output_mode, map_settings
         )
-        if feature_layer:
-            controller.set_layer(feature_layer)
+        if temporal_index:
+            controller.temporal_index = temporal_index
+        elif trajectories:
+            controller.trajectories = trajectories
+            controller.draw_sprites = draw_sprites
+        elif feature_layer:
+            controller.set_layer(feature_layer, feature_ids)
+            controller.highlight_symbol = highlight_symbol
         controller.total_frame_count = total_frames
         controller.frame_rate = frame_rate
 
@@ -121,32 +154,52 @@ class AnimationController(QObject):
         zoom_easing: Optional[QEasingCurve],
         frame_rate: float,
         loop: bool = False,
+        feature_ids: Optional[Sequence[int]] = None,
+        optimize_tour: bool = False,
+        scale_travel_to_distance: bool = False,
+        highlight_symbol: Optional[QgsSymbol] = None,
     ) -> "AnimationController":
         """
         Creates an animation controller for a moving extent animation
+
+        :param highlight_symbol: if set, the feature each frame is hovering
+            at or travelling to is drawn over the frame with this symbol
         """
 
         if not feature_layer:
             raise InvalidAnimationParametersException("No animation layer set")
 
         controller = AnimationController(mode, output_mode, map_settings)
-        controller.set_layer(feature_layer)
+        controller.set_layer(feature_layer, feature_ids)
+        controller.highlight_symbol = highlight_symbol
         controller.loop = loop
 
         hover_frames = hover_duration * frame_rate
         travel_frames = travel_duration * frame_rate
 
-        controller.total_frame_count = int(
-            (
+        if optimize_tour or scale_travel_to_distance:
+            controller.plan_tour(
+                optimize_tour,
+                int(travel_frames) if scale_travel_to_distance else None,
+            )
+
+        if controller.segment_travel_frames is not None:
+            controller.total_frame_count = int(
                 controller.total_feature_count * hover_frames
-                + (
-                    (controller.total_feature_count - 1)
-                    if not loop
-                    else controller.total_feature_count
-                )
-                * travel_frames
+                + sum(controller.segment_travel_frames)
             )
-        )  # nopep8
+        else:
+            controller.total_frame_count = int(
+                (
+                    controller.total_feature_count * hover_frames
+                    + (
+                        (controller.total_feature_count - 1)
+                        if not loop
+                        else controller.total_feature_count
+                    )
+                    * travel_frames
+                )
+            )  # nopep8
 
         controller.hover_duration = hover_duration
         controller.travel_duration = travel_duration
@@ -188,7 +241,10 @@ class AnimationController(QObject):
         self.data_defined_properties = QgsPropertyCollection()
 
         self.feature_layer: Optional[QgsVectorLayer] = None
-        self._features: List[QgsFeature] = []
+        self._features: Sequence[QgsFeature] = []
+        # Resolves the feature id variables of render jobs into features
+        # when the jobs are rendered
+        self.feature_store: Optional[FeatureStore] = None
         self.layer_to_map_transform: Optional[QgsCoordinateTransform] = None
         self.total_feature_count: int = 0
 
@@ -197,6 +253,10 @@ class AnimationController(QObject):
         self.hover_duration: float = 0
         self.travel_duration: float = 0
         self.loop: bool = False
+        # Number of travel frames for each segment of the tour, where
+        # segment i travels from feature i to the next feature, or None
+        # to use the travel duration for all segments
+        self.segment_travel_frames: Optional[List[int]] = None
 
         self.max_scale: float = 0
         self.min_scale: float = 0
@@ -216,18 +276,56 @@ class AnimationController(QObject):
 
         self.reuse_cache: bool = False
 
-    def set_layer(self, layer: QgsVectorLayer):
+        # If True, each job only receives the layers which can contribute
+        # to its frame, based on layer extents and visibility scales
+        self.cull_layers: bool = False
+        self.layer_culling: Optional[LayerCullingIndex] = None
+
+        # If set, fixed extent frames step through the time range of the
+        # indexed layer, rendering only the features visible in each frame
+        self.temporal_index: Optional[TemporalFeatureIndex] = None
+        # Copy of the indexed layer rendered in its place, see
+        # temporal_render_layer()
+        self._temporal_render_layer: Optional[QgsVectorLayer] = None
+        # If set and computed, the temporal layer is rendered as a density
+        # grid per frame
+        self.density_grids: Optional[DensityGrids] = None
+
+        # If set, fixed extent frames show points moving along the tracks
+        # of the animation layer
+        self.trajectories: Optional[TrajectoryInterpolator] = None
+        # If True, trajectory frames are drawn as sprites when possible
+        self.draw_sprites: bool = False
+
+        # If set, fixed extent frames step through the raster time series,
+        # rendering each frame's step in place of the series layer
+        self.raster_series: Optional[RasterTimeSeries] = None
+
+        # If set, the current feature of each frame is drawn over the
+        # frame with this symbol
+        self.highlight_symbol: Optional[QgsSymbol] = None
+        self.highlighter: Optional[FeatureHighlighter] = None
+
+    def set_layer(
+        self, layer: QgsVectorLayer, feature_ids: Optional[Sequence[int]] = None
+    ):
         """
         Sets the layer driving the animation
+
+        :param layer: animation layer
+        :param feature_ids: optional ids of the features to animate, in
+            order. If not set all features are animated, in the layer's
+            feature order.
         """
         self.feature_layer = layer
-        self.total_feature_count = layer.featureCount()
         self.base_expression_context.appendScope(layer.createExpressionContextScope())
 
-        # preload all features into a list, so that we can easily retrieve previous/next features
-        # This is not so nice for large layers, but it's unlikely that someone will be making
-        # an animation with 10k's of features anyway...!
-        self._features = list(self.feature_layer.getFeatures())
+        # features are streamed in blocks, keeping only a small window in
+        # memory, so that previous/next features can be retrieved cheaply
+        # even for layers with many thousands of features
+        self._features = WindowedFeatureSource(self.feature_layer, feature_ids)
+        self.total_feature_count = len(self._features)
+        self.feature_store = FeatureStore(self.feature_layer)
 
     def create_job_for_frame(self, frame: int) -> Optional[RenderJob]:
         """
@@ -243,26 +341,45 @@ class AnimationController(QObject):
             job = next(jobs)
         return job
 
+    def job_count(self) -> int:
+        """
+        Returns the number of jobs yielded by create_jobs()
+        """
+        if self.map_mode == MapMode.FIXED_EXTENT and self.feature_layer:
+            # total_frame_count is the number of frames per feature here
+            return self.total_frame_count * self.total_feature_count
+        return self.total_frame_count
+
     def create_jobs(self) -> Iterator[RenderJob]:
         """
         Yields render jobs for each animation frame
         """
-        if self.map_mode == MapMode.FIXED_EXTENT:
-            if self.feature_layer:
-                self.layer_to_map_transform = QgsCoordinateTransform(
-                    self.feature_layer.crs(),
-                    self.map_settings.destinationCrs(),
-                    QgsProject.instance(),
-                )
+        self.layer_culling = (
+            LayerCullingIndex(
+                self.map_settings.layers(), self.map_settings.destinationCrs()
+            )
+            if self.cull_layers
+            else None
+        )
 
-            for job in self.create_fixed_extent_job():
-                yield job
-        else:
+        if self.feature_layer:
             self.layer_to_map_transform = QgsCoordinateTransform(
                 self.feature_layer.crs(),
                 self.map_settings.destinationCrs(),
                 QgsProject.instance(),
             )
+        self.highlighter = (
+            FeatureHighlighter(
+                self.feature_store, self.highlight_symbol, self.layer_to_map_transform
+            )
+            if self.highlight_symbol and self.feature_store
+            else None
+        )
+
+        if self.map_mode == MapMode.FIXED_EXTENT:
+            for job in self.create_fixed_extent_job():
+                yield job
+        else:
             for job in self.create_moving_extent_job():
                 yield job
 
@@ -274,7 +391,13 @@ class AnimationController(QObject):
         # across the number of features and the frame
         # count so that we can set the current feature id
         # iteratively
-        if not self.feature_layer:
+        if self.temporal_index:
+            for job in self.create_temporal_jobs():
+                yield job
+        elif self.trajectories:
+            for job in self.create_trajectory_jobs():
+                yield job
+        elif not self.feature_layer:
             for self.current_frame in range(self.total_frame_count):
                 name = self.working_directory / "{}-{}.png".format(
                     self.frame_filename_prefix,
@@ -304,11 +427,6 @@ class AnimationController(QObject):
                     )
 
                     scope = QgsExpressionContextScope()
-                    scope.setVariable(
-                        "previous_feature",
-                        None if feature_idx == 0 else self._features[feature_idx - 1],
-                        True,
-                    )
                     scope.setVariable(
                         "previous_feature_id",
                         None
@@ -316,13 +434,6 @@ class AnimationController(QObject):
                         else self._features[feature_idx - 1].id(),
                         True,
                     )
-                    scope.setVariable(
-                        "next_feature",
-                        None
-                        if feature_idx == len(self._features) - 1
-                        else self._features[feature_idx + 1],
-                        True,
-                    )
                     scope.setVariable(
                         "next_feature_id",
                         None
@@ -331,7 +442,6 @@ class AnimationController(QObject):
                         True,
                     )
 
-                    scope.setVariable("hover_feature", feature, True)
                     scope.setVariable("hover_feature_id", feature.id(), True)
 
                     scope.setVariable("current_hover_frame", frame_for_feature)
@@ -350,6 +460,130 @@ class AnimationController(QObject):
 
                     self.current_frame += 1
 
+    def create_temporal_jobs(self) -> Iterator[RenderJob]:
+        """
+        Yields render jobs for fixed extent animations stepping through the
+        time range of a temporal layer
+        """
+        index = self.temporal_index
+        # grids are computed in the background before exporting, so
+        # previews render the points until they are ready
+        density_grids = (
+            self.density_grids
+            if self.density_grids and self.density_grids.grids is not None
+            else None
+        )
+        for self.current_frame in range(self.total_frame_count):
+            name = self.working_directory / "{}-{}.png".format(
+                self.frame_filename_prefix,
+                str(self.current_frame).rjust(10, "0"),
+            )
+            begin, end = index.frame_window(self.current_frame, self.total_frame_count)
+
+            # other temporal layers are filtered by QGIS as usual, and the
+            # @map_start_time/@map_end_time variables are set for the frame
+            self.map_settings.setIsTemporal(True)
+            self.map_settings.setTemporalRange(
+                QgsDateTimeRange(to_date_time(begin), to_date_time(end))
+            )
+            if density_grids:
+                feature_ids = None
+                feature_count = int(density_grids.counts[self.current_frame])
+            else:
+                # the last frame includes the end of the time range
+                feature_ids = index.feature_ids(
+                    begin, end, self.current_frame == self.total_frame_count - 1
+                )
+                feature_count = len(feature_ids)
+
+            scope = QgsExpressionContextScope()
+            scope.setVariable("visible_feature_count", feature_count, True)
+            job = self.create_job(self.map_settings, name.as_posix(), [scope])
+            if density_grids:
+                # the density layer is only created when the job is rendered
+                job.defer_settings_update(
+                    partial(
+                        density_grids.add_density_layer,
+                        frame=self.current_frame,
+                        job=job,
+                    )
+                )
+            else:
+                render_layer = self.temporal_render_layer()
+                job.replace_layers({index.layer.id(): render_layer})
+                job.feature_ids[render_layer.id()] = feature_ids
+                job.owned_layers.append(render_layer)
+            yield job
+
+    def temporal_render_layer(self) -> QgsVectorLayer:
+        """
+        Returns a copy of the indexed layer without its temporal filter,
+        which is rendered in its place restricted to each frame's features.
+
+        QGIS combines a layer's temporal filter with the feature request
+        after applying any feature filter provider, which replaces the
+        feature id filter with an expression evaluated for every feature.
+        """
+        if self._temporal_render_layer is None:
+            layer = self.temporal_index.layer.clone()
+            layer.temporalProperties().setIsActive(False)
+            self._temporal_render_layer = layer
+        return self._temporal_render_layer
+
+    def create_trajectory_jobs(self) -> Iterator[RenderJob]:
+        """
+        Yields render jobs for fixed extent animations of points moving
+        along tracks
+        """
+        frame_times = self.trajectories.frame_times(self.total_frame_count)
+        compositor = None
+        for self.current_frame in range(self.total_frame_count):
+            name = self.working_directory / "{}-{}.png".format(
+                self.frame_filename_prefix,
+                str(self.current_frame).rjust(10, "0"),
+            )
+
+            scope = QgsExpressionContextScope()
+            scope.setVariable(
+                "trajectory_time", float(frame_times[self.current_frame]), True
+            )
+            job = self.create_job(self.map_settings, name.as_posix(), [scope])
+            if self.current_frame == 0 and self.draw_sprites:
+                compositor = self.create_sprite_compositor(job)
+            if compositor:
+                job.sprites = compositor.frame(self.current_frame)
+            else:
+                # the layer of points is only built when the job's
+                # render task is created
+                job.layer_factories.append(
+                    partial(
+                        self.trajectories.create_positions_layer, self.current_frame
+                    )
+                )
+            yield job
+
+    def create_sprite_compositor(self, job: RenderJob) -> Optional[SpriteCompositor]:
+        """
+        Returns a compositor drawing the moving points of trajectory frames
+        as sprites, or None if the frames must be rendered normally
+
+        :param job: the first job of the animation
+        """
+        compositor = SpriteCompositor(
+            self.trajectories.create_positions_layer(0),
+            self.trajectories.positions,
+            self.trajectories.attributes,
+        )
+        reasons = compositor.unsupported_reasons(job.frame_settings)
+        if reasons:
+            self.normal_message.emit(
+                "Rendering every frame, as the moving points cannot be drawn "
+                "as sprites: {}".format("; ".join(reasons))
+            )
+            return None
+        self.verbose_message.emit("Drawing the moving points as sprites")
+        return compositor
+
     def create_moving_extent_job(self) -> Iterator[RenderJob]:
         """
         Yields render jobs for moving extent animations
@@ -416,7 +650,9 @@ class AnimationController(QObject):
 
             if feature_idx > 0:
                 for job in self.fly_feature_to_feature(
-                    self._features[feature_idx - 1], feature
+                    self._features[feature_idx - 1],
+                    feature,
+                    self.travel_frames_for_segment(feature_idx - 1),
                 ):
                     yield job
 
@@ -425,9 +661,67 @@ class AnimationController(QObject):
 
         if self.loop and len(self._features) > 1:
             # insert extra loop back to first feature
-            for job in self.fly_feature_to_feature(feature, self._features[0]):
+            for job in self.fly_feature_to_feature(
+                feature,
+                self._features[0],
+                self.travel_frames_for_segment(len(self._features) - 1),
+            ):
                 yield job
 
+    def plan_tour(self, optimize: bool, travel_frames: Optional[int] = None):
+        """
+        Reorders the features to minimize the distance travelled, and/or
+        spreads travel frames over the tour in proportion to distance
+
+        :param optimize: True to reorder the features
+        :param travel_frames: average number of travel frames per segment,
+            or None to use the same travel duration for every segment
+        """
+        anchors = []
+        for feature in self._features:
+            anchor = self.geometry_to_pointxy(feature)
+            if anchor is None:
+                self.normal_message.emit(
+                    "Tour was not optimized, because some features have "
+                    "unsupported geometries"
+                )
+                return
+            anchors.append(anchor)
+        if len(anchors) < 2:
+            return
+
+        optimizer = TourOptimizer(anchors, loop=self.loop)
+        order = list(range(len(anchors)))
+        if optimize:
+            original_length = optimizer.length(order)
+            order = optimizer.optimize()
+            self._features = WindowedFeatureSource(
+                self.feature_layer,
+                [self._features.ids[index] for index in order],
+            )
+            self.normal_message.emit(
+                "Optimized tour length: {:.0f}% of the original".format(
+                    100 * optimizer.length(order) / original_length
+                    if original_length
+                    else 100
+                )
+            )
+
+        if travel_frames is not None:
+            self.segment_travel_frames = distance_scaled_travel_frames(
+                optimizer.segment_lengths(order), travel_frames
+            )
+
+    def travel_frames_for_segment(self, segment: int) -> int:
+        """
+        Returns the number of travel frames from a feature to the next one
+
+        :param segment: index of the feature the segment starts at
+        """
+        if self.segment_travel_frames is not None:
+            return self.segment_travel_frames[segment]
+        return int(self.travel_duration * self.frame_rate)
+
     def set_extent_center(self, center_x: float, center_y: float):
         """
         Sets the animation to a specific map center coordinate
@@ -570,29 +864,16 @@ class AnimationController(QObject):
             else:
 
                 scope = QgsExpressionContextScope()
-                scope.setVariable("from_feature", None, True)
                 scope.setVariable("from_feature_id", None, True)
-                scope.setVariable("to_feature", None, True)
                 scope.setVariable("to_feature_id", None, True)
 
-                scope.setVariable("hover_feature", feature, True)
                 scope.setVariable("hover_feature_id", feature.id(), True)
 
-                scope.setVariable(
-                    "previous_feature",
-                    previous_feature,
-                    True,
-                )
                 scope.setVariable(
                     "previous_feature_id",
                     None if not previous_feature else previous_feature.id(),
                     True,
                 )
-                scope.setVariable(
-                    "next_feature",
-                    next_feature,
-                    True,
-                )
                 scope.setVariable(
                     "next_feature_id",
                     None if not next_feature else next_feature.id(),
@@ -615,10 +896,16 @@ class AnimationController(QObject):
             self.current_frame += 1
 
     def fly_feature_to_feature(  # pylint: disable=too-many-locals,too-many-branches,too-many-statements
-        self, start_feature: QgsFeature, end_feature: QgsFeature
+        self,
+        start_feature: QgsFeature,
+        end_feature: QgsFeature,
+        travel_frames: Optional[int] = None,
     ) -> Iterator[RenderJob]:
         """
         Yields render jobs for an animation between two features
+
+        :param travel_frames: number of frames to travel for, defaults to
+            the travel duration
         """
 
         # In case we are iterating over lines or polygons, we
@@ -632,7 +919,8 @@ class AnimationController(QObject):
         delta_x = end_point.x() - start_point.x()
         delta_y = end_point.y() - start_point.y()
 
-        travel_frames = int(self.travel_duration * self.frame_rate)
+        if travel_frames is None:
+            travel_frames = int(self.travel_duration * self.frame_rate)
         flying_up = True
         for travel_frame in range(travel_frames):
             # will always be between 0 - 1
@@ -741,12 +1029,9 @@ class AnimationController(QObject):
                 pass
             else:
                 scope = QgsExpressionContextScope()
-                scope.setVariable("from_feature", start_feature, True)
                 scope.setVariable("from_feature_id", start_feature.id(), True)
-                scope.setVariable("to_feature", end_feature, True)
                 scope.setVariable("to_feature_id", end_feature.id(), True)
 
-                scope.setVariable("hover_feature", None, True)
                 scope.setVariable("hover_feature_id", None, True)
 
                 scope.setVariable("current_hover_frame", None, True)
@@ -785,6 +1070,15 @@ class AnimationController(QObject):
 
         settings.setOutputDpi(96)
 
+        if self.layer_culling:
+            settings.setLayers(self.layer_culling.visible_layers(settings))
+
+        # the frame's step of the series is only created when the frame is
+        # rendered, after the series has been cached
+        series_position = (
+            self.raster_series.remove_layer(settings) if self.raster_series else None
+        )
+
         if Qgis.QGIS_VERSION_INT >= 32500:
             settings.setFrameRate(self.frame_rate)
             settings.setCurrentFrame(self.current_frame)
@@ -808,4 +1102,21 @@ class AnimationController(QObject):
         context.appendScope(task_scope)
         settings.setExpressionContext(context)
 
-        return RenderJob(name, settings)
+        job = RenderJob(name, settings)
+        if self.feature_store:
+            # queued jobs only carry feature ids, the features themselves
+            # are only looked up once the job is rendered
+            job.defer_settings_update(self.feature_store.resolve_feature_variables)
+        if self.highlighter:
+            job.defer_settings_update(partial(self.highlighter.add_highlight, job=job))
+        if series_position is not None:
+            job.defer_settings_update(
+                partial(
+                    self.raster_series.add_frame_layer,
+                    frame=self.current_frame,
+                    frame_count=self.total_frame_count,
+                    position=series_position,
+                    job=job,
+                )
+            )
+        return job
@@ -0,0 +1,520 @@
+# coding=utf-8
+
+"""Preparation of layer data before rendering an animation."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.PyQt.QtGui import QPainter
+from qgis.core import (
+    QgsApplication,
+    QgsCoordinateReferenceSystem,
+    QgsFeatureSource,
+    QgsFeedback,
+    QgsMapLayer,
+    QgsMapLayerStyle,
+    QgsMapSettings,
+    QgsMemoryProviderUtils,
+    QgsProviderRegistry,
+    QgsRasterDataProvider,
+    QgsRasterLayer,
+    QgsTask,
+    QgsVectorDataProvider,
+    QgsVectorLayer,
+    QgsVectorLayerFeatureSource,
+)
+
+from .filtered_renderer import create_frame_image, prepare_render_job
+from .settings import setting
+
+# GDAL names of the resampling methods of raster providers which GDAL can
+# warp with, by method name
+PROVIDER_RESAMPLING = {
+    "Bilinear": "bilinear",
+    "Cubic": "cubic",
+    "CubicSpline": "cubicspline",
+    "Lanczos": "lanczos",
+    "Average": "average",
+    "Mode": "mode",
+}
+
+
+def copy_layer_style(source: QgsMapLayer, target: QgsMapLayer):
+    """
+    Copies the style (symbology, labeling, opacity etc) of a layer to
+    another layer, e.g. a temporary copy used for rendering
+    """
+    style = QgsMapLayerStyle()
+    style.readFromLayer(source)
+    style.writeToLayer(target)
+
+
+def layer_data_revision(layer: QgsVectorLayer) -> str:
+    """
+    Returns a string which changes whenever the layer's data changes
+    """
+    parts = [layer.providerType(), layer.source(), layer.subsetString()]
+    path = (
+        QgsProviderRegistry.instance()
+        .decodeUri(layer.providerType(), layer.source())
+        .get("path")
+    )
+    if path and os.path.isfile(path):
+        parts += [str(os.path.getmtime(path)), str(os.path.getsize(path))]
+    else:
+        parts += [str(layer.featureCount()), layer.extent().toString(6)]
+    return "|".join(parts)
+
+
+def raster_resampling(layer: QgsRasterLayer) -> str:
+    """
+    Returns the GDAL name of the resampling method QGIS draws a raster
+    layer with when zoomed in. This is nearest neighbour, unless the layer
+    or its provider is set to resample.
+    """
+    provider = layer.dataProvider()
+    if (
+        provider
+        and hasattr(provider, "enableProviderResampling")
+        and provider.enableProviderResampling()
+    ):
+        method = provider.zoomedInResamplingMethod()
+        for name, gdal_name in PROVIDER_RESAMPLING.items():
+            if method == getattr(QgsRasterDataProvider.ResamplingMethod, name, None):
+                return gdal_name
+        return "near"
+    resampler = layer.resampleFilter().zoomedInResampler()
+    if resampler and resampler.type() in ("bilinear", "cubic"):
+        return resampler.type()
+    return "near"
+
+
+def move_to_main_thread(layer: QgsMapLayer) -> QgsMapLayer:
+    """
+    Hands a layer created by a background task over to the main thread,
+    where the render jobs use it. Must be called on the thread which
+    created the layer.
+    """
+    layer.moveToThread(QgsApplication.instance().thread())
+    return layer
+
+
+def frame_render_time(
+    map_settings: QgsMapSettings,
+    feature_ids: Optional[Dict[str, Sequence[int]]] = None,
+) -> float:
+    """
+    Returns the time taken to render a frame on the calling thread, in
+    seconds. The layers of the map settings must belong to the calling
+    thread.
+
+    The frame is rendered twice and only the second render is timed, so
+    that caches warmed by the first render (e.g. the file system cache)
+    apply to every measurement alike.
+    """
+    elapsed = 0.0
+    for _ in range(2):
+        image = create_frame_image(map_settings)
+        image.fill(0)
+        painter = QPainter(image)
+        try:
+            render_job = prepare_render_job(map_settings, painter, feature_ids)
+            start = time.perf_counter()
+            render_job.renderPrepared()
+            elapsed = time.perf_counter() - start
+        finally:
+            painter.end()
+    return elapsed
+
+
+class SampleFrame:
+    """
+    A frame rendered before and after preparing the layers of an export,
+    to estimate the saving per frame.
+
+    Project layers must not be rendered outside the main thread, so the
+    frame is rendered with layers opened from snapshots of its layers, on
+    the thread preparing them. Only the ids of the frame's layers are kept.
+    """
+
+    def __init__(
+        self,
+        map_settings: QgsMapSettings,
+        feature_ids: Optional[Dict[str, Sequence[int]]] = None,
+    ):
+        self.map_settings = QgsMapSettings(map_settings)
+        self.layer_ids: List[str] = [layer.id() for layer in map_settings.layers()]
+        self.map_settings.setLayers([])
+        self.feature_ids: Dict[str, Sequence[int]] = dict(feature_ids or {})
+
+    def render_time(self, layers: Dict[str, QgsMapLayer]) -> float:
+        """
+        Returns the time taken to render the frame on the calling thread,
+        in seconds
+
+        :param layers: layers to render, by the id of the frame's layer they
+            stand for. They must belong to the calling thread.
+        """
+        settings = QgsMapSettings(self.map_settings)
+        settings.setLayers(
+            [layers[layer_id] for layer_id in self.layer_ids if layer_id in layers]
+        )
+        settings.setLayerStyleOverrides(
+            {
+                layers[layer_id].id(): style
+                for layer_id, style in self.map_settings.layerStyleOverrides().items()
+                if layer_id in layers
+            }
+        )
+        return frame_render_time(
+            settings,
+            {
+                layers[layer_id].id(): ids
+                for layer_id, ids in self.feature_ids.items()
+                if layer_id in layers
+            },
+        )
+
+
+class LayerSnapshot:
+    """
+    What is needed to prepare a layer in a background task, read from the
+    layer on the main thread.
+
+    Project layers must not be used from other threads, so tasks open
+    their own layers from the data source, read features through a
+    feature source and apply the layer's style to the layers they create.
+    """
+
+    def __init__(self, layer: QgsMapLayer):
+        self.layer_id: str = layer.id()
+        self.name: str = layer.name()
+        self.provider_type: str = layer.providerType()
+        self.source: str = layer.source()
+        self.crs = QgsCoordinateReferenceSystem(layer.crs())
+        self.style = QgsMapLayerStyle()
+        self.style.readFromLayer(layer)
+        self.is_vector: bool = isinstance(layer, QgsVectorLayer)
+        self.is_raster: bool = isinstance(layer, QgsRasterLayer)
+        self.feature_source: Optional[QgsVectorLayerFeatureSource] = None
+        if self.is_vector:
+            self.fields = layer.fields()
+            self.wkb_type = layer.wkbType()
+            self.feature_count: int = layer.featureCount()
+            self.feature_source = QgsVectorLayerFeatureSource(layer)
+            self.data_revision: str = layer_data_revision(layer)
+        if self.is_raster:
+            self.resampling: str = raster_resampling(layer)
+
+    def open_layer(self) -> QgsMapLayer:
+        """
+        Opens a new layer on the layer's data source, with its style, on
+        the calling thread
+        """
+        if self.is_vector:
+            layer = QgsVectorLayer(self.source, self.name, self.provider_type)
+        else:
+            layer = QgsRasterLayer(self.source, self.name, self.provider_type)
+        self.style.writeToLayer(layer)
+        return layer
+
+
+class DataPreparation(QObject):
+    """
+    Prepares the layers of an animation for fast rendering.
+
+    Creates missing spatial indexes on file based vector layers, builds
+    missing raster overviews, and optionally copies small to medium vector
+    layers to memory layers which are used in place of the originals for
+    the length of the export.
+
+    Spatial indexes and overviews are written next to the source data, so
+    they also benefit later exports. Layers are prepared from snapshots,
+    so that preparation can run in an ExportPreparationTask.
+    """
+
+    # Largest vector layer (in features) which is copied to memory
+    MEMORY_COPY_MAX_FEATURES = 100000
+
+    # Signals
+    normal_message = pyqtSignal(str)
+
+    def __init__(self, memory_copies: Optional[bool] = None, parent=None):
+        super().__init__(parent=parent)
+        if memory_copies is None:
+            memory_copies = bool(
+                int(setting(key="prepare_data_memory_copies", default=0))
+            )
+        self.memory_copies: bool = memory_copies
+        # Memory copies of layers, by original layer id. They must be kept
+        # alive for as long as any render job refers to them.
+        self.memory_layers: Dict[str, QgsVectorLayer] = {}
+        # Ids of the layers given a spatial index or overviews, which must
+        # be reloaded on the main thread to use them
+        self.indexed_layer_ids: List[str] = []
+        self.elapsed: float = 0
+        # Render times of a sample frame before and after preparing the
+        # layers, in seconds, if a sample frame was given
+        self.unprepared_frame_time: Optional[float] = None
+        self.prepared_frame_time: Optional[float] = None
+
+    def prepare(
+        self,
+        layers: List[LayerSnapshot],
+        sample: Optional[SampleFrame] = None,
+        feedback: Optional[QgsFeedback] = None,
+    ) -> Dict[str, QgsMapLayer]:
+        """
+        Prepares the given layers for rendering
+
+        :param layers: snapshots of the layers rendered in the animation
+        :param sample: optional frame which is rendered before and after
+            preparing the layers, to measure the saving per frame
+        :param feedback: optional feedback for cancellation
+
+        :returns: replacement layers to render instead of the originals,
+            by original layer id
+        """
+        sample_layers = {}
+        if sample:
+            sample_layers = {
+                layer.layer_id: layer.open_layer()
+                for layer in layers
+                if layer.layer_id in sample.layer_ids
+            }
+            self.unprepared_frame_time = sample.render_time(sample_layers)
+
+        start = time.perf_counter()
+        for layer in layers:
+            if feedback and feedback.isCanceled():
+                break
+            if layer.is_vector:
+                reopened = self.create_spatial_index(layer)
+                if self.memory_copies:
+                    copy = self.create_memory_copy(layer, feedback)
+                    if copy:
+                        self.memory_layers[layer.layer_id] = copy
+            elif layer.is_raster:
+                reopened = self.build_overviews(layer)
+            else:
+                reopened = None
+            if reopened:
+                self.indexed_layer_ids.append(layer.layer_id)
+                # layers with new indexes or overviews are rendered in place
+                # of the originals when timing the sample frame
+                if layer.layer_id in sample_layers:
+                    sample_layers[layer.layer_id] = reopened
+        self.elapsed += time.perf_counter() - start
+
+        if sample and not (feedback and feedback.isCanceled()):
+            # feature ids of filtered layers do not apply to their copies
+            sample_layers.update(
+                {
+                    layer_id: copy
+                    for layer_id, copy in self.memory_layers.items()
+                    if layer_id in sample_layers and layer_id not in sample.feature_ids
+                }
+            )
+            self.prepared_frame_time = sample.render_time(sample_layers)
+
+        for copy in self.memory_layers.values():
+            move_to_main_thread(copy)
+        return dict(self.memory_layers)
+
+    @property
+    def saving(self) -> Optional[float]:
+        """
+        Returns the estimated saving in render time per frame, in seconds,
+        or None if no sample frame was rendered
+        """
+        if self.unprepared_frame_time is None or self.prepared_frame_time is None:
+            return None
+        return self.unprepared_frame_time - self.prepared_frame_time
+
+    def create_spatial_index(self, layer: LayerSnapshot) -> Optional[QgsVectorLayer]:
+        """
+        Creates a spatial index for a file based vector layer, if it
+        does not already have one
+
+        :returns: a new layer on the data source, which uses the index, or
+            None if no index was created
+        """
+        if layer.provider_type != "ogr":
+            return None
+        indexed = layer.open_layer()
+        provider = indexed.dataProvider()
+        if (
+            not provider
+            or not hasattr(indexed, "hasSpatialIndex")
+            or indexed.hasSpatialIndex() != QgsFeatureSource.SpatialIndexNotPresent
+            or not provider.capabilities() & QgsVectorDataProvider.CreateSpatialIndex
+        ):
+            return None
+
+        self.normal_message.emit(f"Creating spatial index for {layer.name}")
+        if not provider.createSpatialIndex():
+            self.normal_message.emit(f"Could not create spatial index for {layer.name}")
+            return None
+        return indexed
+
+    def build_overviews(self, layer: LayerSnapshot) -> Optional[QgsRasterLayer]:
+        """
+        Builds overviews for a file based raster layer, if it does not
+        already have any
+
+        :returns: a new layer on the data source, which uses the overviews,
+            or None if no overviews were built
+        """
+        if layer.provider_type != "gdal":
+            return None
+        overviewed = layer.open_layer()
+        provider = overviewed.dataProvider()
+        if (
+            not provider
+            or not provider.capabilities() & QgsRasterDataProvider.BuildPyramids
+            or provider.hasPyramids()
+        ):
+            return None
+
+        pyramids = provider.buildPyramidList()
+        if not pyramids:
+            # raster is too small to benefit from overviews
+            return None
+        for pyramid in pyramids:
+            if hasattr(pyramid, "setBuild"):
+                pyramid.setBuild(True)
+            else:
+                pyramid.build = True
+
+        self.normal_message.emit(f"Building overviews for {layer.name}")
+        error = provider.buildPyramids(pyramids, "AVERAGE")
+        if error:
+            self.normal_message.emit(
+                f"Could not build overviews for {layer.name}: {error}"
+            )
+            return None
+        # the provider only finds the overviews when the file is reopened
+        return layer.open_layer()
+
+    def create_memory_copy(
+        self, layer: LayerSnapshot, feedback: Optional[QgsFeedback] = None
+    ) -> Optional[QgsVectorLayer]:
+        """
+        Copies a vector layer to a memory layer with the same style, if it
+        is small enough
+
+        :param feedback: optional feedback for cancellation
+
+        :returns: the memory layer, or None if the layer was not copied
+        """
+        if (
+            layer.provider_type == "memory"
+            or layer.feature_count < 0
+            or layer.feature_count > DataPreparation.MEMORY_COPY_MAX_FEATURES
+        ):
+            return None
+
+        self.normal_message.emit(f"Copying {layer.name} to memory")
+        copy = QgsMemoryProviderUtils.createMemoryLayer(
+            layer.name, layer.fields, layer.wkb_type, layer.crs
+        )
+        if not copy or not copy.isValid():
+            return None
+        features = []
+        for feature in layer.feature_source.getFeatures():
+            if feedback and feedback.isCanceled():
+                return None
+            features.append(feature)
+        copy.dataProvider().addFeatures(features)
+        copy.updateExtents()
+        layer.style.writeToLayer(copy)
+        return copy
+
+    def reload_indexed_layers(self, layers: List[QgsMapLayer]):
+        """
+        Reloads the layers given a spatial index or overviews, so that
+        their providers use them. Must be called on the main thread.
+        """
+        for layer in layers:
+            if layer.id() in self.indexed_layer_ids:
+                layer.reload()
+
+    def release(self):
+        """
+        Releases any memory copies of layers
+        """
+        self.memory_layers.clear()
+
+
+class ExportPreparationTask(QgsTask):
+    """
+    Runs the steps preparing the layers of an export in the background,
+    so that reading and writing their data does not block the GUI.
+
+    Steps must only use what was read from the project's layers on the
+    main thread (see LayerSnapshot). The dialog swaps the layers they
+    create into the queued jobs once the task has finished.
+    """
+
+    message = pyqtSignal(str)
+    # Sent once all steps have run
+    preparation_completed = pyqtSignal()
+
+    def __init__(self, steps: List[Callable[..., None]]):
+        """
+        :param steps: steps to run in turn, which are called with the
+            task's feedback as their feedback keyword argument and should
+            stop early once it is canceled
+        """
+        super().__init__("Preparing layers", QgsTask.Flag.CanCancel)
+        self.steps = steps
+        self.feedback = QgsFeedback()
+        self.error: Optional[str] = None
+
+    def cancel(self):
+        """
+        Cancels the task, stopping the running step
+        """
+        self.feedback.cancel()
+        super().cancel()
+
+    def run(self):
+        """
+        Runs each step in turn
+        """
+        for i, step in enumerate(self.steps):
+            if self.isCanceled():
+                return False
+            try:
+                step(feedback=self.feedback)
+            except Exception as e:  # pylint: disable=broad-except
+                self.error = str(e)
+                return False
+            self.setProgress(100 * (i + 1) / len(self.steps))
+        return not self.isCanceled()
+
+    def finished(self, result: bool):  # pylint: disable=missing-function-docstring
+        if result:
+            self.preparation_completed.emit()
+        elif self.error:
+            self.message.emit(f"Preparing the layers failed: {self.error}")
+        else:
+            self.message.emit("Preparing the layers was canceled")
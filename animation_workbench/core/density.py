@@ -0,0 +1,392 @@
+# coding=utf-8
+
+"""Precomputed density grids of temporal point layers."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import math
+import os
+import sys
+from typing import Optional
+
+import numpy as np
+from osgeo import gdal
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.core import (
+    QgsBilinearRasterResampler,
+    QgsColorRampShader,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsGradientColorRamp,
+    QgsHeatmapRenderer,
+    QgsMapSettings,
+    QgsProject,
+    QgsRasterLayer,
+    QgsRasterShader,
+    QgsRenderContext,
+    QgsSingleBandPseudoColorRenderer,
+    QgsStyle,
+    QgsTask,
+    QgsVectorLayerFeatureSource,
+)
+
+from .render_queue import RenderJob
+from .temporal_index import TemporalFeatureIndex
+
+
+def gaussian_kernel(radius: float) -> np.ndarray:
+    """
+    Returns a normalized one dimensional Gaussian kernel, with the radius
+    at three standard deviations
+    """
+    half_width = max(int(math.ceil(radius)), 1)
+    sigma = max(radius, 1) / 3
+    offsets = np.arange(-half_width, half_width + 1, dtype=float)
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def separable_blur(grid: np.ndarray, kernel: np.ndarray) -> np.ndarray:
+    """
+    Blurs a grid with a kernel along its rows, then along its columns,
+    which for a Gaussian kernel is the same as a two dimensional blur
+    """
+    half_width = len(kernel) // 2
+    rows, columns = grid.shape
+    padded = np.pad(grid, ((half_width, half_width), (0, 0)))
+    blurred = np.zeros_like(grid)
+    for offset, weight in enumerate(kernel):
+        blurred += weight * padded[offset : offset + rows]
+    padded = np.pad(blurred, ((0, 0), (half_width, half_width)))
+    blurred = np.zeros_like(grid)
+    for offset, weight in enumerate(kernel):
+        blurred += weight * padded[:, offset : offset + columns]
+    return blurred
+
+
+class DensityGrids:
+    """
+    Density of the points of a temporal layer in each frame's time window,
+    rendered in place of the layer as a raster.
+
+    Each frame's points are counted into a grid over the map extent with
+    a NumPy 2D histogram, which is then smoothed by a separable Gaussian
+    blur. This replaces evaluating a kernel density over every point of
+    the layer when rendering each frame, which is what the heatmap
+    renderer does.
+
+    The grids of all frames are computed once and stored in a memory
+    mapped file, which is also described by a GDAL VRT with a band for
+    each frame, so that each frame's raster layer reads its grid straight
+    from the file. Computing them reads the points through a feature
+    source, so it can run in a background task (see DensityGridTask).
+    """
+
+    # Size of the grid cells, in output pixels
+    CELL_SIZE = 4
+    # Blur radius, in output pixels, when the layer has no heatmap renderer
+    DEFAULT_RADIUS = 20
+    # Number of frames computed at a time
+    FRAME_BLOCK = 32
+
+    def __init__(self, index: TemporalFeatureIndex, map_settings: QgsMapSettings):
+        """
+        :param index: time index of the point layer
+        :param map_settings: settings of the frames, with their output size
+        """
+        self.index = index
+        self.layer = index.layer
+        self.extent = map_settings.visibleExtent()
+        self.crs = map_settings.destinationCrs()
+        size = map_settings.outputSize()
+        self.output_size = (size.width(), size.height())
+        self.columns = max(int(math.ceil(size.width() / DensityGrids.CELL_SIZE)), 1)
+        self.rows = max(int(math.ceil(size.height() / DensityGrids.CELL_SIZE)), 1)
+
+        # the layer's heatmap renderer settings are used if it has one
+        renderer = self.layer.renderer()
+        self.renderer_dump: str = renderer.dump()
+        self.color_ramp = None
+        self.maximum_value: float = 0
+        self.radius: float = DensityGrids.DEFAULT_RADIUS
+        if isinstance(renderer, QgsHeatmapRenderer):
+            context = QgsRenderContext.fromMapSettings(map_settings)
+            self.radius = context.convertToPainterUnits(
+                renderer.radius(), renderer.radiusUnit(), renderer.radiusMapUnitScale()
+            )
+            self.color_ramp = renderer.colorRamp().clone()
+            self.maximum_value = renderer.maximumValue()
+
+        # the points are read when the grids are computed
+        self.source = QgsVectorLayerFeatureSource(self.layer)
+        self.transform = QgsCoordinateTransform(
+            self.layer.crs(), self.crs, QgsProject.instance()
+        )
+        self.xs = np.zeros(0)
+        self.ys = np.zeros(0)
+        self.starts = np.zeros(0)
+        self.ends = np.zeros(0)
+
+        self.path: Optional[str] = None
+        self.grids: Optional[np.ndarray] = None
+        # number of points in each frame, and the highest density
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.maximum: float = 0
+
+    def read_points(self):
+        """
+        Reads the location of each indexed feature, in the map CRS
+        """
+        request = QgsFeatureRequest()
+        request.setNoAttributes()
+        locations = {}
+        for feature in self.source.getFeatures(request):
+            geometry = feature.geometry()
+            if geometry.isEmpty():
+                continue
+            point = geometry.centroid().asPoint()
+            try:
+                point = self.transform.transform(point)
+            except QgsCsException:
+                continue
+            locations[feature.id()] = (point.x(), point.y())
+
+        positions = [
+            position
+            for position, feature_id in enumerate(self.index.ids)
+            if feature_id in locations
+        ]
+        coordinates = np.array(
+            [locations[self.index.ids[position]] for position in positions],
+            dtype=float,
+        ).reshape(-1, 2)
+        self.xs = coordinates[:, 0]
+        self.ys = coordinates[:, 1]
+        self.starts = np.array(self.index.starts, dtype=float)[positions]
+        self.ends = np.array(self.index.ends, dtype=float)[positions]
+
+    def visible(
+        self, begin: float, end: float, include_end: bool = False
+    ) -> np.ndarray:
+        """
+        Returns a mask of the points visible in a time window, matching
+        TemporalFeatureIndex.feature_ids()
+        """
+        if self.index.accumulate:
+            begin = -np.inf
+        started = self.starts <= end if include_end else self.starts < end
+        return started & np.where(
+            self.ends > self.starts, self.ends >= begin, self.starts >= begin
+        )
+
+    def grid(self, visible: np.ndarray) -> np.ndarray:
+        """
+        Returns the blurred counts of the points in a mask of visible
+        points, with the first row at the top of the map
+        """
+        counts, _, _ = np.histogram2d(
+            self.ys[visible],
+            self.xs[visible],
+            bins=(self.rows, self.columns),
+            range=(
+                (self.extent.yMinimum(), self.extent.yMaximum()),
+                (self.extent.xMinimum(), self.extent.xMaximum()),
+            ),
+        )
+        kernel = gaussian_kernel(self.radius / DensityGrids.CELL_SIZE)
+        return separable_blur(counts[::-1], kernel)
+
+    def compute(
+        self, frame_count: int, directory: str, feedback: Optional[QgsFeedback] = None
+    ) -> bool:
+        """
+        Computes the grids of all frames
+
+        :param frame_count: number of frames in the animation
+        :param directory: directory for the grids file
+        :param feedback: optional feedback for progress and cancellation
+        :returns: False if computing the grids was canceled
+        """
+        self.read_points()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "density.raw")
+        self.grids = np.memmap(
+            self.path,
+            dtype=np.float32,
+            mode="w+",
+            shape=(frame_count, self.rows, self.columns),
+        )
+        self.counts = np.zeros(frame_count, dtype=np.int64)
+        for start in range(0, frame_count, DensityGrids.FRAME_BLOCK):
+            if feedback and feedback.isCanceled():
+                self.grids = None
+                return False
+            end = min(start + DensityGrids.FRAME_BLOCK, frame_count)
+            block = np.zeros((end - start, self.rows, self.columns), dtype=np.float32)
+            for frame in range(start, end):
+                begin, window_end = self.index.frame_window(frame, frame_count)
+                # the last frame includes the end of the time range
+                visible = self.visible(begin, window_end, frame == frame_count - 1)
+                self.counts[frame] = np.count_nonzero(visible)
+                block[frame - start] = self.grid(visible)
+            self.grids[start:end] = block
+            if feedback:
+                feedback.setProgress(100 * end / frame_count)
+        self.grids.flush()
+        self.maximum = float(self.grids.max()) if frame_count else 0
+        self.write_vrt()
+        return True
+
+    def write_vrt(self):
+        """
+        Writes a GDAL VRT describing the grids file, with a band per frame
+        """
+        frame_count, rows, columns = self.grids.shape
+        dataset = gdal.GetDriverByName("VRT").Create(self.vrt_path, columns, rows, 0)
+        dataset.SetProjection(self.crs.toWkt())
+        dataset.SetGeoTransform(
+            (
+                self.extent.xMinimum(),
+                self.extent.width() / columns,
+                0,
+                self.extent.yMaximum(),
+                0,
+                -self.extent.height() / rows,
+            )
+        )
+        for frame in range(frame_count):
+            dataset.AddBand(
+                gdal.GDT_Float32,
+                options=[
+                    "subClass=VRTRawRasterBand",
+                    f"SourceFilename={self.path}",
+                    f"ImageOffset={frame * rows * columns * 4}",
+                    "PixelOffset=4",
+                    f"LineOffset={columns * 4}",
+                    f"ByteOrder={'LSB' if sys.byteorder == 'little' else 'MSB'}",
+                ],
+            )
+            # cells without any points are transparent
+            dataset.GetRasterBand(frame + 1).SetNoDataValue(0)
+        dataset.FlushCache()
+        dataset = None
+
+    @property
+    def vrt_path(self) -> str:
+        """
+        Returns the path of the VRT describing the grids
+        """
+        return os.path.splitext(self.path)[0] + ".vrt"
+
+    def is_current(self, frame_count: int, map_settings: QgsMapSettings) -> bool:
+        """
+        Returns True if the grids are up to date with the layer and frames
+        """
+        size = map_settings.outputSize()
+        return (
+            self.grids is not None
+            and len(self.grids) == frame_count
+            and self.index.is_current()
+            and self.extent == map_settings.visibleExtent()
+            and self.crs == map_settings.destinationCrs()
+            and self.output_size == (size.width(), size.height())
+            and self.layer.renderer().dump() == self.renderer_dump
+        )
+
+    def create_layer(self, frame: int) -> QgsRasterLayer:
+        """
+        Creates a raster layer showing the density grid of a frame
+        """
+        layer = QgsRasterLayer(self.vrt_path, f"{self.layer.name()} density", "gdal")
+        maximum = self.maximum_value if self.maximum_value > 0 else self.maximum
+        if self.color_ramp:
+            color_ramp = self.color_ramp.clone()
+        else:
+            color_ramp = QgsStyle.defaultStyle().colorRamp("Magma") or (
+                QgsGradientColorRamp()
+            )
+
+        ramp_shader = QgsColorRampShader(0, max(maximum, 1e-6))
+        ramp_shader.setSourceColorRamp(color_ramp)
+        ramp_shader.classifyColorRamp()
+        shader = QgsRasterShader()
+        shader.setRasterShaderFunction(ramp_shader)
+        renderer = QgsSingleBandPseudoColorRenderer(
+            layer.dataProvider(), frame + 1, shader
+        )
+        layer.setRenderer(renderer)
+        layer.resampleFilter().setZoomedInResampler(QgsBilinearRasterResampler())
+        layer.setOpacity(self.layer.opacity())
+        return layer
+
+    def add_density_layer(
+        self, map_settings: QgsMapSettings, frame: int, job: RenderJob
+    ):
+        """
+        Renders a frame's density layer in place of the point layer. Used
+        as a deferred update, so the layer is only created when the frame
+        is rendered.
+        """
+        density_layer = self.create_layer(frame)
+        job.owned_layers.append(density_layer)
+        layers = map_settings.layers()
+        layer_ids = [layer.id() for layer in layers]
+        if self.layer.id() in layer_ids:
+            layers[layer_ids.index(self.layer.id())] = density_layer
+        else:
+            layers.insert(0, density_layer)
+        map_settings.setLayers(layers)
+
+
+class DensityGridTask(QgsTask):
+    """
+    Computes density grids in a background task, so that reading the
+    points and counting them for every frame does not block the GUI
+    """
+
+    message = pyqtSignal(str)
+    # Sends the computed grids
+    grids_computed = pyqtSignal(object)
+
+    def __init__(self, grids: DensityGrids, frame_count: int, directory: str):
+        super().__init__("Computing density grids", QgsTask.Flag.CanCancel)
+        self.grids = grids
+        self.frame_count = frame_count
+        self.directory = directory
+        self.feedback = QgsFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+
+    def cancel(self):
+        """
+        Cancels the task, stopping after the current block of frames
+        """
+        self.feedback.cancel()
+        super().cancel()
+
+    def run(self):
+        """
+        Computes the grids of all frames
+        """
+        return self.grids.compute(self.frame_count, self.directory, self.feedback)
+
+    def finished(self, result: bool):  # pylint: disable=missing-function-docstring
+        if result:
+            self.grids_computed.emit(self.grids)
+        else:
+            self.message.emit("Computing the density grids was canceled")
@@ -0,0 +1,296 @@
+# coding=utf-8
+
+"""Memory bounded access to the features driving an animation."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+from array import array
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional, Tuple
+
+from qgis.core import (
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextScope,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsMapSettings,
+    QgsVectorLayer,
+)
+
+from .data_preparation import layer_data_revision
+
+
+class WindowedFeatureSource:
+    """
+    Read-only sequence of the features of a layer, in iteration order
+    or in the order of a given list of feature ids, which only keeps a
+    small window of features in memory.
+
+    Unless one is given, a compact index of feature ids (8 bytes per
+    feature) is built with a single pass over the layer, without
+    attributes or geometries. Features
+    are then fetched in blocks as they are accessed, so iterating streams
+    through the layer, while looking up the previous, current and next
+    features (including wrapping around to the first and last features)
+    is served from the window.
+    """
+
+    # Number of features fetched from the layer in one request
+    BLOCK_SIZE = 64
+    # Maximum number of features kept in memory
+    WINDOW_SIZE = 256
+
+    def __init__(self, layer: QgsVectorLayer, ids: Optional[Iterable[int]] = None):
+        self.layer = layer
+        if ids is None:
+            request = QgsFeatureRequest()
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+            request.setNoAttributes()
+            ids = (f.id() for f in layer.getFeatures(request))
+        self.ids = array("q", ids)
+        self.window: "OrderedDict[int, QgsFeature]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[QgsFeature]:
+        for index in range(len(self.ids)):
+            yield self[index]
+
+    def __getitem__(self, index: int) -> QgsFeature:
+        """
+        Returns the feature at an index
+
+        :raises ValueError: if the feature has been deleted from the layer
+            since the source was built
+        """
+        if index < 0:
+            index += len(self.ids)
+        if not 0 <= index < len(self.ids):
+            raise IndexError("feature index out of range")
+
+        feature = self.window.get(index)
+        if feature is None:
+            self._fetch_block(index)
+            feature = self.window[index]
+        else:
+            self.window.move_to_end(index)
+        return feature
+
+    def _fetch_block(self, start: int):
+        """
+        Fetches the block of features starting at an index into the window
+
+        :raises ValueError: if features of the block have been deleted from
+            the layer
+        """
+        block_ids = self.ids[start : start + WindowedFeatureSource.BLOCK_SIZE]
+        index_for_id = {
+            feature_id: start + offset for offset, feature_id in enumerate(block_ids)
+        }
+        request = QgsFeatureRequest().setFilterFids(list(block_ids))
+        for feature in self.layer.getFeatures(request):
+            self.window[index_for_id.pop(feature.id())] = feature
+        if index_for_id:
+            raise ValueError(
+                f"Features {', '.join(str(i) for i in sorted(index_for_id))} "
+                f"of {self.layer.name()} no longer exist. Were they deleted "
+                "after the animation was set up?"
+            )
+
+        # the requested feature is kept as the most recently used
+        if start in self.window:
+            self.window.move_to_end(start)
+        while len(self.window) > WindowedFeatureSource.WINDOW_SIZE:
+            self.window.popitem(last=False)
+
+
+class FeatureStore:
+    """
+    Shared store which resolves feature ids to features, so that render
+    jobs only need to carry feature ids until they are rendered.
+
+    Recently resolved features are cached, as consecutive frames usually
+    refer to the same few features.
+    """
+
+    # Expression context variables holding features. Jobs carry the
+    # matching "<name>_id" variables, which are resolved into these.
+    FEATURE_VARIABLES = (
+        "hover_feature",
+        "from_feature",
+        "to_feature",
+        "previous_feature",
+        "next_feature",
+    )
+
+    # Maximum number of features kept in memory
+    CACHE_SIZE = 16
+
+    def __init__(self, layer: QgsVectorLayer):
+        self.layer = layer
+        self.cache: "OrderedDict[int, QgsFeature]" = OrderedDict()
+
+    def feature(self, feature_id: int) -> QgsFeature:
+        """
+        Returns the feature with the given id
+        """
+        feature = self.cache.get(feature_id)
+        if feature is None:
+            feature = self.layer.getFeature(feature_id)
+            self.cache[feature_id] = feature
+            while len(self.cache) > FeatureStore.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(feature_id)
+        return feature
+
+    def resolve_feature_variables(self, map_settings: QgsMapSettings):
+        """
+        Adds the features for the feature id variables in the expression
+        context of a frame's map settings
+        """
+        context = map_settings.expressionContext()
+        scope = QgsExpressionContextScope()
+        for name in FeatureStore.FEATURE_VARIABLES:
+            id_name = f"{name}_id"
+            if not context.hasVariable(id_name):
+                continue
+            feature_id = context.variable(id_name)
+            scope.setVariable(
+                name, None if feature_id is None else self.feature(feature_id), True
+            )
+        context.appendScope(scope)
+        map_settings.setExpressionContext(context)
+
+
+class FeatureIdCache:
+    """
+    Cache of the ids of the features of a layer matching a filter
+    expression, in the order given by an order-by expression.
+
+    Ids are kept as compact arrays, and only recomputed when the
+    expressions or the layer's data change, so that sorting and filtering
+    large layers is done once per configuration rather than for every
+    preview or export.
+    """
+
+    # Maximum number of id arrays kept in memory
+    MAX_ENTRIES = 8
+
+    def __init__(self):
+        self.entries: "OrderedDict[Tuple, array]" = OrderedDict()
+        # ids of the layers whose edits invalidate the cache
+        self.watched_layers = set()
+
+    @staticmethod
+    def create_request(
+        layer: QgsVectorLayer,
+        filter_expression: str = "",
+        order_by: str = "",
+        descending: bool = False,
+    ) -> QgsFeatureRequest:
+        """
+        Creates a request for the ids of the matching features, in order
+
+        :raises ValueError: if an expression is not valid
+        """
+        request = QgsFeatureRequest()
+        expressions = [e for e in (filter_expression, order_by) if e]
+        needs_geometry = False
+        attributes = set()
+        for expression_string in expressions:
+            expression = QgsExpression(expression_string)
+            if expression.hasParserError():
+                raise ValueError(
+                    f"Invalid expression {expression_string}: "
+                    f"{expression.parserErrorString()}"
+                )
+            needs_geometry = needs_geometry or expression.needsGeometry()
+            attributes.update(expression.referencedColumns())
+
+        if filter_expression:
+            request.setFilterExpression(filter_expression)
+            request.setExpressionContext(
+                QgsExpressionContext(
+                    QgsExpressionContextUtils.globalProjectLayerScopes(layer)
+                )
+            )
+        if order_by:
+            request.setOrderBy(
+                QgsFeatureRequest.OrderBy(
+                    [QgsFeatureRequest.OrderByClause(order_by, not descending)]
+                )
+            )
+
+        if not needs_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if QgsFeatureRequest.ALL_ATTRIBUTES not in attributes:
+            request.setSubsetOfAttributes(list(attributes), layer.fields())
+        return request
+
+    def feature_ids(
+        self,
+        layer: QgsVectorLayer,
+        filter_expression: str = "",
+        order_by: str = "",
+        descending: bool = False,
+    ) -> array:
+        """
+        Returns the ids of the features matching a filter expression, in
+        the order given by an order-by expression
+
+        :param layer: layer to return feature ids for
+        :param filter_expression: optional expression selecting features
+        :param order_by: optional expression to order features by
+        :param descending: True to order features in descending order
+
+        :raises ValueError: if an expression is not valid
+        """
+        key = (
+            layer.id(),
+            layer_data_revision(layer),
+            filter_expression,
+            order_by,
+            descending,
+        )
+        ids = self.entries.get(key)
+        if ids is not None:
+            self.entries.move_to_end(key)
+            return ids
+
+        request = self.create_request(layer, filter_expression, order_by, descending)
+        ids = array("q", (f.id() for f in layer.getFeatures(request)))
+
+        if layer.id() not in self.watched_layers:
+            self.watched_layers.add(layer.id())
+            layer.dataChanged.connect(
+                lambda layer_id=layer.id(): self.invalidate(layer_id)
+            )
+        self.entries[key] = ids
+        while len(self.entries) > FeatureIdCache.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+        return ids
+
+    def invalidate(self, layer_id: str):
+        """
+        Discards the cached ids for a layer
+        """
+        for key in [key for key in self.entries if key[0] == layer_id]:
+            del self.entries[key]
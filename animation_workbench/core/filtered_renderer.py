@@ -0,0 +1,267 @@
+# coding=utf-8
+
+"""Rendering of frames restricted to precomputed feature ids."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.PyQt.QtGui import QImage, QPainter
+from qgis.core import (
+    QgsFeatureFilterProvider,
+    QgsFeatureRequest,
+    QgsMapLayer,
+    QgsMapRendererCustomPainterJob,
+    QgsMapSettings,
+    QgsRenderContext,
+    QgsTask,
+    QgsVectorLayer,
+)
+
+
+class FeatureIdFilterProvider(QgsFeatureFilterProvider):
+    """
+    Restricts the features rendered from layers to precomputed feature ids.
+
+    This replaces any filter expression of the render request for those
+    layers. QGIS adds a layer's temporal filter to the request after the
+    provider is applied, which replaces the ids again, so layers must be
+    rendered with their temporal properties inactive.
+    """
+
+    def __init__(self, feature_ids: Dict[str, Sequence[int]]):
+        super().__init__()
+        self.feature_ids = feature_ids
+
+    def filterFeatures(  # pylint: disable=invalid-name
+        self, layer: QgsVectorLayer, request: QgsFeatureRequest
+    ):
+        """
+        Restricts a feature request for a layer to its feature ids
+        """
+        feature_ids = self.feature_ids.get(layer.id())
+        if feature_ids is not None:
+            request.setFilterFids(list(feature_ids))
+
+    def layerFilterExpression(  # pylint: disable=invalid-name,unused-argument
+        self, layer: QgsVectorLayer
+    ) -> str:
+        """
+        Returns an additional filter expression for a layer, there is none
+        """
+        return ""
+
+    def layerAttributes(  # pylint: disable=invalid-name,unused-argument
+        self, layer: QgsVectorLayer, attributes: List[str]
+    ) -> List[str]:
+        """
+        Returns the attributes of a layer which may be rendered, all of them
+        """
+        return attributes
+
+    def clone(self) -> "FeatureIdFilterProvider":
+        """
+        Returns a copy of the filter provider
+        """
+        return FeatureIdFilterProvider(self.feature_ids)
+
+
+def create_frame_image(map_settings: QgsMapSettings) -> QImage:
+    """
+    Creates an image to draw a frame on, in the same way as
+    QgsMapRendererTask
+    """
+    image = QImage(map_settings.deviceOutputSize(), map_settings.outputImageFormat())
+    image.setDevicePixelRatio(map_settings.devicePixelRatio())
+    dots_per_meter = int(round(map_settings.outputDpi() / 0.0254))
+    image.setDotsPerMeterX(dots_per_meter)
+    image.setDotsPerMeterY(dots_per_meter)
+    image.fill(map_settings.backgroundColor())
+    return image
+
+
+def prepare_render_job(
+    map_settings: QgsMapSettings,
+    painter: QPainter,
+    feature_ids: Optional[Dict[str, Sequence[int]]] = None,
+) -> QgsMapRendererCustomPainterJob:
+    """
+    Creates a job rendering the map with a painter and prepares it, which
+    creates the renderers of its layers. This must be called on the main
+    thread. The prepared job can then be rendered on any thread with
+    renderPrepared(), as QgsMapRendererTask does.
+
+    :param feature_ids: ids of the only features to render from layers,
+        by layer id
+    """
+    render_job = QgsMapRendererCustomPainterJob(map_settings, painter)
+    if feature_ids:
+        render_job.setFeatureFilterProvider(FeatureIdFilterProvider(feature_ids))
+    render_job.prepare()
+    return render_job
+
+
+class FilteredMapRendererTask(QgsTask):
+    """
+    Renders a frame to an image file, like QgsMapRendererTask, optionally
+    restricting the features rendered from some layers to precomputed
+    feature ids
+
+    Layers which are only needed for this frame can be created by the task,
+    and are drawn above the layers of the map settings.
+
+    Like QgsMapRendererTask, the render is prepared on the main thread
+    when the task is created, as creating layer renderers is not thread
+    safe. Only the prepared render and writing the image run in the task.
+    The times at which these happen are recorded by the task and sent with
+    frame_timed, as the task manager's signals are delivered on the main
+    thread.
+    """
+
+    # Signals
+    renderingComplete = pyqtSignal()  # pylint: disable=invalid-name
+    # Sends the times at which the task started, finished drawing the frame
+    # and finished writing it, in seconds since the epoch
+    frame_timed = pyqtSignal(float, float, float)
+
+    def __init__(
+        self,
+        map_settings: QgsMapSettings,
+        file_name: str,
+        feature_ids: Dict[str, Sequence[int]],
+        flags: QgsTask.Flags = QgsTask.CanCancel,
+        layer_factories: Optional[List[Callable[[], QgsMapLayer]]] = None,
+    ):
+        super().__init__("Rendering frame", flags)
+        self.map_settings = QgsMapSettings(map_settings)
+        self.file_name = file_name
+        self.feature_ids = feature_ids
+        self.annotations: List = []
+        self.decorations: List = []
+        self.started: Optional[float] = None
+        self.rendered: Optional[float] = None
+        self.written: Optional[float] = None
+
+        # Layers created for this frame, kept until the task is deleted
+        self.created_layers = [create() for create in layer_factories or []]
+        self.image = create_frame_image(self.map_settings)
+        self.painter = QPainter(self.image)
+        self.render_job: Optional[QgsMapRendererCustomPainterJob] = self.prepare()
+
+    def prepare(self) -> Optional[QgsMapRendererCustomPainterJob]:
+        """
+        Prepares the render of the map layers, on the main thread
+
+        :returns: prepared render job, or None if the layers are not
+            rendered with a render job
+        """
+        settings = QgsMapSettings(self.map_settings)
+        if self.created_layers:
+            settings.setLayers(self.created_layers + settings.layers())
+        return prepare_render_job(settings, self.painter, self.feature_ids)
+
+    def addAnnotations(self, annotations: List):  # pylint: disable=invalid-name
+        """
+        Adds annotations to draw over the map
+        """
+        self.annotations.extend(annotations)
+
+    def addDecorations(self, decorations: List):  # pylint: disable=invalid-name
+        """
+        Adds decorations to draw over the map
+        """
+        self.decorations.extend(decorations)
+
+    def cancel(self):
+        """
+        Cancels the task, stopping the render
+        """
+        if self.render_job:
+            self.render_job.cancelWithoutBlocking()
+        super().cancel()
+
+    def run(self):  # pylint: disable=missing-function-docstring
+        self.started = time.time()
+        if not self.render_map(self.painter):
+            self.painter.end()
+            return False
+
+        settings = self.map_settings
+        context = QgsRenderContext.fromMapSettings(settings)
+        context.setPainter(self.painter)
+        for decoration in self.decorations:
+            decoration.render(settings, context)
+        self.draw_annotations(context)
+        self.painter.end()
+        self.rendered = time.time()
+
+        saved = self.image.save(self.file_name, "PNG")
+        self.written = time.time()
+        return saved
+
+    def render_map(self, painter: QPainter) -> bool:
+        """
+        Renders the map layers with a painter, completing the prepared
+        render
+
+        :returns: False if the task was canceled
+        """
+        if self.isCanceled():
+            return False
+        self.render_job.renderPrepared()
+        return not self.isCanceled()
+
+    def draw_annotations(self, context: QgsRenderContext):
+        """
+        Draws the annotations, in the same way as QgsMapRendererTask
+        """
+        settings = self.map_settings
+        extent = settings.extent()
+        size = settings.outputSize()
+        for annotation in self.annotations:
+            if not annotation or not annotation.isVisible():
+                continue
+            if annotation.mapLayer() and annotation.mapLayer() not in settings.layers():
+                continue
+            if annotation.hasFixedMapPosition():
+                x = (
+                    size.width()
+                    * (annotation.mapPosition().x() - extent.xMinimum())
+                    / extent.width()
+                )
+                y = size.height() * (
+                    1
+                    - (annotation.mapPosition().y() - extent.yMinimum())
+                    / extent.height()
+                )
+            else:
+                x = annotation.relativePosition().x() * size.width()
+                y = annotation.relativePosition().y() * size.height()
+            context.painter().save()
+            context.painter().translate(x, y)
+            annotation.render(context)
+            context.painter().restore()
+
+    def finished(self, result: bool):  # pylint: disable=missing-function-docstring
+        if self.painter.isActive():
+            # the task was canceled before it ran
+            self.painter.end()
+        if result:
+            self.frame_timed.emit(self.started, self.rendered, self.written)
+            self.renderingComplete.emit()
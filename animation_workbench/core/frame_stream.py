@@ -0,0 +1,178 @@
+# coding=utf-8
+
+"""Ordered stream of rendered frames, for encoding while rendering."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import os
+import queue
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+
+def frame_file_names(work_directory: str, prefix: str, frame_count: int) -> List[str]:
+    """
+    Returns the paths of the frames of an animation, in frame order, named
+    in the same way as the animation controller names them
+
+    :param frame_count: number of frames of the animation, which are
+        numbered from 0
+    """
+    return [
+        os.path.join(work_directory, f"{prefix}-{frame:010d}.png")
+        for frame in range(frame_count)
+    ]
+
+
+def reused_frame_files(frame_files: Iterable[str], queued: Iterable[str]) -> List[str]:
+    """
+    Returns the frames of an animation which are not queued for rendering,
+    because they were kept from an earlier export, in frame order
+
+    :param frame_files: paths of all frames of the animation
+    :param queued: paths of the frames queued for rendering
+    """
+    queued = {os.path.normpath(str(name)) for name in queued}
+    return [
+        name
+        for name in frame_files
+        if os.path.normpath(name) not in queued and os.path.exists(name)
+    ]
+
+
+class OrderedFrameStream:
+    """
+    Hands rendered frames to an encoder in frame order, as soon as every
+    earlier frame has been rendered.
+
+    Frames are rendered by a pool of tasks and finish out of order. Each
+    frame which finishes ahead of an earlier one is held in a reorder
+    window, and released together with the frames after it once the
+    earlier frames are in. Frames which fail to render are skipped, so
+    they never hold up the stream.
+
+    Completions are reported on the main thread, while the encoder reads
+    the stream from its task's thread, so the released frames are passed
+    through a thread safe queue.
+    """
+
+    # Seconds between checks for cancellation while waiting for frames
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, file_names: Iterable[str], delete_consumed: bool = False):
+        """
+        :param file_names: names of all frames of the animation. Frames
+            are streamed in the order of their names.
+        :param delete_consumed: True to delete each frame once it has been
+            passed to the encoder, to limit the disk space used by long
+            exports
+        """
+        self.file_names = sorted({os.path.normpath(str(name)) for name in file_names})
+        self.positions: Dict[str, int] = {
+            name: position for position, name in enumerate(self.file_names)
+        }
+        self.delete_consumed = delete_consumed
+        # position of the first frame which has not been released
+        self.next_position: int = 0
+        # frames which completed ahead of an earlier frame, by position,
+        # with True if they rendered successfully
+        self.window: Dict[int, bool] = {}
+        self.ready: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.finished: bool = False
+        if not self.file_names:
+            self.finish()
+
+    def frame_rendered(self, file_name: str):
+        """
+        Reports that a frame has been rendered
+        """
+        self.frame_completed(file_name, True)
+
+    def frame_failed(self, file_name: str):
+        """
+        Reports that a frame could not be rendered
+        """
+        self.frame_completed(file_name, False)
+
+    def frame_completed(self, file_name: str, rendered: bool):
+        """
+        Reports that a frame has completed, releasing it and any frames
+        after it in the window if all earlier frames have completed
+        """
+        if self.finished:
+            return
+        position = self.positions.get(os.path.normpath(str(file_name)))
+        if position is None or position < self.next_position:
+            return
+        self.window[position] = rendered
+        while self.next_position in self.window:
+            if self.window.pop(self.next_position):
+                self.ready.put(self.file_names[self.next_position])
+            self.next_position += 1
+        if self.next_position == len(self.file_names):
+            self.finish()
+
+    def finish(self):
+        """
+        Ends the stream once rendering is complete, releasing the frames
+        still in the window and skipping any that never completed
+        """
+        if self.finished:
+            return
+        for position in sorted(self.window):
+            if self.window[position]:
+                self.ready.put(self.file_names[position])
+        self.window.clear()
+        self.next_position = len(self.file_names)
+        self.finished = True
+        self.ready.put(None)
+
+    def cancel(self):
+        """
+        Ends the stream without releasing any more frames
+        """
+        self.window.clear()
+        self.finished = True
+        self.ready.put(None)
+
+    def frames(self, is_canceled: Callable[[], bool]) -> Iterator[str]:
+        """
+        Yields the released frames in order, waiting for frames which are
+        still rendering, until the stream ends
+
+        :param is_canceled: returns True if the reader has been canceled
+        """
+        while True:
+            try:
+                file_name = self.ready.get(timeout=OrderedFrameStream.POLL_INTERVAL)
+            except queue.Empty:
+                if is_canceled():
+                    return
+                continue
+            if file_name is None:
+                return
+            yield file_name
+
+    def consumed(self, file_name: str):
+        """
+        Reports that a frame has been passed to the encoder
+        """
+        if not self.delete_consumed:
+            return
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
@@ -0,0 +1,291 @@
+# coding=utf-8
+
+"""Precomputed generalization levels for heavy vector layers."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import hashlib
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsFeedback,
+    QgsProject,
+    QgsUnitTypes,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+from .data_preparation import LayerSnapshot, move_to_main_thread
+from .render_queue import RenderJob
+
+# Length of a pixel at 96 dpi, in metres
+PIXEL_SIZE_METRES = 0.0254 / 96
+
+
+def level_scales(min_scale: float, max_scale: float, count: int) -> List[float]:
+    """
+    Returns the scales to generalize for, geometrically spaced across a
+    scale range, from the most detailed (smallest scale denominator) up
+
+    :param min_scale: smallest scale denominator visited
+    :param max_scale: largest scale denominator visited
+    :param count: maximum number of levels
+    """
+    if min_scale <= 0 or max_scale <= 0:
+        return []
+    if count <= 1 or max_scale <= min_scale:
+        return [min_scale]
+    ratio = max_scale / min_scale
+    return [min_scale * ratio ** (i / (count - 1)) for i in range(count)]
+
+
+class GeneralizationCache(QObject):
+    """
+    Precomputes simplified versions of heavy line and polygon layers for
+    the scale range an animation visits, and renders each frame with the
+    simplest version which is still accurate to within a fraction of a
+    pixel at that frame's scale.
+
+    Levels are written as GeoPackages to the cache directory, keyed by the
+    layer's data revision and the simplification tolerance, so repeated
+    exports reuse them. Levels are written from layer snapshots, so that
+    generalizing can run in an ExportPreparationTask.
+    """
+
+    # Number of generalization levels across the visited scale range
+    LEVEL_COUNT = 3
+    # Simplification tolerance, in pixels at the level's scale
+    TOLERANCE_PIXELS = 0.5
+    # Layers with fewer (estimated) vertices than this are not generalized
+    HEAVY_MIN_VERTICES = 100000
+    # Number of features sampled when estimating a layer's vertex count
+    VERTEX_SAMPLE_FEATURES = 100
+
+    # Signals
+    normal_message = pyqtSignal(str)
+
+    def __init__(self, cache_directory: str, parent=None):
+        super().__init__(parent=parent)
+        self.cache_directory: str = cache_directory
+        # Generalized layers for each level, by original layer id, as
+        # (level scale, layer) sorted from the most detailed level up.
+        # They must be kept alive for as long as any render job refers
+        # to them.
+        self.levels: Dict[str, List[Tuple[float, QgsVectorLayer]]] = {}
+        self.elapsed: float = 0
+
+    @staticmethod
+    def estimated_vertex_count(layer: LayerSnapshot) -> int:
+        """
+        Estimates the number of vertices in a layer from a sample of its
+        features
+        """
+        request = QgsFeatureRequest().setNoAttributes()
+        request.setLimit(GeneralizationCache.VERTEX_SAMPLE_FEATURES)
+        sampled = 0
+        vertices = 0
+        for feature in layer.feature_source.getFeatures(request):
+            sampled += 1
+            if feature.hasGeometry():
+                vertices += feature.geometry().constGet().nCoordinates()
+        if not sampled:
+            return 0
+        return int(vertices / sampled * max(layer.feature_count, sampled))
+
+    def is_heavy(self, layer: LayerSnapshot) -> bool:
+        """
+        Returns True if a layer is a line or polygon layer with enough
+        vertices to benefit from generalization
+        """
+        return (
+            layer.is_vector
+            and QgsWkbTypes.geometryType(layer.wkb_type)
+            in (QgsWkbTypes.LineGeometry, QgsWkbTypes.PolygonGeometry)
+            and self.estimated_vertex_count(layer)
+            >= GeneralizationCache.HEAVY_MIN_VERTICES
+        )
+
+    @staticmethod
+    def tolerance(layer: LayerSnapshot, scale: float) -> float:
+        """
+        Returns the simplification tolerance for a scale, in layer units
+        """
+        metres_to_layer_units = QgsUnitTypes.fromUnitToUnitFactor(
+            QgsUnitTypes.DistanceMeters, layer.crs.mapUnits()
+        )
+        return (
+            scale
+            * PIXEL_SIZE_METRES
+            * GeneralizationCache.TOLERANCE_PIXELS
+            * metres_to_layer_units
+        )
+
+    def cache_path(self, layer: LayerSnapshot, tolerance: float) -> str:
+        """
+        Returns the path of a generalized copy of a layer
+        """
+        key = f"{layer.data_revision}|{tolerance:.9g}"
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_directory, f"generalized-{digest}.gpkg")
+
+    @staticmethod
+    def write_generalized(
+        layer: LayerSnapshot,
+        path: str,
+        tolerance: float,
+        feedback: Optional[QgsFeedback] = None,
+    ) -> bool:
+        """
+        Writes a copy of a layer with all geometries simplified to the
+        given tolerance
+
+        :param feedback: optional feedback, which stops writing the copy
+            once canceled
+
+        :returns: True if the copy was written successfully
+        """
+        # write to a temporary name, so that an interrupted write is
+        # never mistaken for a cached level
+        temp_path = f"{path}.partial.gpkg"
+        if hasattr(QgsVectorFileWriter, "create"):
+            options = QgsVectorFileWriter.SaveVectorOptions()
+            options.driverName = "GPKG"
+            options.fileEncoding = "UTF-8"
+            writer = QgsVectorFileWriter.create(
+                temp_path,
+                layer.fields,
+                layer.wkb_type,
+                layer.crs,
+                QgsProject.instance().transformContext(),
+                options,
+            )
+        else:
+            writer = QgsVectorFileWriter(
+                temp_path,
+                "UTF-8",
+                layer.fields,
+                layer.wkb_type,
+                layer.crs,
+                "GPKG",
+            )
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            return False
+
+        for feature in layer.feature_source.getFeatures(QgsFeatureRequest()):
+            if feedback and feedback.isCanceled():
+                del writer
+                os.remove(temp_path)
+                return False
+            if feature.hasGeometry():
+                simplified = feature.geometry().simplify(tolerance)
+                if not simplified.isEmpty():
+                    feature.setGeometry(simplified)
+            writer.addFeature(feature)
+        del writer
+
+        os.replace(temp_path, path)
+        return True
+
+    def prepare(
+        self,
+        layers: List[LayerSnapshot],
+        min_scale: float,
+        max_scale: float,
+        feedback: Optional[QgsFeedback] = None,
+    ) -> int:
+        """
+        Creates the generalization levels for the heavy layers
+
+        :param layers: snapshots of the layers rendered in the animation
+        :param min_scale: smallest scale denominator the animation visits
+        :param max_scale: largest scale denominator the animation visits
+        :param feedback: optional feedback for cancellation
+
+        :returns: number of layers generalized
+        """
+        start = time.perf_counter()
+        scales = level_scales(min_scale, max_scale, GeneralizationCache.LEVEL_COUNT)
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+        for layer in layers:
+            if not scales or not self.is_heavy(layer):
+                continue
+
+            levels = []
+            for scale in scales:
+                if feedback and feedback.isCanceled():
+                    break
+                tolerance = self.tolerance(layer, scale)
+                path = self.cache_path(layer, tolerance)
+                if not os.path.exists(path):
+                    self.normal_message.emit(
+                        f"Generalizing {layer.name} for 1:{scale:,.0f}"
+                    )
+                    if not self.write_generalized(layer, path, tolerance, feedback):
+                        if not (feedback and feedback.isCanceled()):
+                            self.normal_message.emit(
+                                f"Could not generalize {layer.name}"
+                            )
+                        break
+                level = QgsVectorLayer(path, layer.name, "ogr")
+                if not level.isValid():
+                    break
+                layer.style.writeToLayer(level)
+                levels.append((scale, move_to_main_thread(level)))
+
+            if levels:
+                self.levels[layer.layer_id] = levels
+
+        self.elapsed += time.perf_counter() - start
+        return len(self.levels)
+
+    def level_for_scale(self, layer_id: str, scale: float) -> Optional[QgsVectorLayer]:
+        """
+        Returns the simplest generalized layer which is accurate at a
+        scale, or None if the original layer should be rendered
+        """
+        selected = None
+        for level_scale, level in self.levels.get(layer_id, []):
+            if level_scale > scale:
+                break
+            selected = level
+        return selected
+
+    def apply(self, job: RenderJob):
+        """
+        Swaps the right generalization level into a render job for its scale
+        """
+        if not self.levels:
+            return
+        scale = job.frame_settings.scale()
+        replacements = {}
+        for layer_id in self.levels:
+            level = self.level_for_scale(layer_id, scale)
+            if level is not None:
+                replacements[layer_id] = level
+        job.replace_layers(replacements)
+
+    def release(self):
+        """
+        Releases the generalized layers. The cached files are kept for reuse.
+        """
+        self.levels.clear()
@@ -0,0 +1,175 @@
+# coding=utf-8
+
+"""Highlighting of the current feature of an animation."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+from collections import OrderedDict
+from typing import Optional
+
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsFeature,
+    QgsFillSymbol,
+    QgsGeometry,
+    QgsLineSymbol,
+    QgsMapDecoration,
+    QgsMapSettings,
+    QgsMarkerSymbol,
+    QgsRenderContext,
+    QgsSymbol,
+    QgsWkbTypes,
+)
+
+from .feature_source import FeatureStore
+from .render_queue import RenderJob
+
+
+def highlight_geometry(
+    geometry: QgsGeometry, symbol: QgsSymbol
+) -> Optional[QgsGeometry]:
+    """
+    Returns the geometry to draw a feature with a symbol, converting it
+    if the symbol is for a different type of geometry, or None if it
+    cannot be drawn with the symbol
+
+    Marker symbols are drawn at a point on the surface of lines and
+    polygons, and line symbols along the boundary of polygons.
+    """
+    if geometry is None or geometry.isEmpty():
+        return None
+    geometry_type = geometry.type()
+    if isinstance(symbol, QgsMarkerSymbol):
+        if geometry_type == QgsWkbTypes.PointGeometry:
+            return geometry
+        return geometry.pointOnSurface()
+    if isinstance(symbol, QgsLineSymbol):
+        if geometry_type == QgsWkbTypes.LineGeometry:
+            return geometry
+        if geometry_type == QgsWkbTypes.PolygonGeometry:
+            return QgsGeometry(geometry.constGet().boundary())
+        return None
+    if isinstance(symbol, QgsFillSymbol):
+        if geometry_type == QgsWkbTypes.PolygonGeometry:
+            return geometry
+    return None
+
+
+class HighlightDecoration(QgsMapDecoration):
+    """
+    Map decoration drawing a geometry with a symbol over a frame
+    """
+
+    def __init__(self, geometry: QgsGeometry, symbol: QgsSymbol):
+        """
+        :param geometry: geometry to draw, in the map CRS
+        :param symbol: symbol to draw the geometry with
+        """
+        super().__init__()
+        self.geometry = geometry
+        self.symbol = symbol.clone()
+
+    def render(  # pylint: disable=invalid-name
+        self, map_settings: QgsMapSettings, context: QgsRenderContext
+    ):
+        """
+        Draws the geometry
+        """
+        feature = QgsFeature()
+        feature.setGeometry(self.geometry)
+        context.expressionContext().setFeature(feature)
+        self.symbol.startRender(context)
+        self.symbol.renderFeature(feature, context)
+        self.symbol.stopRender(context)
+
+
+class FeatureHighlighter:
+    """
+    Highlights the feature each frame is hovering at or travelling to,
+    by drawing it with a highlight symbol over the rendered frame.
+
+    This draws one feature per frame, fetched by id, rather than having
+    a rule or data defined style compare every feature of the layer with
+    @hover_feature_id on every frame. Geometries are cached after they
+    are transformed to the map CRS, as consecutive frames usually
+    highlight the same feature.
+    """
+
+    # Maximum number of geometries kept in the cache
+    CACHE_SIZE = 16
+
+    def __init__(
+        self,
+        feature_store: FeatureStore,
+        symbol: QgsSymbol,
+        layer_to_map_transform: QgsCoordinateTransform,
+    ):
+        """
+        :param feature_store: store of the animation layer's features
+        :param symbol: symbol to highlight features with
+        :param layer_to_map_transform: transform from the animation layer
+            CRS to the map CRS
+        """
+        self.feature_store = feature_store
+        self.symbol = symbol.clone()
+        self.transform = layer_to_map_transform
+        self.geometries: "OrderedDict[int, Optional[QgsGeometry]]" = OrderedDict()
+
+    def geometry(self, feature_id: int) -> Optional[QgsGeometry]:
+        """
+        Returns the geometry to highlight a feature, in the map CRS
+        """
+        if feature_id in self.geometries:
+            self.geometries.move_to_end(feature_id)
+            return self.geometries[feature_id]
+
+        feature = self.feature_store.feature(feature_id)
+        geometry = highlight_geometry(feature.geometry(), self.symbol)
+        if geometry is not None:
+            geometry = QgsGeometry(geometry)
+            try:
+                geometry.transform(self.transform)
+            except QgsCsException:
+                geometry = None
+
+        self.geometries[feature_id] = geometry
+        while len(self.geometries) > FeatureHighlighter.CACHE_SIZE:
+            self.geometries.popitem(last=False)
+        return geometry
+
+    def add_highlight(self, map_settings: QgsMapSettings, job: RenderJob):
+        """
+        Adds a decoration highlighting the frame's current feature to a
+        render job. Used as a deferred update, so the feature is only
+        fetched when the frame is rendered.
+
+        The current feature is the hovered feature, or the feature being
+        travelled to on travel frames.
+        """
+        context = map_settings.expressionContext()
+        feature_id = None
+        for variable in ("hover_feature_id", "to_feature_id"):
+            if context.hasVariable(variable):
+                feature_id = context.variable(variable)
+            if feature_id is not None:
+                break
+        if feature_id is None:
+            return
+        geometry = self.geometry(feature_id)
+        if geometry is not None:
+            job.decorations.append(HighlightDecoration(geometry, self.symbol))
@@ -0,0 +1,116 @@
+# coding=utf-8
+
+"""Per-frame culling of layers which cannot contribute to a frame."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+from typing import List, Optional
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsMapLayer,
+    QgsMapSettings,
+    QgsProject,
+    QgsRectangle,
+)
+
+
+class LayerCullingIndex:
+    """
+    Index of layer extents and visibility scale ranges, used to pass only
+    the layers which can contribute to a frame to its render job.
+
+    Layer extents are transformed to the destination CRS once, when the
+    index is built. Layers without a usable extent (e.g. web services, or
+    extents which cannot be transformed) are never culled.
+    """
+
+    # Frame extents are grown by this fraction before testing them against
+    # layer extents, so that symbols and labels of features just outside
+    # the frame are still drawn
+    EXTENT_BUFFER = 0.1
+
+    def __init__(
+        self,
+        layers: List[QgsMapLayer],
+        destination_crs: QgsCoordinateReferenceSystem,
+    ):
+        self.destination_crs = destination_crs
+        self.layers: List[QgsMapLayer] = list(layers)
+        # Extent of each layer in the destination CRS, in layer order, or
+        # None if the layer is never culled by extent
+        self.extents: List[Optional[QgsRectangle]] = [
+            self.destination_extent(layer) for layer in self.layers
+        ]
+
+    def destination_extent(self, layer: QgsMapLayer) -> Optional[QgsRectangle]:
+        """
+        Returns the extent of a layer in the destination CRS, or None if
+        it is unknown
+        """
+        extent = layer.extent()
+        # extents of single points and straight lines have no width or no
+        # height, but can still be tested against frame extents
+        if not self.is_usable(extent):
+            return None
+        if not layer.crs().isValid() or layer.crs() == self.destination_crs:
+            return QgsRectangle(extent)
+        try:
+            transformed = QgsCoordinateTransform(
+                layer.crs(), self.destination_crs, QgsProject.instance()
+            ).transformBoundingBox(extent)
+        except QgsCsException:
+            return None
+        if not self.is_usable(transformed):
+            return None
+        return transformed
+
+    @staticmethod
+    def is_usable(extent: QgsRectangle) -> bool:
+        """
+        Returns True if an extent can be tested against frame extents
+        """
+        return (
+            not extent.isNull()
+            and extent.isFinite()
+            and extent.width() >= 0
+            and extent.height() >= 0
+        )
+
+    def visible_layers(self, map_settings: QgsMapSettings) -> List[QgsMapLayer]:
+        """
+        Returns the layers which can contribute to a frame, in render order
+        """
+        if map_settings.destinationCrs() != self.destination_crs:
+            # the CRS changes per frame (e.g. sphere animations), so the
+            # indexed extents do not apply
+            return self.layers
+
+        frame_extent = map_settings.visibleExtent()
+        frame_extent = frame_extent.buffered(
+            max(frame_extent.width(), frame_extent.height())
+            * LayerCullingIndex.EXTENT_BUFFER
+        )
+        scale = map_settings.scale()
+        return [
+            layer
+            for layer, extent in zip(self.layers, self.extents)
+            if layer.isInScaleRange(scale)
+            and (extent is None or extent.intersects(frame_extent))
+        ]
@@ -0,0 +1,436 @@
+# coding=utf-8
+
+"""Per-layer render time profiling of animation frames."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import csv
+import os
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, TypeVar
+
+from qgis.PyQt.QtCore import pyqtSignal
+from qgis.PyQt.QtGui import QPainter
+from qgis.core import (
+    QgsMapDecoration,
+    QgsMapLayer,
+    QgsMapSettings,
+    QgsRenderContext,
+    QgsTask,
+)
+
+from .filtered_renderer import create_frame_image, prepare_render_job
+from .render_queue import RenderJob
+from .sprite_renderer import SpriteFrame
+
+T = TypeVar("T")
+
+# Action reported for frames which have no current_animation_action,
+# e.g. fixed extent animations without a feature layer
+NO_ACTION = "Static"
+
+
+def sample_evenly(items: List[T], count: int) -> List[T]:
+    """
+    Returns up to count items, evenly spaced through a list
+
+    :param items: items to sample from
+    :param count: maximum number of items to return. If zero or larger
+        than the number of items, all items are returned.
+    """
+    return [items[index] for index in sample_indices(len(items), count)]
+
+
+def sample_indices(total: int, count: int) -> List[int]:
+    """
+    Returns up to count indices, evenly spaced through a number of items
+
+    :param total: number of items to sample from
+    :param count: maximum number of indices to return. If zero or larger
+        than the number of items, all indices are returned.
+    """
+    if count <= 0 or count >= total:
+        return list(range(total))
+    step = total / count
+    return [int(i * step) for i in range(count)]
+
+
+def sample_evenly_from(items: Iterable[T], total: int, count: int) -> List[T]:
+    """
+    Returns up to count items, evenly spaced through an iterable of a known
+    length, without keeping the other items. Iteration stops after the
+    last sampled item.
+
+    :param items: items to sample from
+    :param total: number of items the iterable yields
+    :param count: maximum number of items to return
+    """
+    indices = sample_indices(total, count)
+    if not indices:
+        return []
+    wanted = set(indices)
+    sampled = []
+    for index, item in enumerate(items):
+        if index in wanted:
+            sampled.append(item)
+        if index >= indices[-1]:
+            break
+    return sampled
+
+
+class PreparedRender:
+    """
+    A render of one layer of a frame, prepared on the main thread so that
+    it can be timed on another thread
+    """
+
+    def __init__(
+        self, layer_id: str, name: str, action: str, map_settings: QgsMapSettings
+    ):
+        self.layer_id = layer_id
+        self.name = name
+        self.action = action
+        self.map_settings = map_settings
+        self.image = create_frame_image(map_settings)
+        self.image.fill(0)
+        self.painter = QPainter(self.image)
+        # Time spent preparing the render on the main thread, in seconds
+        self.prepare_time: float = 0
+
+    def draw(self):
+        """
+        Draws the layer with the painter
+        """
+        raise NotImplementedError
+
+    def render(self) -> float:
+        """
+        Draws the layer, returning the elapsed time in seconds including
+        the time spent preparing it
+        """
+        start = time.perf_counter()
+        try:
+            self.draw()
+        finally:
+            self.end()
+        return self.prepare_time + time.perf_counter() - start
+
+    def end(self):
+        """
+        Ends painting, if the render was not drawn
+        """
+        if self.painter.isActive():
+            self.painter.end()
+
+
+class LayerRender(PreparedRender):
+    """
+    A render of a map layer, restricted to the same features as when
+    the frame is exported
+    """
+
+    def __init__(
+        self,
+        layer: QgsMapLayer,
+        action: str,
+        map_settings: QgsMapSettings,
+        feature_ids: Dict[str, Sequence[int]],
+    ):
+        settings = QgsMapSettings(map_settings)
+        settings.setLayers([layer])
+        super().__init__(layer.id(), layer.name(), action, settings)
+        # layers created for the frame are only referenced by the render
+        self.layer = layer
+        start = time.perf_counter()
+        self.render_job = prepare_render_job(settings, self.painter, feature_ids)
+        self.prepare_time = time.perf_counter() - start
+
+    def draw(self):
+        """
+        Completes the prepared render job
+        """
+        self.render_job.renderPrepared()
+
+
+class SpriteRender(PreparedRender):
+    """
+    A frame's sprites drawn over its prerendered background, which
+    replaces rendering its layers
+    """
+
+    def __init__(self, sprites: SpriteFrame, action: str, map_settings: QgsMapSettings):
+        compositor = sprites.compositor
+        super().__init__(
+            compositor.layer.id(), compositor.layer.name(), action, map_settings
+        )
+        # the background is rendered once for all frames, so is not timed
+        compositor.prepare(map_settings)
+        self.compositor = compositor
+        start = time.perf_counter()
+        self.placements = compositor.placements(sprites.frame, map_settings)
+        self.prepare_time = time.perf_counter() - start
+
+    def draw(self):
+        """
+        Draws the background and the sprites of the frame
+        """
+        self.compositor.draw(self.painter, self.placements)
+
+
+class DecorationRender(PreparedRender):
+    """
+    The decorations drawn over a frame only, e.g. feature highlights
+    """
+
+    # Id and name the decorations are reported with
+    LAYER_ID = "frame_decorations"
+    NAME = "Frame decorations"
+
+    def __init__(
+        self,
+        decorations: List[QgsMapDecoration],
+        action: str,
+        map_settings: QgsMapSettings,
+    ):
+        super().__init__(
+            DecorationRender.LAYER_ID, DecorationRender.NAME, action, map_settings
+        )
+        self.decorations = decorations
+
+    def draw(self):
+        """
+        Draws the decorations
+        """
+        context = QgsRenderContext.fromMapSettings(self.map_settings)
+        context.setPainter(self.painter)
+        for decoration in self.decorations:
+            decoration.render(self.map_settings, context)
+
+
+class LayerRenderProfiler:
+    """
+    Measures how long each map layer takes to render in a set of frames,
+    aggregated per layer and per animation action (hovering or travelling).
+
+    Each layer of a frame is rendered on its own, in the frame's map
+    settings. The total is therefore slightly more than the full frame
+    render time (labeling and compositing are repeated per layer), but it
+    reliably shows which layers dominate the frame time.
+
+    Frames are rendered as they are exported: layers are restricted to the
+    frame's feature ids, layers created for the frame are included, frames
+    drawn with sprites time drawing the sprites instead of their layers,
+    and the frame's own decorations are timed together.
+    """
+
+    def __init__(self):
+        self.layer_names: Dict[str, str] = {}
+        # Render times in seconds, by layer id, then action
+        self.times: Dict[str, Dict[str, List[float]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        self.frame_count: int = 0
+
+    @staticmethod
+    def job_action(job: RenderJob) -> str:
+        """
+        Returns the animation action of a render job
+        """
+        context = job.map_settings.expressionContext()
+        action = context.variable("current_animation_action")
+        return action or NO_ACTION
+
+    @staticmethod
+    def prepare_job(job: RenderJob) -> List[PreparedRender]:
+        """
+        Prepares the render of each layer of a render job. This must be
+        called on the main thread.
+        """
+        action = LayerRenderProfiler.job_action(job)
+        map_settings = job.map_settings
+        if job.sprites:
+            renders = [SpriteRender(job.sprites, action, map_settings)]
+        else:
+            created_layers = [create() for create in job.layer_factories]
+            renders = [
+                LayerRender(layer, action, map_settings, job.feature_ids)
+                for layer in created_layers + map_settings.layers()
+            ]
+        if job.decorations:
+            renders.append(DecorationRender(job.decorations, action, map_settings))
+        return renders
+
+    def record(self, render: PreparedRender):
+        """
+        Draws a prepared render and records its render time
+        """
+        self.layer_names[render.layer_id] = render.name
+        self.times[render.layer_id][render.action].append(render.render())
+
+    def profile_job(self, job: RenderJob):
+        """
+        Profiles the render time of each layer in a render job, on the
+        main thread
+        """
+        for render in self.prepare_job(job):
+            self.record(render)
+        self.frame_count += 1
+
+    def report(self) -> List[dict]:
+        """
+        Returns the per-layer timings, sorted from slowest to fastest layer
+        """
+        totals = {
+            layer_id: sum(sum(times) for times in actions.values())
+            for layer_id, actions in self.times.items()
+        }
+        overall = sum(totals.values())
+
+        result = []
+        for layer_id in sorted(totals, key=totals.get, reverse=True):
+            actions = self.times[layer_id]
+            frames = sum(len(times) for times in actions.values())
+            result.append(
+                {
+                    "layer_id": layer_id,
+                    "layer": self.layer_names[layer_id],
+                    "frames": frames,
+                    "total_time": totals[layer_id],
+                    "mean_time": totals[layer_id] / frames if frames else None,
+                    "share": totals[layer_id] / overall if overall else None,
+                    "mean_time_by_action": {
+                        action: sum(times) / len(times)
+                        for action, times in sorted(actions.items())
+                    },
+                }
+            )
+        return result
+
+    def report_text(self) -> str:
+        """
+        Returns the per-layer timings as human readable text
+        """
+        lines = [f"Layer render times ({self.frame_count} frames profiled):"]
+        for row in self.report():
+            by_action = ", ".join(
+                f"{action}: {mean * 1000:.0f}ms"
+                for action, mean in row["mean_time_by_action"].items()
+            )
+            lines.append(
+                "  {:>5.1%}  {:>7.0f}ms/frame  {}  ({})".format(
+                    row["share"] or 0,
+                    (row["mean_time"] or 0) * 1000,
+                    row["layer"],
+                    by_action,
+                )
+            )
+        return "\n".join(lines)
+
+    def export(self, directory: str, prefix: str) -> List[str]:
+        """
+        Writes the per-layer timings to "<prefix>-layer-timings.csv"
+
+        :returns: list of written file paths
+        """
+        csv_path = os.path.join(directory, f"{prefix}-layer-timings.csv")
+        report = self.report()
+        actions = sorted({a for row in report for a in row["mean_time_by_action"]})
+        with open(csv_path, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(
+                ["layer_id", "layer", "frames", "total_time", "mean_time", "share"]
+                + [f"mean_time_{action.lower()}" for action in actions]
+            )
+            for row in report:
+                writer.writerow(
+                    [
+                        row["layer_id"],
+                        row["layer"],
+                        row["frames"],
+                        row["total_time"],
+                        row["mean_time"],
+                        row["share"],
+                    ]
+                    + [row["mean_time_by_action"].get(action) for action in actions]
+                )
+        return [csv_path]
+
+
+class LayerProfilingTask(QgsTask):
+    """
+    Profiles the per-layer render times of a set of frames in background
+    tasks
+
+    Like QgsMapRendererTask, the renders are prepared on the main thread
+    when the task is created. Each task only profiles the first of its
+    frames, so that the prepared images of every frame are not held at
+    once. When it completes, next_task() returns the task profiling the
+    remaining frames, which continues with the same profiler.
+    """
+
+    message = pyqtSignal(str)
+    # Sends the completed profiler
+    profiling_completed = pyqtSignal(object)
+
+    def __init__(
+        self,
+        jobs: Iterable[RenderJob],
+        profiler: Optional[LayerRenderProfiler] = None,
+    ):
+        super().__init__("Profiling layer render times", QgsTask.Flag.CanCancel)
+        self.jobs: List[RenderJob] = list(jobs)
+        self.profiler = profiler or LayerRenderProfiler()
+        self.total_frames = self.profiler.frame_count + len(self.jobs)
+        self.renders: List[PreparedRender] = (
+            LayerRenderProfiler.prepare_job(self.jobs[0]) if self.jobs else []
+        )
+
+    def next_task(self) -> Optional["LayerProfilingTask"]:
+        """
+        Returns a task profiling the remaining frames, or None if this was
+        the last frame. This must be called on the main thread.
+        """
+        if len(self.jobs) <= 1:
+            return None
+        return LayerProfilingTask(self.jobs[1:], self.profiler)
+
+    def run(self):
+        """
+        Profiles each layer of the frame in turn
+        """
+        for i, render in enumerate(self.renders):
+            if self.isCanceled():
+                return False
+            self.profiler.record(render)
+            self.setProgress(
+                100
+                * (self.profiler.frame_count + (i + 1) / len(self.renders))
+                / self.total_frames
+            )
+        if self.jobs:
+            self.profiler.frame_count += 1
+        return True
+
+    def finished(self, result: bool):  # pylint: disable=missing-function-docstring
+        for render in self.renders:
+            render.end()
+        self.renders = []
+        if not result:
+            self.message.emit("Layer profiling was canceled")
+        elif len(self.jobs) <= 1:
+            self.profiling_completed.emit(self.profiler)
@@ -0,0 +1,276 @@
+# coding=utf-8
+
+"""Prometheus metrics exporter for unattended render hosts."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from .render_metrics import RenderMetrics
+from .settings import setting
+from .utilities import memory_usage
+
+# Prefix for the names of all exported metrics
+METRIC_PREFIX = "animation_workbench"
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsExporter:
+    """
+    Exposes the render queue and movie encoder state as Prometheus metrics.
+
+    Metrics can be served over HTTP on localhost (scraped from
+    http://127.0.0.1:<port>/metrics), and/or written to a file for the
+    node_exporter textfile collector on hosts without an open port.
+    Both outputs are opt-in via the workbench settings.
+    """
+
+    # Minimum number of seconds between rewrites of the metrics textfile
+    TEXTFILE_INTERVAL = 5
+
+    def __init__(
+        self,
+        render_queue,
+        port: Optional[int] = None,
+        textfile_path: Optional[str] = None,
+    ):
+        """
+        :param render_queue: render queue to report on
+        :type render_queue: RenderQueue
+
+        :param port: localhost port to serve metrics on, or None to read
+            it from the settings. The endpoint is disabled if no port is
+            set or enabled.
+        :type port: int
+
+        :param textfile_path: path of the textfile collector output, or
+            None to read it from the settings. An empty path disables
+            the textfile output.
+        :type textfile_path: str
+        """
+        self.render_queue = render_queue
+        if port is None and int(setting(key="metrics_endpoint", default=0)):
+            port = int(setting(key="metrics_port", default=9464))
+        if textfile_path is None:
+            textfile_path = setting(key="metrics_textfile", default="")
+        self.port: Optional[int] = port
+        self.textfile_path: str = textfile_path or ""
+
+        self.encoded_frames: int = 0
+        self.encode_fps: float = 0
+        self.last_textfile_write: float = 0
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._server_thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Returns True if any metrics output is enabled
+        """
+        return bool(self.port or self.textfile_path)
+
+    def start(self):
+        """
+        Starts serving metrics, if enabled. Does nothing if already started.
+        """
+        if self.textfile_path:
+            self.render_queue.status_changed.connect(self.update_textfile)
+
+        if not self.port or self._server is not None:
+            return
+
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Serves the metrics page
+            """
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """
+                Handles a scrape request
+                """
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                # scrapes are frequent, don't spam stderr
+                pass
+
+        # Only ever bound to the loopback interface
+        self._server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self._server.daemon_threads = True
+        self._server_thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics-exporter", daemon=True
+        )
+        self._server_thread.start()
+
+    def stop(self):
+        """
+        Stops serving metrics, writing a final textfile if enabled
+        """
+        if self.textfile_path:
+            try:
+                self.render_queue.status_changed.disconnect(self.update_textfile)
+            except TypeError:
+                # not connected
+                pass
+            self.write_textfile()
+
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            self._server_thread = None
+
+    def set_encode_progress(self, encoded_frames: int, fps: float):
+        """
+        Records the movie encoder progress
+        """
+        self.encoded_frames = encoded_frames
+        self.encode_fps = fps
+
+    def update_textfile(self):
+        """
+        Rewrites the textfile, throttled to TEXTFILE_INTERVAL
+        """
+        now = time.time()
+        if now - self.last_textfile_write < MetricsExporter.TEXTFILE_INTERVAL:
+            return
+        self.write_textfile()
+
+    def write_textfile(self):
+        """
+        Writes the metrics to the textfile collector path.
+
+        The file is written to a temporary file and then moved into place,
+        so that the collector never reads a partially written file.
+        """
+        if not self.textfile_path:
+            return
+        self.last_textfile_write = time.time()
+        temp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as textfile:
+                textfile.write(self.render())
+            os.replace(temp_path, self.textfile_path)
+        except OSError:
+            # monitoring must never break an export
+            pass
+
+    def render(self) -> str:
+        """
+        Returns the current metrics in the Prometheus text exposition format
+        """
+        queue = self.render_queue
+        metrics: RenderMetrics = queue.metrics
+        lines: List[str] = []
+
+        def add(name: str, metric_type: str, help_text: str, value):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            lines.append(f"{METRIC_PREFIX}_{name} {value}")
+
+        add(
+            "queue_depth",
+            "gauge",
+            "Number of frames waiting to be dispatched to a render task",
+            len(queue.job_queue),
+        )
+        add(
+            "in_flight_tasks",
+            "gauge",
+            "Number of frames currently being rendered",
+            queue.active_queue_size(),
+        )
+        add(
+            "frames",
+            "gauge",
+            "Total number of frames in the current export",
+            queue.total_queue_size,
+        )
+        add(
+            "frames_completed_total",
+            "counter",
+            "Number of frames successfully rendered",
+            metrics.frames_completed,
+        )
+        add(
+            "frames_failed_total",
+            "counter",
+            "Number of frames which failed to render or were canceled",
+            metrics.frames_failed,
+        )
+        add(
+            "written_bytes_total",
+            "counter",
+            "Total size of the rendered frame images",
+            metrics.bytes_written,
+        )
+
+        name = f"{METRIC_PREFIX}_frame_render_seconds"
+        lines.append(f"# HELP {name} Time taken to render each frame")
+        lines.append(f"# TYPE {name} histogram")
+        cumulative = 0
+        for bound, count in zip(
+            RenderMetrics.RENDER_TIME_BUCKETS, metrics.render_time_counts
+        ):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += metrics.render_time_counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_sum {metrics.render_time_sum}")
+        lines.append(f"{name}_count {cumulative}")
+
+        add(
+            "render_frames_per_second",
+            "gauge",
+            "Render throughput over the most recently completed frames",
+            metrics.rolling_frames_per_second() or 0,
+        )
+        add(
+            "encoded_frames",
+            "gauge",
+            "Number of frames encoded by the movie encoder",
+            self.encoded_frames,
+        )
+        add(
+            "encode_frames_per_second",
+            "gauge",
+            "Movie encoder throughput",
+            self.encode_fps,
+        )
+        add(
+            "resident_memory_bytes",
+            "gauge",
+            "Resident memory used by the QGIS process",
+            memory_usage() or 0,
+        )
+
+        return "\n".join(lines) + "\n"
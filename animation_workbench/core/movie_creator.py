@@ -6,14 +6,24 @@ __license__ = "GPL version 3"
 __email__ = "tim@kartoza.com"
 __revision__ = "$Format:%H$"
 
+import io
+import math
 import os
+import re
+import subprocess
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from qgis.PyQt.QtCore import pyqtSignal, QProcess
+from qgis.PyQt.QtGui import QImageReader
 from qgis.core import QgsTask, QgsBlockingProcess, QgsFeedback
+from .frame_stream import OrderedFrameStream, frame_file_names
+from .profiling import StageProfiler
 from .settings import setting
+from .trace_recorder import TraceRecorder
 from .utilities import CoreUtils
 
 
@@ -26,34 +36,124 @@ class MovieFormat(Enum):
     MP4 = 1
 
 
+# Number of cores a single libx264 process keeps busy
+ENCODER_CORES = 6
+# Frames smaller than this (in pixels) encode faster than they render, so
+# their encode is never split
+MIN_SEGMENTED_FRAME_SIZE = 1280 * 720
+# Minimum number of groups of pictures in each segment, so that the cost
+# of starting an encoder is small compared to the segment
+MIN_SEGMENT_GOPS = 5
+
+
+def automatic_segment_count(
+    frame_count: int,
+    gop_size: int,
+    width: int,
+    height: int,
+    cores: Optional[int] = None,
+) -> int:
+    """
+    Returns the number of segments to encode a frame sequence in, so that
+    the parallel encoders use the available cores
+
+    :param frame_count: number of frames to encode
+    :param gop_size: number of frames in each group of pictures
+    :param width: frame width in pixels
+    :param height: frame height in pixels
+    :param cores: number of cores, or None to use the CPU count
+    """
+    if width * height < MIN_SEGMENTED_FRAME_SIZE:
+        return 1
+    cores = cores or os.cpu_count() or 1
+    count = cores // ENCODER_CORES
+    return max(1, min(count, frame_count // (gop_size * MIN_SEGMENT_GOPS)))
+
+
 class MovieCommandGenerator:
     """
     Generates the command line strings for movie creation
     """
 
+    # Length of the groups of pictures of segmented encodes, in seconds
+    GOP_SECONDS = 2
+
     def __init__(
         self,
         output_file: str,
         output_mode: str,
-        intro_command: Optional[tuple],
-        outro_command: Optional[tuple],
-        music_command: Optional[tuple],
+        intro_inputs: Optional[List[List[str]]],
+        outro_inputs: Optional[List[List[str]]],
+        music_inputs: Optional[List[List[str]]],
         output_format: MovieFormat,
         work_directory: str,
         frame_filename_prefix: str,
         framerate: int,
         temp_dir: str,
+        frames_from_pipe: bool = False,
+        segment_count: int = 1,
+        frame_count: int = 0,
+        first_frame: int = 0,
     ):
         self.output_file = output_file
         self.output_mode = output_mode
-        self.intro_command = intro_command
-        self.outro_command = outro_command
-        self.music_command = music_command
+        # ffmpeg input arguments of each intro, outro and music file
+        self.intro_inputs = intro_inputs or []
+        self.outro_inputs = outro_inputs or []
+        self.music_inputs = music_inputs or []
         self.format = output_format
         self.work_directory = work_directory
         self.frame_filename_prefix = frame_filename_prefix
         self.framerate = framerate
         self.temp_dir = temp_dir
+        # If True, the rendered frames are written to the standard input
+        # of the main encode, as they are rendered
+        self.frames_from_pipe = frames_from_pipe
+        # If more than one, the frames are encoded in this many segments
+        # of the frame_count frames from first_frame on, which are then
+        # joined with the intro and outro without encoding them again
+        self.segment_count = segment_count
+        self.frame_count = frame_count
+        self.first_frame = first_frame
+        # Files of the intro, the segments of the frames and the outro,
+        # which are encoded in parallel. Set by as_commands().
+        self.segment_files: List[str] = []
+
+    @property
+    def frames_input(self) -> str:
+        """
+        Returns the ffmpeg input pattern matching the rendered frames
+        """
+        if self.frames_from_pipe:
+            return "pipe:0"
+        # Assumes numbers of files are 10 digits
+        return f"{self.work_directory}/{self.frame_filename_prefix}-%010d.png"
+
+    @staticmethod
+    def gop_size(framerate: int) -> int:
+        """
+        Returns the number of frames in each group of pictures of a
+        segmented encode
+        """
+        return max(int(round(framerate * MovieCommandGenerator.GOP_SECONDS)), 1)
+
+    def segment_ranges(self) -> List[Tuple[int, int]]:
+        """
+        Returns the first frame and number of frames of each segment of
+        the main video. Segments start on group of pictures boundaries,
+        so the segments have the same key frames as a single encode.
+        """
+        if self.frames_from_pipe or self.segment_count < 2 or not self.frame_count:
+            return [(self.first_frame, self.frame_count)]
+        gop_size = self.gop_size(self.framerate)
+        gop_count = math.ceil(self.frame_count / gop_size)
+        count = min(self.segment_count, gop_count)
+        ranges = []
+        for index in range(count):
+            start = index * gop_count // count * gop_size
+            end = min((index + 1) * gop_count // count * gop_size, self.frame_count)
+            ranges.append((self.first_frame + start, end - start))
+        return ranges
 
     def as_commands(self) -> List[Tuple[str, List]]:  # pylint: disable= R0915
         """
@@ -114,138 +214,187 @@ class MovieCommandGenerator:
             )
         else:
             ffmpeg = CoreUtils.which("ffmpeg")[0]
-            # Also, we will make a video of the scene - useful for cases where
-            # you have a larger colour palette and gif will not hack it.
-            # The Pad option is to deal with cases where ffmpeg complains
-            # because the h or w of the image is an odd number of pixels.
-            # color=white pads the video with white pixels.
-            # Change to black if needed.
-            # -y to force overwrite exising file
-
-            # Generate the intro video, if any
-            intro_file = None
-            outro_file = None
-            music_file = None
-            if self.intro_command:
-                intro_file = str(os.path.join(self.temp_dir, "intro.mp4"))
-                self.intro_command.append(intro_file)
-                results.append((ffmpeg, self.intro_command))
-            # Generate the outro video, if any
-            if self.outro_command:
-                outro_file = str(os.path.join(self.temp_dir, "outro.mp4"))
-                self.outro_command.append(outro_file)
-                results.append((ffmpeg, self.outro_command))
-            # Generate the sound track, if any
-            if self.music_command:
-                music_file = str(os.path.join(self.temp_dir, "music.mp3"))
-                self.music_command.append(music_file)
-                results.append((ffmpeg, self.music_command))
+            # The intro, the rendered frames, the outro and the soundtrack
+            # are combined by one filter graph, so every frame is only
+            # encoded once. If the frames are split into segments, each
+            # piece is encoded once and the pieces are joined by copying.
+            segment_ranges = self.segment_ranges()
+            if len(segment_ranges) > 1:
+                results += self.segment_commands(ffmpeg, segment_ranges)
+            else:
+                results.append((ffmpeg, self.single_pass_arguments()))
+        return results
+
+    @property
+    def normalize_filter(self) -> str:
+        """
+        Returns the filter bringing a video stream to the output size and
+        frame rate, so that streams can be concatenated
+        """
+        # The pad is to deal with cases where ffmpeg complains because
+        # the h or w of the image is an odd number of pixels.
+        # color=white pads the video with white pixels.
+        # Change to black if needed.
+        return (
+            f"scale={self.output_mode},pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,"
+            f"setsar=1:1,fps={self.framerate}"
+        )
 
+    def video_graph(self, count: int) -> str:
+        """
+        Returns a filter graph normalizing the video streams of the first
+        count inputs and concatenating them into the [video] output
+        """
+        filters = [
+            f"[{index}:v]{self.normalize_filter}[v{index}]" for index in range(count)
+        ]
+        labels = "".join(f"[v{index}]" for index in range(count))
+        filters.append(f"{labels}concat=n={count}:v=1:a=0[video]")
+        return ";".join(filters)
+
+    @staticmethod
+    def audio_graph(first_input: int, count: int) -> str:
+        """
+        Returns a filter graph concatenating the audio streams of count
+        inputs from first_input on into the [audio] output
+        """
+        labels = "".join(
+            f"[{index}:a]" for index in range(first_input, first_input + count)
+        )
+        return f"{labels}concat=n={count}:v=0:a=1[audio]"
+
+    def frames_input_arguments(self) -> List[str]:
+        """
+        Returns the input arguments reading the rendered frames
+        """
+        arguments = []
+        if self.frames_from_pipe:
+            arguments += ["-f", "image2pipe"]
+        return arguments + ["-framerate", str(self.framerate), "-i", self.frames_input]
+
+    def encode_arguments(self) -> List[str]:
+        """
+        Returns the output arguments encoding the video stream. Every
+        encode uses the same arguments, so their outputs can be joined
+        without encoding them again.
+        """
+        return ["-c:v", "libx264", "-pix_fmt", "yuv420p"]
+
+    def single_pass_arguments(self) -> List[str]:
+        """
+        Returns the arguments encoding the intro, the rendered frames and
+        the outro into the output file and adding the soundtrack, with a
+        single encode of every frame
+        """
+        arguments = ["-hide_banner", "-y"]
+        for media_input in self.intro_inputs:
+            arguments += media_input
+        arguments += self.frames_input_arguments()
+        for media_input in self.outro_inputs:
+            arguments += media_input
+        video_count = len(self.intro_inputs) + 1 + len(self.outro_inputs)
+        for media_input in self.music_inputs:
+            arguments += media_input
+
+        graph = self.video_graph(video_count)
+        if self.music_inputs:
+            graph += ";" + self.audio_graph(video_count, len(self.music_inputs))
+        arguments += ["-filter_complex", graph, "-map", "[video]"]
+        arguments += self.encode_arguments()
+        if self.music_inputs:
+            # will truncate output to shortest between vid and audio
+            arguments += ["-map", "[audio]", "-c:a", "aac", "-shortest"]
+        arguments.append(self.output_file)
+        return arguments
+
+    def segment_commands(
+        self, ffmpeg: str, segment_ranges: List[Tuple[int, int]]
+    ) -> List[Tuple[str, List]]:
+        """
+        Returns the commands encoding the intro, each segment of the
+        rendered frames and the outro as separate files with the same
+        encoding arguments, which can run in parallel, followed by the
+        command joining them into the output file with the soundtrack
+        """
+        results = []
+        output_arguments = self.encode_arguments() + [
+            "-g",
+            str(self.gop_size(self.framerate)),
+        ]
+        self.segment_files = []
+
+        def add_clip(media_inputs: List[List[str]], name: str):
+            clip_file = str(os.path.join(self.temp_dir, f"{name}.mp4"))
+            arguments = ["-hide_banner", "-y"]
+            for media_input in media_inputs:
+                arguments += media_input
+            arguments += [
+                "-filter_complex",
+                self.video_graph(len(media_inputs)),
+                "-map",
+                "[video]",
+            ]
+            self.segment_files.append(clip_file)
+            results.append((ffmpeg, arguments + output_arguments + [clip_file]))
+
+        if self.intro_inputs:
+            add_clip(self.intro_inputs, "intro")
+        for index, (start, length) in enumerate(segment_ranges):
+            segment_file = str(os.path.join(self.temp_dir, f"main-{index:03d}.mp4"))
+            self.segment_files.append(segment_file)
             arguments = [
                 "-hide_banner",
                 "-y",
                 "-framerate",
                 str(self.framerate),
+                "-start_number",
+                str(start),
                 "-i",
-                # Assumes numbers of files are 10 digits
-                f"{self.work_directory}/{self.frame_filename_prefix}-%010d.png",
+                self.frames_input,
                 "-vf",
-                "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white",
-                "-c:v",
-                "libx264",
-                "-pix_fmt",
-                "yuv420p",
+                self.normalize_filter,
             ]
-
-            main_file = str(os.path.join(self.temp_dir, "main.mp4"))
-            arguments.append(main_file)
-            # This will build the base video with no soundtrack
-            # in the above temporary folder
+            arguments += output_arguments + ["-frames:v", str(length), segment_file]
             results.append((ffmpeg, arguments))
-
-            # windows_command = ("""
-            #    %s -y -framerate %s -pattern_type sequence \
-            #    -start_number 0000000001 \
-            #    -i "%s/%s-%00000000010d.png" -vf \
-            #    "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white" \
-            #    -c:v libx264 -pix_fmt yuv420p %s""" % (
-            #    ffmpeg,
-            #    framerate,
-            #    self.work_directory,
-            #    self.frame_filename_prefix,
-            #    self.output_file))
-
-            # Second pass - now we add the intro and outro videos to the main
-            # video if they exist. See https://trac.ffmpeg.org/wiki/Concatenate
-            combined_file = None
-
-            if music_file:
-                # Write to a temporary file that we will add music to after
-                combined_file = str(os.path.join(self.temp_dir, "combined.mp4"))
-            else:
-                # Write to the final output file
-                combined_file = self.output_file
-
-            file_list_text = ""
-            if intro_file:
-                file_list_text += f"file {intro_file}\n"
-            file_list_text += f"file {main_file}\n"
-            if outro_file:
-                file_list_text += f"file {outro_file}\n"
-
-            file_list_path = str(os.path.join(self.temp_dir, "list.txt"))
-            with open(file_list_path, "w", encoding="utf-8") as file_list_file:
-                file_list_file.write(file_list_text)
-
-            arguments = [
-                "-y",
-                "-f",
-                "concat",
-                "-safe",
-                "0",
-                "-i",
-                file_list_path,
-                "-c",
-                "copy",
-                "-vf",
-                f"pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,scale={self.output_mode},setsar=1:1",
+        if self.outro_inputs:
+            add_clip(self.outro_inputs, "outro")
+
+        # See https://trac.ffmpeg.org/wiki/Concatenate
+        segment_list_path = str(os.path.join(self.temp_dir, "segments.txt"))
+        with open(segment_list_path, "w", encoding="utf-8") as segment_list_file:
+            for segment_file in self.segment_files:
+                segment_list_file.write(f"file {segment_file}\n")
+
+        arguments = [
+            "-hide_banner",
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            segment_list_path,
+        ]
+        for media_input in self.music_inputs:
+            arguments += media_input
+        if self.music_inputs:
+            arguments += [
+                "-filter_complex",
+                self.audio_graph(1, len(self.music_inputs)),
+                "-map",
+                "0:v",
+                "-map",
+                "[audio]",
                 "-c:v",
-                "libx264",
-                "-pix_fmt",
-                "yuv420p",
-                combined_file,
+                "copy",
+                "-c:a",
+                "aac",
+                "-shortest",
             ]
-
-            # This will build the base video with no soundtrack
-            # in the above temporary folder
-            results.append((ffmpeg, arguments))
-
-            # Third pass - now we add the soundtrack to the main video if it exists
-
-            # If there is a music file, we add the
-            # file into the video container. From my testing on the CLI,
-            # this works more smoothly and doesn't have issues like
-            # video blanking that doing it in the first pass does.
-            if music_file:
-                arguments = []
-                arguments.append("-y")
-                arguments.append("-i")
-                arguments.append(combined_file)
-                arguments.append("-i")
-                arguments.append(music_file)
-                arguments.append("-c")
-                # Will copy the sound into the video container
-                arguments.append("copy")
-                arguments.append("-map")
-                # Take the video from the first input (0)
-                arguments.append("0:v:0")
-                arguments.append("-map")
-                # And the audio from the second (1)
-                arguments.append("1:a:0")
-                # will truncate output to shortest between vid and audio
-                arguments.append("-shortest")
-                arguments.append(self.output_file)
-                results.append((ffmpeg, arguments))
+        else:
+            arguments += ["-c", "copy"]
+        arguments.append(self.output_file)
+        results.append((ffmpeg, arguments))
         return results
 
 
@@ -256,38 +405,95 @@ class MovieCreationTask(QgsTask):
 
     FORMAT_GIF = "FORMAT_GIF"
 
+    # Matches the progress lines ffmpeg writes while encoding
+    FFMPEG_PROGRESS_RE = re.compile(r"frame=\s*(\d+)\s+fps=\s*([\d.]+)")
+
     message = pyqtSignal(str)
     movie_created = pyqtSignal(str)
+    # Sends the number of frames encoded so far and the current encoding
+    # frames per second, while the rendered frames are being encoded
+    encode_progress = pyqtSignal(int, float)
 
     def __init__(
         self,
         output_file: str,
         output_mode: str,
-        intro_command: str,
-        outro_command: str,
-        music_command: str,
+        intro_inputs: Optional[List[List[str]]],
+        outro_inputs: Optional[List[List[str]]],
+        music_inputs: Optional[List[List[str]]],
         output_format: MovieFormat,
         work_directory: str,
         frame_filename_prefix: str,
         framerate: int,
+        total_frames: Optional[int] = None,
+        trace: Optional[TraceRecorder] = None,
+        frame_stream: Optional[OrderedFrameStream] = None,
+        segment_count: int = 1,
+        frame_count: int = 0,
     ):
         super().__init__("Exporting Movie", QgsTask.Flag.CanCancel)
 
         self.output_file = output_file
         self.output_mode = output_mode
-        self.intro_command = intro_command
-        self.outro_command = outro_command
-        self.music_command = music_command
+        self.intro_inputs = intro_inputs
+        self.outro_inputs = outro_inputs
+        self.music_inputs = music_inputs
         self.format = output_format
         self.work_directory = work_directory
         self.frame_filename_prefix = frame_filename_prefix
         self.framerate = framerate
+        # Number of rendered frames, used to report encoding progress
+        self.total_frames = total_frames
+        # Records each encoder subprocess, if trace export is enabled
+        self.trace = trace or TraceRecorder(enabled=False)
+        # If set, the frames are encoded from this stream while they are
+        # still being rendered, instead of from the files once they all
+        # exist
+        self.frame_stream = frame_stream
+        # Number of segments to encode the frames in parallel in, or 0 to
+        # choose from the number of cores and the frame size
+        self.segment_count = segment_count
+        # Number of frames of the animation, numbered from 0. Only these
+        # frames are split into segments, so frames left in the work
+        # directory by earlier, longer exports are not encoded with them.
+        self.frame_count = frame_count
+        # Frames encoded so far and encoding rate of each parallel segment
+        self.segment_progress: Dict[int, Tuple[int, float]] = {}
 
         self.feedback: Optional[QgsFeedback] = None
 
-    def run_process(self, command: str, arguments: List[str]):
+    def report_encode_progress(self, output: str, segment: Optional[int] = None):
+        """
+        Reports encoding progress from a line of ffmpeg output
+
+        :param segment: index of the segment encoded by the process, if
+            segments are encoded in parallel. Their progress is summed.
+        """
+        match = MovieCreationTask.FFMPEG_PROGRESS_RE.search(output)
+        if not match:
+            return
+        frames = int(match.group(1))
+        rate = float(match.group(2))
+        if segment is not None:
+            self.segment_progress[segment] = (frames, rate)
+            frames = sum(progress[0] for progress in self.segment_progress.values())
+            rate = sum(progress[1] for progress in self.segment_progress.values())
+        self.encode_progress.emit(frames, rate)
+        if self.total_frames:
+            self.setProgress(min(100.0, 100 * frames / self.total_frames))
+
+    def run_process(
+        self,
+        command: str,
+        arguments: List[str],
+        report_progress: bool = False,
+        segment: Optional[int] = None,
+    ):
         """
         Runs a process in a blocking way, reporting the stdout output to the user
+
+        If report_progress is True, ffmpeg progress output is parsed and
+        reported via the encode_progress signal.
         """
         self.message.emit(
             "Generating Movie: {} {}".format(command, " ".join(arguments))
@@ -311,6 +517,8 @@ class MovieCreationTask(QgsTask):
 
             if on_stderr.buffer.endswith("\n") or on_stderr.buffer.endswith("\r"):
                 # flush buffer
+                if report_progress:
+                    self.report_encode_progress(on_stderr.buffer, segment)
                 self.message.emit(on_stderr.buffer.rstrip())
                 on_stderr.buffer = ""
 
@@ -336,6 +544,131 @@ class MovieCreationTask(QgsTask):
         else:
             self.message.emit("Process returned error code {}".format(res))
 
+    def run_segment_processes(self, commands: List[Tuple[str, List[str]]]):
+        """
+        Runs the encoders of the segments of the main video in parallel,
+        returning once they have all finished
+        """
+        self.segment_progress = {}
+
+        def run_segment(segment: int, command: str, arguments: List[str]):
+            with self.trace.span(
+                os.path.basename(command),
+                "encode",
+                f"{TraceRecorder.ENCODER_LANE} {segment + 1}",
+                {"arguments": " ".join(arguments)},
+            ):
+                self.run_process(
+                    command, arguments, report_progress=True, segment=segment
+                )
+
+        with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+            futures = [
+                executor.submit(run_segment, segment, command, arguments)
+                for segment, (command, arguments) in enumerate(commands)
+            ]
+            for future in futures:
+                future.result()
+
+    def plan_segments(self) -> Tuple[int, int, int]:
+        """
+        Returns the number of segments to encode the rendered frames in,
+        the number of frames and the number of the first frame
+        """
+        frame_files = frame_file_names(
+            self.work_directory, self.frame_filename_prefix, self.frame_count
+        )
+        if self.segment_count == 1 or not frame_files:
+            return 1, len(frame_files), 0
+        if not all(os.path.exists(frame_file) for frame_file in frame_files):
+            # segments are read by frame number, so a missing frame would
+            # shift the frames of every later segment
+            self.message.emit(
+                "Some frames are missing, so the movie is encoded in a "
+                "single segment"
+            )
+            return 1, len(frame_files), 0
+        first_frame = 0
+        segment_count = self.segment_count
+        if not segment_count:
+            size = QImageReader(frame_files[0]).size()
+            segment_count = automatic_segment_count(
+                len(frame_files),
+                MovieCommandGenerator.gop_size(self.framerate),
+                size.width(),
+                size.height(),
+            )
+        return segment_count, len(frame_files), first_frame
+
+    def run_piped_process(self, command: str, arguments: List[str]):
+        """
+        Runs an encoder process, writing the frames of the frame stream to
+        its standard input as they are released, and reporting its
+        progress and output to the user
+        """
+        self.message.emit(
+            "Generating Movie: {} {}".format(command, " ".join(arguments))
+        )
+        try:
+            # QgsBlockingProcess cannot write to the standard input
+            process = subprocess.Popen(  # pylint: disable=consider-using-with
+                [command] + arguments,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        except OSError:
+            self.message.emit(
+                f"Process {command} failed to start. Either {command} "
+                "is missing, or you may have insufficient permissions to "
+                "run the program."
+            )
+            self.frame_stream.cancel()
+            return
+
+        def read_stderr():
+            # ffmpeg ends progress lines with a carriage return
+            for line in io.TextIOWrapper(
+                process.stderr, encoding="utf-8", errors="replace", newline=""
+            ):
+                self.report_encode_progress(line)
+                self.message.emit(line.rstrip())
+
+        reader = threading.Thread(target=read_stderr, daemon=True)
+        reader.start()
+
+        encoded = 0
+        for file_name in self.frame_stream.frames(self.feedback.isCanceled):
+            try:
+                with open(file_name, "rb") as frame_file:
+                    process.stdin.write(frame_file.read())
+            except BrokenPipeError:
+                break
+            except OSError as e:
+                self.message.emit(f"Could not encode {file_name}: {e}")
+                continue
+            self.frame_stream.consumed(file_name)
+            encoded += 1
+
+        if self.feedback.isCanceled():
+            process.kill()
+        else:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        res = process.wait()
+        reader.join()
+
+        if self.feedback.isCanceled():
+            self.message.emit("Process was canceled and did not complete")
+        elif res == 0:
+            self.message.emit(
+                f"Process completed successfully, encoding {encoded} frames"
+            )
+        else:
+            self.message.emit("Process returned error code {}".format(res))
+
     def run(self):
         """
         Creates a movie in a background task
@@ -360,21 +693,65 @@ class MovieCreationTask(QgsTask):
             # This way we can inspect the intermediate outputs if needed
             if debug_mode:
                 tmp = "/tmp"
+            segment_count, frame_count, first_frame = (
+                self.plan_segments()
+                if self.format == MovieFormat.MP4 and not self.frame_stream
+                else (1, 0, 0)
+            )
+            if segment_count > 1:
+                self.message.emit(
+                    f"Encoding {frame_count} frames in {segment_count} segments"
+                )
             generator = MovieCommandGenerator(
                 output_file=self.output_file,
                 output_mode=self.output_mode,
-                intro_command=self.intro_command,
-                outro_command=self.outro_command,
-                music_command=self.music_command,
+                intro_inputs=self.intro_inputs,
+                outro_inputs=self.outro_inputs,
+                music_inputs=self.music_inputs,
                 output_format=self.format,
                 work_directory=self.work_directory,
                 frame_filename_prefix=self.frame_filename_prefix,
                 framerate=self.framerate,
                 temp_dir=tmp,
+                frames_from_pipe=self.frame_stream is not None,
+                segment_count=segment_count,
+                frame_count=frame_count,
+                first_frame=first_frame,
             )
 
-            for command, arguments in generator.as_commands():
-                self.run_process(command, arguments)
+            profiler = StageProfiler("movie_creation")
+            with profiler:
+                commands = generator.as_commands()
+                segment_commands = [
+                    (command, arguments)
+                    for command, arguments in commands
+                    if arguments[-1] in generator.segment_files
+                ]
+                for command, arguments in commands:
+                    if arguments[-1] in generator.segment_files:
+                        # the segments are run together, at the first
+                        if arguments[-1] == generator.segment_files[0]:
+                            self.run_segment_processes(segment_commands)
+                        continue
+                    with self.trace.span(
+                        os.path.basename(command),
+                        "encode",
+                        TraceRecorder.ENCODER_LANE,
+                        {"arguments": " ".join(arguments)},
+                    ):
+                        if self.frame_stream and generator.frames_input in arguments:
+                            self.run_piped_process(command, arguments)
+                        else:
+                            self.run_process(
+                                command,
+                                arguments,
+                                report_progress=generator.frames_input in arguments,
+                            )
+
+        for profile_file in profiler.write(
+            self.work_directory, self.frame_filename_prefix
+        ):
+            self.message.emit(f"Profile written to: {profile_file}")
 
         self.movie_created.emit(self.output_file)
         self.feedback = None
@@ -383,5 +760,7 @@ class MovieCreationTask(QgsTask):
     def cancel(self):  # pylint: disable=missing-function-docstring
         if self.feedback is not None:
             self.feedback.cancel()
+        if self.frame_stream is not None:
+            self.frame_stream.cancel()
 
         super().cancel()
@@ -0,0 +1,178 @@
+# coding=utf-8
+
+"""Optional profiling of the animation export stages."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import cProfile
+import os
+import threading
+import tracemalloc
+import weakref
+from typing import List, Optional
+
+from .settings import setting
+
+
+class StageProfiler:
+    """
+    Runs cProfile, and optionally tracemalloc, around a named export stage.
+
+    Profiling is only performed when enabled in the workbench settings
+    (the "profiling_mode" and "profile_memory" keys), so stages can always
+    be wrapped in a profiler at negligible cost.
+
+    A stage may be entered many times (e.g. each time the render queue
+    dispatches tasks) and the results accumulate until write() is called.
+    Nested entries are counted, so only the outermost one toggles the
+    profiler.
+
+    Memory tracing is shared by all profilers, so tracemalloc is only
+    stopped once every profiler tracing memory has been written (or
+    discarded without being written), and never if it was already
+    tracing before profiling started.
+    """
+
+    # Profilers tracing memory which have not been written yet. Profilers
+    # which are discarded without being written drop out when collected.
+    _tracing_profilers: "weakref.WeakSet[StageProfiler]" = weakref.WeakSet()
+    # True if tracemalloc was started by the profilers
+    _started_tracing = False
+    # Stages may be profiled on task threads
+    _tracing_lock = threading.Lock()
+
+    def __init__(
+        self,
+        stage: str,
+        enabled: Optional[bool] = None,
+        trace_memory: Optional[bool] = None,
+    ):
+        self.stage: str = stage
+        if enabled is None:
+            enabled = bool(int(setting(key="profiling_mode", default=0)))
+        if trace_memory is None:
+            trace_memory = bool(int(setting(key="profile_memory", default=0)))
+        self.enabled: bool = enabled
+        self.trace_memory: bool = enabled and trace_memory
+
+        self.profiler: Optional[cProfile.Profile] = (
+            cProfile.Profile() if enabled else None
+        )
+        self._depth = 0
+        self._profiling = False
+
+    def __enter__(self) -> "StageProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """
+        Starts (or resumes) profiling the stage
+        """
+        if not self.enabled:
+            return
+
+        self._depth += 1
+        if self._depth > 1:
+            return
+
+        if self.trace_memory:
+            self.start_tracing()
+
+        try:
+            self.profiler.enable()
+            self._profiling = True
+        except ValueError:
+            # another profiler is already active on this thread
+            self._profiling = False
+
+    def start_tracing(self):
+        """
+        Starts tracing memory allocations, unless another profiler or the
+        user is already tracing them
+        """
+        with StageProfiler._tracing_lock:
+            if self in StageProfiler._tracing_profilers:
+                return
+            if not StageProfiler._tracing_profilers and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                StageProfiler._started_tracing = True
+            StageProfiler._tracing_profilers.add(self)
+
+    def stop_tracing(self):
+        """
+        Stops tracing memory allocations for this profiler, stopping
+        tracemalloc once no profiler needs it
+        """
+        with StageProfiler._tracing_lock:
+            StageProfiler._tracing_profilers.discard(self)
+            if StageProfiler._tracing_profilers or not StageProfiler._started_tracing:
+                return
+            StageProfiler._started_tracing = False
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def stop(self):
+        """
+        Pauses profiling the stage
+        """
+        if not self.enabled or self._depth == 0:
+            return
+
+        self._depth -= 1
+        if self._depth > 0:
+            return
+
+        if self._profiling:
+            self.profiler.disable()
+            self._profiling = False
+
+    def write(self, directory: str, prefix: str) -> List[str]:
+        """
+        Writes the collected profile to the given directory.
+
+        The cProfile statistics are written to "<prefix>-<stage>.pstats"
+        (readable with the pstats module or tools such as snakeviz), and
+        a memory snapshot taken now to "<prefix>-<stage>.tracemalloc"
+        (readable with tracemalloc.Snapshot.load). The snapshot is only
+        taken here, as it is too expensive to take each time the stage is
+        paused.
+
+        :returns: list of written file paths
+        """
+        if not self.enabled:
+            return []
+
+        written = []
+        stats_path = os.path.join(directory, f"{prefix}-{self.stage}.pstats")
+        self.profiler.dump_stats(stats_path)
+        written.append(stats_path)
+
+        if self.trace_memory and tracemalloc.is_tracing():
+            snapshot_path = os.path.join(
+                directory, f"{prefix}-{self.stage}.tracemalloc"
+            )
+            tracemalloc.take_snapshot().dump(snapshot_path)
+            written.append(snapshot_path)
+
+        if self.trace_memory:
+            self.stop_tracing()
+
+        return written
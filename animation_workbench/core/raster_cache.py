@@ -0,0 +1,267 @@
+# coding=utf-8
+
+"""Cache of raster layers pre-warped to the animation destination CRS."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import hashlib
+import os
+import time
+from typing import Dict, Iterable, List, Optional
+
+from osgeo import gdal
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsFeedback,
+    QgsMapLayer,
+    QgsProviderRegistry,
+    QgsRasterLayer,
+    QgsRectangle,
+)
+
+from .data_preparation import LayerSnapshot, move_to_main_thread
+from .render_queue import RenderJob
+
+
+def frames_extent(jobs: Iterable[RenderJob]) -> QgsRectangle:
+    """
+    Returns the union of the visible extents of all frames, in the
+    destination CRS
+    """
+    extent = QgsRectangle()
+    extent.setMinimal()
+    for job in jobs:
+        extent.combineExtentWith(job.frame_settings.visibleExtent())
+    return extent
+
+
+class RasterWarpCache(QObject):
+    """
+    Warps raster layers which are not in the animation's destination CRS
+    into tiled, overviewed GeoTIFFs in that CRS, clipped to the extent the
+    animation visits.
+
+    The warped copies are used in place of the originals for the length
+    of the export, so that pixels are reprojected once per export rather
+    than once per frame. Pixels are resampled in the same way as QGIS
+    draws the layer, which is nearest neighbour unless the layer is set to
+    resample, so categorical rasters keep their values. Copies are kept in
+    the cache directory, keyed by the source file, its modification time,
+    the destination CRS, the clip extent and the resampling method, so
+    repeated exports of the same animation reuse them.
+    Rasters are warped from layer snapshots, so that warping can run in
+    an ExportPreparationTask.
+    """
+
+    # Warped rasters are clipped to the frames extent grown by this
+    # fraction, so that rendering at the edges does not show nodata
+    EXTENT_BUFFER = 0.05
+    # Overviews are built until the smallest is below this size in pixels
+    MIN_OVERVIEW_SIZE = 256
+
+    # Signals
+    normal_message = pyqtSignal(str)
+
+    def __init__(self, cache_directory: str, parent=None):
+        super().__init__(parent=parent)
+        self.cache_directory: str = cache_directory
+        # Warped layers, by original layer id. They must be kept alive for
+        # as long as any render job refers to them.
+        self.warped_layers: Dict[str, QgsRasterLayer] = {}
+        self.elapsed: float = 0
+
+    @staticmethod
+    def source_path(layer: LayerSnapshot) -> Optional[str]:
+        """
+        Returns the path of a file based raster layer, or None if the
+        layer is not a local GDAL file
+        """
+        if not layer.is_raster or layer.provider_type != "gdal":
+            return None
+        path = (
+            QgsProviderRegistry.instance().decodeUri("gdal", layer.source).get("path")
+        )
+        if not path or not os.path.isfile(path):
+            return None
+        return path
+
+    def cache_path(
+        self,
+        source_path: str,
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        resampling: str = "near",
+    ) -> str:
+        """
+        Returns the path of the warped copy of a raster
+        """
+        key = "|".join(
+            [
+                os.path.abspath(source_path),
+                str(os.path.getmtime(source_path)),
+                destination_crs.toWkt(),
+                extent.toString(6),
+                resampling,
+            ]
+        )
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(source_path))[0]
+        return os.path.join(self.cache_directory, f"{name}-{digest}.tif")
+
+    def warp(
+        self,
+        source_path: str,
+        target_path: str,
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        resampling: str = "near",
+        feedback: Optional[QgsFeedback] = None,
+    ) -> bool:
+        """
+        Warps a raster file to a tiled, overviewed GeoTIFF
+
+        :param resampling: GDAL name of the resampling method
+        :param feedback: optional feedback, which stops the warp once
+            canceled
+
+        :returns: True if the raster was warped successfully
+        """
+        destination_srs = destination_crs.authid() or destination_crs.toWkt()
+        # write to a temporary name, so that an interrupted warp is
+        # never mistaken for a cached copy
+        temp_path = f"{target_path}.partial.tif"
+        # a partial file left by an interrupted warp would be warped into
+        self.remove_partial(temp_path)
+        try:
+            dataset = gdal.Warp(
+                temp_path,
+                source_path,
+                format="GTiff",
+                dstSRS=destination_srs,
+                outputBounds=(
+                    extent.xMinimum(),
+                    extent.yMinimum(),
+                    extent.xMaximum(),
+                    extent.yMaximum(),
+                ),
+                resampleAlg=resampling,
+                multithread=True,
+                # GDAL stops warping when the callback returns 0
+                callback=lambda *args: int(not (feedback and feedback.isCanceled())),
+                creationOptions=["TILED=YES", "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"],
+            )
+        except RuntimeError:
+            # raised instead of returning None when GDAL exceptions are on
+            dataset = None
+        if dataset is None:
+            self.remove_partial(temp_path)
+            return False
+
+        levels = []
+        level = 2
+        while (
+            max(dataset.RasterXSize, dataset.RasterYSize) / level
+            >= RasterWarpCache.MIN_OVERVIEW_SIZE
+        ):
+            levels.append(level)
+            level *= 2
+        if levels:
+            dataset.BuildOverviews("AVERAGE", levels)
+        dataset = None
+
+        os.replace(temp_path, target_path)
+        return True
+
+    @staticmethod
+    def remove_partial(path: str):
+        """
+        Removes a partially written warp, if there is one
+        """
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def prepare(
+        self,
+        layers: List[LayerSnapshot],
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        feedback: Optional[QgsFeedback] = None,
+    ) -> Dict[str, QgsMapLayer]:
+        """
+        Creates warped copies of the raster layers which are not in the
+        destination CRS
+
+        :param layers: snapshots of the layers rendered in the animation
+        :param destination_crs: CRS the animation is rendered in
+        :param extent: extent visited by the animation, in the destination CRS
+        :param feedback: optional feedback for cancellation
+
+        :returns: replacement layers to render instead of the originals,
+            by original layer id
+        """
+        start = time.perf_counter()
+        extent = extent.buffered(
+            max(extent.width(), extent.height()) * RasterWarpCache.EXTENT_BUFFER
+        )
+        os.makedirs(self.cache_directory, exist_ok=True)
+
+        for layer in layers:
+            if feedback and feedback.isCanceled():
+                break
+            if layer.crs == destination_crs:
+                continue
+            source_path = self.source_path(layer)
+            if not source_path:
+                continue
+
+            target_path = self.cache_path(
+                source_path, destination_crs, extent, layer.resampling
+            )
+            if os.path.exists(target_path):
+                self.normal_message.emit(f"Using cached warp of {layer.name}")
+            else:
+                self.normal_message.emit(
+                    f"Warping {layer.name} to {destination_crs.authid()}"
+                )
+                if not self.warp(
+                    source_path,
+                    target_path,
+                    destination_crs,
+                    extent,
+                    layer.resampling,
+                    feedback,
+                ):
+                    self.normal_message.emit(f"Could not warp {layer.name}")
+                    continue
+
+            warped = QgsRasterLayer(target_path, layer.name, "gdal")
+            if not warped.isValid():
+                continue
+            layer.style.writeToLayer(warped)
+            self.warped_layers[layer.layer_id] = move_to_main_thread(warped)
+
+        self.elapsed += time.perf_counter() - start
+        return dict(self.warped_layers)
+
+    def release(self):
+        """
+        Releases the warped layers. The cached files are kept for reuse.
+        """
+        self.warped_layers.clear()
@@ -0,0 +1,426 @@
+# coding=utf-8
+
+"""Raster time series served from a memory mapped cache."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import hashlib
+import math
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+from osgeo import gdal
+from qgis.PyQt.QtCore import QObject, pyqtSignal
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsFeedback,
+    QgsMapSettings,
+    QgsProject,
+    QgsRasterLayer,
+    QgsRasterRenderer,
+    QgsRectangle,
+    QgsSingleBandGrayRenderer,
+    QgsSingleBandPseudoColorRenderer,
+)
+
+from .data_preparation import copy_layer_style
+from .raster_cache import RasterWarpCache
+from .render_queue import RenderJob
+
+
+def set_renderer_band(renderer: QgsRasterRenderer, band: int):
+    """
+    Points a single band raster renderer at another band
+    """
+    if isinstance(renderer, QgsSingleBandGrayRenderer):
+        renderer.setGrayBand(band)
+    elif isinstance(renderer, QgsSingleBandPseudoColorRenderer):
+        renderer.setBand(band)
+    elif hasattr(renderer, "setInputBand"):
+        renderer.setInputBand(band)
+
+
+class RasterTimeSeries(QObject):
+    """
+    Steps through the time steps of a raster series, showing one step (or
+    a blend of two) in each frame in place of the series layer.
+
+    The steps are the bands of the series layer if it has more than one,
+    otherwise the single band rasters in the same layer group, sorted by
+    name. Before rendering, the extent visited by the animation is read
+    from every step once, warped to the map CRS, into a memory mapped
+    float32 cube. The cube is described by a GDAL VRT with a band per
+    step, so each frame's layer reads its pixels straight from the cache
+    file instead of reopening and rereading the original rasters.
+
+    Frames between two steps are optionally interpolated by a small
+    per-frame VRT, whose derived band sums the two steps of the cube
+    weighted by the frame's position between them.
+    """
+
+    # Signals
+    normal_message = pyqtSignal(str)
+
+    def __init__(
+        self,
+        layer: QgsRasterLayer,
+        cache_directory: str,
+        interpolate: bool = False,
+        parent=None,
+    ):
+        """
+        :param layer: raster layer of the series, styled for the animation
+        :param cache_directory: directory for the cached cube
+        :param interpolate: True to blend the steps either side of frames
+            which fall between two steps
+        """
+        super().__init__(parent=parent)
+        self.layer = layer
+        self.cache_directory: str = cache_directory
+        self.interpolate: bool = interpolate
+        # source file and band of each step
+        self.steps: List[Tuple[str, int]] = self.series_steps(layer)
+        self.path: Optional[str] = None
+        self.cube: Optional[np.ndarray] = None
+        self.elapsed: float = 0
+
+    @staticmethod
+    def series_steps(layer: QgsRasterLayer) -> List[Tuple[str, int]]:
+        """
+        Returns the source file and band of each step of the series of
+        a raster layer
+
+        :raises ValueError: if the layer is not a local GDAL raster
+        """
+        path = RasterWarpCache.source_path(layer)
+        if not path:
+            raise ValueError(f"{layer.name()} is not a local raster file")
+        if layer.bandCount() > 1:
+            return [(path, band) for band in range(1, layer.bandCount() + 1)]
+
+        node = QgsProject.instance().layerTreeRoot().findLayer(layer.id())
+        if node is None or node.parent() is None:
+            return [(path, 1)]
+        siblings = []
+        for child in node.parent().findLayers():
+            if child.parent() != node.parent():
+                continue
+            sibling = child.layer()
+            if not isinstance(sibling, QgsRasterLayer) or sibling.bandCount() != 1:
+                continue
+            sibling_path = RasterWarpCache.source_path(sibling)
+            if sibling_path:
+                siblings.append((sibling.name(), sibling_path))
+        return [(sibling_path, 1) for _, sibling_path in sorted(siblings)]
+
+    def step_weights(self, frame: int, frame_count: int) -> List[Tuple[int, float]]:
+        """
+        Returns the steps shown in a frame and their weights. The first and
+        last frames show the first and last steps, and frames in between
+        show the nearest earlier step, or blend the steps either side of
+        them when interpolating.
+        """
+        if len(self.steps) < 2 or frame_count < 2:
+            return [(0, 1.0)]
+        position = frame * (len(self.steps) - 1) / (frame_count - 1)
+        # frames which fall on a step, up to rounding, show that step
+        lower = int(math.floor(position + 1e-6))
+        fraction = max(position - lower, 0)
+        if not self.interpolate or fraction < 1e-6:
+            return [(lower, 1.0)]
+        return [(lower, 1 - fraction), (lower + 1, fraction)]
+
+    def cache_path(
+        self,
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        resolution: Optional[float],
+    ) -> str:
+        """
+        Returns the path of the cube file for an extent and resolution
+        """
+        parts = [
+            f"{os.path.abspath(path)}:{os.path.getmtime(path)}:{band}"
+            for path, band in self.steps
+        ]
+        parts += [destination_crs.toWkt(), extent.toString(6), str(resolution)]
+        digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(self.steps[0][0]))[0]
+        return os.path.join(self.cache_directory, f"{name}-series-{digest}.raw")
+
+    def prepare(
+        self,
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        resolution: Optional[float] = None,
+        feedback: Optional[QgsFeedback] = None,
+    ) -> bool:
+        """
+        Reads the series into the cache, unless a cached cube exists
+
+        :param destination_crs: CRS the animation is rendered in
+        :param extent: extent visited by the animation, in the destination CRS
+        :param resolution: size of the cached pixels in map units, or None
+            to keep the resolution of the series
+        :param feedback: optional feedback for cancellation
+
+        :returns: True if the cube is ready
+        """
+        start = time.perf_counter()
+        os.makedirs(self.cache_directory, exist_ok=True)
+        self.path = self.cache_path(destination_crs, extent, resolution)
+        if os.path.exists(self.vrt_path):
+            self.normal_message.emit(f"Using cached series of {self.layer.name()}")
+            dataset = gdal.Open(self.vrt_path)
+            shape = (dataset.RasterCount, dataset.RasterYSize, dataset.RasterXSize)
+            dataset = None
+        else:
+            self.normal_message.emit(
+                f"Caching {len(self.steps)} steps of {self.layer.name()}"
+            )
+            shape = self.read_steps(destination_crs, extent, resolution, feedback)
+            if shape is None:
+                if not (feedback and feedback.isCanceled()):
+                    self.normal_message.emit(f"Could not read {self.layer.name()}")
+                self.path = None
+                return False
+
+        self.cube = np.memmap(self.path, dtype=np.float32, mode="r", shape=shape)
+        self.elapsed += time.perf_counter() - start
+        return True
+
+    def read_steps(
+        self,
+        destination_crs: QgsCoordinateReferenceSystem,
+        extent: QgsRectangle,
+        resolution: Optional[float],
+        feedback: Optional[QgsFeedback] = None,
+    ) -> Optional[Tuple[int, int, int]]:
+        """
+        Warps every step to the extent and writes it to the cube file,
+        then writes the VRT describing the cube
+
+        :returns: shape of the cube, or None if a step could not be read
+            or reading was canceled
+        """
+        options = {
+            "format": "VRT",
+            "dstSRS": destination_crs.authid() or destination_crs.toWkt(),
+            "outputBounds": (
+                extent.xMinimum(),
+                extent.yMinimum(),
+                extent.xMaximum(),
+                extent.yMaximum(),
+            ),
+            "outputType": gdal.GDT_Float32,
+            "dstNodata": float("nan"),
+            "resampleAlg": "bilinear",
+        }
+        if resolution:
+            options["xRes"] = options["yRes"] = resolution
+
+        # write to a temporary name, so that an interrupted read is never
+        # mistaken for a cached cube
+        temp_path = f"{self.path}.partial"
+        cube = None
+        datasets = {}
+        for step, (path, band) in enumerate(self.steps):
+            if feedback and feedback.isCanceled():
+                return None
+            if path not in datasets:
+                # the warped VRT only reads the source when a band is read
+                datasets[path] = gdal.Warp("", path, **options)
+                if datasets[path] is None:
+                    return None
+            dataset = datasets[path]
+            if cube is None:
+                # later files are warped to the same grid as the first
+                options.pop("xRes", None)
+                options.pop("yRes", None)
+                options["width"] = dataset.RasterXSize
+                options["height"] = dataset.RasterYSize
+                geo_transform = dataset.GetGeoTransform()
+                projection = dataset.GetProjection()
+                cube = np.memmap(
+                    temp_path,
+                    dtype=np.float32,
+                    mode="w+",
+                    shape=(len(self.steps), dataset.RasterYSize, dataset.RasterXSize),
+                )
+            cube[step] = dataset.GetRasterBand(band).ReadAsArray()
+            if step + 1 == len(self.steps) or self.steps[step + 1][0] != path:
+                datasets.pop(path)
+        shape = cube.shape
+        cube.flush()
+        del cube
+        os.replace(temp_path, self.path)
+        self.write_vrt(shape, geo_transform, projection)
+        return shape
+
+    def write_vrt(
+        self,
+        shape: Tuple[int, int, int],
+        geo_transform: Tuple[float, ...],
+        projection: str,
+    ):
+        """
+        Writes a GDAL VRT describing the cube file, with a band per step
+        """
+        step_count, rows, columns = shape
+        # written to a temporary name, as the VRT marks a complete cube
+        temp_path = f"{self.vrt_path}.partial.vrt"
+        dataset = gdal.GetDriverByName("VRT").Create(temp_path, columns, rows, 0)
+        dataset.SetProjection(projection)
+        dataset.SetGeoTransform(geo_transform)
+        for step in range(step_count):
+            dataset.AddBand(
+                gdal.GDT_Float32,
+                options=[
+                    "subClass=VRTRawRasterBand",
+                    f"SourceFilename={self.path}",
+                    f"ImageOffset={step * rows * columns * 4}",
+                    "PixelOffset=4",
+                    f"LineOffset={columns * 4}",
+                    f"ByteOrder={'LSB' if sys.byteorder == 'little' else 'MSB'}",
+                ],
+            )
+            dataset.GetRasterBand(step + 1).SetNoDataValue(float("nan"))
+        dataset.FlushCache()
+        dataset = None
+        os.replace(temp_path, self.vrt_path)
+
+    @property
+    def vrt_path(self) -> str:
+        """
+        Returns the path of the VRT describing the cube
+        """
+        return os.path.splitext(self.path)[0] + ".vrt"
+
+    def blend_path(self, weights: List[Tuple[int, float]]) -> str:
+        """
+        Returns the path of a VRT blending steps of the cube, writing it
+        if it does not exist
+        """
+        (lower, _), (_, fraction) = weights
+        path = f"{os.path.splitext(self.path)[0]}-{lower}-{fraction:.4f}.vrt"
+        if os.path.exists(path):
+            return path
+
+        cube = gdal.Open(self.vrt_path)
+        dataset = gdal.GetDriverByName("VRT").Create(
+            path, cube.RasterXSize, cube.RasterYSize, 0
+        )
+        dataset.SetProjection(cube.GetProjection())
+        dataset.SetGeoTransform(cube.GetGeoTransform())
+        cube = None
+        dataset.AddBand(
+            gdal.GDT_Float32,
+            options=["subClass=VRTDerivedRasterBand", "PixelFunctionType=sum"],
+        )
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(float("nan"))
+        for index, (step, weight) in enumerate(weights):
+            band.SetMetadataItem(
+                f"source_{index}",
+                "<ComplexSource>"
+                f'<SourceFilename relativeToVRT="0">{escape(self.vrt_path)}'
+                "</SourceFilename>"
+                f"<SourceBand>{step + 1}</SourceBand>"
+                f"<ScaleRatio>{weight!r}</ScaleRatio>"
+                "</ComplexSource>",
+                "new_vrt_sources",
+            )
+        dataset.FlushCache()
+        dataset = None
+        return path
+
+    def create_layer(self, frame: int, frame_count: int) -> QgsRasterLayer:
+        """
+        Creates a raster layer showing a frame's step of the series,
+        styled like the series layer
+        """
+        weights = self.step_weights(frame, frame_count)
+        if len(weights) == 1:
+            path, band = self.vrt_path, weights[0][0] + 1
+        else:
+            path, band = self.blend_path(weights), 1
+        layer = QgsRasterLayer(path, self.layer.name(), "gdal")
+        copy_layer_style(self.layer, layer)
+        set_renderer_band(layer.renderer(), band)
+        return layer
+
+    def create_step_layer(self, frame: int, frame_count: int) -> QgsRasterLayer:
+        """
+        Creates a raster layer showing a frame's step of the series read
+        straight from its source raster, styled like the series layer.
+        Used when the cube is not prepared, e.g. for previews, so frames
+        between two steps show the earlier step without blending.
+        """
+        path, band = self.steps[self.step_weights(frame, frame_count)[0][0]]
+        layer = QgsRasterLayer(path, self.layer.name(), "gdal")
+        copy_layer_style(self.layer, layer)
+        set_renderer_band(layer.renderer(), band)
+        return layer
+
+    def remove_layer(self, map_settings: QgsMapSettings) -> Optional[int]:
+        """
+        Removes the series layer from map settings
+
+        :returns: position of the removed layer, or None if the settings
+            do not render the series layer
+        """
+        layers = map_settings.layers()
+        layer_ids = [layer.id() for layer in layers]
+        if self.layer.id() not in layer_ids:
+            return None
+        position = layer_ids.index(self.layer.id())
+        del layers[position]
+        map_settings.setLayers(layers)
+        return position
+
+    def add_frame_layer(
+        self,
+        map_settings: QgsMapSettings,
+        frame: int,
+        frame_count: int,
+        position: int,
+        job: RenderJob,
+    ):
+        """
+        Renders a frame's step of the series where the series layer was
+        removed. Used as a deferred update, so the layer is only created
+        when the frame is rendered. The step is read from its source
+        raster if the cube is not prepared, e.g. for previews.
+        """
+        if self.cube is None:
+            layer = self.create_step_layer(frame, frame_count)
+        else:
+            layer = self.create_layer(frame, frame_count)
+        job.owned_layers.append(layer)
+        layers = map_settings.layers()
+        layers.insert(position, layer)
+        map_settings.setLayers(layers)
+
+    def release(self):
+        """
+        Releases the cube. The cached files are kept for reuse.
+        """
+        self.cube = None
@@ -0,0 +1,360 @@
+# coding=utf-8
+
+"""Per-frame render timing instrumentation for the render queue."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import bisect
+import csv
+import json
+import math
+import os
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Returns the given percentile of a list of values, using linear
+    interpolation between the closest ranks.
+
+    :param values: values to calculate the percentile for
+    :param fraction: percentile as a fraction, e.g. 0.95 for p95
+
+    :returns: percentile value, or None if values is empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    if lower == upper:
+        return ordered[int(position)]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class FrameTiming:
+    """
+    Timestamps and output details recorded for a single rendered frame.
+
+    All timestamps are seconds since the epoch, or None if that stage
+    was never reached (e.g. for canceled or failed frames). The started,
+    rendered and written times are recorded by the render task on its
+    worker thread, the others on the main thread.
+    """
+
+    FIELDS = [
+        "file_name",
+        "created",
+        "queued",
+        "started",
+        "rendered",
+        "written",
+        "queue_wait",
+        "render_time",
+        "write_time",
+        "output_size",
+        "worker",
+        "success",
+    ]
+
+    def __init__(self, file_name: str):
+        self.file_name: str = file_name
+        self.created: Optional[float] = None
+        self.queued: Optional[float] = None
+        self.started: Optional[float] = None
+        self.rendered: Optional[float] = None
+        self.written: Optional[float] = None
+        self.output_size: Optional[int] = None
+        self.worker: Optional[int] = None
+        self.success: bool = False
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        """
+        Time spent between the frame being queued and its task starting
+        """
+        if self.queued is None or self.started is None:
+            return None
+        return self.started - self.queued
+
+    @property
+    def render_time(self) -> Optional[float]:
+        """
+        Time spent between the frame task starting and rendering finishing
+        """
+        if self.started is None or self.rendered is None:
+            return None
+        return self.rendered - self.started
+
+    @property
+    def write_time(self) -> Optional[float]:
+        """
+        Time spent between rendering finishing and the frame being written
+        """
+        if self.rendered is None or self.written is None:
+            return None
+        return self.written - self.rendered
+
+    def as_dict(self) -> dict:
+        """
+        Returns the timing as a dictionary, suitable for CSV or JSON export
+        """
+        return {field: getattr(self, field) for field in FrameTiming.FIELDS}
+
+
+class RenderMetrics:
+    """
+    Collects per-frame timings for a render queue run and calculates
+    summary statistics from them.
+    """
+
+    # Number of buckets used when reporting frames per second over time
+    FPS_BUCKETS = 10
+    # Number of recently completed frames used for rolling statistics
+    RECENT_FRAMES = 100
+    # Upper bounds, in seconds, of the render time histogram buckets
+    RENDER_TIME_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self):
+        self.timings: Dict[str, FrameTiming] = {}
+        # Most recently written frames, in order of completion. Kept
+        # separately so that live statistics are cheap to sample.
+        self.recent: Deque[FrameTiming] = deque(maxlen=RenderMetrics.RECENT_FRAMES)
+        self.bytes_written: int = 0
+        self.frames_completed: int = 0
+        self.frames_failed: int = 0
+        # Cumulative render time histogram. The final count is for render
+        # times greater than the last bucket bound.
+        self.render_time_counts: List[int] = [0] * (
+            len(RenderMetrics.RENDER_TIME_BUCKETS) + 1
+        )
+        self.render_time_sum: float = 0
+
+    def reset(self):
+        """
+        Clears all recorded timings
+        """
+        self.timings.clear()
+        self.recent.clear()
+        self.bytes_written = 0
+        self.frames_completed = 0
+        self.frames_failed = 0
+        self.render_time_counts = [0] * (len(RenderMetrics.RENDER_TIME_BUCKETS) + 1)
+        self.render_time_sum = 0
+
+    def frame(self, file_name: str) -> FrameTiming:
+        """
+        Returns the timing record for a frame, creating it if required
+        """
+        timing = self.timings.get(file_name)
+        if timing is None:
+            timing = FrameTiming(file_name)
+            self.timings[file_name] = timing
+        return timing
+
+    def frame_written(
+        self, file_name: str, written: float, output_size: Optional[int]
+    ) -> FrameTiming:
+        """
+        Records that a frame was successfully written to disk
+        """
+        timing = self.frame(file_name)
+        timing.written = written
+        timing.output_size = output_size
+        timing.success = True
+        self.recent.append(timing)
+        self.bytes_written += output_size or 0
+        self.frames_completed += 1
+
+        render_time = timing.render_time
+        if render_time is not None:
+            self.render_time_sum += render_time
+            bucket = bisect.bisect_left(RenderMetrics.RENDER_TIME_BUCKETS, render_time)
+            self.render_time_counts[bucket] += 1
+        return timing
+
+    def frame_failed(self, file_name: str) -> FrameTiming:
+        """
+        Records that a frame failed to render or was canceled
+        """
+        timing = self.frame(file_name)
+        timing.success = False
+        self.frames_failed += 1
+        return timing
+
+    def rolling_frames_per_second(self) -> Optional[float]:
+        """
+        Returns the throughput over the most recently written frames, or
+        None if not enough frames have been written yet
+        """
+        if len(self.recent) < 2:
+            return None
+        duration = self.recent[-1].written - self.recent[0].written
+        if duration <= 0:
+            return None
+        return (len(self.recent) - 1) / duration
+
+    def recent_render_times(self) -> List[float]:
+        """
+        Returns the render times of the most recently written frames,
+        in order of completion
+        """
+        return [t.render_time for t in self.recent if t.render_time is not None]
+
+    def completed_timings(self) -> List[FrameTiming]:
+        """
+        Returns timings for all successfully written frames, in order
+        of completion
+        """
+        return sorted(
+            (t for t in self.timings.values() if t.success and t.written),
+            key=lambda t: t.written,
+        )
+
+    def frames_per_second(self) -> List[float]:
+        """
+        Returns the frame throughput over the course of the run, split
+        into FPS_BUCKETS equal time intervals
+        """
+        completed = self.completed_timings()
+        if not completed:
+            return []
+
+        start = min(t.queued or t.written for t in completed)
+        end = completed[-1].written
+        duration = end - start
+        if duration <= 0:
+            return []
+
+        bucket_size = duration / RenderMetrics.FPS_BUCKETS
+        counts = [0] * RenderMetrics.FPS_BUCKETS
+        for timing in completed:
+            bucket = min(
+                int((timing.written - start) / bucket_size),
+                RenderMetrics.FPS_BUCKETS - 1,
+            )
+            counts[bucket] += 1
+        return [count / bucket_size for count in counts]
+
+    def summary(self) -> dict:
+        """
+        Returns summary statistics for the recorded timings
+        """
+        completed = self.completed_timings()
+        render_times = [t.render_time for t in completed if t.render_time is not None]
+        write_times = [t.write_time for t in completed if t.write_time is not None]
+        queue_waits = [t.queue_wait for t in completed if t.queue_wait is not None]
+
+        result = {
+            "frames": len(self.timings),
+            "completed_frames": len(completed),
+            "render_time_p50": percentile(render_times, 0.5),
+            "render_time_p95": percentile(render_times, 0.95),
+            "render_time_max": max(render_times) if render_times else None,
+            "write_time_p50": percentile(write_times, 0.5),
+            "write_time_p95": percentile(write_times, 0.95),
+            "queue_wait_mean": (
+                sum(queue_waits) / len(queue_waits) if queue_waits else None
+            ),
+            "queue_wait_max": max(queue_waits) if queue_waits else None,
+            "frames_per_second": None,
+            "frames_per_second_over_time": self.frames_per_second(),
+        }
+
+        if completed:
+            start = min(t.queued or t.written for t in completed)
+            duration = completed[-1].written - start
+            if duration > 0:
+                result["frames_per_second"] = len(completed) / duration
+
+        return result
+
+    def summary_text(self) -> str:
+        """
+        Returns the summary statistics as human readable text
+        """
+
+        def format_seconds(value: Optional[float]) -> str:
+            if value is None:
+                return "n/a"
+            return f"{value:.3f}s"
+
+        summary = self.summary()
+        lines = [
+            "Render timing summary:",
+            f"  Frames completed: {summary['completed_frames']}"
+            f" of {summary['frames']}",
+            f"  Render time p50: {format_seconds(summary['render_time_p50'])}",
+            f"  Render time p95: {format_seconds(summary['render_time_p95'])}",
+            f"  Render time max: {format_seconds(summary['render_time_max'])}",
+            f"  Write time p50: {format_seconds(summary['write_time_p50'])}",
+            f"  Write time p95: {format_seconds(summary['write_time_p95'])}",
+            f"  Queue wait mean: {format_seconds(summary['queue_wait_mean'])}",
+            f"  Queue wait max: {format_seconds(summary['queue_wait_max'])}",
+        ]
+        if summary["frames_per_second"] is not None:
+            lines.append(f"  Frames per second: {summary['frames_per_second']:.2f}")
+        if summary["frames_per_second_over_time"]:
+            lines.append(
+                "  Frames per second over time: "
+                + ", ".join(
+                    f"{fps:.1f}" for fps in summary["frames_per_second_over_time"]
+                )
+            )
+        return "\n".join(lines)
+
+    def export_csv(self, file_path: str):
+        """
+        Writes the per-frame timings to a CSV file
+        """
+        with open(file_path, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=FrameTiming.FIELDS)
+            writer.writeheader()
+            for timing in self.timings.values():
+                writer.writerow(timing.as_dict())
+
+    def export_json(self, file_path: str):
+        """
+        Writes the per-frame timings and summary statistics to a JSON file
+        """
+        with open(file_path, "w", encoding="utf-8") as json_file:
+            json.dump(
+                {
+                    "summary": self.summary(),
+                    "frames": [t.as_dict() for t in self.timings.values()],
+                },
+                json_file,
+                indent=2,
+            )
+
+    def export(self, directory: str, prefix: str) -> List[str]:
+        """
+        Exports the timings as CSV and JSON files to a directory
+
+        :param directory: directory to write files to, usually the
+            directory containing the rendered frames
+        :param prefix: prefix for the exported file names
+
+        :returns: list of written file paths
+        """
+        csv_path = os.path.join(directory, f"{prefix}-timings.csv")
+        json_path = os.path.join(directory, f"{prefix}-timings.json")
+        self.export_csv(csv_path)
+        self.export_json(json_path)
+        return [csv_path, json_path]
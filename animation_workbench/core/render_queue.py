@@ -18,8 +18,10 @@ __revision__ = "$Format:%H$"
 # (at your option) any later version.
 # ---------------------------------------------------------------------
 
+import os
+import time
 from functools import partial
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Sequence
 
 # DO NOT REMOVE THIS - it forces sip2
 # noinspection PyUnresolvedReferences
@@ -28,7 +30,8 @@ from qgis.PyQt.QtCore import QObject, pyqtSignal
 from qgis.PyQt.QtGui import QImage
 from qgis.core import QgsApplication, QgsMapRendererParallelJob
 from qgis.core import (
-    QgsMapRendererTask,
+    QgsMapDecoration,
+    QgsMapLayer,
     QgsMapSettings,
     QgsProxyProgressTask,
     QgsFeedback,
@@ -36,7 +39,12 @@ from qgis.core import (
     QgsTask,
 )
 
+from .filtered_renderer import FeatureIdFilterProvider, FilteredMapRendererTask
+from .profiling import StageProfiler
+from .render_metrics import RenderMetrics
+from .sprite_renderer import SpriteFrame
 from .settings import setting
+from .trace_recorder import TraceRecorder
 
 
 class RenderJob:
@@ -46,13 +54,107 @@ class RenderJob:
 
     def __init__(self, file_name: str, map_settings: QgsMapSettings):
         self.file_name: str = file_name
-        self.map_settings: QgsMapSettings = map_settings
+        self._map_settings: QgsMapSettings = map_settings
+        # Updates to the map settings which are deferred until the settings
+        # are first needed for rendering, e.g. resolving feature variables
+        self._pending_updates: List[Callable[[QgsMapSettings], None]] = []
+        # Ids of the only features to render from layers, by layer id
+        self.feature_ids: Dict[str, Sequence[int]] = {}
+        # Layers created only for this frame, which must be kept alive
+        # until the frame is rendered
+        self.owned_layers: List[QgsMapLayer] = []
+        # Create layers drawn above the frame's layers, which are only
+        # built when the frame's render task is created
+        self.layer_factories: List[Callable[[], QgsMapLayer]] = []
+        # If set, the frame is drawn as sprites over a prerendered
+        # background instead of being rendered
+        self.sprites: Optional[SpriteFrame] = None
+        # Decorations drawn over this frame only, after any decorations
+        # shared by all frames
+        self.decorations: List[QgsMapDecoration] = []
+        # Time at which the job was created, used for render timing metrics
+        self.created: float = time.time()
+
+    @property
+    def map_settings(self) -> QgsMapSettings:
+        """
+        Returns the map settings for the frame, applying any deferred updates
+        """
+        if self._pending_updates:
+            updates = self._pending_updates
+            self._pending_updates = []
+            for update in updates:
+                update(self._map_settings)
+        return self._map_settings
+
+    @map_settings.setter
+    def map_settings(self, map_settings: QgsMapSettings):
+        self._map_settings = map_settings
+
+    @property
+    def frame_settings(self) -> QgsMapSettings:
+        """
+        Returns the map settings for the frame without applying deferred
+        updates. Use this to read or change the extent, scale, CRS or layers
+        of queued jobs without materializing them.
+        """
+        return self._map_settings
+
+    def defer_settings_update(self, update: Callable[[QgsMapSettings], None]):
+        """
+        Defers an update to the map settings until they are first accessed.
+        Updates may fetch features or create layers, so the map settings
+        must first be accessed on the main thread.
+
+        :param update: callable which is passed the map settings to update
+        """
+        self._pending_updates.append(update)
+
+    def replace_layers(self, replacements: Dict[str, QgsMapLayer]):
+        """
+        Renders the given layers in place of the layers they replace
+
+        :param replacements: layers to render instead, by the id of the
+            layer they replace
+        """
+        # feature ids of filtered layers do not apply to their replacements
+        replacements = {
+            layer_id: layer
+            for layer_id, layer in replacements.items()
+            if layer_id not in self.feature_ids
+        }
+        layers = self.frame_settings.layers()
+        if not any(layer.id() in replacements for layer in layers):
+            return
+        self.frame_settings.setLayers(
+            [replacements.get(layer.id(), layer) for layer in layers]
+        )
+        # keep any map theme styles applied to the replaced layers
+        self.frame_settings.setLayerStyleOverrides(
+            {
+                (
+                    replacements[layer_id].id()
+                    if layer_id in replacements
+                    else layer_id
+                ): style
+                for layer_id, style in self.frame_settings.layerStyleOverrides().items()
+            }
+        )
 
     def render_to_image(self) -> QImage:
         """
         Renders the frame to an image
         """
-        render_job = QgsMapRendererParallelJob(self.map_settings)
+        if self.sprites:
+            return self.sprites.render_to_image(self.map_settings)
+        map_settings = QgsMapSettings(self.map_settings)
+        created_layers = [create() for create in self.layer_factories]
+        map_settings.setLayers(created_layers + map_settings.layers())
+        render_job = QgsMapRendererParallelJob(map_settings)
+        if self.feature_ids:
+            render_job.setFeatureFilterProvider(
+                FeatureIdFilterProvider(self.feature_ids)
+            )
         render_job.start()
         render_job.waitForFinished()
         return render_job.renderedImage()
@@ -62,23 +164,35 @@ class RenderJob:
         annotations_list: Optional[List] = None,
         decorations: Optional[List] = None,
         hidden: bool = False,
-    ) -> QgsMapRendererTask:
+    ) -> FilteredMapRendererTask:
         """
-        Creates a map renderer task for the frame
+        Creates a map renderer task for the frame. This must be called from
+        the main thread, as the render is prepared when the task is created.
+
+        Frames are rendered with FilteredMapRendererTask rather than
+        QgsMapRendererTask even when no features are filtered, as it
+        records when the frame is drawn and written from within the task.
         """
 
         # Set the output file name for the render task
 
-        if Qgis.QGIS_VERSION_INT >= 32500 and hidden:
-            # can only mark tasks as hidden on 3.26+
-            task = QgsMapRendererTask(
+        flags = (
+            QgsTask.Flags(QgsTask.Hidden | QgsTask.CanCancel)
+            if Qgis.QGIS_VERSION_INT >= 32500 and hidden
+            else QgsTask.CanCancel
+        )
+        if self.sprites:
+            task = self.sprites.create_task(
+                self.map_settings, self.file_name, flags=flags
+            )
+        else:
+            task = FilteredMapRendererTask(
                 self.map_settings,
                 self.file_name,
-                "PNG",
-                flags=QgsTask.Flags(QgsTask.Hidden | QgsTask.CanCancel),
+                self.feature_ids,
+                flags=flags,
+                layer_factories=self.layer_factories,
             )
-        else:
-            task = QgsMapRendererTask(self.map_settings, self.file_name, "PNG")
         # We need to clone the annotations because otherwise SIP will
         # pass ownership and then cause a crash when the render task is
         # destroyed
@@ -87,8 +201,14 @@ class RenderJob:
             task.addAnnotations(cloned_annotations)
 
         # Add decorations to the render job
+        decorations = list(decorations or []) + self.decorations
         if decorations:
             task.addDecorations(decorations)
+
+        # the task only holds weak references to the layers it renders,
+        # and does not own its decorations
+        task.owned_layers = self.owned_layers
+        task.owned_decorations = self.decorations
         return task
 
 
@@ -128,6 +248,8 @@ class RenderQueue(QObject):
     status_message = pyqtSignal(str)
     # Sends the path to each frame as it is rendered
     image_rendered = pyqtSignal(str)
+    # Sends the path to each frame which fails to render
+    image_failed = pyqtSignal(str)
 
     def __init__(self, parent=None):
         super().__init__(parent=parent)
@@ -145,6 +267,17 @@ class RenderQueue(QObject):
         # empty.
         self.job_queue: List[RenderJob] = []
         self.active_tasks = {}
+        # Maps the file name of each active task to the worker slot
+        # (0 to render_thread_pool_size - 1) it is running in
+        self.active_workers = {}
+
+        # Per-frame timings for the current run
+        self.metrics = RenderMetrics()
+        # Profiles task dispatch, if enabled in the workbench settings
+        self.profiler = StageProfiler("render_queue", enabled=False)
+        # Records dispatch and signal handling spans, if trace export is
+        # enabled. Set by the caller for each run.
+        self.trace = TraceRecorder(enabled=False)
 
         # "parent" task which just reports overall progress of the queue
         self.proxy_task: Optional[QgsProxyProgressTask] = None
@@ -172,6 +305,8 @@ class RenderQueue(QObject):
         """
         self.job_queue.clear()
         self.active_tasks.clear()
+        self.active_workers.clear()
+        self.metrics.reset()
         self.proxy_task = None
         self.proxy_feedback = None
 
@@ -196,7 +331,9 @@ class RenderQueue(QObject):
         self.total_feature_count = 0
         self.completed_feature_count = 0
 
-        self.proxy_feedback.cancel()
+        # the queue may be canceled before it starts processing
+        if self.proxy_feedback:
+            self.proxy_feedback.cancel()
 
         for _, task in self.active_tasks.items():
             task.cancel()
@@ -231,6 +368,8 @@ class RenderQueue(QObject):
             # can't set a proxy task as cancelable in < 3.26 :(
             self.proxy_task = QgsProxyProgressTask("Exporting frames")
 
+        self.profiler = StageProfiler("render_queue")
+
         self.proxy_feedback = RenderQueueFeedback(len(self.job_queue))
         self.proxy_feedback.progressChanged.connect(self.proxy_task.setProxyProgress)
 
@@ -257,34 +396,86 @@ class RenderQueue(QObject):
             self.update_status()
             return
 
-        free_threads = self.render_thread_pool_size - len(self.active_tasks)
-        for _ in range(free_threads):
-            job = self.job_queue.pop(0)
-            if self.verbose_mode:
-                self.status_message.emit(f"Rendering: {job.file_name}")
-
-            # create a hidden task, because the proxy wrapper task
-            # will be the only one we want to expose to users
-            task = job.create_task(self.annotations_list, self.decorations, hidden=True)
-            self.active_tasks[job.file_name] = task
-
-            task.taskCompleted.connect(
-                partial(self.task_completed, file_name=job.file_name)
-            )
-            task.taskTerminated.connect(
-                partial(self.finalize_task, file_name=job.file_name)
-            )
-
-            QgsApplication.taskManager().addTask(task)
-            self.proxy_feedback.set_remaining_steps(len(self.job_queue))
+        with self.profiler, self.trace.span("dispatch", "render_queue"):
+            free_threads = self.render_thread_pool_size - len(self.active_tasks)
+            for _ in range(free_threads):
+                if not self.job_queue:
+                    break
+                job = self.job_queue.pop(0)
+                if self.verbose_mode:
+                    self.status_message.emit(f"Rendering: {job.file_name}")
+
+                # create a hidden task, because the proxy wrapper task
+                # will be the only one we want to expose to users
+                task = job.create_task(
+                    self.annotations_list, self.decorations, hidden=True
+                )
+                self.active_tasks[job.file_name] = task
+                worker = self._free_worker_slot()
+                self.active_workers[job.file_name] = worker
+                self.metrics.frame(job.file_name).worker = worker
+
+                task.frame_timed.connect(
+                    partial(self.task_timed, file_name=job.file_name)
+                )
+                task.taskCompleted.connect(
+                    partial(self.task_completed, file_name=job.file_name)
+                )
+                task.taskTerminated.connect(
+                    partial(self.task_terminated, file_name=job.file_name)
+                )
+
+                QgsApplication.taskManager().addTask(task)
+                self.proxy_feedback.set_remaining_steps(len(self.job_queue))
 
         self.update_status()
 
+    def _free_worker_slot(self) -> int:
+        """
+        Returns the lowest worker slot not currently used by an active task
+        """
+        used_slots = set(self.active_workers.values())
+        slot = 0
+        while slot in used_slots:
+            slot += 1
+        return slot
+
+    def task_timed(
+        self, file_name: str, started: float, rendered: float, written: float
+    ):
+        """
+        Called with the times recorded by an active task, on the worker
+        thread, when it started, finished drawing its frame and finished
+        writing it. This is sent just before the task completes.
+        """
+        timing = self.metrics.frame(file_name)
+        timing.started = started
+        timing.rendered = rendered
+        timing.written = written
+
     def task_completed(self, file_name: str):
         """
         Called whenever an active task is SUCCESSFULLY completed
         """
-        self.image_rendered.emit(file_name)
+        try:
+            output_size = os.path.getsize(file_name)
+        except OSError:
+            output_size = None
+        written = self.metrics.frame(file_name).written
+        self.metrics.frame_written(file_name, written or time.time(), output_size)
+
+        with self.trace.span(
+            "image_rendered", "render_queue", args={"file_name": file_name}
+        ):
+            self.image_rendered.emit(file_name)
+        self.finalize_task(file_name)
+
+    def task_terminated(self, file_name: str):
+        """
+        Called whenever an active task fails or is canceled
+        """
+        self.metrics.frame_failed(file_name)
+        self.image_failed.emit(file_name)
         self.finalize_task(file_name)
 
     def finalize_task(self, file_name: str):
@@ -293,6 +484,8 @@ class RenderQueue(QObject):
         """
         if file_name in self.active_tasks:
             del self.active_tasks[file_name]
+        if file_name in self.active_workers:
+            del self.active_workers[file_name]
         self.total_completed += 1
 
         if self.frames_per_feature:
@@ -315,9 +508,35 @@ class RenderQueue(QObject):
         """
         self.decorations = decorations
 
+    def queued_layers(self) -> List[QgsMapLayer]:
+        """
+        Returns all layers rendered by the queued jobs, in render order
+        """
+        layers = {}
+        for job in self.job_queue:
+            for layer in job.frame_settings.layers():
+                layers.setdefault(layer.id(), layer)
+        return list(layers.values())
+
+    def replace_layers(self, replacements: Dict[str, QgsMapLayer]):
+        """
+        Replaces layers in all queued jobs, e.g. with prepared copies
+
+        :param replacements: layers to render instead, by the id of the
+            layer they replace
+        """
+        if not replacements:
+            return
+        for job in self.job_queue:
+            job.replace_layers(replacements)
+
     def add_job(self, job: RenderJob):
         """
         Adds a job to the queue
         """
         self.job_queue.append(job)
         self.total_queue_size += 1
+
+        timing = self.metrics.frame(job.file_name)
+        timing.created = job.created
+        timing.queued = time.time()
@@ -0,0 +1,532 @@
+# coding=utf-8
+
+"""Compositing of moving point markers as sprites over a static background."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import math
+import re
+import sys
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+from qgis.PyQt.QtCore import QPointF, Qt
+from qgis.PyQt.QtGui import QImage, QPainter
+from qgis.core import (
+    QgsCoordinateTransform,
+    QgsCsException,
+    QgsExpression,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsGeometry,
+    QgsMapLayer,
+    QgsMapLayerStyle,
+    QgsMapRendererCustomPainterJob,
+    QgsMapRendererParallelJob,
+    QgsMapSettings,
+    QgsMarkerSymbol,
+    QgsPointXY,
+    QgsProject,
+    QgsRenderContext,
+    QgsSymbol,
+    QgsSymbolLayerUtils,
+    QgsTask,
+    QgsVectorLayer,
+)
+
+from .filtered_renderer import FilteredMapRendererTask
+
+# Variables which may change from one frame to the next
+FRAME_VARIABLES = {
+    "frame_number",
+    "frame_duration",
+    "frame_timeoffset",
+    "animation_start_time",
+    "animation_end_time",
+    "animation_interval",
+    "map_start_time",
+    "map_end_time",
+    "map_interval",
+    "current_animation_action",
+    "current_hover_frame",
+    "current_travel_frame",
+    "hover_frames",
+    "travel_frames",
+    "hover_feature",
+    "hover_feature_id",
+    "previous_feature",
+    "previous_feature_id",
+    "next_feature",
+    "next_feature_id",
+    "from_feature",
+    "from_feature_id",
+    "to_feature",
+    "to_feature_id",
+    "visible_feature_count",
+    "trajectory_time",
+}
+
+# Matches variables referenced as @name or var('name') in style XML
+VARIABLE_PATTERN = re.compile(r"@(\w+)|var\(\s*(?:'|&apos;)(\w+)")
+
+# Layout of each point of a multipoint WKB in the native byte order
+WKB_BYTE_ORDER = 1 if sys.byteorder == "little" else 0
+WKB_POINT = np.dtype([("order", "u1"), ("type", "=u4"), ("x", "=f8"), ("y", "=f8")])
+# Layout of the header of a multipoint WKB, before its points
+WKB_MULTIPOINT = np.dtype([("order", "u1"), ("type", "=u4"), ("count", "=u4")])
+
+
+def frame_dependencies(layer: QgsMapLayer) -> Set[str]:
+    """
+    Returns the variables which change from frame to frame referenced by
+    a layer's symbology, labeling or other style settings
+    """
+    style = QgsMapLayerStyle()
+    style.readFromLayer(layer)
+    variables = set()
+    for at_name, var_name in VARIABLE_PATTERN.findall(style.xmlData()):
+        variables.add(at_name or var_name)
+    return variables & FRAME_VARIABLES
+
+
+def multipoint_geometry(xs: np.ndarray, ys: np.ndarray) -> QgsGeometry:
+    """
+    Returns a multipoint geometry of arrays of coordinates, built from a
+    WKB written with NumPy rather than from a Python object per point
+    """
+    points = np.empty(len(xs), dtype=WKB_POINT)
+    points["order"] = WKB_BYTE_ORDER
+    points["type"] = 1
+    points["x"] = xs
+    points["y"] = ys
+    header = np.array([(WKB_BYTE_ORDER, 4, len(xs))], dtype=WKB_MULTIPOINT)
+    geometry = QgsGeometry()
+    geometry.fromWkb(header.tobytes() + points.tobytes())
+    return geometry
+
+
+def transform_points(
+    xs: np.ndarray, ys: np.ndarray, transform: QgsCoordinateTransform
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms arrays of coordinates, returning NaN for points which
+    cannot be transformed
+
+    The points are transformed with a single call, as one multipoint
+    geometry built from the arrays, rather than one call per point.
+    """
+    geometry = multipoint_geometry(xs, ys)
+    try:
+        geometry.transform(transform)
+    except QgsCsException:
+        # some points are outside the area the transform can handle
+        return transform_points_separately(xs, ys, transform)
+    transformed = np.frombuffer(
+        bytes(geometry.asWkb()), dtype=WKB_POINT, offset=WKB_MULTIPOINT.itemsize
+    )
+    return transformed["x"].copy(), transformed["y"].copy()
+
+
+def transform_points_separately(
+    xs: np.ndarray, ys: np.ndarray, transform: QgsCoordinateTransform
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Transforms arrays of coordinates one point at a time, returning NaN
+    for points which cannot be transformed
+    """
+    transformed_xs = np.full(len(xs), np.nan)
+    transformed_ys = np.full(len(ys), np.nan)
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        try:
+            point = transform.transform(QgsPointXY(x, y))
+        except QgsCsException:
+            continue
+        transformed_xs[i], transformed_ys[i] = point.x(), point.y()
+    return transformed_xs, transformed_ys
+
+
+class SpriteCompositor:
+    """
+    Draws frames of point markers moving over an otherwise static map
+    without a full render of each frame.
+
+    The map without the moving points is rendered once as the background
+    of every frame, and each distinct marker symbol of the points is
+    rasterized once as a sprite. Each frame is then drawn by copying the
+    background and the sprites at the frame's positions, which are
+    converted to pixels for all points at once with NumPy.
+
+    This only gives the same result as a full render when nothing else on
+    the map changes between frames and the markers do not depend on the
+    frame, which is checked by unsupported_reasons().
+    """
+
+    # Renderers whose symbols only depend on the points' attributes
+    SUPPORTED_RENDERERS = ("singleSymbol", "categorizedSymbol", "graduatedSymbol")
+    # Padding around each sprite, in pixels, for antialiasing
+    SPRITE_PADDING = 2
+
+    def __init__(self, layer: QgsVectorLayer, positions: np.ndarray, attributes):
+        """
+        :param layer: point layer with the style of the moving points
+        :param positions: position of each point for every frame, in the
+            layer's CRS, with shape (frames, points, 2) and NaN for hidden
+            points
+        :param attributes: attributes of each point
+        """
+        self.layer = layer
+        self.positions = positions
+        self.attributes = attributes
+
+        self.background: Optional[QImage] = None
+        self.sprites: List[QImage] = []
+        # position of the marker's point within each sprite, and each
+        # sprite's size, in pixels
+        self.anchors = np.zeros((0, 2))
+        self.sizes = np.zeros((0, 2))
+        # sprite drawn for each point, or -1 for points without a symbol
+        self.point_sprites = np.zeros(0, dtype=np.int64)
+        self.transform: Optional[QgsCoordinateTransform] = None
+
+    def unsupported_reasons(self, map_settings: QgsMapSettings) -> List[str]:
+        """
+        Returns the reasons why frames cannot be drawn as sprites over the
+        map, or an empty list if they can
+
+        :param map_settings: settings of the map without the moving points
+        """
+        reasons = []
+        if map_settings.rotation():
+            reasons.append("the map is rotated")
+
+        layer = self.layer
+        if layer.labelsEnabled():
+            reasons.append("the moving points are labeled")
+        if layer.diagramsEnabled():
+            reasons.append("the moving points have diagrams")
+        if layer.featureBlendMode() != QPainter.CompositionMode_SourceOver:
+            reasons.append("the moving points use feature blending")
+
+        renderer = layer.renderer()
+        if renderer.type() not in SpriteCompositor.SUPPORTED_RENDERERS:
+            reasons.append(
+                f"the {renderer.type()} renderer of the moving points is not supported"
+            )
+        else:
+            if (
+                renderer.type() != "singleSymbol"
+                and not QgsExpression(renderer.classAttribute()).isField()
+            ):
+                reasons.append("the moving points are classified by an expression")
+            if renderer.usingSymbolLevels():
+                reasons.append("the moving points use symbol levels")
+            if renderer.paintEffect() and renderer.paintEffect().enabled():
+                reasons.append("the moving points have draw effects")
+            for symbol in renderer.symbols(
+                QgsRenderContext.fromMapSettings(map_settings)
+            ):
+                reasons.extend(self.symbol_reasons(symbol))
+
+        for background_layer in map_settings.layers():
+            variables = frame_dependencies(background_layer)
+            if variables:
+                reasons.append(
+                    "{} depends on {}".format(
+                        background_layer.name(),
+                        ", ".join(f"@{variable}" for variable in sorted(variables)),
+                    )
+                )
+            elif (
+                map_settings.isTemporal()
+                and background_layer.temporalProperties()
+                and background_layer.temporalProperties().isActive()
+            ):
+                reasons.append(f"{background_layer.name()} changes over time")
+            if (
+                isinstance(background_layer, QgsVectorLayer)
+                and background_layer.labelsEnabled()
+            ):
+                # labels are drawn above all layers, so would be covered by
+                # the sprites
+                reasons.append(f"{background_layer.name()} is labeled")
+        return reasons
+
+    @staticmethod
+    def symbol_reasons(symbol: QgsSymbol) -> List[str]:
+        """
+        Returns the reasons why a symbol cannot be drawn as a sprite
+        """
+        if not isinstance(symbol, QgsMarkerSymbol):
+            return ["the moving points do not use marker symbols"]
+        reasons = []
+        if symbol.hasDataDefinedProperties():
+            reasons.append("the moving points have data defined symbols")
+        for symbol_layer in symbol.symbolLayers():
+            if symbol_layer.layerType() == "GeometryGenerator":
+                reasons.append("the moving points use geometry generators")
+            elif symbol_layer.paintEffect() and symbol_layer.paintEffect().enabled():
+                reasons.append("the moving points have draw effects")
+        return reasons
+
+    def prepare(self, map_settings: QgsMapSettings):
+        """
+        Renders the background and the sprites, if not already done
+
+        :param map_settings: settings of the map without the moving points
+        """
+        if self.background is not None:
+            return
+
+        render_job = QgsMapRendererParallelJob(map_settings)
+        render_job.start()
+        render_job.waitForFinished()
+        self.background = render_job.renderedImage()
+
+        self.create_sprites(map_settings)
+        if self.layer.crs() != map_settings.destinationCrs():
+            self.transform = QgsCoordinateTransform(
+                self.layer.crs(), map_settings.destinationCrs(), QgsProject.instance()
+            )
+
+    def create_sprites(self, map_settings: QgsMapSettings):
+        """
+        Rasterizes the symbol of each point, once for each distinct symbol
+        """
+        context = QgsRenderContext.fromMapSettings(map_settings)
+        context.expressionContext().appendScope(
+            QgsExpressionContextUtils.layerScope(self.layer)
+        )
+        renderer = self.layer.renderer().clone()
+        renderer.startRender(context, self.layer.fields())
+
+        sprite_keys = {}
+        anchors = []
+        self.point_sprites = np.full(len(self.attributes), -1, dtype=np.int64)
+        feature = QgsFeature(self.layer.fields())
+        for point, attributes in enumerate(self.attributes):
+            feature.setAttributes(attributes)
+            context.expressionContext().setFeature(feature)
+            symbol = renderer.symbolForFeature(feature, context)
+            if symbol is None:
+                continue
+            key = QgsSymbolLayerUtils.symbolProperties(symbol)
+            if key not in sprite_keys:
+                sprite_keys[key] = len(self.sprites)
+                sprite, anchor = self.rasterize(symbol, context)
+                self.sprites.append(sprite)
+                anchors.append(anchor)
+            self.point_sprites[point] = sprite_keys[key]
+        renderer.stopRender(context)
+
+        self.anchors = np.array(anchors, dtype=float).reshape(-1, 2)
+        self.sizes = np.array(
+            [(sprite.width(), sprite.height()) for sprite in self.sprites],
+            dtype=float,
+        ).reshape(-1, 2)
+
+    @staticmethod
+    def rasterize(
+        symbol: QgsMarkerSymbol, context: QgsRenderContext
+    ) -> Tuple[QImage, Tuple[float, float]]:
+        """
+        Renders a marker symbol to an image
+
+        :returns: the image, and the position of the marker's point in it
+        """
+        symbol = symbol.clone()
+        padding = SpriteCompositor.SPRITE_PADDING
+
+        scratch = QImage(1, 1, QImage.Format_ARGB32_Premultiplied)
+        painter = QPainter(scratch)
+        context.setPainter(painter)
+        symbol.startRender(context)
+        bounds = symbol.bounds(QPointF(0, 0), context)
+        symbol.stopRender(context)
+        painter.end()
+
+        image = QImage(
+            math.ceil(bounds.width()) + 2 * padding,
+            math.ceil(bounds.height()) + 2 * padding,
+            QImage.Format_ARGB32_Premultiplied,
+        )
+        image.fill(Qt.transparent)
+        anchor = QPointF(padding - bounds.left(), padding - bounds.top())
+        painter = QPainter(image)
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        context.setPainter(painter)
+        symbol.startRender(context)
+        symbol.renderPoint(anchor, None, context)
+        symbol.stopRender(context)
+        painter.end()
+        context.setPainter(None)
+        return image, (anchor.x(), anchor.y())
+
+    def placements(
+        self, frame: int, map_settings: QgsMapSettings
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns the sprites to draw for a frame, and the pixel positions of
+        their top left corners, leaving out sprites outside of the map
+
+        :returns: sprite index, left and top arrays
+        """
+        positions = self.positions[frame]
+        visible = ~np.isnan(positions[:, 0]) & (self.point_sprites >= 0)
+        points = np.nonzero(visible)[0]
+        xs = positions[points, 0].astype(float)
+        ys = positions[points, 1].astype(float)
+        if self.transform and len(points):
+            xs, ys = transform_points(xs, ys, self.transform)
+
+        extent = map_settings.visibleExtent()
+        map_units_per_pixel = map_settings.mapUnitsPerPixel()
+        sprites = self.point_sprites[points]
+        with np.errstate(invalid="ignore"):
+            left = np.rint(
+                (xs - extent.xMinimum()) / map_units_per_pixel
+                - self.anchors[sprites, 0]
+            )
+            top = np.rint(
+                (extent.yMaximum() - ys) / map_units_per_pixel
+                - self.anchors[sprites, 1]
+            )
+            size = map_settings.outputSize()
+            inside = (
+                (left < size.width())
+                & (top < size.height())
+                & (left + self.sizes[sprites, 0] > 0)
+                & (top + self.sizes[sprites, 1] > 0)
+            )
+        return (
+            sprites[inside],
+            left[inside].astype(np.int64),
+            top[inside].astype(np.int64),
+        )
+
+    def draw(
+        self,
+        painter: QPainter,
+        placements: Tuple[np.ndarray, np.ndarray, np.ndarray],
+    ):
+        """
+        Draws the background and the sprites of a frame
+        """
+        painter.drawImage(0, 0, self.background)
+        sprites, lefts, tops = placements
+
+        opacity = self.layer.opacity()
+        blend_mode = self.layer.blendMode()
+        if opacity >= 1 and blend_mode == QPainter.CompositionMode_SourceOver:
+            target = painter
+        else:
+            # the layer's opacity and blending apply to all its points at
+            # once, so the sprites are drawn to their own image first
+            image = QImage(self.background.size(), QImage.Format_ARGB32_Premultiplied)
+            image.fill(Qt.transparent)
+            target = QPainter(image)
+
+        for sprite, left, top in zip(sprites, lefts, tops):
+            target.drawImage(int(left), int(top), self.sprites[sprite])
+
+        if target is not painter:
+            target.end()
+            painter.save()
+            painter.setOpacity(opacity)
+            painter.setCompositionMode(blend_mode)
+            painter.drawImage(0, 0, image)
+            painter.restore()
+
+    def frame(self, frame: int) -> "SpriteFrame":
+        """
+        Returns a frame to draw with the compositor
+        """
+        return SpriteFrame(self, frame)
+
+
+class SpriteFrame:
+    """
+    A frame drawn by a sprite compositor
+    """
+
+    def __init__(self, compositor: SpriteCompositor, frame: int):
+        self.compositor = compositor
+        self.frame = frame
+
+    def create_task(
+        self,
+        map_settings: QgsMapSettings,
+        file_name: str,
+        flags: QgsTask.Flags = QgsTask.CanCancel,
+    ) -> "SpriteRendererTask":
+        """
+        Creates a task drawing the frame to an image file. This must be
+        called from the main thread.
+        """
+        self.compositor.prepare(map_settings)
+        return SpriteRendererTask(
+            map_settings,
+            file_name,
+            self.compositor,
+            self.compositor.placements(self.frame, map_settings),
+            flags,
+        )
+
+    def render_to_image(self, map_settings: QgsMapSettings) -> QImage:
+        """
+        Draws the frame to an image
+        """
+        self.compositor.prepare(map_settings)
+        image = QImage(self.compositor.background.size(), QImage.Format_ARGB32)
+        image.fill(map_settings.backgroundColor())
+        painter = QPainter(image)
+        self.compositor.draw(
+            painter, self.compositor.placements(self.frame, map_settings)
+        )
+        painter.end()
+        return image
+
+
+class SpriteRendererTask(FilteredMapRendererTask):
+    """
+    Draws a frame with a sprite compositor to an image file, with the
+    same decorations and annotations as a rendered frame
+    """
+
+    def __init__(
+        self,
+        map_settings: QgsMapSettings,
+        file_name: str,
+        compositor: SpriteCompositor,
+        placements: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        flags: QgsTask.Flags = QgsTask.CanCancel,
+    ):
+        super().__init__(map_settings, file_name, {}, flags)
+        self.compositor = compositor
+        self.placements = placements
+
+    def prepare(self) -> Optional[QgsMapRendererCustomPainterJob]:
+        """
+        Frames drawn with sprites have no layers to render
+        """
+        return None
+
+    def render_map(self, painter: QPainter) -> bool:
+        """
+        Draws the background and sprites of the frame
+        """
+        self.compositor.draw(painter, self.placements)
+        return not self.isCanceled()
@@ -0,0 +1,336 @@
+# coding=utf-8
+
+"""Index of the time ranges of the features of a temporal layer."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import math
+from array import array
+from typing import List, Optional, Tuple
+
+from qgis.PyQt.QtCore import QDate, QDateTime, Qt
+from qgis.core import (
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeatureRequest,
+    QgsInterval,
+    QgsVectorLayer,
+    QgsVectorLayerTemporalProperties,
+)
+
+from .data_preparation import layer_data_revision
+
+
+def to_seconds(value) -> Optional[float]:
+    """
+    Converts a date or date time value to seconds since the epoch, or
+    None if the value is not a valid date or date time
+    """
+    if isinstance(value, QDate):
+        value = QDateTime(value)
+    elif isinstance(value, str):
+        value = QDateTime.fromString(value, Qt.ISODate)
+    if not isinstance(value, QDateTime) or not value.isValid():
+        return None
+    return value.toMSecsSinceEpoch() / 1000
+
+
+def to_date_time(seconds: float) -> QDateTime:
+    """
+    Converts seconds since the epoch to a date time
+    """
+    return QDateTime.fromMSecsSinceEpoch(int(round(seconds * 1000)))
+
+
+def accumulates_features(layer: QgsVectorLayer) -> bool:
+    """
+    Returns True if a layer's features stay visible once they have
+    started, with its "accumulate features over time" setting, which
+    older QGIS versions do not have
+    """
+    properties = layer.temporalProperties()
+    return bool(getattr(properties, "accumulateFeatures", lambda: False)())
+
+
+class TemporalFeatureIndex:
+    """
+    Index of the time range of each feature of a layer, used to look up
+    the features visible in each frame's time window without evaluating
+    the layer's temporal filter against every feature on every frame.
+
+    The layer's time range is split into equal buckets, and each feature
+    is added to the buckets its time range overlaps. Features spanning
+    many buckets are kept in a separate list which is checked for every
+    window, so the index stays small for long lived features.
+
+    If the layer accumulates features over time, each window is looked up
+    from the start of the layer's time range, as QGIS filters the layer.
+    """
+
+    # Number of buckets the layer's time range is split into
+    BUCKET_COUNT = 4096
+    # Features spanning more buckets than this are not added to buckets
+    MAX_SPANNED_BUCKETS = 16
+
+    def __init__(
+        self,
+        layer: QgsVectorLayer,
+        start_expression: str,
+        end_expression: Optional[str] = None,
+        duration: float = 0,
+        accumulate: bool = False,
+    ):
+        """
+        :param layer: temporal layer to index
+        :param start_expression: expression giving each feature's start time
+        :param end_expression: optional expression giving each feature's end
+            time. If not set features last for the duration.
+        :param duration: duration of features without an end time, in seconds
+        :param accumulate: True if features stay visible once they have
+            started
+        """
+        self.layer = layer
+        self.accumulate = accumulate
+        self.revision: str = self.layer_revision(layer)
+        self.ids = array("q")
+        self.starts = array("d")
+        self.ends = array("d")
+        self.begin: float = 0
+        self.end: float = 0
+        self.bucket_size: float = 1
+        self.buckets: List[array] = []
+        # positions of the features spanning too many buckets to index
+        self.long_features = array("q")
+
+        self.read_layer(start_expression, end_expression, duration)
+        self.build_buckets()
+
+    @staticmethod
+    def layer_revision(layer: QgsVectorLayer) -> str:
+        """
+        Returns a string which changes whenever the layer's data or
+        temporal settings change
+        """
+        properties = layer.temporalProperties()
+        return "|".join(
+            [
+                layer_data_revision(layer),
+                str(properties.mode()),
+                properties.startField(),
+                properties.endField(),
+                properties.startExpression(),
+                properties.endExpression(),
+                str(properties.fixedDuration()),
+                str(properties.durationUnits()),
+                str(accumulates_features(layer)),
+            ]
+        )
+
+    def is_current(self) -> bool:
+        """
+        Returns True if the index is up to date with its layer
+        """
+        return self.revision == self.layer_revision(self.layer)
+
+    @staticmethod
+    def from_layer(layer: QgsVectorLayer) -> "TemporalFeatureIndex":
+        """
+        Creates an index using the layer's temporal properties
+
+        :raises ValueError: if the layer's temporal properties are not
+            supported
+        """
+        properties = layer.temporalProperties()
+        if not properties.isActive():
+            raise ValueError(f"{layer.name()} has no temporal settings")
+
+        mode = properties.mode()
+        accumulate = accumulates_features(layer)
+        if mode == QgsVectorLayerTemporalProperties.ModeFeatureDateTimeInstantFromField:
+            return TemporalFeatureIndex(
+                layer,
+                QgsExpression.quotedColumnRef(properties.startField()),
+                duration=QgsInterval(
+                    properties.fixedDuration(), properties.durationUnits()
+                ).seconds(),
+                accumulate=accumulate,
+            )
+        if (
+            mode
+            == QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromFields
+        ):
+            # features without a start or end field are open ended
+            return TemporalFeatureIndex(
+                layer,
+                (
+                    QgsExpression.quotedColumnRef(properties.startField())
+                    if properties.startField()
+                    else "NULL"
+                ),
+                (
+                    QgsExpression.quotedColumnRef(properties.endField())
+                    if properties.endField()
+                    else "NULL"
+                ),
+                accumulate=accumulate,
+            )
+        if (
+            mode
+            == QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromExpressions
+        ):
+            return TemporalFeatureIndex(
+                layer,
+                properties.startExpression(),
+                properties.endExpression(),
+                accumulate=accumulate,
+            )
+        raise ValueError(
+            f"The temporal settings of {layer.name()} are not supported, use "
+            "start and end fields or expressions, or a single date time field"
+        )
+
+    def read_layer(
+        self, start_expression: str, end_expression: Optional[str], duration: float
+    ):
+        """
+        Reads the time range of each feature from the layer
+        """
+        context = QgsExpressionContext(
+            QgsExpressionContextUtils.globalProjectLayerScopes(self.layer)
+        )
+        start = QgsExpression(start_expression)
+        start.prepare(context)
+        end = None
+        if end_expression:
+            end = QgsExpression(end_expression)
+            end.prepare(context)
+
+        attributes = set(start.referencedColumns())
+        if end:
+            attributes.update(end.referencedColumns())
+        request = QgsFeatureRequest()
+        if not start.needsGeometry() and not (end and end.needsGeometry()):
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if QgsFeatureRequest.ALL_ATTRIBUTES not in attributes:
+            request.setSubsetOfAttributes(list(attributes), self.layer.fields())
+
+        for feature in self.layer.getFeatures(request):
+            context.setFeature(feature)
+            start_time = to_seconds(start.evaluate(context))
+            end_time = to_seconds(end.evaluate(context)) if end else None
+            if start_time is None and end_time is None:
+                # features without a time are never visible
+                continue
+            if start_time is None:
+                start_time = -math.inf
+            if end_time is None:
+                end_time = math.inf if end else start_time + duration
+
+            self.ids.append(feature.id())
+            self.starts.append(start_time)
+            self.ends.append(end_time)
+
+    def build_buckets(self):
+        """
+        Adds each feature to the buckets its time range overlaps
+        """
+        finite = [t for t in self.starts if math.isfinite(t)] + [
+            t for t in self.ends if math.isfinite(t)
+        ]
+        if not finite:
+            return
+        self.begin = min(finite)
+        self.end = max(finite)
+        self.bucket_size = (self.end - self.begin) / TemporalFeatureIndex.BUCKET_COUNT
+        if self.bucket_size <= 0:
+            self.bucket_size = 1
+        self.buckets = [array("q") for _ in range(TemporalFeatureIndex.BUCKET_COUNT)]
+
+        for position, (start, end) in enumerate(zip(self.starts, self.ends)):
+            first, last = self.bucket_range(start, end)
+            if last - first >= TemporalFeatureIndex.MAX_SPANNED_BUCKETS:
+                self.long_features.append(position)
+                continue
+            for bucket in range(first, last + 1):
+                self.buckets[bucket].append(position)
+
+    def bucket_range(self, start: float, end: float) -> Tuple[int, int]:
+        """
+        Returns the first and last buckets overlapping a time range
+        """
+        last_bucket = len(self.buckets) - 1
+
+        def bucket(time: float) -> int:
+            if time == -math.inf:
+                return 0
+            if time == math.inf:
+                return last_bucket
+            return min(
+                max(int((time - self.begin) // self.bucket_size), 0), last_bucket
+            )
+
+        return bucket(start), bucket(end)
+
+    def frame_window(self, frame: int, frame_count: int) -> Tuple[float, float]:
+        """
+        Returns the time window of a frame, when the layer's time range is
+        split evenly over a number of frames
+
+        :returns: start and end of the window, in seconds since the epoch
+        """
+        frame_duration = (self.end - self.begin) / max(frame_count, 1)
+        begin = self.begin + frame * frame_duration
+        return begin, begin + frame_duration
+
+    def feature_ids(self, begin: float, end: float, include_end: bool = False) -> array:
+        """
+        Returns the ids of the features visible in a time window, in the
+        layer's feature order. If features accumulate, this includes the
+        features which ended before the window.
+
+        :param begin: start of the window, in seconds since the epoch
+        :param end: end of the window, in seconds since the epoch
+        :param include_end: True to include features starting at the end
+            of the window, e.g. for the last frame of the animation
+        """
+        if not self.buckets:
+            return array("q")
+        if self.accumulate:
+            begin = -math.inf
+        first, last = self.bucket_range(begin, end)
+        candidates = set(self.long_features)
+        for bucket in range(first, last + 1):
+            candidates.update(self.buckets[bucket])
+        return array(
+            "q",
+            (
+                self.ids[position]
+                for position in sorted(candidates)
+                if (
+                    self.starts[position] <= end
+                    if include_end
+                    else self.starts[position] < end
+                )
+                and (
+                    self.ends[position] >= begin
+                    if self.ends[position] > self.starts[position]
+                    # instants are visible in the window containing them
+                    else self.starts[position] >= begin
+                )
+            ),
+        )
@@ -0,0 +1,203 @@
+# coding=utf-8
+
+"""Ordering of the features of an animation to minimize travel."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import math
+from typing import List, Sequence
+
+from qgis.core import QgsPointXY, QgsRectangle, QgsSpatialIndex
+
+
+def distance_scaled_travel_frames(
+    lengths: Sequence[float], travel_frames: int, min_frames: int = 2
+) -> List[int]:
+    """
+    Distributes travel frames over the segments of a tour in proportion
+    to their lengths, keeping the total travel time of the tour
+
+    :param lengths: length of each segment of the tour
+    :param travel_frames: travel frames per segment, on average
+    :param min_frames: minimum number of frames for any segment
+    """
+    total_length = sum(lengths)
+    if total_length <= 0:
+        return [travel_frames for _ in lengths]
+    total_frames = travel_frames * len(lengths)
+    return [
+        max(min_frames, int(round(total_frames * length / total_length)))
+        for length in lengths
+    ]
+
+
+class TourOptimizer:
+    """
+    Orders a set of points to minimize the total distance travelled
+    when visiting them in turn.
+
+    A tour is built by always travelling to the nearest point not yet
+    visited, using a spatial index, and is then improved by 2-opt moves
+    (reversing parts of the tour which cross or double back), considering
+    only the nearest neighbours of each point so that large tours stay
+    fast to optimize. The first point always stays first.
+    """
+
+    # Number of nearest neighbours considered for each point by 2-opt
+    NEIGHBOURS = 8
+    # Maximum number of 2-opt passes over the tour
+    MAX_PASSES = 50
+    # Improvements smaller than this are ignored, to avoid cycling on
+    # rounding errors
+    EPSILON = 1e-9
+
+    def __init__(self, points: Sequence[QgsPointXY], loop: bool = False):
+        """
+        :param points: points to visit
+        :param loop: True if the tour returns from the last point to the first
+        """
+        self.points: List[QgsPointXY] = list(points)
+        self.loop = loop
+        self.index = QgsSpatialIndex()
+        for i, point in enumerate(self.points):
+            self.index.addFeature(i, QgsRectangle(point, point))
+        self.neighbours: List[List[int]] = [
+            [
+                j
+                for j in self.index.nearestNeighbor(point, TourOptimizer.NEIGHBOURS + 1)
+                if j != i
+            ]
+            for i, point in enumerate(self.points)
+        ]
+
+    def distance(self, i: int, j: int) -> float:
+        """
+        Returns the distance between two points, by index
+        """
+        return math.hypot(
+            self.points[i].x() - self.points[j].x(),
+            self.points[i].y() - self.points[j].y(),
+        )
+
+    def segment_lengths(self, order: Sequence[int]) -> List[float]:
+        """
+        Returns the length of each segment of a tour, including the
+        segment back to the first point for looping tours
+        """
+        lengths = [self.distance(a, b) for a, b in zip(order, order[1:])]
+        if self.loop and len(order) > 1:
+            lengths.append(self.distance(order[-1], order[0]))
+        return lengths
+
+    def length(self, order: Sequence[int]) -> float:
+        """
+        Returns the total length of a tour
+        """
+        return sum(self.segment_lengths(order))
+
+    def nearest_neighbour_order(self) -> List[int]:
+        """
+        Returns a tour starting at the first point, which always travels to
+        the nearest point not yet visited
+        """
+        count = len(self.points)
+        if count == 0:
+            return []
+        order = [0]
+        remaining = set(range(1, count))
+        while remaining:
+            current = self.points[order[-1]]
+            candidates = []
+            neighbours = TourOptimizer.NEIGHBOURS
+            while not candidates and neighbours < len(self.points):
+                candidates = [
+                    j
+                    for j in self.index.nearestNeighbor(current, neighbours)
+                    if j in remaining
+                ]
+                neighbours *= 4
+            if not candidates:
+                # all nearby points are visited, fall back to a full scan
+                candidates = list(remaining)
+            following = min(candidates, key=lambda j: self.distance(order[-1], j))
+            order.append(following)
+            remaining.remove(following)
+        return order
+
+    def improve(self, order: Sequence[int]) -> List[int]:
+        """
+        Improves a tour with 2-opt moves until no move shortens it
+        """
+        order = list(order)
+        count = len(order)
+        if count < 4:
+            return order
+        position = [0] * count
+        for i, point in enumerate(order):
+            position[point] = i
+        # open tours have no edge from the last point back to the first
+        edge_count = count if self.loop else count - 1
+
+        for _ in range(TourOptimizer.MAX_PASSES):
+            improved = False
+            for i in range(edge_count):
+                a = order[i]
+                b = order[(i + 1) % count]
+                for c in self.neighbours[a]:
+                    j = position[c]
+                    if j >= edge_count:
+                        continue
+                    d = order[(j + 1) % count]
+                    if c == b or d == a:
+                        continue
+                    delta = (
+                        self.distance(a, c)
+                        + self.distance(b, d)
+                        - self.distance(a, b)
+                        - self.distance(c, d)
+                    )
+                    if delta < -TourOptimizer.EPSILON:
+                        # reverse the points between the two edges, so that
+                        # they become (a, c) and (b, d)
+                        start, end = (i + 1, j) if i < j else (j + 1, i)
+                        order[start : end + 1] = order[start : end + 1][::-1]
+                        for k in range(start, end + 1):
+                            position[order[k]] = k
+                        improved = True
+                        break
+                else:
+                    if not self.loop and i < count - 2:
+                        # open tours can also end at any point, by
+                        # reversing the rest of the tour after a
+                        last = order[-1]
+                        if (
+                            self.distance(a, last)
+                            < self.distance(a, b) - TourOptimizer.EPSILON
+                        ):
+                            order[i + 1 :] = order[i + 1 :][::-1]
+                            for k in range(i + 1, count):
+                                position[order[k]] = k
+                            improved = True
+            if not improved:
+                break
+        return order
+
+    def optimize(self) -> List[int]:
+        """
+        Returns the indexes of the points in the optimized visiting order
+        """
+        return self.improve(self.nearest_neighbour_order())
@@ -0,0 +1,233 @@
+# coding=utf-8
+
+"""Chrome trace event recording of the animation export pipeline."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from .render_metrics import RenderMetrics
+from .settings import setting
+
+
+class TraceRecorder:
+    """
+    Records the stages of an export as Chrome trace events.
+
+    The written JSON file can be opened in https://ui.perfetto.dev or
+    chrome://tracing to show job generation, render tasks on their worker
+    threads, queue waits and movie encoder subprocesses on a single
+    timeline, making idle gaps and serialization points visible.
+
+    Recording is only performed when enabled in the workbench settings
+    (the "trace_export" key), so stages can always be wrapped in spans
+    at negligible cost.
+
+    Events are grouped into named lanes (shown as threads in the trace
+    viewer) rather than by the real thread identifiers, so that each
+    render worker slot gets a stable lane.
+    """
+
+    MAIN_LANE = "main"
+    ENCODER_LANE = "movie encoder"
+
+    def __init__(self, enabled: Optional[bool] = None):
+        if enabled is None:
+            enabled = bool(int(setting(key="trace_export", default=0)))
+        self.enabled: bool = enabled
+        self.origin: float = time.time()
+        self.events: List[dict] = []
+        self.lanes: Dict[str, int] = {}
+
+    def _lane_id(self, lane: str) -> int:
+        """
+        Returns the trace thread id for a lane, registering it if required
+        """
+        lane_id = self.lanes.get(lane)
+        if lane_id is None:
+            lane_id = len(self.lanes) + 1
+            self.lanes[lane] = lane_id
+        return lane_id
+
+    def _timestamp(self, seconds: float) -> float:
+        """
+        Converts a time.time() value to trace microseconds
+        """
+        return (seconds - self.origin) * 1000000
+
+    def add_span(
+        self,
+        name: str,
+        category: str,
+        start: float,
+        end: float,
+        lane: str = MAIN_LANE,
+        args: Optional[dict] = None,
+    ):
+        """
+        Records a completed span.
+
+        :param name: name of the span
+        :param category: trace category, e.g. "render" or "encode"
+        :param start: start time, as a time.time() value
+        :param end: end time, as a time.time() value
+        :param lane: name of the lane to show the span in
+        :param args: optional details shown when the span is selected
+        """
+        if not self.enabled:
+            return
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": self._timestamp(start),
+            "dur": max(end - start, 0) * 1000000,
+            "pid": 1,
+            "tid": self._lane_id(lane),
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def add_async_span(
+        self, name: str, category: str, span_id: int, start: float, end: float
+    ):
+        """
+        Records a span which may overlap others in the same category,
+        such as the time frames spend waiting in the queue
+        """
+        if not self.enabled:
+            return
+        for phase, timestamp in (("b", start), ("e", end)):
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": phase,
+                    "id": span_id,
+                    "ts": self._timestamp(timestamp),
+                    "pid": 1,
+                    "tid": self._lane_id(TraceRecorder.MAIN_LANE),
+                }
+            )
+
+    @contextmanager
+    def span(
+        self,
+        name: str,
+        category: str,
+        lane: str = MAIN_LANE,
+        args: Optional[dict] = None,
+    ):
+        """
+        Context manager recording the enclosed block as a span
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, category, start, time.time(), lane, args)
+
+    def add_frame_timings(self, metrics: RenderMetrics):
+        """
+        Records the render tasks and queue waits from a render queue run
+        """
+        if not self.enabled:
+            return
+        for index, timing in enumerate(metrics.timings.values()):
+            frame_name = os.path.basename(timing.file_name)
+            if timing.queued is not None and timing.started is not None:
+                self.add_async_span(
+                    "queue wait", "queue", index, timing.queued, timing.started
+                )
+            if timing.started is None:
+                continue
+            lane = f"render worker {timing.worker or 0}"
+            if timing.rendered is not None:
+                self.add_span(
+                    frame_name,
+                    "render",
+                    timing.started,
+                    timing.rendered,
+                    lane,
+                    {"file_name": timing.file_name, "success": timing.success},
+                )
+                if timing.written is not None:
+                    self.add_span(
+                        "write",
+                        "render",
+                        timing.rendered,
+                        timing.written,
+                        lane,
+                        {"output_size": timing.output_size},
+                    )
+
+    def trace_events(self) -> List[dict]:
+        """
+        Returns all recorded events, preceded by lane name metadata
+        """
+        metadata = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": 1,
+                "args": {"name": "Animation Workbench export"},
+            }
+        ]
+        for lane, lane_id in self.lanes.items():
+            metadata.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": lane_id,
+                    "args": {"name": lane},
+                }
+            )
+            metadata.append(
+                {
+                    "name": "thread_sort_index",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": lane_id,
+                    "args": {"sort_index": lane_id},
+                }
+            )
+        return metadata + self.events
+
+    def write(self, directory: str, prefix: str) -> List[str]:
+        """
+        Writes the trace to "<prefix>-trace.json" in the given directory
+
+        :returns: list of written file paths
+        """
+        if not self.enabled:
+            return []
+        trace_path = os.path.join(directory, f"{prefix}-trace.json")
+        with open(trace_path, "w", encoding="utf-8") as trace_file:
+            json.dump(
+                {"traceEvents": self.trace_events(), "displayTimeUnit": "ms"},
+                trace_file,
+            )
+        return [trace_path]
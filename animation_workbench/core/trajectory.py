@@ -0,0 +1,273 @@
+# coding=utf-8
+
+"""Interpolation of moving points along tracks."""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+__license__ = "GPL version 3"
+__email__ = "tim@kartoza.com"
+__revision__ = "$Format:%H$"
+
+# -----------------------------------------------------------
+# Copyright (C) 2022 Tim Sutton
+# -----------------------------------------------------------
+# Licensed under the terms of GNU GPL 3
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+# ---------------------------------------------------------------------
+
+import os
+from typing import List, Optional
+
+import numpy as np
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsMapLayerStyle,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+from .data_preparation import layer_data_revision
+from .sprite_renderer import multipoint_geometry
+
+
+class TrajectoryInterpolator:
+    """
+    Precomputes the position of a moving point along each track of a line
+    layer for every frame of an animation, and builds the layer of points
+    for each frame from those positions.
+
+    If the tracks have M values these are used as the time (in seconds) at
+    each vertex, so points move at their recorded speeds and only appear
+    while their track is active. Otherwise every point travels along its
+    whole track at a constant speed over the length of the animation.
+
+    Positions are computed with NumPy for blocks of frames at a time, and
+    stored in a memory mapped array so that long animations with many
+    tracks do not need to fit in memory.
+
+    The layer of points for a frame is only built when the frame's render
+    task is created, so the layers of queued frames are not all kept in
+    memory. Everything it needs from the line layer is read when the
+    interpolator is created.
+    """
+
+    # Number of frames interpolated at a time
+    FRAME_BLOCK = 64
+
+    def __init__(self, layer: QgsVectorLayer, style_file: Optional[str] = None):
+        """
+        :param layer: line layer containing the tracks
+        :param style_file: optional QML style for the moving points
+        """
+        self.layer = layer
+        self.style_file = style_file
+        self.revision: str = layer_data_revision(layer)
+        self.uses_time = QgsWkbTypes.hasM(layer.wkbType())
+        self.name: str = layer.name()
+        self.crs = QgsCoordinateReferenceSystem(layer.crs())
+        self.fields = layer.fields()
+
+        # Vertices of all tracks, concatenated, with the start of each
+        # track's vertices in offsets
+        self.xs = np.zeros(0)
+        self.ys = np.zeros(0)
+        self.times = np.zeros(0)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.attributes: List[list] = []
+        # A feature with the attributes of each track, copied for the
+        # track's point in each frame
+        self.features: List[QgsFeature] = []
+        self.read_tracks()
+
+        # Positions for each frame and track, NaN if not visible
+        self.positions: Optional[np.ndarray] = None
+        self.style: QgsMapLayerStyle = self.create_style()
+
+    def read_tracks(self):
+        """
+        Reads the vertices and attributes of each track
+        """
+        xs = []
+        ys = []
+        times = []
+        offsets = [0]
+        for feature in self.layer.getFeatures():
+            geometry = feature.geometry()
+            if geometry.isEmpty():
+                continue
+            vertices = np.array(
+                [(v.x(), v.y(), v.m()) for v in geometry.vertices()], dtype=float
+            )
+            if self.uses_time:
+                track_times = vertices[:, 2]
+                if np.isnan(track_times).any():
+                    continue
+                # times must not go backwards
+                track_times = np.maximum.accumulate(track_times)
+            else:
+                # linear referencing, by the fraction of the track's length
+                steps = np.hypot(np.diff(vertices[:, 0]), np.diff(vertices[:, 1]))
+                distance = np.concatenate([[0], np.cumsum(steps)])
+                track_times = distance / distance[-1] if distance[-1] > 0 else distance
+
+            xs.append(vertices[:, 0])
+            ys.append(vertices[:, 1])
+            times.append(track_times)
+            offsets.append(offsets[-1] + len(vertices))
+            self.attributes.append(feature.attributes())
+            track_feature = QgsFeature(self.fields)
+            track_feature.setAttributes(feature.attributes())
+            self.features.append(track_feature)
+
+        if xs:
+            self.xs = np.concatenate(xs)
+            self.ys = np.concatenate(ys)
+            self.times = np.concatenate(times)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    @property
+    def track_count(self) -> int:
+        """
+        Returns the number of tracks
+        """
+        return len(self.offsets) - 1
+
+    def time_range(self):
+        """
+        Returns the first and last times of all tracks
+        """
+        if not len(self.times):  # pylint: disable=len-as-condition
+            return 0.0, 0.0
+        return float(self.times.min()), float(self.times.max())
+
+    def frame_times(self, frame_count: int) -> np.ndarray:
+        """
+        Returns the time of each frame
+        """
+        begin, end = self.time_range()
+        return np.linspace(begin, end, frame_count)
+
+    def interpolate(self, times: np.ndarray) -> np.ndarray:
+        """
+        Returns the position of every track at each of the given times
+
+        :returns: array of shape (len(times), track count, 2), with NaN
+            for tracks which are not active at a time
+        """
+        count = self.track_count
+        result = np.full((len(times), count, 2), np.nan, dtype=np.float32)
+        if not count:
+            return result
+
+        starts = self.offsets[:-1]
+        ends = self.offsets[1:] - 1
+        # Tracks are searched all at once, by offsetting each track's times
+        # so that the times of all tracks form one increasing sequence
+        begin, end = self.time_range()
+        stride = (end - begin) + 1
+        track_index = np.repeat(np.arange(count), np.diff(self.offsets))
+        keys = (self.times - begin) + track_index * stride
+
+        query_times = np.asarray(times, dtype=float)[:, np.newaxis]
+        active = (query_times >= self.times[starts]) & (query_times <= self.times[ends])
+        queries = (query_times - begin) + np.arange(count) * stride
+
+        lower = np.searchsorted(keys, queries, side="right") - 1
+        lower = np.clip(lower, starts, np.maximum(ends - 1, starts))
+        upper = np.minimum(lower + 1, ends)
+        span = keys[upper] - keys[lower]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.where(span > 0, (queries - keys[lower]) / span, 0)
+        fraction = np.clip(fraction, 0, 1)
+
+        x = self.xs[lower] + (self.xs[upper] - self.xs[lower]) * fraction
+        y = self.ys[lower] + (self.ys[upper] - self.ys[lower]) * fraction
+        result[:, :, 0] = np.where(active, x, np.nan)
+        result[:, :, 1] = np.where(active, y, np.nan)
+        return result
+
+    def precompute(self, frame_count: int, directory: str):
+        """
+        Computes the positions of all tracks for every frame
+
+        :param frame_count: number of frames in the animation
+        :param directory: directory for the memory mapped positions file
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.positions = np.lib.format.open_memmap(
+            os.path.join(directory, "trajectory_positions.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(frame_count, self.track_count, 2),
+        )
+        frame_times = self.frame_times(frame_count)
+        for start in range(0, frame_count, TrajectoryInterpolator.FRAME_BLOCK):
+            end = start + TrajectoryInterpolator.FRAME_BLOCK
+            self.positions[start:end] = self.interpolate(frame_times[start:end])
+        self.positions.flush()
+
+    def is_current(self, frame_count: int) -> bool:
+        """
+        Returns True if the precomputed positions are up to date with the
+        layer and frame count
+        """
+        return (
+            self.positions is not None
+            and len(self.positions) == frame_count
+            and self.revision == layer_data_revision(self.layer)
+        )
+
+    def create_layer(self) -> QgsVectorLayer:
+        """
+        Creates an empty memory layer for the moving points
+        """
+        layer = QgsVectorLayer(
+            "Point?crs={}".format(self.crs.authid() or "EPSG:4326"),
+            f"{self.name} positions",
+            "memory",
+        )
+        if not self.crs.authid():
+            layer.setCrs(self.crs)
+        layer.dataProvider().addAttributes(self.fields.toList())
+        layer.updateFields()
+        return layer
+
+    def create_style(self) -> QgsMapLayerStyle:
+        """
+        Returns the style of the moving points, from the style file if
+        there is one
+        """
+        layer = self.create_layer()
+        if self.style_file:
+            layer.loadNamedStyle(self.style_file)
+        style = QgsMapLayerStyle()
+        style.readFromLayer(layer)
+        return style
+
+    def create_positions_layer(self, frame: int) -> QgsVectorLayer:
+        """
+        Creates a memory layer with the moving points for a frame
+
+        The points' geometries are built from the frame's positions all at
+        once, and their attributes are copied from the track features.
+        """
+        layer = self.create_layer()
+        positions = self.positions[frame]
+        tracks = np.nonzero(~np.isnan(positions[:, 0]))[0]
+        if len(tracks):  # pylint: disable=len-as-condition
+            points = multipoint_geometry(
+                positions[tracks, 0], positions[tracks, 1]
+            ).asGeometryCollection()
+            features = []
+            for track, point in zip(tracks, points):
+                feature = QgsFeature(self.features[track])
+                feature.setGeometry(point)
+                features.append(feature)
+            layer.dataProvider().addFeatures(features)
+            layer.updateExtents()
+        self.style.writeToLayer(layer)
+        return layer
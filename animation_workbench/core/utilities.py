@@ -21,6 +21,7 @@ __revision__ = "$Format:%H$"
 from math import floor
 import os
 import sys
+from typing import Optional
 
 
 class CoreUtils:
@@ -112,3 +113,66 @@ def calculate_cardinality(angle):
     index = int(floor(bearing / direction_interval))
     index %= direction_count
     return direction_list[index]
+
+
+def memory_usage() -> Optional[int]:
+    """Return the resident set size of the current process.
+
+    Uses psutil when it is available, otherwise falls back to /proc on
+    Linux.
+
+    :return: Resident set size in bytes, or None if it cannot be determined.
+    :rtype: int
+    """
+    try:
+        import psutil  # pylint: disable=import-outside-toplevel
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/statm", encoding="utf-8") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def human_readable_size(size: Optional[float]) -> str:
+    """Format a size in bytes for display.
+
+    :param size: Size in bytes.
+    :type size: float
+
+    :return: Formatted size, e.g. "12.3 MB".
+    :rtype: str
+    """
+    if size is None:
+        return "n/a"
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def human_readable_duration(seconds: Optional[float]) -> str:
+    """Format a duration in seconds for display.
+
+    :param seconds: Duration in seconds.
+    :type seconds: float
+
+    :return: Formatted duration, e.g. "1h 02m 03s".
+    :rtype: str
+    """
+    if seconds is None:
+        return "n/a"
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m {seconds:02d}s"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
@@ -50,6 +50,83 @@ class WorkbenchSettings(FORM_CLASS, QgsOptionsPageWidget):
             self.verbose_mode_checkbox.setChecked(True)
         else:
             self.verbose_mode_checkbox.setChecked(False)
+        # Profiles each export stage with cProfile, writing .pstats files
+        # to the working directory for later diagnosis
+        profiling_mode = int(setting(key="profiling_mode", default=0))
+        if profiling_mode:
+            self.profiling_mode_checkbox.setChecked(True)
+        else:
+            self.profiling_mode_checkbox.setChecked(False)
+        # Also records memory snapshots with tracemalloc when profiling
+        profile_memory = int(setting(key="profile_memory", default=0))
+        if profile_memory:
+            self.profile_memory_checkbox.setChecked(True)
+        else:
+            self.profile_memory_checkbox.setChecked(False)
+        # Only renders layers which are visible in each frame
+        cull_layers = int(setting(key="cull_layers", default=0))
+        if cull_layers:
+            self.cull_layers_checkbox.setChecked(True)
+        else:
+            self.cull_layers_checkbox.setChecked(False)
+        # Creates missing spatial indexes and raster overviews before
+        # rendering, optionally copying small vector layers to memory
+        prepare_data = int(setting(key="prepare_data", default=0))
+        if prepare_data:
+            self.prepare_data_checkbox.setChecked(True)
+        else:
+            self.prepare_data_checkbox.setChecked(False)
+        memory_copies = int(setting(key="prepare_data_memory_copies", default=0))
+        if memory_copies:
+            self.memory_copies_checkbox.setChecked(True)
+        else:
+            self.memory_copies_checkbox.setChecked(False)
+        # Warps rasters to the destination CRS once per export
+        raster_warp_cache = int(setting(key="raster_warp_cache", default=0))
+        if raster_warp_cache:
+            self.raster_warp_cache_checkbox.setChecked(True)
+        else:
+            self.raster_warp_cache_checkbox.setChecked(False)
+        # Renders heavy layers with geometries simplified for each scale
+        generalize_layers = int(setting(key="generalize_layers", default=0))
+        if generalize_layers:
+            self.generalize_layers_checkbox.setChecked(True)
+        else:
+            self.generalize_layers_checkbox.setChecked(False)
+        # Encodes the movie from the frames as they are rendered
+        pipelined_encoding = int(setting(key="pipelined_encoding", default=0))
+        if pipelined_encoding:
+            self.pipelined_encoding_checkbox.setChecked(True)
+        else:
+            self.pipelined_encoding_checkbox.setChecked(False)
+        delete_encoded_frames = int(setting(key="delete_encoded_frames", default=0))
+        if delete_encoded_frames:
+            self.delete_encoded_frames_checkbox.setChecked(True)
+        else:
+            self.delete_encoded_frames_checkbox.setChecked(False)
+        # Encodes the movie in segments in parallel, 0 to choose automatically
+        self.encoding_segments_spin.setValue(
+            int(setting(key="encoding_segments", default=1))
+        )
+        # Number of frames to profile layer by layer after each export
+        self.layer_profile_frames_spin.setValue(
+            int(setting(key="layer_profile_frames", default=0))
+        )
+        # Records a Chrome trace event timeline of each export
+        trace_export = int(setting(key="trace_export", default=0))
+        if trace_export:
+            self.trace_export_checkbox.setChecked(True)
+        else:
+            self.trace_export_checkbox.setChecked(False)
+        # Serves Prometheus metrics on localhost while exporting
+        metrics_endpoint = int(setting(key="metrics_endpoint", default=0))
+        if metrics_endpoint:
+            self.metrics_endpoint_checkbox.setChecked(True)
+        else:
+            self.metrics_endpoint_checkbox.setChecked(False)
+        self.metrics_port_spin.setValue(int(setting(key="metrics_port", default=9464)))
+        # Writes Prometheus metrics for the node_exporter textfile collector
+        self.metrics_textfile_edit.setText(setting(key="metrics_textfile", default=""))
 
     def apply(self):
         """Process the animation sequence.
@@ -70,6 +147,73 @@ class WorkbenchSettings(FORM_CLASS, QgsOptionsPageWidget):
         else:
             set_setting(key="verbose_mode", value=0)
 
+        if self.profiling_mode_checkbox.isChecked():
+            set_setting(key="profiling_mode", value=1)
+        else:
+            set_setting(key="profiling_mode", value=0)
+
+        if self.profile_memory_checkbox.isChecked():
+            set_setting(key="profile_memory", value=1)
+        else:
+            set_setting(key="profile_memory", value=0)
+
+        if self.cull_layers_checkbox.isChecked():
+            set_setting(key="cull_layers", value=1)
+        else:
+            set_setting(key="cull_layers", value=0)
+
+        if self.prepare_data_checkbox.isChecked():
+            set_setting(key="prepare_data", value=1)
+        else:
+            set_setting(key="prepare_data", value=0)
+
+        if self.memory_copies_checkbox.isChecked():
+            set_setting(key="prepare_data_memory_copies", value=1)
+        else:
+            set_setting(key="prepare_data_memory_copies", value=0)
+
+        if self.raster_warp_cache_checkbox.isChecked():
+            set_setting(key="raster_warp_cache", value=1)
+        else:
+            set_setting(key="raster_warp_cache", value=0)
+
+        if self.generalize_layers_checkbox.isChecked():
+            set_setting(key="generalize_layers", value=1)
+        else:
+            set_setting(key="generalize_layers", value=0)
+
+        if self.pipelined_encoding_checkbox.isChecked():
+            set_setting(key="pipelined_encoding", value=1)
+        else:
+            set_setting(key="pipelined_encoding", value=0)
+
+        if self.delete_encoded_frames_checkbox.isChecked():
+            set_setting(key="delete_encoded_frames", value=1)
+        else:
+            set_setting(key="delete_encoded_frames", value=0)
+
+        set_setting(
+            key="encoding_segments",
+            value=self.encoding_segments_spin.value(),
+        )
+
+        set_setting(
+            key="layer_profile_frames",
+            value=self.layer_profile_frames_spin.value(),
+        )
+
+        if self.trace_export_checkbox.isChecked():
+            set_setting(key="trace_export", value=1)
+        else:
+            set_setting(key="trace_export", value=0)
+
+        if self.metrics_endpoint_checkbox.isChecked():
+            set_setting(key="metrics_endpoint", value=1)
+        else:
+            set_setting(key="metrics_endpoint", value=0)
+        set_setting(key="metrics_port", value=self.metrics_port_spin.value())
+        set_setting(key="metrics_textfile", value=self.metrics_textfile_edit.text())
+
 
 class AnimationWorkbenchOptionsFactory(QgsOptionsWidgetFactory):
     """
@@ -9,6 +9,7 @@ __revision__ = "$Format:%H$"
 import json
 import os
 from os.path import expanduser
+from typing import List
 from qgis.PyQt.QtWidgets import QWidget, QSizePolicy
 from qgis.PyQt.QtCore import Qt
 
@@ -47,7 +48,6 @@ class MediaListWidget(QWidget, FORM_CLASS):
         # "images", "images and movies", "movies", "sound".
         self.media_type = None
         self.media_filter = None
-        self.output_mode = None
         self.media_list.currentRowChanged.connect(self.media_item_selected)
         self.add_media.clicked.connect(self.choose_media_file)
         self.remove_media.clicked.connect(self.remove_media_file)
@@ -77,21 +77,6 @@ class MediaListWidget(QWidget, FORM_CLASS):
         if media_type == "sounds":
             self.media_filter = self.sounds_filter
 
-    def set_output_resolution(self, mode: str):
-        """Set the output resolution for the media list.
-        :param mode: Mode for video - either "720p", "1080p" or "4k"
-        :type mode: str
-
-        """
-        if mode == "720p":
-            self.output_mode = "1280:720"
-        elif mode == "1080p":
-            self.output_mode = "1920:1080"
-        elif mode == "4k":
-            self.output_mode = "3840:2160"
-        else:  # Map canvas size
-            self.output_mode = str(mode)
-
     def media_item_selected(self, current_index):
         """Handler for when an item is selected in the media list."""
         if current_index < 0:
@@ -218,45 +203,20 @@ class MediaListWidget(QWidget, FORM_CLASS):
             total += self.media_list.item(index).data(Qt.UserRole)
         return total
 
-    def video_command(self):
-        """Generate command for creating a video from the media files.
+    def input_arguments(self) -> List[List[str]]:
+        """Returns the ffmpeg input arguments of each media file.
 
-        ..note:: You need to add an executable and output filename to the command
-            arguments before running this command. This is done in the
-            movie_creator class.
+        ..note:: The inputs are combined with the rendered frames by the
+            movie_creator class, which scales them to the output size.
         """
-        count = self.media_list.count()
-        if count == 0:
-            return None
-        arguments = ["-y"]
+        inputs = []
         for index in range(self.media_list.count()):
             file = self.media_list.item(index).text()
             duration = self.media_list.item(index).data(Qt.UserRole)
+            arguments = []
             if self.media_type == "images":
                 # Images need to loop for a certain duration
-                arguments.append("-loop")
-                arguments.append("1")
-                arguments.append("-t")
-                arguments.append(str(duration))
-            arguments.append("-i")
-            arguments.append(file)
-        if self.media_type != "sounds":
-            arguments.append("-filter_complex")
-            # Unsafe=1 used to deal with images or vids of different sizes
-            arguments.append(
-                f"concat=n={count}:v=1:a=0:unsafe=1"
-                f",pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,scale={self.output_mode},setsar=1:1"
-            )
-            arguments.append("-c:v")
-            arguments.append("libx264")
-            arguments.append("-pix_fmt")
-            arguments.append("yuv420p")
-            arguments.append("-r")
-            # TODO - set this to the desired frame rate...
-            arguments.append("60")
-            arguments.append("-movflags")
-            arguments.append("+faststart")
-        # args.append("-vf")
-        # args.append("scale={self.output_mode}")
-        # consumer of this output needs to add filename as last arg
-        return arguments
+                arguments += ["-loop", "1", "-t", str(duration)]
+            arguments += ["-i", file]
+            inputs.append(arguments)
+        return inputs
@@ -0,0 +1,366 @@
+# coding=utf-8
+"""Animation controller micro benchmarks.
+
+Times frame plan (render job) generation in isolation from rendering,
+for memory layers of increasing size and every combination of map mode,
+looping, easing and data defined scales. Each benchmark is run several
+rounds and reported with pytest-benchmark style statistics, together
+with the Python memory allocated per generated job.
+
+Run from the repository root with::
+
+    python -m animation_workbench.test.benchmark_controller
+
+The following environment variables control the run:
+
+* BENCHMARK_RESULTS: path of the JSON results file
+  (default: benchmark_controller_results.json)
+* BENCHMARK_FILTER: only run benchmarks whose name contains this text
+* BENCHMARK_ROUNDS: number of timed rounds per benchmark (default: 3)
+* BENCHMARK_BASELINE: path of a previous results file to compare against.
+  The run fails if any benchmark's median time regresses by more than
+  BENCHMARK_TOLERANCE (default: 0.2, i.e. 20%)
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+
+# Benchmarks always run headless
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+# pylint: disable=wrong-import-position
+import itertools
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from qgis.PyQt.QtCore import QEasingCurve
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsMapSettings,
+    QgsProperty,
+    QgsReferencedRectangle,
+)
+
+from animation_workbench.core import AnimationController, MapMode
+from .benchmark_utilities import (
+    BENCHMARK_CRS,
+    BENCHMARK_EXTENT,
+    create_synthetic_layer,
+    write_results,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+FEATURE_COUNTS = [10, 100, 1000, 10000]
+MAP_MODES = [MapMode.PLANAR, MapMode.SPHERE, MapMode.FIXED_EXTENT]
+# Kept low so that large layers still generate a manageable number of jobs
+FRAME_RATE = 10
+HOVER_DURATION = 0.2
+TRAVEL_DURATION = 0.2
+# Number of jobs retained when measuring memory use per job
+MEMORY_SAMPLE_JOBS = 500
+
+
+def benchmark(func: Callable[[], int], rounds: int) -> dict:
+    """
+    Times a function over several rounds, in the style of pytest-benchmark.
+
+    :param func: function to time. Must return the number of jobs generated.
+    :param rounds: number of timed rounds
+
+    :returns: timing statistics, in seconds
+    """
+    timings = []
+    jobs = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        jobs = func()
+        timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return {
+        "rounds": rounds,
+        "jobs": jobs,
+        "min": min(timings),
+        "max": max(timings),
+        "mean": statistics.mean(timings),
+        "median": median,
+        "stddev": statistics.stdev(timings) if rounds > 1 else 0,
+        "jobs_per_second": jobs / median if median else None,
+    }
+
+
+def memory_per_job(create_iterator: Callable[[], Iterator]) -> dict:
+    """
+    Measures the Python memory allocated per retained job, and the peak
+    allocation while generating them.
+
+    Only allocations made through the Python allocator are traced, so
+    memory held by the underlying QGIS objects is not included.
+    """
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        jobs = list(itertools.islice(create_iterator(), MEMORY_SAMPLE_JOBS))
+        after, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "sampled_jobs": len(jobs),
+        "bytes_per_job": (after - before) / len(jobs) if jobs else None,
+        "peak_bytes": peak - before,
+    }
+
+
+def create_map_settings(layer) -> QgsMapSettings:
+    """
+    Creates map settings for a benchmark layer
+    """
+    map_settings = QgsMapSettings()
+    map_settings.setDestinationCrs(QgsCoordinateReferenceSystem(BENCHMARK_CRS))
+    map_settings.setExtent(BENCHMARK_EXTENT)
+    map_settings.setLayers([layer])
+    return map_settings
+
+
+def create_controller(
+    layer,
+    map_mode: MapMode,
+    loop: bool,
+    easing: bool,
+    data_defined: bool,
+) -> AnimationController:
+    """
+    Creates an animation controller for a benchmark combination
+    """
+    map_settings = create_map_settings(layer)
+    if map_mode == MapMode.FIXED_EXTENT:
+        controller = AnimationController.create_fixed_extent_controller(
+            map_settings=map_settings,
+            output_mode="1920:1080",
+            feature_layer=layer,
+            output_extent=QgsReferencedRectangle(
+                BENCHMARK_EXTENT, QgsCoordinateReferenceSystem(BENCHMARK_CRS)
+            ),
+            total_frames=int(HOVER_DURATION * FRAME_RATE),
+            frame_rate=FRAME_RATE,
+        )
+    else:
+        controller = AnimationController.create_moving_extent_controller(
+            map_settings=map_settings,
+            mode=map_mode,
+            output_mode="1920:1080",
+            feature_layer=layer,
+            travel_duration=TRAVEL_DURATION,
+            hover_duration=HOVER_DURATION,
+            min_scale=25000000,
+            max_scale=10000000,
+            pan_easing=QEasingCurve(QEasingCurve.InOutQuad) if easing else None,
+            zoom_easing=QEasingCurve(QEasingCurve.InOutQuad) if easing else None,
+            frame_rate=FRAME_RATE,
+            loop=loop,
+        )
+
+    if data_defined:
+        controller.data_defined_properties.setProperty(
+            AnimationController.PROPERTY_MIN_SCALE,
+            QgsProperty.fromExpression('"id" * 10 + 25000000'),
+        )
+        controller.data_defined_properties.setProperty(
+            AnimationController.PROPERTY_MAX_SCALE,
+            QgsProperty.fromExpression('"id" * 10 + 10000000'),
+        )
+    return controller
+
+
+def count_jobs(iterator: Iterator) -> int:
+    """
+    Exhausts an iterator of jobs without retaining them, returning the count
+    """
+    count = 0
+    for _ in iterator:
+        count += 1
+    return count
+
+
+def create_jobs_benchmarks(
+    layers: Dict[int, object],
+) -> Iterator[Tuple[str, Callable[[], Iterator]]]:
+    """
+    Yields named factories for full create_jobs() runs
+    """
+    for feature_count, map_mode, loop, easing, data_defined in itertools.product(
+        FEATURE_COUNTS, MAP_MODES, [False, True], [False, True], [False, True]
+    ):
+        if map_mode == MapMode.FIXED_EXTENT and (loop or easing or data_defined):
+            # these options have no effect for fixed extent animations
+            continue
+
+        name = "create_jobs_{}_{}{}{}{}".format(
+            map_mode.name.lower(),
+            feature_count,
+            "_loop" if loop else "",
+            "_easing" if easing else "",
+            "_data_defined" if data_defined else "",
+        )
+
+        def factory(
+            layer=layers[feature_count],
+            map_mode=map_mode,
+            loop=loop,
+            easing=easing,
+            data_defined=data_defined,
+        ):
+            return create_controller(
+                layer, map_mode, loop, easing, data_defined
+            ).create_jobs()
+
+        yield name, factory
+
+
+def helper_benchmarks(
+    layers: Dict[int, object],
+) -> Iterator[Tuple[str, Callable[[], Iterator]]]:
+    """
+    Yields named factories for the individual job generation helpers
+    """
+    layer = layers[FEATURE_COUNTS[-1]]
+
+    def prepare(map_mode: MapMode = MapMode.PLANAR) -> AnimationController:
+        controller = create_controller(layer, map_mode, False, True, False)
+        # create_jobs() sets up the layer to map transform and scales,
+        # so consume its first job before calling the helpers directly
+        next(controller.create_jobs())
+        return controller
+
+    def create_job():
+        controller = prepare()
+        return (
+            controller.create_job(controller.map_settings, f"/tmp/frame-{i}.png")
+            for i in range(MEMORY_SAMPLE_JOBS)
+        )
+
+    def hover_at_feature():
+        controller = prepare()
+        return controller.hover_at_feature(1)
+
+    def fly_feature_to_feature():
+        controller = prepare()
+        return controller.fly_feature_to_feature(
+            controller._features[0],  # pylint: disable=protected-access
+            controller._features[1],  # pylint: disable=protected-access
+        )
+
+    def create_moving_extent_job():
+        return prepare().create_moving_extent_job()
+
+    def create_fixed_extent_job():
+        return prepare(MapMode.FIXED_EXTENT).create_fixed_extent_job()
+
+    yield "create_job", create_job
+    yield "hover_at_feature", hover_at_feature
+    yield "fly_feature_to_feature", fly_feature_to_feature
+    yield "create_moving_extent_job", create_moving_extent_job
+    yield "create_fixed_extent_job", create_fixed_extent_job
+
+
+def compare_to_baseline(results: List[dict], baseline_path: str, tolerance: float):
+    """
+    Compares results to a baseline results file.
+
+    :returns: list of regression descriptions
+    """
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        baseline = {
+            result["name"]: result for result in json.load(baseline_file)["results"]
+        }
+
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if not previous or not previous["median"]:
+            continue
+        change = result["median"] / previous["median"] - 1
+        result["baseline_change"] = change
+        if change > tolerance:
+            regressions.append(
+                "{}: median {:.4f}s vs {:.4f}s (+{:.0%})".format(
+                    result["name"], result["median"], previous["median"], change
+                )
+            )
+    return regressions
+
+
+def run_benchmarks() -> int:
+    """
+    Runs all controller benchmarks and writes the results file
+
+    :returns: process exit code, non-zero if regressions were found
+    """
+    results_path = os.environ.get(
+        "BENCHMARK_RESULTS", "benchmark_controller_results.json"
+    )
+    name_filter = os.environ.get("BENCHMARK_FILTER", "")
+    rounds = int(os.environ.get("BENCHMARK_ROUNDS", 3))
+
+    layers = {count: create_synthetic_layer("Point", count) for count in FEATURE_COUNTS}
+
+    results = []
+    for name, factory in itertools.chain(
+        create_jobs_benchmarks(layers), helper_benchmarks(layers)
+    ):
+        if name_filter not in name:
+            continue
+
+        result = {"name": name}
+        result.update(benchmark(lambda f=factory: count_jobs(f()), rounds))
+        result.update(memory_per_job(factory))
+        results.append(result)
+        print(
+            "{:<60} median {:>9.4f}s  {:>10.0f} jobs/s  {:>8} B/job".format(
+                name,
+                result["median"],
+                result["jobs_per_second"] or 0,
+                (
+                    "{:.0f}".format(result["bytes_per_job"])
+                    if result["bytes_per_job"] is not None
+                    else "n/a"
+                ),
+            )
+        )
+
+    regressions = []
+    baseline_path = os.environ.get("BENCHMARK_BASELINE")
+    if baseline_path:
+        regressions = compare_to_baseline(
+            results, baseline_path, float(os.environ.get("BENCHMARK_TOLERANCE", 0.2))
+        )
+
+    write_results(results_path, "controller", results)
+    print(f"Results written to {results_path}")
+
+    if regressions:
+        print("Regressions compared to baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks())
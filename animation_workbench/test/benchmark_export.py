@@ -0,0 +1,308 @@
+# coding=utf-8
+"""End to end render benchmark suite.
+
+Renders synthetic projects headless and records job generation time,
+render and encode throughput and peak memory use for each scenario, so
+that export performance can be tracked across plugin and QGIS releases.
+
+Run from the repository root with::
+
+    QT_QPA_PLATFORM=offscreen python -m animation_workbench.test.benchmark_export
+
+The following environment variables control the run:
+
+* BENCHMARK_RESULTS: path of the JSON results file
+  (default: benchmark_export_results.json)
+* BENCHMARK_FILTER: only run scenarios whose name contains this text,
+  e.g. "point_1000" or "planar_1080p"
+* BENCHMARK_THREADS: render thread pool size (default: number of CPUs)
+* BENCHMARK_SKIP_ENCODE: set to 1 to skip the movie encoding stage
+
+Peak RSS is the peak for the whole process up to the end of each
+scenario, so run a single scenario per process (via BENCHMARK_FILTER)
+when comparing memory use between scenarios.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+
+# Benchmarks always run headless
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+# pylint: disable=wrong-import-position
+import itertools
+import tempfile
+from pathlib import Path
+from typing import Iterator, Optional
+
+from qgis.PyQt.QtCore import QEasingCurve
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsMapSettings,
+    QgsReferencedRectangle,
+)
+
+from animation_workbench.core import (
+    AnimationController,
+    MapMode,
+    MovieCreationTask,
+    MovieFormat,
+    RenderQueue,
+)
+from animation_workbench.core.utilities import CoreUtils
+from .benchmark_utilities import (
+    BENCHMARK_CRS,
+    BENCHMARK_EXTENT,
+    Stopwatch,
+    create_basemap_raster,
+    create_synthetic_layer,
+    peak_memory_usage,
+    wait_for_signal,
+    write_results,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+GEOMETRY_TYPES = ["Point", "LineString", "Polygon"]
+FEATURE_COUNTS = [10, 1000, 100000]
+BASEMAPS = [False, True]
+MAP_MODES = [MapMode.FIXED_EXTENT, MapMode.PLANAR, MapMode.SPHERE]
+RESOLUTIONS = {
+    "720p": "1280:720",
+    "1080p": "1920:1080",
+    "4k": "3840:2160",
+}
+
+# Number of frames rendered for fixed extent scenarios
+FIXED_EXTENT_FRAMES = 30
+# Moving extent scenarios tour 3 points, hovering for 5 frames and
+# travelling for 10 frames, giving 35 frames in total
+MOVING_FRAME_RATE = 10
+MOVING_HOVER_DURATION = 0.5
+MOVING_TRAVEL_DURATION = 1
+
+
+class BenchmarkScenario:
+    """
+    A single benchmark scenario
+    """
+
+    def __init__(
+        self,
+        geometry_type: str,
+        feature_count: int,
+        basemap: bool,
+        map_mode: MapMode,
+        resolution: str,
+    ):
+        self.geometry_type = geometry_type
+        self.feature_count = feature_count
+        self.basemap = basemap
+        self.map_mode = map_mode
+        self.resolution = resolution
+
+    @property
+    def name(self) -> str:
+        """
+        Unique name of the scenario
+        """
+        return "{}_{}{}_{}_{}".format(
+            self.geometry_type.lower(),
+            self.feature_count,
+            "_basemap" if self.basemap else "",
+            self.map_mode.name.lower(),
+            self.resolution,
+        )
+
+
+def scenarios() -> Iterator[BenchmarkScenario]:
+    """
+    Yields all benchmark scenarios, respecting the BENCHMARK_FILTER
+    environment variable
+    """
+    name_filter = os.environ.get("BENCHMARK_FILTER", "")
+    for (
+        geometry_type,
+        feature_count,
+        basemap,
+        map_mode,
+        resolution,
+    ) in itertools.product(
+        GEOMETRY_TYPES, FEATURE_COUNTS, BASEMAPS, MAP_MODES, RESOLUTIONS
+    ):
+        scenario = BenchmarkScenario(
+            geometry_type, feature_count, basemap, map_mode, resolution
+        )
+        if name_filter in scenario.name:
+            yield scenario
+
+
+def create_controller(
+    scenario: BenchmarkScenario, map_settings: QgsMapSettings
+) -> AnimationController:
+    """
+    Creates the animation controller for a scenario
+    """
+    output_mode = RESOLUTIONS[scenario.resolution]
+    if scenario.map_mode == MapMode.FIXED_EXTENT:
+        return AnimationController.create_fixed_extent_controller(
+            map_settings=map_settings,
+            output_mode=output_mode,
+            feature_layer=None,
+            output_extent=QgsReferencedRectangle(
+                BENCHMARK_EXTENT, QgsCoordinateReferenceSystem(BENCHMARK_CRS)
+            ),
+            total_frames=FIXED_EXTENT_FRAMES,
+            frame_rate=MOVING_FRAME_RATE,
+        )
+
+    # The tour is kept short and independent of the rendered data, so that
+    # the number of frames is the same for every scenario
+    tour_layer = create_synthetic_layer("Point", 3, seed=2)
+    return AnimationController.create_moving_extent_controller(
+        map_settings=map_settings,
+        mode=scenario.map_mode,
+        output_mode=output_mode,
+        feature_layer=tour_layer,
+        travel_duration=MOVING_TRAVEL_DURATION,
+        hover_duration=MOVING_HOVER_DURATION,
+        min_scale=25000000,
+        max_scale=10000000,
+        pan_easing=QEasingCurve(QEasingCurve.Linear),
+        zoom_easing=QEasingCurve(QEasingCurve.Linear),
+        frame_rate=MOVING_FRAME_RATE,
+    )
+
+
+def encode_movie(work_directory: str, prefix: str, output_mode: str) -> Optional[float]:
+    """
+    Encodes the rendered frames to an MP4, returning the elapsed time or
+    None if ffmpeg is not available
+    """
+    if os.environ.get("BENCHMARK_SKIP_ENCODE") == "1" or not CoreUtils.which("ffmpeg"):
+        return None
+
+    task = MovieCreationTask(
+        output_file=os.path.join(work_directory, "benchmark.mp4"),
+        output_mode=output_mode,
+        intro_inputs=None,
+        outro_inputs=None,
+        music_inputs=None,
+        output_format=MovieFormat.MP4,
+        work_directory=work_directory,
+        frame_filename_prefix=prefix,
+        framerate=MOVING_FRAME_RATE,
+    )
+    with Stopwatch() as stopwatch:
+        task.run()
+    return stopwatch.elapsed
+
+
+def run_scenario(
+    scenario: BenchmarkScenario, layers: dict, basemap, thread_pool_size: int
+) -> dict:
+    """
+    Runs a single benchmark scenario and returns its results
+    """
+    with tempfile.TemporaryDirectory() as work_directory:
+        map_settings = QgsMapSettings()
+        map_settings.setDestinationCrs(QgsCoordinateReferenceSystem(BENCHMARK_CRS))
+        map_settings.setExtent(BENCHMARK_EXTENT)
+        scenario_layers = [layers[(scenario.geometry_type, scenario.feature_count)]]
+        if scenario.basemap:
+            scenario_layers.append(basemap)
+        map_settings.setLayers(scenario_layers)
+
+        controller = create_controller(scenario, map_settings)
+        controller.working_directory = Path(work_directory)
+        controller.frame_filename_prefix = "benchmark"
+
+        with Stopwatch() as job_generation:
+            jobs = list(controller.create_jobs())
+
+        render_queue = RenderQueue()
+        render_queue.render_thread_pool_size = thread_pool_size
+        for job in jobs:
+            render_queue.add_job(job)
+
+        with Stopwatch() as render:
+            render_queue.start_processing()
+            wait_for_signal(render_queue.processing_completed)
+
+        render_summary = render_queue.metrics.summary()
+        render_queue.metrics.export(work_directory, "benchmark")
+
+        encode_time = encode_movie(
+            work_directory, "benchmark", RESOLUTIONS[scenario.resolution]
+        )
+
+        return {
+            "scenario": scenario.name,
+            "geometry_type": scenario.geometry_type,
+            "feature_count": scenario.feature_count,
+            "basemap": scenario.basemap,
+            "map_mode": scenario.map_mode.name,
+            "resolution": scenario.resolution,
+            "frames": len(jobs),
+            "thread_pool_size": thread_pool_size,
+            "job_generation_time": job_generation.elapsed,
+            "render_time": render.elapsed,
+            "render_fps": len(jobs) / render.elapsed if render.elapsed else None,
+            "render_time_p50": render_summary["render_time_p50"],
+            "render_time_p95": render_summary["render_time_p95"],
+            "encode_time": encode_time,
+            "encode_fps": len(jobs) / encode_time if encode_time else None,
+            "peak_rss": peak_memory_usage(),
+        }
+
+
+def run_benchmarks():
+    """
+    Runs all benchmark scenarios and writes the results file
+    """
+    results_path = os.environ.get("BENCHMARK_RESULTS", "benchmark_export_results.json")
+    thread_pool_size = int(os.environ.get("BENCHMARK_THREADS", os.cpu_count() or 1))
+
+    results = []
+    layers = {}
+    with tempfile.TemporaryDirectory() as data_directory:
+        basemap = create_basemap_raster(os.path.join(data_directory, "basemap.tif"))
+        for scenario in scenarios():
+            key = (scenario.geometry_type, scenario.feature_count)
+            if key not in layers:
+                layers[key] = create_synthetic_layer(*key)
+
+            print(f"Running {scenario.name}")
+            result = run_scenario(scenario, layers, basemap, thread_pool_size)
+            print(
+                "  jobs: {:.2f}s, render: {:.2f} fps, encode: {} fps".format(
+                    result["job_generation_time"],
+                    result["render_fps"] or 0,
+                    (
+                        "{:.2f}".format(result["encode_fps"])
+                        if result["encode_fps"]
+                        else "n/a"
+                    ),
+                )
+            )
+            results.append(result)
+
+            # results are written after every scenario, so that partial
+            # results survive an interrupted run
+            write_results(results_path, "export", results)
+
+    print(f"Results written to {results_path}")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
@@ -0,0 +1,243 @@
+# coding=utf-8
+"""Common functionality used by the benchmark suites.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+from typing import List, Optional
+
+from osgeo import gdal, osr
+from qgis.PyQt.QtCore import QEventLoop, QTimer
+from qgis.core import (
+    Qgis,
+    QgsFeature,
+    QgsGeometry,
+    QgsPointXY,
+    QgsRasterLayer,
+    QgsRectangle,
+    QgsVectorLayer,
+)
+
+# All synthetic data is generated in web mercator, within this extent
+BENCHMARK_CRS = "EPSG:3857"
+BENCHMARK_EXTENT = QgsRectangle(0, 0, 1000000, 1000000)
+
+
+def _random_point(rng: random.Random, extent: QgsRectangle) -> QgsPointXY:
+    """
+    Returns a random point within an extent
+    """
+    return QgsPointXY(
+        rng.uniform(extent.xMinimum(), extent.xMaximum()),
+        rng.uniform(extent.yMinimum(), extent.yMaximum()),
+    )
+
+
+def create_synthetic_layer(
+    geometry_type: str,
+    feature_count: int,
+    extent: QgsRectangle = BENCHMARK_EXTENT,
+    seed: int = 1,
+) -> QgsVectorLayer:
+    """
+    Creates a memory layer filled with reproducible random features.
+
+    :param geometry_type: one of "Point", "LineString" or "Polygon"
+    :param feature_count: number of features to create
+    :param extent: extent to create features within
+    :param seed: random seed, so that the same layer is created every run
+    """
+    layer = QgsVectorLayer(
+        f"{geometry_type}?crs={BENCHMARK_CRS}&field=id:integer&field=name:string",
+        f"{geometry_type.lower()}_{feature_count}",
+        "memory",
+    )
+    rng = random.Random(seed)
+    # size of lines and polygons, relative to the extent
+    feature_size = extent.width() / 100
+
+    features = []
+    for i in range(feature_count):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([i, f"feature {i}"])
+        origin = _random_point(rng, extent)
+        if geometry_type == "Point":
+            geometry = QgsGeometry.fromPointXY(origin)
+        elif geometry_type == "LineString":
+            # a short random walk
+            points = [origin]
+            for _ in range(9):
+                previous = points[-1]
+                points.append(
+                    QgsPointXY(
+                        previous.x() + rng.uniform(-1, 1) * feature_size,
+                        previous.y() + rng.uniform(-1, 1) * feature_size,
+                    )
+                )
+            geometry = QgsGeometry.fromPolylineXY(points)
+        else:
+            # an irregular 16 sided polygon
+            ring = []
+            for vertex in range(16):
+                angle = 2 * math.pi * vertex / 16
+                radius = feature_size * rng.uniform(0.5, 1)
+                ring.append(
+                    QgsPointXY(
+                        origin.x() + math.cos(angle) * radius,
+                        origin.y() + math.sin(angle) * radius,
+                    )
+                )
+            ring.append(ring[0])
+            geometry = QgsGeometry.fromPolygonXY([ring])
+        feature.setGeometry(geometry)
+        features.append(feature)
+
+    layer.dataProvider().addFeatures(features)
+    layer.updateExtents()
+    return layer
+
+
+def create_basemap_raster(
+    file_path: str,
+    size: int = 1024,
+    extent: QgsRectangle = BENCHMARK_EXTENT,
+) -> QgsRasterLayer:
+    """
+    Creates a single band GeoTIFF basemap with a reproducible pattern and
+    returns it as a raster layer.
+    """
+    driver = gdal.GetDriverByName("GTiff")
+    dataset = driver.Create(file_path, size, size, 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(
+        [
+            extent.xMinimum(),
+            extent.width() / size,
+            0,
+            extent.yMaximum(),
+            0,
+            -extent.height() / size,
+        ]
+    )
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(3857)
+    dataset.SetProjection(srs.ExportToWkt())
+    row_pattern = bytes(range(256)) * (size // 256 + 1)
+    band = dataset.GetRasterBand(1)
+    for row in range(size):
+        offset = row % 256
+        band.WriteRaster(0, row, size, 1, row_pattern[offset : offset + size])
+    dataset.FlushCache()
+    dataset = None
+
+    return QgsRasterLayer(file_path, "basemap")
+
+
+def peak_memory_usage() -> Optional[int]:
+    """
+    Returns the peak resident set size of the process in bytes, or None
+    if it cannot be determined on this platform
+    """
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def wait_for_signal(signal, timeout: float = 3600) -> bool:
+    """
+    Runs an event loop until a signal is emitted or the timeout (in seconds)
+    elapses.
+
+    :returns: True if the signal was emitted before the timeout
+    """
+    loop = QEventLoop()
+    emitted = []
+
+    def on_emitted(*_):
+        emitted.append(True)
+        loop.quit()
+
+    signal.connect(on_emitted)
+    QTimer.singleShot(int(timeout * 1000), loop.quit)
+    loop.exec_()
+    signal.disconnect(on_emitted)
+    return bool(emitted)
+
+
+class Stopwatch:
+    """
+    Context manager recording the elapsed wall time of a block, in seconds
+    """
+
+    def __init__(self):
+        self.start: float = 0
+        self.elapsed: float = 0
+
+    def __enter__(self) -> "Stopwatch":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.perf_counter() - self.start
+
+
+def environment_details() -> dict:
+    """
+    Returns details of the benchmark environment, so that results from
+    different machines and releases can be compared
+    """
+    metadata_path = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), "metadata.txt"
+    )
+    plugin_version = None
+    with open(metadata_path, encoding="utf-8") as metadata_file:
+        for line in metadata_file:
+            if line.startswith("version="):
+                plugin_version = line.split("=", 1)[1].strip()
+
+    return {
+        "plugin_version": plugin_version,
+        "qgis_version": Qgis.QGIS_VERSION,
+        "gdal_version": gdal.VersionInfo("RELEASE_NAME"),
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def write_results(file_path: str, suite: str, results: List[dict]):
+    """
+    Writes benchmark results as machine readable JSON
+    """
+    with open(file_path, "w", encoding="utf-8") as results_file:
+        json.dump(
+            {
+                "suite": suite,
+                "environment": environment_details(),
+                "results": results,
+            },
+            results_file,
+            indent=2,
+        )
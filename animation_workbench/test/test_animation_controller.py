@@ -31,6 +31,7 @@ from qgis.core import (
 )
 
 from animation_workbench.core import AnimationController, MapMode
+from animation_workbench.core.feature_source import FeatureStore
 from .utilities import get_qgis_app
 
 QGIS_APP = get_qgis_app()
@@ -41,6 +42,42 @@ class AnimationControllerTest(unittest.TestCase):
 
     # pylint: disable=too-many-statements
 
+    @staticmethod
+    def feature_variables(map_settings):
+        """
+        Returns the ids of the features of the feature variables of map
+        settings, by variable name
+        """
+        context = map_settings.expressionContext()
+        variables = {}
+        for name in FeatureStore.FEATURE_VARIABLES:
+            feature = context.variable(name)
+            variables[name] = None if feature is None else feature.id()
+            variables[f"{name}_id"] = context.variable(f"{name}_id")
+        return variables
+
+    def assert_preview_variables(self, controller, frames):
+        """
+        Asserts the feature variables of exported jobs are resolved to the
+        same features as the jobs of the preview, which are rendered
+        through the same path
+        """
+        jobs = list(controller.create_jobs())
+        for frame in frames:
+            job = jobs[frame]
+            # queued jobs only carry the feature ids until they are rendered
+            self.assertFalse(
+                job.frame_settings.expressionContext().hasVariable("hover_feature")
+            )
+            variables = self.feature_variables(job.map_settings)
+            for name in FeatureStore.FEATURE_VARIABLES:
+                self.assertEqual(variables[name], variables[f"{name}_id"])
+
+            preview_job = controller.create_job_for_frame(frame)
+            # the preview renders the frame's job with a render task
+            task = preview_job.create_task()
+            self.assertEqual(self.feature_variables(task.map_settings), variables)
+
     def test_fixed_extent(self):
         """
         Test a fixed extent job
@@ -1310,6 +1347,60 @@ class AnimationControllerTest(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(it)
 
+    def test_preview_feature_variables(self):
+        """
+        Test feature variables are resolved to the same features for
+        exported and previewed frames
+        """
+        vl = QgsVectorLayer("Point?crs=EPSG:4326&field=name:string", "vl", "memory")
+        for name, x, y in (("f1", 1, 2), ("f2", 10, 20), ("f3", 20, 10)):
+            f = QgsFeature(vl.fields())
+            f["name"] = name
+            f.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+            self.assertTrue(vl.dataProvider().addFeature(f))
+
+        map_settings = QgsMapSettings()
+        map_settings.setExtent(QgsRectangle(1, 2, 3, 4))
+        map_settings.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:4326"))
+        map_settings.setOutputSize(QSize(400, 300))
+        controller = AnimationController.create_moving_extent_controller(
+            map_settings=map_settings,
+            output_mode=None,
+            mode=MapMode.PLANAR,
+            feature_layer=vl,
+            travel_duration=2,
+            hover_duration=1,
+            min_scale=2000000,
+            max_scale=1000000,
+            pan_easing=QEasingCurve(QEasingCurve.Type.Linear),
+            zoom_easing=QEasingCurve(QEasingCurve.Type.Linear),
+            frame_rate=2,
+        )
+        frames = range(controller.job_count())
+        self.assert_preview_variables(controller, frames)
+        # hovering and travelling frames are both covered
+        jobs = list(controller.create_jobs())
+        self.assertTrue(
+            any(self.feature_variables(job.map_settings)["to_feature"] for job in jobs)
+        )
+        self.assertEqual(
+            self.feature_variables(jobs[0].map_settings)["hover_feature"],
+            next(vl.getFeatures()).id(),
+        )
+
+        extent = QgsReferencedRectangle(
+            map_settings.extent(), map_settings.destinationCrs()
+        )
+        controller = AnimationController.create_fixed_extent_controller(
+            map_settings=map_settings,
+            output_mode=None,
+            feature_layer=vl,
+            output_extent=extent,
+            total_frames=2,
+            frame_rate=10,
+        )
+        self.assert_preview_variables(controller, range(controller.total_frame_count))
+
 
 if __name__ == "__main__":
     suite = unittest.makeSuite(AnimationControllerTest)
@@ -0,0 +1,188 @@
+# coding=utf-8
+"""Data preparation test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import json
+import os
+import tempfile
+import unittest
+
+from qgis.PyQt.QtCore import QSize
+from qgis.core import QgsMapSettings, QgsRectangle, QgsVectorLayer
+
+from animation_workbench.core import (
+    DataPreparation,
+    ExportPreparationTask,
+    LayerSnapshot,
+    RenderJob,
+    RenderQueue,
+    SampleFrame,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class DataPreparationTest(unittest.TestCase):
+    """Test DataPreparation works."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.temp_dir.name, "points.geojson")
+        with open(path, "w", encoding="utf-8") as geojson:
+            json.dump(
+                {
+                    "type": "FeatureCollection",
+                    "features": [
+                        {
+                            "type": "Feature",
+                            "properties": {"id": i},
+                            "geometry": {"type": "Point", "coordinates": [i, i]},
+                        }
+                        for i in range(5)
+                    ],
+                },
+                geojson,
+            )
+        self.layer = QgsVectorLayer(path, "points", "ogr")
+        self.assertTrue(self.layer.isValid())
+
+    def tearDown(self):
+        self.layer = None
+        self.temp_dir.cleanup()
+
+    def test_memory_copies(self):
+        """
+        Test copying vector layers to memory
+        """
+        self.assertEqual(
+            DataPreparation(memory_copies=False).prepare([LayerSnapshot(self.layer)]),
+            {},
+        )
+
+        preparation = DataPreparation(memory_copies=True)
+        replacements = preparation.prepare([LayerSnapshot(self.layer)])
+        copy = replacements[self.layer.id()]
+        self.assertEqual(copy.providerType(), "memory")
+        self.assertEqual(copy.name(), "points")
+        self.assertEqual(copy.featureCount(), 5)
+        self.assertEqual(copy.renderer().type(), self.layer.renderer().type())
+        self.assertEqual(copy.crs(), self.layer.crs())
+
+        # memory layers are never copied again
+        self.assertIsNone(preparation.create_memory_copy(LayerSnapshot(copy)))
+
+    def test_sample_frame(self):
+        """
+        Test the sample frame is timed before and after preparing the layers
+        """
+        map_settings = QgsMapSettings()
+        map_settings.setOutputSize(QSize(50, 50))
+        map_settings.setExtent(QgsRectangle(0, 0, 5, 5))
+        map_settings.setLayers([self.layer])
+
+        preparation = DataPreparation(memory_copies=True)
+        self.assertIsNone(preparation.saving)
+        sample = SampleFrame(map_settings)
+        # only the ids of the project's layers are kept
+        self.assertEqual(sample.layer_ids, [self.layer.id()])
+        self.assertEqual(sample.map_settings.layers(), [])
+        preparation.prepare([LayerSnapshot(self.layer)], sample)
+        self.assertGreater(preparation.unprepared_frame_time, 0)
+        self.assertGreater(preparation.prepared_frame_time, 0)
+        self.assertAlmostEqual(
+            preparation.saving,
+            preparation.unprepared_frame_time - preparation.prepared_frame_time,
+        )
+
+        # the frame is rendered with the layers standing for its layers,
+        # with feature ids applied to them
+        opened = LayerSnapshot(self.layer).open_layer()
+        sample = SampleFrame(map_settings, {self.layer.id(): [1]})
+        self.assertGreater(sample.render_time({self.layer.id(): opened}), 0)
+
+    def test_cancel_preparation(self):
+        """
+        Test canceling the preparation task stops the running step and
+        skips the remaining steps
+        """
+        steps = []
+        task = ExportPreparationTask([])
+
+        def first_step(feedback):
+            task.cancel()
+            # long steps stop once the feedback is canceled
+            steps.append(
+                DataPreparation(memory_copies=True).prepare(
+                    [LayerSnapshot(self.layer)], feedback=feedback
+                )
+            )
+
+        task.steps = [first_step, lambda feedback: steps.append("second")]
+        self.assertFalse(task.run())
+        self.assertEqual(steps, [{}])
+        task.finished(False)
+
+        # canceling before rendering started does not fail
+        queue = RenderQueue()
+        queue.reset()
+        queue.cancel_processing()
+        self.assertEqual(queue.job_queue, [])
+
+    def test_preparation_task(self):
+        """
+        Test the preparation task runs its steps in order
+        """
+        steps = []
+        task = ExportPreparationTask(
+            [
+                lambda feedback: steps.append("first"),
+                lambda feedback: steps.append("second"),
+            ]
+        )
+        self.assertTrue(task.run())
+        self.assertEqual(steps, ["first", "second"])
+        self.assertEqual(task.progress(), 100)
+
+        # a failing step stops the task and is reported
+        messages = []
+        task = ExportPreparationTask([lambda feedback: 1 / 0])
+        task.message.connect(messages.append)
+        self.assertFalse(task.run())
+        task.finished(False)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("failed", messages[0])
+
+    def test_replace_layers(self):
+        """
+        Test replacing layers in queued render jobs
+        """
+        map_settings = QgsMapSettings()
+        map_settings.setLayers([self.layer])
+        queue = RenderQueue()
+        queue.add_job(RenderJob("/tmp/frame-0.png", map_settings))
+
+        replacements = DataPreparation(memory_copies=True).prepare(
+            [LayerSnapshot(self.layer)]
+        )
+        queue.replace_layers(replacements)
+        self.assertEqual(
+            [layer.id() for layer in queue.job_queue[0].map_settings.layers()],
+            [replacements[self.layer.id()].id()],
+        )
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DataPreparationTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,126 @@
+# coding=utf-8
+"""Density grids test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import tempfile
+import unittest
+
+import numpy as np
+from qgis.PyQt.QtCore import QDate, QDateTime, QSize, QTime, Qt
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsFeedback,
+    QgsGeometry,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsRectangle,
+    QgsVectorLayer,
+    QgsVectorLayerTemporalProperties,
+)
+
+from animation_workbench.core.density import (
+    DensityGrids,
+    gaussian_kernel,
+    separable_blur,
+)
+from animation_workbench.core.temporal_index import TemporalFeatureIndex
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class DensityGridsTest(unittest.TestCase):
+    """Test DensityGrids works."""
+
+    def test_separable_blur(self):
+        """
+        Test blurring spreads counts without changing their total
+        """
+        kernel = gaussian_kernel(3)
+        self.assertEqual(len(kernel), 7)
+        self.assertAlmostEqual(kernel.sum(), 1)
+
+        grid = np.zeros((21, 21))
+        grid[10, 10] = 1
+        blurred = separable_blur(grid, kernel)
+        self.assertAlmostEqual(blurred.sum(), 1)
+        self.assertEqual(np.unravel_index(blurred.argmax(), blurred.shape), (10, 10))
+        self.assertAlmostEqual(blurred[10, 7], blurred[13, 10])
+        self.assertEqual(blurred[10, 6], 0)
+
+    def test_compute(self):
+        """
+        Test points are counted in the frames they are visible in
+        """
+        layer = QgsVectorLayer(
+            "Point?crs=EPSG:3857&field=time:datetime", "events", "memory"
+        )
+        features = []
+        # two points on day 1 at the top left, one on day 2 at the bottom
+        # right, and one at the end of the time range, in the last frame
+        for day, x, y in [(1, 30, 70), (1, 32, 68), (2, 70, 30), (3, 50, 50)]:
+            feature = QgsFeature(layer.fields())
+            feature.setAttributes(
+                [QDateTime(QDate(2020, 1, day), QTime(12, 0), Qt.UTC)]
+            )
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        properties = layer.temporalProperties()
+        properties.setIsActive(True)
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeInstantFromField
+        )
+        properties.setStartField("time")
+        index = TemporalFeatureIndex.from_layer(layer)
+
+        map_settings = QgsMapSettings()
+        map_settings.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:3857"))
+        map_settings.setOutputSize(QSize(100, 100))
+        map_settings.setExtent(QgsRectangle(0, 0, 100, 100))
+
+        grids = DensityGrids(index, map_settings)
+        self.assertEqual((grids.rows, grids.columns), (25, 25))
+        with tempfile.TemporaryDirectory() as directory:
+            feedback = QgsFeedback()
+            feedback.cancel()
+            self.assertFalse(grids.compute(2, directory, feedback))
+            self.assertIsNone(grids.grids)
+            self.assertFalse(grids.is_current(2, map_settings))
+
+            feedback = QgsFeedback()
+            self.assertTrue(grids.compute(2, directory, feedback))
+            self.assertEqual(feedback.progress(), 100)
+            self.assertTrue(grids.is_current(2, map_settings))
+            self.assertFalse(grids.is_current(3, map_settings))
+            self.assertEqual(grids.counts.tolist(), [2, 2])
+
+            first, second = np.array(grids.grids)
+            self.assertAlmostEqual(float(first.sum()), 2, 3)
+            self.assertGreater(first[7, 7], first[17, 17])
+            self.assertAlmostEqual(float(second.sum()), 2, 3)
+            self.assertGreater(second[17, 17], second[7, 7])
+
+            density_layer = grids.create_layer(1)
+            self.assertTrue(density_layer.isValid())
+            self.assertEqual(density_layer.bandCount(), 2)
+            self.assertEqual(density_layer.renderer().band(), 2)
+            del density_layer
+            grids.grids = None
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(DensityGridsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,217 @@
+# coding=utf-8
+"""Windowed feature source test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+from qgis.core import (
+    QgsExpressionContext,
+    QgsExpressionContextScope,
+    QgsFeature,
+    QgsGeometry,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsVectorLayer,
+)
+
+from animation_workbench.core import RenderJob
+from animation_workbench.core.feature_source import (
+    FeatureIdCache,
+    FeatureStore,
+    WindowedFeatureSource,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class WindowedFeatureSourceTest(unittest.TestCase):
+    """Test WindowedFeatureSource works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=id:integer", "points", "memory"
+        )
+        features = []
+        for i in range(1000):
+            feature = QgsFeature(self.layer.fields())
+            feature.setAttributes([i])
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(i, 0)))
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+
+    def test_sequence(self):
+        """
+        Test the source behaves like a list of the layer's features
+        """
+        source = WindowedFeatureSource(self.layer)
+        expected = list(self.layer.getFeatures())
+
+        self.assertEqual(len(source), 1000)
+        self.assertEqual([f.id() for f in source], [f.id() for f in expected])
+        self.assertEqual(source[0]["id"], 0)
+        self.assertEqual(source[500]["id"], 500)
+        self.assertEqual(source[-1]["id"], 999)
+        self.assertEqual(source[-1].geometry().asPoint().x(), 999)
+        with self.assertRaises(IndexError):
+            source[1000]  # pylint: disable=pointless-statement
+
+    def test_window(self):
+        """
+        Test only a bounded window of features is kept in memory
+        """
+        source = WindowedFeatureSource(self.layer)
+        for index, feature in enumerate(source):
+            self.assertEqual(feature["id"], index)
+            # previous and next lookups, as made while animating
+            if index > 0:
+                self.assertEqual(source[index - 1]["id"], index - 1)
+            self.assertEqual(
+                source[(index + 1) % len(source)]["id"], (index + 1) % 1000
+            )
+            self.assertLessEqual(len(source.window), WindowedFeatureSource.WINDOW_SIZE)
+
+    def test_deleted_feature(self):
+        """
+        Test features deleted after the source is built are reported
+        """
+        source = WindowedFeatureSource(self.layer)
+        deleted = source.ids[100]
+        self.assertTrue(self.layer.dataProvider().deleteFeatures([deleted]))
+
+        self.assertEqual(source[0]["id"], 0)
+        with self.assertRaisesRegex(ValueError, f"Features {deleted} of points"):
+            source[100]  # pylint: disable=pointless-statement
+
+
+class FeatureStoreTest(unittest.TestCase):
+    """Test FeatureStore works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=id:integer", "points", "memory"
+        )
+        features = []
+        for i in range(100):
+            feature = QgsFeature(self.layer.fields())
+            feature.setAttributes([i])
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+        self.features = list(self.layer.getFeatures())
+
+    def test_feature(self):
+        """
+        Test features are looked up by id with a bounded cache
+        """
+        store = FeatureStore(self.layer)
+        for feature in self.features:
+            self.assertEqual(store.feature(feature.id())["id"], feature["id"])
+            self.assertLessEqual(len(store.cache), FeatureStore.CACHE_SIZE)
+
+    def test_deferred_resolution(self):
+        """
+        Test feature variables are only resolved when a job is rendered
+        """
+        scope = QgsExpressionContextScope()
+        scope.setVariable("hover_feature_id", self.features[5].id(), True)
+        scope.setVariable("previous_feature_id", None, True)
+        context = QgsExpressionContext()
+        context.appendScope(scope)
+        map_settings = QgsMapSettings()
+        map_settings.setExpressionContext(context)
+
+        job = RenderJob("/tmp/frame-0.png", map_settings)
+        job.defer_settings_update(FeatureStore(self.layer).resolve_feature_variables)
+        context = job.frame_settings.expressionContext()
+        self.assertFalse(context.hasVariable("hover_feature"))
+
+        context = job.map_settings.expressionContext()
+        self.assertEqual(context.variable("hover_feature")["id"], 5)
+        self.assertTrue(context.hasVariable("previous_feature"))
+        self.assertIsNone(context.variable("previous_feature"))
+        self.assertFalse(context.hasVariable("next_feature"))
+
+
+class FeatureIdCacheTest(unittest.TestCase):
+    """Test FeatureIdCache works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=id:integer&field=rank:integer",
+            "points",
+            "memory",
+        )
+        features = []
+        for i in range(20):
+            feature = QgsFeature(self.layer.fields())
+            feature.setAttributes([i, (i * 7) % 20])
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+
+    def ranks(self, ids):
+        """
+        Returns the rank attribute of the features with the given ids
+        """
+        return [self.layer.getFeature(feature_id)["rank"] for feature_id in ids]
+
+    def test_filter_and_order(self):
+        """
+        Test ids are filtered and ordered by expressions
+        """
+        cache = FeatureIdCache()
+        self.assertEqual(len(cache.feature_ids(self.layer)), 20)
+
+        ids = cache.feature_ids(self.layer, order_by='"rank"')
+        self.assertEqual(self.ranks(ids), list(range(20)))
+
+        ids = cache.feature_ids(
+            self.layer, filter_expression='"rank" < 5', order_by='"rank"'
+        )
+        self.assertEqual(self.ranks(ids), [0, 1, 2, 3, 4])
+
+        ids = cache.feature_ids(
+            self.layer,
+            filter_expression='"rank" < 5',
+            order_by='"rank"',
+            descending=True,
+        )
+        self.assertEqual(self.ranks(ids), [4, 3, 2, 1, 0])
+
+        with self.assertRaises(ValueError):
+            cache.feature_ids(self.layer, filter_expression='"rank" <')
+
+    def test_cache(self):
+        """
+        Test ids are reused until the layer data changes
+        """
+        cache = FeatureIdCache()
+        ids = cache.feature_ids(self.layer, order_by='"rank"')
+        self.assertIs(cache.feature_ids(self.layer, order_by='"rank"'), ids)
+
+        feature = QgsFeature(self.layer.fields())
+        feature.setAttributes([20, 20])
+        self.layer.dataProvider().addFeatures([feature])
+        self.layer.reload()
+        self.assertEqual(len(cache.feature_ids(self.layer, order_by='"rank"')), 21)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestSuite(
+        [
+            unittest.makeSuite(WindowedFeatureSourceTest),
+            unittest.makeSuite(FeatureStoreTest),
+            unittest.makeSuite(FeatureIdCacheTest),
+        ]
+    )
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
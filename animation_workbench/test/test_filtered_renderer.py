@@ -0,0 +1,239 @@
+# coding=utf-8
+"""Filtered renderer test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import time
+import unittest
+
+from qgis.PyQt.QtCore import QDate, QDateTime, QSize, QTime, Qt
+from qgis.core import (
+    QgsExpression,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsProperty,
+    QgsRectangle,
+    QgsReferencedRectangle,
+    QgsSymbolLayer,
+    QgsVectorLayer,
+    QgsVectorLayerTemporalProperties,
+    qgsfunction,
+)
+
+from animation_workbench.core import AnimationController, RenderJob
+from animation_workbench.core.filtered_renderer import (
+    FeatureIdFilterProvider,
+    FilteredMapRendererTask,
+)
+from animation_workbench.core.temporal_index import TemporalFeatureIndex
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+RENDERED_FEATURES = []
+
+
+@qgsfunction(args="auto", group="Custom")
+def count_rendered_feature(feature, parent):  # pylint: disable=unused-argument
+    """
+    Records each rendered feature, returning a symbol size
+    """
+    RENDERED_FEATURES.append(feature.id())
+    return 2
+
+
+class FilteredRendererTest(unittest.TestCase):
+    """Test rendering restricted to feature ids works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=id:integer", "points", "memory"
+        )
+        features = []
+        for i in range(10):
+            feature = QgsFeature(self.layer.fields())
+            feature.setAttributes([i])
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+        self.other_layer = QgsVectorLayer("Point?crs=EPSG:4326", "other", "memory")
+
+    def test_filter_provider(self):
+        """
+        Test feature requests are restricted to the feature ids
+        """
+        ids = [f.id() for f in self.layer.getFeatures()][:3]
+        provider = FeatureIdFilterProvider({self.layer.id(): ids})
+
+        request = QgsFeatureRequest().setFilterExpression('"id" > 5')
+        provider.filterFeatures(self.layer, request)
+        self.assertEqual(request.filterType(), QgsFeatureRequest.FilterFids)
+        self.assertEqual(
+            sorted(f["id"] for f in self.layer.getFeatures(request)), [0, 1, 2]
+        )
+
+        request = QgsFeatureRequest()
+        provider.filterFeatures(self.other_layer, request)
+        self.assertEqual(request.filterType(), QgsFeatureRequest.FilterNone)
+
+    def test_create_task(self):
+        """
+        Test jobs with feature ids are rendered with a filtered task
+        """
+        map_settings = QgsMapSettings()
+        map_settings.setLayers([self.layer])
+        job = RenderJob("/tmp/frame-0.png", map_settings)
+        task = job.create_task()
+        self.assertIsInstance(task, FilteredMapRendererTask)
+        self.assertIsNone(task.render_job.featureFilterProvider())
+
+        job.feature_ids[self.layer.id()] = [1]
+        task = job.create_task()
+        self.assertIsInstance(
+            task.render_job.featureFilterProvider(), FeatureIdFilterProvider
+        )
+
+        # filtered layers keep their feature ids, so they are not replaced
+        copy = self.layer.materialize(QgsFeatureRequest())
+        job.replace_layers({self.layer.id(): copy})
+        self.assertEqual(job.frame_settings.layers(), [self.layer])
+
+    def test_layer_factories(self):
+        """
+        Test layers created for a frame are only created when its task
+        is created, and are drawn above its layers
+        """
+        created = []
+
+        def create_layer():
+            layer = QgsVectorLayer("Point?crs=EPSG:4326", "created", "memory")
+            created.append(layer.id())
+            return layer
+
+        map_settings = QgsMapSettings()
+        map_settings.setOutputSize(QSize(50, 50))
+        map_settings.setExtent(QgsRectangle(-1, -1, 1, 1))
+        map_settings.setLayers([self.layer])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job = RenderJob(os.path.join(temp_dir, "frame-0.png"), map_settings)
+            job.layer_factories.append(create_layer)
+            self.assertEqual(created, [])
+            task = job.create_task()
+            self.assertIsInstance(task, FilteredMapRendererTask)
+            self.assertEqual(len(created), 1)
+            # the render is prepared when the task is created
+            self.assertIsNotNone(task.render_job)
+
+            self.assertTrue(task.run())
+            self.assertEqual(len(created), 1)
+            self.assertTrue(os.path.exists(job.file_name))
+            # the created layer is only kept by the task
+            self.assertEqual(task.map_settings.layers(), [self.layer])
+            self.assertEqual([layer.id() for layer in task.created_layers], created)
+
+            self.assertEqual(job.render_to_image().size(), QSize(50, 50))
+            self.assertEqual(len(created), 2)
+            self.assertEqual(job.map_settings.layers(), [self.layer])
+
+    def test_frame_timed(self):
+        """
+        Test the task records when it draws and writes the frame, and sends
+        the times when it finishes
+        """
+        map_settings = QgsMapSettings()
+        map_settings.setOutputSize(QSize(50, 50))
+        map_settings.setExtent(QgsRectangle(-1, -1, 1, 1))
+        map_settings.setLayers([self.layer])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            job = RenderJob(os.path.join(temp_dir, "frame-0.png"), map_settings)
+            task = job.create_task()
+            timed = []
+            task.frame_timed.connect(lambda *times: timed.append(times))
+            before = time.time()
+            self.assertTrue(task.run())
+            task.finished(True)
+
+        self.assertEqual(len(timed), 1)
+        started, rendered, written = timed[0]
+        self.assertLessEqual(before, started)
+        self.assertLessEqual(started, rendered)
+        self.assertLessEqual(rendered, written)
+        self.assertLessEqual(written, time.time())
+
+    def test_temporal_render(self):
+        """
+        Test temporal frames only fetch the features of their ids
+        """
+        layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=time:datetime", "events", "memory"
+        )
+        features = []
+        for number in range(1, 5):
+            feature = QgsFeature(layer.fields())
+            feature.setAttributes(
+                [QDateTime(QDate(2020, 1, number), QTime(0, 0), Qt.UTC)]
+            )
+            feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(number, 0)))
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        layer.updateExtents()
+        properties = layer.temporalProperties()
+        properties.setIsActive(True)
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeInstantFromField
+        )
+        properties.setStartField("time")
+        properties.setFixedDuration(0)
+        layer.renderer().symbol().symbolLayer(0).setDataDefinedProperty(
+            QgsSymbolLayer.PropertySize,
+            QgsProperty.fromExpression("count_rendered_feature()"),
+        )
+
+        map_settings = QgsMapSettings()
+        map_settings.setLayers([layer])
+        map_settings.setOutputSize(QSize(100, 100))
+        extent = QgsReferencedRectangle(QgsRectangle(0, -5, 5, 5), layer.crs())
+        controller = AnimationController.create_fixed_extent_controller(
+            map_settings=map_settings,
+            output_mode="1280:720",
+            feature_layer=None,
+            output_extent=extent,
+            total_frames=2,
+            frame_rate=10,
+            temporal_index=TemporalFeatureIndex.from_layer(layer),
+        )
+        job = next(controller.create_jobs())
+        render_layer = job.frame_settings.layers()[0]
+        self.assertNotEqual(render_layer.id(), layer.id())
+        self.assertFalse(render_layer.temporalProperties().isActive())
+        # the first two days are in the first frame's window
+        self.assertEqual(len(job.feature_ids[render_layer.id()]), 2)
+
+        # only the features of the ids are fetched, even though the frame's
+        # time range covers more
+        first_id = next(layer.getFeatures()).id()
+        job.feature_ids[render_layer.id()] = [first_id]
+        try:
+            job.render_to_image()
+        finally:
+            QgsExpression.unregisterFunction("count_rendered_feature")
+        self.assertEqual(RENDERED_FEATURES, [first_id])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FilteredRendererTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
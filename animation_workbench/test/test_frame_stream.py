@@ -0,0 +1,116 @@
+# coding=utf-8
+"""Ordered frame stream test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import unittest
+
+from animation_workbench.core.frame_stream import (
+    OrderedFrameStream,
+    frame_file_names,
+    reused_frame_files,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class OrderedFrameStreamTest(unittest.TestCase):
+    """Test OrderedFrameStream works."""
+
+    @staticmethod
+    def released(stream: OrderedFrameStream):
+        """
+        Returns the frames released so far, without waiting for more
+        """
+        frames = []
+        while not stream.ready.empty():
+            frames.append(stream.ready.get())
+        return frames
+
+    def test_reorder(self):
+        """
+        Test frames are released in order once earlier frames complete
+        """
+        names = [f"/tmp/frames-{frame:010d}.png" for frame in range(5)]
+        stream = OrderedFrameStream(reversed(names))
+
+        stream.frame_rendered(names[1])
+        stream.frame_rendered(names[2])
+        self.assertEqual(self.released(stream), [])
+        self.assertEqual(sorted(stream.window), [1, 2])
+
+        stream.frame_rendered(names[0])
+        self.assertEqual(self.released(stream), names[:3])
+        self.assertEqual(stream.window, {})
+
+        # failed frames are skipped, and frames are only released once
+        stream.frame_failed(names[3])
+        stream.frame_rendered(names[0])
+        self.assertEqual(self.released(stream), [])
+        stream.frame_rendered(names[4])
+        self.assertEqual(self.released(stream), [names[4], None])
+        self.assertTrue(stream.finished)
+
+    def test_finish(self):
+        """
+        Test finishing releases the window, skipping missing frames
+        """
+        names = [f"/tmp/frames-{frame:010d}.png" for frame in range(4)]
+        stream = OrderedFrameStream(names)
+        stream.frame_rendered(names[3])
+        stream.frame_rendered(names[1])
+        stream.finish()
+        self.assertEqual(
+            list(stream.frames(lambda: False)),
+            [names[1], names[3]],
+        )
+
+    def test_consumed(self):
+        """
+        Test consumed frames are only deleted if requested
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, "frames-0000000000.png")
+            with open(name, "wb") as frame_file:
+                frame_file.write(b"png")
+
+            OrderedFrameStream([name]).consumed(name)
+            self.assertTrue(os.path.exists(name))
+            OrderedFrameStream([name], delete_consumed=True).consumed(name)
+            self.assertFalse(os.path.exists(name))
+
+    def test_reused_frames(self):
+        """
+        Test only existing frames of the animation which are not queued
+        are reused, leaving out frames of earlier, longer exports
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            frames = frame_file_names(directory, "frames", 3)
+            self.assertEqual(
+                frames[2], os.path.join(directory, "frames-0000000002.png")
+            )
+            stale = os.path.join(directory, "frames-0000000005.png")
+            for name in frames[:2] + [stale]:
+                with open(name, "wb") as frame_file:
+                    frame_file.write(b"png")
+
+            self.assertEqual(reused_frame_files(frames, frames[1:]), frames[:1])
+            self.assertEqual(reused_frame_files(frames, []), frames[:2])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(OrderedFrameStreamTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
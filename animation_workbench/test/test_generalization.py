@@ -0,0 +1,90 @@
+# coding=utf-8
+"""Generalization cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import unittest
+
+from qgis.core import QgsFeature, QgsGeometry, QgsPointXY, QgsVectorLayer
+
+from animation_workbench.core import GeneralizationCache, LayerSnapshot
+from animation_workbench.core.generalization import level_scales
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class GeneralizationCacheTest(unittest.TestCase):
+    """Test GeneralizationCache works."""
+
+    def test_level_scales(self):
+        """
+        Test choosing the scales to generalize for
+        """
+        self.assertEqual(level_scales(0, 1000, 3), [])
+        self.assertEqual(level_scales(5000, 5000, 3), [5000])
+        scales = level_scales(1000, 100000, 3)
+        self.assertEqual(len(scales), 3)
+        self.assertAlmostEqual(scales[0], 1000)
+        self.assertAlmostEqual(scales[1], 10000)
+        self.assertAlmostEqual(scales[2], 100000)
+
+    def test_level_for_scale(self):
+        """
+        Test selecting the simplest level which is accurate at a scale
+        """
+        cache = GeneralizationCache(tempfile.gettempdir())
+        levels = [
+            QgsVectorLayer("LineString", f"level {i}", "memory") for i in range(3)
+        ]
+        cache.levels["layer"] = list(zip([1000, 10000, 100000], levels))
+
+        self.assertIsNone(cache.level_for_scale("layer", 500))
+        self.assertEqual(cache.level_for_scale("layer", 1000), levels[0])
+        self.assertEqual(cache.level_for_scale("layer", 50000), levels[1])
+        self.assertEqual(cache.level_for_scale("layer", 1000000), levels[2])
+        self.assertIsNone(cache.level_for_scale("other layer", 50000))
+
+    def test_write_generalized(self):
+        """
+        Test writing a simplified copy of a layer
+        """
+        layer = QgsVectorLayer(
+            "LineString?crs=EPSG:3857&field=name:string", "line", "memory"
+        )
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes(["line"])
+        feature.setGeometry(
+            QgsGeometry.fromPolylineXY(
+                [QgsPointXY(x, 0.001 * (x % 2)) for x in range(100)]
+            )
+        )
+        layer.dataProvider().addFeatures([feature])
+
+        with tempfile.TemporaryDirectory() as cache_directory:
+            path = os.path.join(cache_directory, "generalized.gpkg")
+            self.assertTrue(
+                GeneralizationCache.write_generalized(LayerSnapshot(layer), path, 1)
+            )
+            generalized = QgsVectorLayer(path, "generalized", "ogr")
+            feature = next(generalized.getFeatures())
+            self.assertEqual(feature["name"], "line")
+            self.assertEqual(feature.geometry().constGet().nCoordinates(), 2)
+            generalized = None
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(GeneralizationCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
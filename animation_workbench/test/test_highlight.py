@@ -0,0 +1,129 @@
+# coding=utf-8
+"""Feature highlight test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsExpressionContext,
+    QgsExpressionContextScope,
+    QgsFeature,
+    QgsFillSymbol,
+    QgsGeometry,
+    QgsLineSymbol,
+    QgsMapSettings,
+    QgsMarkerSymbol,
+    QgsProject,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+from animation_workbench.core.feature_source import FeatureStore
+from animation_workbench.core.highlight import (
+    FeatureHighlighter,
+    HighlightDecoration,
+    highlight_geometry,
+)
+from animation_workbench.core.render_queue import RenderJob
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class FeatureHighlighterTest(unittest.TestCase):
+    """Test FeatureHighlighter works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer("Polygon?crs=EPSG:4326", "areas", "memory")
+        features = []
+        for x in range(3):
+            feature = QgsFeature()
+            feature.setGeometry(
+                QgsGeometry.fromWkt(
+                    f"Polygon(({x} 0, {x + 1} 0, {x + 1} 1, {x} 1, {x} 0))"
+                )
+            )
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+        self.ids = [f.id() for f in self.layer.getFeatures()]
+
+    def test_highlight_geometry(self):
+        """
+        Test geometries are converted to match the highlight symbol
+        """
+        polygon = next(self.layer.getFeatures()).geometry()
+        self.assertEqual(highlight_geometry(polygon, QgsFillSymbol()), polygon)
+        self.assertEqual(
+            highlight_geometry(polygon, QgsLineSymbol()).type(),
+            QgsWkbTypes.LineGeometry,
+        )
+        self.assertEqual(
+            highlight_geometry(polygon, QgsMarkerSymbol()).type(),
+            QgsWkbTypes.PointGeometry,
+        )
+        point = QgsGeometry.fromWkt("Point(1 1)")
+        self.assertIsNone(highlight_geometry(point, QgsFillSymbol()))
+        self.assertIsNone(highlight_geometry(QgsGeometry(), QgsMarkerSymbol()))
+
+    def test_add_highlight(self):
+        """
+        Test the current feature of a frame is added as a decoration
+        """
+        transform = QgsCoordinateTransform(
+            self.layer.crs(),
+            QgsCoordinateReferenceSystem("EPSG:3857"),
+            QgsProject.instance(),
+        )
+        highlighter = FeatureHighlighter(
+            FeatureStore(self.layer), QgsFillSymbol(), transform
+        )
+
+        map_settings = QgsMapSettings()
+        context = QgsExpressionContext()
+        scope = QgsExpressionContextScope()
+        scope.setVariable("hover_feature_id", self.ids[1])
+        context.appendScope(scope)
+        map_settings.setExpressionContext(context)
+
+        job = RenderJob("frame.png", map_settings)
+        highlighter.add_highlight(job.frame_settings, job)
+        self.assertEqual(len(job.decorations), 1)
+        self.assertIsInstance(job.decorations[0], HighlightDecoration)
+        # the geometry is drawn in the map CRS
+        bounds = job.decorations[0].geometry.boundingBox()
+        self.assertAlmostEqual(bounds.xMinimum(), 111319.49, 1)
+
+        # travel frames highlight the feature being travelled to
+        scope = QgsExpressionContextScope()
+        scope.setVariable("to_feature_id", self.ids[2])
+        scope.setVariable("hover_feature_id", None)
+        context = QgsExpressionContext()
+        context.appendScope(scope)
+        map_settings.setExpressionContext(context)
+        job = RenderJob("frame.png", map_settings)
+        highlighter.add_highlight(job.frame_settings, job)
+        self.assertEqual(len(job.decorations), 1)
+        self.assertEqual(job.decorations[0].geometry, highlighter.geometry(self.ids[2]))
+
+        # frames without a current feature are not highlighted
+        job = RenderJob("frame.png", QgsMapSettings())
+        highlighter.add_highlight(job.frame_settings, job)
+        self.assertEqual(job.decorations, [])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FeatureHighlighterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
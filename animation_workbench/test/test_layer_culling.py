@@ -0,0 +1,99 @@
+# coding=utf-8
+"""Layer culling test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+from qgis.PyQt.QtCore import QSize
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsFeature,
+    QgsGeometry,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsRectangle,
+    QgsVectorLayer,
+)
+
+from animation_workbench.core.layer_culling import LayerCullingIndex
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def create_point_layer(name: str, x: float, y: float) -> QgsVectorLayer:
+    """
+    Creates a layer with a single point
+    """
+    layer = QgsVectorLayer("Point?crs=EPSG:4326", name, "memory")
+    feature = QgsFeature()
+    feature.setGeometry(QgsGeometry.fromPointXY(QgsPointXY(x, y)))
+    layer.dataProvider().addFeatures([feature])
+    layer.updateExtents()
+    return layer
+
+
+class LayerCullingIndexTest(unittest.TestCase):
+    """Test LayerCullingIndex works."""
+
+    def test_visible_layers(self):
+        """
+        Test culling layers by extent and scale
+        """
+        west = create_point_layer("west", -100, 0)
+        east = create_point_layer("east", 100, 0)
+        # a horizontal line has an extent without height
+        line = QgsVectorLayer("LineString?crs=EPSG:4326", "line", "memory")
+        feature = QgsFeature()
+        feature.setGeometry(
+            QgsGeometry.fromPolylineXY([QgsPointXY(-95, 0), QgsPointXY(-91, 0)])
+        )
+        line.dataProvider().addFeatures([feature])
+        line.updateExtents()
+        empty = QgsVectorLayer("Point?crs=EPSG:4326", "empty", "memory")
+        zoomed_in_only = create_point_layer("zoomed in only", -100, 0)
+        zoomed_in_only.setScaleBasedVisibility(True)
+        # only visible at scales larger than 1:10000
+        zoomed_in_only.setMinimumScale(10000)
+
+        crs = QgsCoordinateReferenceSystem("EPSG:4326")
+        index = LayerCullingIndex([west, east, line, empty, zoomed_in_only], crs)
+        self.assertEqual(index.extents[1], QgsRectangle(100, 0, 100, 0))
+        self.assertIsNone(index.extents[3])
+
+        map_settings = QgsMapSettings()
+        map_settings.setDestinationCrs(crs)
+        map_settings.setOutputSize(QSize(400, 400))
+        map_settings.setLayers([west, east, line, empty, zoomed_in_only])
+        map_settings.setExtent(QgsRectangle(-110, -10, -90, 10))
+        # layers without an extent are never culled
+        self.assertEqual(
+            [layer.name() for layer in index.visible_layers(map_settings)],
+            ["west", "line", "empty"],
+        )
+
+        map_settings.setExtent(QgsRectangle(-100.001, -0.001, -99.999, 0.001))
+        self.assertEqual(
+            [layer.name() for layer in index.visible_layers(map_settings)],
+            ["west", "empty", "zoomed in only"],
+        )
+
+        # no culling when the CRS differs from the indexed CRS
+        map_settings.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:3857"))
+        self.assertEqual(len(index.visible_layers(map_settings)), 5)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(LayerCullingIndexTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,179 @@
+# coding=utf-8
+"""Layer render profiler test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+from qgis.PyQt.QtCore import QSize
+from qgis.core import (
+    QgsGeometry,
+    QgsMapSettings,
+    QgsMarkerSymbol,
+    QgsPointXY,
+    QgsRectangle,
+    QgsVectorLayer,
+)
+
+from animation_workbench.core import LayerRenderProfiler, RenderJob
+from animation_workbench.core.filtered_renderer import FeatureIdFilterProvider
+from animation_workbench.core.highlight import HighlightDecoration
+from animation_workbench.core.layer_profiler import (
+    NO_ACTION,
+    DecorationRender,
+    LayerProfilingTask,
+    sample_evenly,
+    sample_evenly_from,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class LayerRenderProfilerTest(unittest.TestCase):
+    """Test LayerRenderProfiler works."""
+
+    def test_sample_evenly(self):
+        """
+        Test sampling evenly spaced frames
+        """
+        self.assertEqual(sample_evenly(list(range(10)), 0), list(range(10)))
+        self.assertEqual(sample_evenly(list(range(10)), 20), list(range(10)))
+        self.assertEqual(sample_evenly(list(range(10)), 5), [0, 2, 4, 6, 8])
+        self.assertEqual(sample_evenly(list(range(100)), 3), [0, 33, 66])
+
+    def test_sample_evenly_from(self):
+        """
+        Test sampling evenly spaced items while iterating
+        """
+        consumed = []
+
+        def items():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        self.assertEqual(sample_evenly_from(items(), 100, 3), [0, 33, 66])
+        # iteration stops at the last sampled item
+        self.assertEqual(len(consumed), 67)
+        self.assertEqual(sample_evenly_from(range(4), 4, 10), [0, 1, 2, 3])
+        self.assertEqual(sample_evenly_from(range(4), 0, 10), [])
+
+    def test_report(self):
+        """
+        Test aggregating layer timings per layer and action
+        """
+        profiler = LayerRenderProfiler()
+        profiler.layer_names = {"fast": "Fast layer", "slow": "Slow layer"}
+        profiler.times["fast"]["Hovering"] = [0.1, 0.1]
+        profiler.times["slow"]["Hovering"] = [0.4, 0.6]
+        profiler.times["slow"]["Travelling"] = [1.0, 2.0]
+        profiler.frame_count = 4
+
+        report = profiler.report()
+        self.assertEqual([row["layer"] for row in report], ["Slow layer", "Fast layer"])
+        self.assertAlmostEqual(report[0]["total_time"], 4)
+        self.assertAlmostEqual(report[0]["mean_time"], 1)
+        self.assertAlmostEqual(report[0]["share"], 4 / 4.2)
+        self.assertAlmostEqual(report[0]["mean_time_by_action"]["Hovering"], 0.5)
+        self.assertAlmostEqual(report[0]["mean_time_by_action"]["Travelling"], 1.5)
+        self.assertEqual(report[1]["frames"], 2)
+
+        text = profiler.report_text().splitlines()
+        self.assertEqual(text[0], "Layer render times (4 frames profiled):")
+        self.assertIn("Slow layer", text[1])
+        self.assertIn("Fast layer", text[2])
+
+    def test_task_resolves_jobs(self):
+        """
+        Test deferred job updates are applied when the task is created,
+        on the main thread, rather than when it runs
+        """
+        updates = []
+        job = RenderJob("frame.png", QgsMapSettings())
+        job.defer_settings_update(updates.append)
+        LayerProfilingTask([job])
+        self.assertEqual(len(updates), 1)
+
+    def test_prepare_job(self):
+        """
+        Test frames are profiled with the same features, layers and
+        decorations as when they are exported
+        """
+        layer = QgsVectorLayer("Point?crs=EPSG:4326", "points", "memory")
+        created = QgsVectorLayer("Point?crs=EPSG:4326", "created", "memory")
+        map_settings = QgsMapSettings()
+        map_settings.setOutputSize(QSize(50, 50))
+        map_settings.setExtent(QgsRectangle(-1, -1, 1, 1))
+        map_settings.setLayers([layer])
+        job = RenderJob("frame.png", map_settings)
+        job.feature_ids[layer.id()] = [1]
+        job.layer_factories.append(lambda: created)
+        job.decorations.append(
+            HighlightDecoration(
+                QgsGeometry.fromPointXY(QgsPointXY(0, 0)),
+                QgsMarkerSymbol.createSimple({}),
+            )
+        )
+
+        renders = LayerRenderProfiler.prepare_job(job)
+        self.assertEqual(
+            [render.layer_id for render in renders],
+            [created.id(), layer.id(), DecorationRender.LAYER_ID],
+        )
+        # the render jobs are prepared before the task runs
+        self.assertIsInstance(
+            renders[1].render_job.featureFilterProvider(), FeatureIdFilterProvider
+        )
+        self.assertIsNone(renders[0].render_job.featureFilterProvider())
+
+        profiler = LayerRenderProfiler()
+        for render in renders:
+            profiler.record(render)
+        self.assertEqual(
+            profiler.layer_names[DecorationRender.LAYER_ID], DecorationRender.NAME
+        )
+        self.assertEqual(len(profiler.times[layer.id()][NO_ACTION]), 1)
+
+    def test_task_per_frame(self):
+        """
+        Test each task profiles one frame, continuing with the same profiler
+        """
+        map_settings = QgsMapSettings()
+        map_settings.setOutputSize(QSize(50, 50))
+        map_settings.setExtent(QgsRectangle(-1, -1, 1, 1))
+        map_settings.setLayers(
+            [QgsVectorLayer("Point?crs=EPSG:4326", "points", "memory")]
+        )
+        jobs = [RenderJob(f"frame-{i}.png", map_settings) for i in range(2)]
+        completed = []
+
+        task = LayerProfilingTask(jobs)
+        task.profiling_completed.connect(completed.append)
+        self.assertTrue(task.run())
+        task.finished(True)
+        self.assertEqual(completed, [])
+
+        next_task = task.next_task()
+        self.assertIs(next_task.profiler, task.profiler)
+        next_task.profiling_completed.connect(completed.append)
+        self.assertTrue(next_task.run())
+        next_task.finished(True)
+        self.assertIsNone(next_task.next_task())
+        self.assertEqual(completed, [task.profiler])
+        self.assertEqual(task.profiler.frame_count, 2)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(LayerRenderProfilerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
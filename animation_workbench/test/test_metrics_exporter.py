@@ -0,0 +1,99 @@
+# coding=utf-8
+"""Metrics exporter test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import unittest
+
+from animation_workbench.core import MetricsExporter, RenderQueue
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class MetricsExporterTest(unittest.TestCase):
+    """Test MetricsExporter works."""
+
+    @staticmethod
+    def create_queue() -> RenderQueue:
+        """
+        Creates a render queue with 3 finished frames, one of which failed
+        """
+        queue = RenderQueue()
+        queue.total_queue_size = 5
+        queue.total_completed = 3
+        for i, render_time in enumerate([0.2, 3]):
+            timing = queue.metrics.frame(f"/tmp/frame-{i}.png")
+            timing.started = 100
+            timing.rendered = 100 + render_time
+            queue.metrics.frame_written(timing.file_name, 100 + render_time, 1000)
+        queue.metrics.frame_failed("/tmp/frame-2.png")
+        return queue
+
+    def test_render(self):
+        """
+        Test rendering metrics in the Prometheus text format
+        """
+        exporter = MetricsExporter(self.create_queue(), port=0, textfile_path="")
+        self.assertFalse(exporter.enabled)
+        exporter.set_encode_progress(12, 24.5)
+
+        lines = exporter.render().splitlines()
+        self.assertIn("animation_workbench_frames 5", lines)
+        self.assertIn("animation_workbench_in_flight_tasks 0", lines)
+        self.assertIn("animation_workbench_frames_completed_total 2", lines)
+        self.assertIn("animation_workbench_frames_failed_total 1", lines)
+        self.assertIn("animation_workbench_written_bytes_total 2000", lines)
+        self.assertIn("animation_workbench_encoded_frames 12", lines)
+        self.assertIn("animation_workbench_encode_frames_per_second 24.5", lines)
+        self.assertIn(
+            "# TYPE animation_workbench_frame_render_seconds histogram", lines
+        )
+        self.assertIn(
+            'animation_workbench_frame_render_seconds_bucket{le="0.1"} 0', lines
+        )
+        self.assertIn(
+            'animation_workbench_frame_render_seconds_bucket{le="0.25"} 1', lines
+        )
+        self.assertIn(
+            'animation_workbench_frame_render_seconds_bucket{le="5"} 2', lines
+        )
+        self.assertIn(
+            'animation_workbench_frame_render_seconds_bucket{le="+Inf"} 2', lines
+        )
+        self.assertIn("animation_workbench_frame_render_seconds_count 2", lines)
+
+    def test_textfile(self):
+        """
+        Test writing metrics for the textfile collector
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "animation_workbench.prom")
+            exporter = MetricsExporter(self.create_queue(), port=0, textfile_path=path)
+            self.assertTrue(exporter.enabled)
+            exporter.start()
+            exporter.stop()
+
+            with open(path, encoding="utf-8") as textfile:
+                self.assertIn(
+                    "animation_workbench_frames_completed_total 2",
+                    textfile.read().splitlines(),
+                )
+            self.assertEqual(os.listdir(temp_dir), ["animation_workbench.prom"])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(MetricsExporterTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
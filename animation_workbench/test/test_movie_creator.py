@@ -14,9 +14,16 @@ __copyright__ = "Copyright 2018, North Road"
 # This will get replaced with a git SHA1 when you do a git archive
 __revision__ = "$Format:%H$"
 
+import os
+import tempfile
 import unittest
 
-from animation_workbench.core import MovieCommandGenerator, MovieFormat
+from animation_workbench.core import (
+    MovieCommandGenerator,
+    MovieCreationTask,
+    MovieFormat,
+)
+from animation_workbench.core.movie_creator import automatic_segment_count
 from .utilities import get_qgis_app
 
 QGIS_APP = get_qgis_app()
@@ -34,9 +41,9 @@ class MovieCreatorTest(unittest.TestCase):
         generator = MovieCommandGenerator(
             output_file="/home/me/videos/test.mp4",
             output_mode="1920:1080",
-            intro_command=None,
-            outro_command=None,
-            music_command=None,
+            intro_inputs=None,
+            outro_inputs=None,
+            music_inputs=None,
             output_format=MovieFormat.MP4,
             work_directory="/tmp/movies",
             frame_filename_prefix="frames",
@@ -57,29 +64,12 @@ class MovieCreatorTest(unittest.TestCase):
                         "90",
                         "-i",
                         "/tmp/movies/frames-%010d.png",
-                        "-vf",
-                        "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white",
-                        "-c:v",
-                        "libx264",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "/tmp/main.mp4",
-                    ],
-                ),
-                (
-                    "/usr/bin/ffmpeg",
-                    [
-                        "-y",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
-                        "-i",
-                        "/tmp/list.txt",
-                        "-c",
-                        "copy",
-                        "-vf",
-                        "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,scale=1920:1080,setsar=1:1",
+                        "-filter_complex",
+                        "[0:v]scale=1920:1080,pad=ceil(iw/2)*2:ceil(ih/2)*2:"
+                        "color=white,setsar=1:1,fps=90[v0];"
+                        "[v0]concat=n=1:v=1:a=0[video]",
+                        "-map",
+                        "[video]",
                         "-c:v",
                         "libx264",
                         "-pix_fmt",
@@ -98,15 +88,19 @@ class MovieCreatorTest(unittest.TestCase):
         generator = MovieCommandGenerator(
             output_file="/home/me/videos/test.mp4",
             output_mode="1920:1080",
-            intro_command=None,
-            outro_command=None,
-            music_command=None,
+            intro_inputs=[["-loop", "1", "-t", "2", "-i", "/home/me/intro.png"]],
+            outro_inputs=[["-i", "/home/me/outro.mp4"]],
+            music_inputs=[["-i", "/home/me/one.mp3"], ["-i", "/home/me/two.mp3"]],
             output_format=MovieFormat.MP4,
             work_directory="/tmp/movies",
             frame_filename_prefix="frames",
             framerate=90,
             temp_dir="/tmp",
         )
+        normalize = (
+            "scale=1920:1080,pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,"
+            "setsar=1:1,fps=90"
+        )
 
         commands = generator.as_commands()
         self.assertEqual(
@@ -117,44 +111,225 @@ class MovieCreatorTest(unittest.TestCase):
                     [
                         "-hide_banner",
                         "-y",
+                        "-loop",
+                        "1",
+                        "-t",
+                        "2",
+                        "-i",
+                        "/home/me/intro.png",
                         "-framerate",
                         "90",
                         "-i",
                         "/tmp/movies/frames-%010d.png",
-                        "-vf",
-                        "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white",
-                        "-c:v",
-                        "libx264",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "/tmp/main.mp4",
-                    ],
-                ),
-                (
-                    "/usr/bin/ffmpeg",
-                    [
-                        "-y",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
                         "-i",
-                        "/tmp/list.txt",
-                        "-c",
-                        "copy",
-                        "-vf",
-                        "pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,"
-                        "scale=1920:1080,setsar=1:1",
+                        "/home/me/outro.mp4",
+                        "-i",
+                        "/home/me/one.mp3",
+                        "-i",
+                        "/home/me/two.mp3",
+                        "-filter_complex",
+                        f"[0:v]{normalize}[v0];[1:v]{normalize}[v1];"
+                        f"[2:v]{normalize}[v2];"
+                        "[v0][v1][v2]concat=n=3:v=1:a=0[video];"
+                        "[3:a][4:a]concat=n=2:v=0:a=1[audio]",
+                        "-map",
+                        "[video]",
                         "-c:v",
                         "libx264",
                         "-pix_fmt",
                         "yuv420p",
+                        "-map",
+                        "[audio]",
+                        "-c:a",
+                        "aac",
+                        "-shortest",
                         "/home/me/videos/test.mp4",
                     ],
                 ),
             ],
         )
 
+    def test_mp4_from_pipe(self):
+        """
+        Test mp4 command generation for frames encoded while rendering
+        """
+        generator = MovieCommandGenerator(
+            output_file="/home/me/videos/test.mp4",
+            output_mode="1920:1080",
+            intro_inputs=[["-i", "/home/me/intro.mp4"]],
+            outro_inputs=None,
+            music_inputs=None,
+            output_format=MovieFormat.MP4,
+            work_directory="/tmp/movies",
+            frame_filename_prefix="frames",
+            framerate=90,
+            temp_dir="/tmp",
+            frames_from_pipe=True,
+        )
+
+        commands = generator.as_commands()
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(
+            commands[0][1][:10],
+            [
+                "-hide_banner",
+                "-y",
+                "-i",
+                "/home/me/intro.mp4",
+                "-f",
+                "image2pipe",
+                "-framerate",
+                "90",
+                "-i",
+                "pipe:0",
+            ],
+        )
+        self.assertIn(generator.frames_input, commands[0][1])
+        self.assertEqual(commands[0][1][-1], "/home/me/videos/test.mp4")
+
+    def test_mp4_segments(self):
+        """
+        Test mp4 command generation for frames encoded in parallel segments
+        """
+        self.maxDiff = None
+        generator = MovieCommandGenerator(
+            output_file="/home/me/videos/test.mp4",
+            output_mode="1920:1080",
+            intro_inputs=[["-i", "/home/me/intro.mp4"]],
+            outro_inputs=None,
+            music_inputs=[["-i", "/home/me/music.mp3"]],
+            output_format=MovieFormat.MP4,
+            work_directory="/tmp/movies",
+            frame_filename_prefix="frames",
+            framerate=30,
+            temp_dir="/tmp",
+            segment_count=3,
+            frame_count=400,
+            first_frame=1,
+        )
+        # segments are whole groups of pictures of 2 seconds, except the last
+        self.assertEqual(generator.segment_ranges(), [(1, 120), (121, 120), (241, 160)])
+
+        commands = generator.as_commands()
+        self.assertEqual(
+            generator.segment_files,
+            [
+                "/tmp/intro.mp4",
+                "/tmp/main-000.mp4",
+                "/tmp/main-001.mp4",
+                "/tmp/main-002.mp4",
+            ],
+        )
+        self.assertEqual(len(commands), 5)
+        self.assertEqual(
+            commands[0][1][-5:],
+            ["-pix_fmt", "yuv420p", "-g", "60", "/tmp/intro.mp4"],
+        )
+        self.assertEqual(
+            commands[2],
+            (
+                "/usr/bin/ffmpeg",
+                [
+                    "-hide_banner",
+                    "-y",
+                    "-framerate",
+                    "30",
+                    "-start_number",
+                    "121",
+                    "-i",
+                    "/tmp/movies/frames-%010d.png",
+                    "-vf",
+                    "scale=1920:1080,pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white,"
+                    "setsar=1:1,fps=30",
+                    "-c:v",
+                    "libx264",
+                    "-pix_fmt",
+                    "yuv420p",
+                    "-g",
+                    "60",
+                    "-frames:v",
+                    "120",
+                    "/tmp/main-001.mp4",
+                ],
+            ),
+        )
+        # the pieces are joined without encoding them again
+        self.assertEqual(
+            commands[4],
+            (
+                "/usr/bin/ffmpeg",
+                [
+                    "-hide_banner",
+                    "-y",
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-i",
+                    "/tmp/segments.txt",
+                    "-i",
+                    "/home/me/music.mp3",
+                    "-filter_complex",
+                    "[1:a]concat=n=1:v=0:a=1[audio]",
+                    "-map",
+                    "0:v",
+                    "-map",
+                    "[audio]",
+                    "-c:v",
+                    "copy",
+                    "-c:a",
+                    "aac",
+                    "-shortest",
+                    "/home/me/videos/test.mp4",
+                ],
+            ),
+        )
+        with open("/tmp/segments.txt", encoding="utf-8") as segment_list:
+            self.assertEqual(
+                segment_list.read().splitlines(),
+                [f"file {name}" for name in generator.segment_files],
+            )
+
+    def test_plan_segments(self):
+        """
+        Test frames are only split into segments when none are missing, and
+        frames which are not part of the animation are left out
+        """
+        with tempfile.TemporaryDirectory() as work_directory:
+            task = MovieCreationTask(
+                output_file=os.path.join(work_directory, "test.mp4"),
+                output_mode="1920:1080",
+                intro_inputs=None,
+                outro_inputs=None,
+                music_inputs=None,
+                output_format=MovieFormat.MP4,
+                work_directory=work_directory,
+                frame_filename_prefix="frames",
+                framerate=30,
+                segment_count=2,
+                frame_count=4,
+            )
+            # frame 9 was left by an earlier, longer export
+            for frame in (0, 1, 2, 3, 9):
+                name = os.path.join(work_directory, f"frames-{frame:010d}.png")
+                with open(name, "wb") as frame_file:
+                    frame_file.write(b"png")
+            self.assertEqual(task.plan_segments(), (2, 4, 0))
+
+            os.remove(os.path.join(work_directory, f"frames-{1:010d}.png"))
+            self.assertEqual(task.plan_segments(), (1, 4, 0))
+
+    def test_automatic_segment_count(self):
+        """
+        Test the number of segments is chosen from the cores and frame size
+        """
+        self.assertEqual(automatic_segment_count(3000, 60, 3840, 2160, cores=32), 5)
+        self.assertEqual(automatic_segment_count(3000, 60, 3840, 2160, cores=4), 1)
+        # small frames are not split
+        self.assertEqual(automatic_segment_count(3000, 60, 640, 480, cores=32), 1)
+        # short animations are split into fewer segments
+        self.assertEqual(automatic_segment_count(600, 60, 3840, 2160, cores=32), 2)
+
     def test_gif(self):
         """
         Test gif command generation
@@ -162,9 +337,9 @@ class MovieCreatorTest(unittest.TestCase):
         generator = MovieCommandGenerator(
             output_file="/home/me/videos/test.gif",
             output_mode="720p",
-            intro_command=None,
-            outro_command=None,
-            music_command=None,
+            intro_inputs=None,
+            outro_inputs=None,
+            music_inputs=None,
             output_format=MovieFormat.GIF,
             work_directory="/tmp/movies",
             frame_filename_prefix="frames",
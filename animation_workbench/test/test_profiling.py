@@ -0,0 +1,111 @@
+# coding=utf-8
+"""Stage profiler test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import pstats
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from animation_workbench.core import StageProfiler
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def profiled_stage():
+    """
+    A function for the profiler to record
+    """
+    return sum(range(100))
+
+
+class StageProfilerTest(unittest.TestCase):
+    """Test StageProfiler works."""
+
+    def test_disabled(self):
+        """
+        Test that a disabled profiler profiles and writes nothing
+        """
+        profiler = StageProfiler("render_queue", enabled=False, trace_memory=False)
+        with profiler:
+            profiled_stage()
+        self.assertIsNone(profiler.profiler)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(profiler.write(temp_dir, "test"), [])
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_write(self):
+        """
+        Test that repeated and nested entries accumulate into one profile,
+        with a single memory snapshot taken when it is written
+        """
+        was_tracing = tracemalloc.is_tracing()
+        profiler = StageProfiler("render_queue", enabled=True, trace_memory=True)
+        with mock.patch(
+            "tracemalloc.take_snapshot", wraps=tracemalloc.take_snapshot
+        ) as take_snapshot:
+            for _ in range(3):
+                with profiler:
+                    with profiler:
+                        profiled_stage()
+            self.assertEqual(take_snapshot.call_count, 0)
+
+            with tempfile.TemporaryDirectory() as temp_dir:
+                written = profiler.write(temp_dir, "test")
+                self.assertEqual(take_snapshot.call_count, 1)
+                self.assertEqual(
+                    [os.path.basename(path) for path in written],
+                    ["test-render_queue.pstats", "test-render_queue.tracemalloc"],
+                )
+                stats = pstats.Stats(written[0])
+                calls = [
+                    call_count
+                    for (_, _, function), (_, call_count, *_) in stats.stats.items()
+                    if function == "profiled_stage"
+                ]
+                self.assertEqual(calls, [3])
+                tracemalloc.Snapshot.load(written[1])
+        self.assertEqual(tracemalloc.is_tracing(), was_tracing)
+
+    def test_shared_tracing(self):
+        """
+        Test that memory tracing is only stopped once the last profiler
+        tracing memory is written
+        """
+        was_tracing = tracemalloc.is_tracing()
+        outer = StageProfiler("job_generation", enabled=True, trace_memory=True)
+        inner = StageProfiler("render_queue", enabled=True, trace_memory=True)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with outer:
+                with inner:
+                    profiled_stage()
+                written = outer.write(temp_dir, "test")
+            self.assertTrue(tracemalloc.is_tracing())
+            self.assertIn(
+                os.path.join(temp_dir, "test-job_generation.tracemalloc"), written
+            )
+
+            written = inner.write(temp_dir, "test")
+            self.assertIn(
+                os.path.join(temp_dir, "test-render_queue.tracemalloc"), written
+            )
+        self.assertEqual(tracemalloc.is_tracing(), was_tracing)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(StageProfilerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,128 @@
+# coding=utf-8
+"""Raster warp cache test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import unittest
+
+from qgis.core import (
+    QgsBilinearRasterResampler,
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsProject,
+    QgsRasterLayer,
+    QgsRectangle,
+)
+
+from animation_workbench.core import LayerSnapshot, RasterWarpCache
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class RasterWarpCacheTest(unittest.TestCase):
+    """Test RasterWarpCache works."""
+
+    def test_prepare(self):
+        """
+        Test warping a raster to the destination CRS, and reusing the cache
+        """
+        layer = QgsRasterLayer(
+            os.path.join(os.path.dirname(__file__), "data", "dem.tif"), "dem"
+        )
+        self.assertTrue(layer.isValid())
+        destination_crs = QgsCoordinateReferenceSystem(
+            "EPSG:3857" if layer.crs().authid() != "EPSG:3857" else "EPSG:4326"
+        )
+        extent = QgsCoordinateTransform(
+            layer.crs(), destination_crs, QgsProject.instance()
+        ).transformBoundingBox(layer.extent())
+
+        with tempfile.TemporaryDirectory() as cache_directory:
+            cache = RasterWarpCache(cache_directory)
+            replacements = cache.prepare(
+                [LayerSnapshot(layer)], destination_crs, extent
+            )
+            warped = replacements[layer.id()]
+            self.assertTrue(warped.isValid())
+            self.assertEqual(warped.crs(), destination_crs)
+            self.assertEqual(warped.name(), "dem")
+            self.assertEqual(len(os.listdir(cache_directory)), 1)
+            cached_path = warped.source()
+
+            # a second export reuses the cached copy
+            replacements = RasterWarpCache(cache_directory).prepare(
+                [LayerSnapshot(layer)], destination_crs, extent
+            )
+            self.assertEqual(replacements[layer.id()].source(), cached_path)
+            self.assertEqual(len(os.listdir(cache_directory)), 1)
+
+            # layers already in the destination CRS are rendered as they are
+            self.assertEqual(
+                RasterWarpCache(cache_directory).prepare(
+                    [LayerSnapshot(layer)], layer.crs(), layer.extent()
+                ),
+                {},
+            )
+
+    def test_resampling(self):
+        """
+        Test rasters are warped with the resampling method QGIS draws them
+        with, which is part of the cache key
+        """
+        layer = QgsRasterLayer(
+            os.path.join(os.path.dirname(__file__), "data", "dem.tif"), "dem"
+        )
+        self.assertEqual(LayerSnapshot(layer).resampling, "near")
+        layer.resampleFilter().setZoomedInResampler(QgsBilinearRasterResampler())
+        self.assertEqual(LayerSnapshot(layer).resampling, "bilinear")
+
+        with tempfile.TemporaryDirectory() as cache_directory:
+            cache = RasterWarpCache(cache_directory)
+            crs = QgsCoordinateReferenceSystem("EPSG:3857")
+            extent = QgsRectangle(0, 0, 10, 10)
+            self.assertNotEqual(
+                cache.cache_path(layer.source(), crs, extent),
+                cache.cache_path(layer.source(), crs, extent, "bilinear"),
+            )
+
+    def test_failed_warp(self):
+        """
+        Test a failed warp leaves no partial file behind
+        """
+        with tempfile.TemporaryDirectory() as cache_directory:
+            source_path = os.path.join(cache_directory, "not_a_raster.tif")
+            with open(source_path, "w", encoding="utf-8") as source:
+                source.write("not a raster")
+            target_path = os.path.join(cache_directory, "warped.tif")
+            # left over from an interrupted warp
+            with open(f"{target_path}.partial.tif", "w", encoding="utf-8") as partial:
+                partial.write("partial")
+
+            cache = RasterWarpCache(cache_directory)
+            self.assertFalse(
+                cache.warp(
+                    source_path,
+                    target_path,
+                    QgsCoordinateReferenceSystem("EPSG:3857"),
+                    QgsRectangle(0, 0, 10, 10),
+                )
+            )
+            self.assertEqual(os.listdir(cache_directory), ["not_a_raster.tif"])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(RasterWarpCacheTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,139 @@
+# coding=utf-8
+"""Raster time series test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from osgeo import gdal, osr
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsMapSettings,
+    QgsPointXY,
+    QgsRasterLayer,
+    QgsRectangle,
+    QgsSingleBandGrayRenderer,
+)
+
+from animation_workbench.core.raster_series import RasterTimeSeries
+from animation_workbench.core.render_queue import RenderJob
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class RasterTimeSeriesTest(unittest.TestCase):
+    """Test RasterTimeSeries works."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # three 10x10 steps with the values 0, 10 and 20
+        path = os.path.join(self.directory.name, "series.tif")
+        dataset = gdal.GetDriverByName("GTiff").Create(
+            path, 10, 10, 3, gdal.GDT_Float32
+        )
+        dataset.SetGeoTransform((0, 1, 0, 10, 0, -1))
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(3857)
+        dataset.SetProjection(srs.ExportToWkt())
+        for step in range(3):
+            dataset.GetRasterBand(step + 1).WriteArray(
+                np.full((10, 10), step * 10, dtype=np.float32)
+            )
+        dataset = None
+        self.layer = QgsRasterLayer(path, "series", "gdal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_step_weights(self):
+        """
+        Test frames are mapped to the steps of the series
+        """
+        series = RasterTimeSeries(self.layer, self.directory.name)
+        self.assertEqual(len(series.steps), 3)
+        self.assertEqual(series.step_weights(0, 5), [(0, 1.0)])
+        self.assertEqual(series.step_weights(1, 5), [(0, 1.0)])
+        self.assertEqual(series.step_weights(2, 5), [(1, 1.0)])
+        self.assertEqual(series.step_weights(4, 5), [(2, 1.0)])
+
+        series.interpolate = True
+        self.assertEqual(series.step_weights(1, 5), [(0, 0.5), (1, 0.5)])
+        self.assertEqual(series.step_weights(2, 5), [(1, 1.0)])
+        self.assertEqual(series.step_weights(0, 1), [(0, 1.0)])
+
+    def test_unprepared_frame_layers(self):
+        """
+        Test frames render their step from the source raster without a cube
+        """
+        self.layer.setRenderer(QgsSingleBandGrayRenderer(self.layer.dataProvider(), 1))
+        series = RasterTimeSeries(self.layer, self.directory.name, interpolate=True)
+        map_settings = QgsMapSettings()
+        map_settings.setLayers([self.layer])
+        position = series.remove_layer(map_settings)
+        job = RenderJob("frame.png", map_settings)
+        series.add_frame_layer(
+            job.frame_settings, frame=4, frame_count=5, position=position, job=job
+        )
+        frame_layer = job.frame_settings.layers()[0]
+        self.assertEqual(job.owned_layers, [frame_layer])
+        self.assertEqual(frame_layer.renderer().grayBand(), 3)
+        value, ok = frame_layer.dataProvider().sample(QgsPointXY(5, 5), 3)
+        self.assertTrue(ok)
+        self.assertEqual(value, 20)
+        del frame_layer
+        job.owned_layers.clear()
+
+    def test_frame_layers(self):
+        """
+        Test frames render their step of the series from the cache
+        """
+        series = RasterTimeSeries(
+            self.layer, os.path.join(self.directory.name, "cache"), interpolate=True
+        )
+        self.assertTrue(
+            series.prepare(
+                QgsCoordinateReferenceSystem("EPSG:3857"), QgsRectangle(2, 2, 8, 8)
+            )
+        )
+        self.assertEqual(series.cube.shape, (3, 6, 6))
+        self.assertEqual(series.cube[:, 3, 3].tolist(), [0, 10, 20])
+
+        map_settings = QgsMapSettings()
+        map_settings.setLayers([self.layer])
+        position = series.remove_layer(map_settings)
+        self.assertEqual(position, 0)
+        self.assertEqual(map_settings.layers(), [])
+
+        job = RenderJob("frame.png", map_settings)
+        series.add_frame_layer(
+            job.frame_settings, frame=3, frame_count=5, position=position, job=job
+        )
+        frame_layer = job.frame_settings.layers()[0]
+        self.assertEqual(job.owned_layers, [frame_layer])
+        self.assertTrue(frame_layer.isValid())
+        # the frame is halfway between the second step and the third
+        value, ok = frame_layer.dataProvider().sample(QgsPointXY(5, 5), 1)
+        self.assertTrue(ok)
+        self.assertAlmostEqual(value, 15)
+        del frame_layer
+        job.owned_layers.clear()
+        series.release()
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(RasterTimeSeriesTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,117 @@
+# coding=utf-8
+"""Render metrics test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from animation_workbench.core import RenderMetrics
+from animation_workbench.core.render_metrics import percentile
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class RenderMetricsTest(unittest.TestCase):
+    """Test RenderMetrics works."""
+
+    @staticmethod
+    def create_metrics() -> RenderMetrics:
+        """
+        Creates metrics for 4 frames, with render times of 1, 2, 3 and 4 seconds
+        and write times of half a second
+        """
+        metrics = RenderMetrics()
+        for i in range(4):
+            timing = metrics.frame(f"/tmp/frame-{i}.png")
+            timing.created = 100
+            timing.queued = 100
+            timing.started = 100 + i
+            timing.rendered = 100 + i + (i + 1)
+            timing.written = 100 + i + (i + 1) + 0.5
+            timing.output_size = 1000
+            timing.worker = i % 2
+            timing.success = True
+        return metrics
+
+    def test_percentile(self):
+        """
+        Test percentile calculation
+        """
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([5], 0.95), 5)
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 0.5), 3)
+        self.assertAlmostEqual(percentile([1, 2, 3, 4], 0.5), 2.5)
+        self.assertAlmostEqual(percentile([4, 3, 2, 1], 0.95), 3.85)
+
+    def test_summary(self):
+        """
+        Test summary statistics
+        """
+        metrics = self.create_metrics()
+        # a frame which never completed should be excluded from statistics
+        metrics.frame("/tmp/frame-4.png").queued = 100
+
+        summary = metrics.summary()
+        self.assertEqual(summary["frames"], 5)
+        self.assertEqual(summary["completed_frames"], 4)
+        self.assertAlmostEqual(summary["render_time_p50"], 2.5)
+        self.assertAlmostEqual(summary["render_time_p95"], 3.85)
+        self.assertEqual(summary["render_time_max"], 4)
+        self.assertAlmostEqual(summary["write_time_p50"], 0.5)
+        self.assertAlmostEqual(summary["write_time_p95"], 0.5)
+        self.assertAlmostEqual(summary["queue_wait_mean"], 1.5)
+        self.assertEqual(summary["queue_wait_max"], 3)
+        # 4 frames, last written 7.5 seconds after being queued
+        self.assertAlmostEqual(summary["frames_per_second"], 4 / 7.5)
+        self.assertEqual(
+            len(summary["frames_per_second_over_time"]), RenderMetrics.FPS_BUCKETS
+        )
+        self.assertIn("Render time p95: 3.850s", metrics.summary_text())
+        self.assertIn("Write time p50: 0.500s", metrics.summary_text())
+
+    def test_export(self):
+        """
+        Test exporting timings to CSV and JSON
+        """
+        metrics = self.create_metrics()
+        with tempfile.TemporaryDirectory() as tmp:
+            files = metrics.export(tmp, "frames")
+            self.assertEqual(
+                files,
+                [
+                    os.path.join(tmp, "frames-timings.csv"),
+                    os.path.join(tmp, "frames-timings.json"),
+                ],
+            )
+            with open(files[0], encoding="utf-8") as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            self.assertEqual(len(rows), 4)
+            self.assertEqual(rows[1]["file_name"], "/tmp/frame-1.png")
+            self.assertEqual(rows[1]["render_time"], "2")
+            self.assertEqual(rows[1]["write_time"], "0.5")
+            self.assertEqual(rows[1]["worker"], "1")
+
+            with open(files[1], encoding="utf-8") as json_file:
+                content = json.load(json_file)
+            self.assertEqual(content["summary"]["completed_frames"], 4)
+            self.assertEqual(content["frames"][3]["queue_wait"], 3)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(RenderMetricsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
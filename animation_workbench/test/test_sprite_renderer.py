@@ -0,0 +1,158 @@
+# coding=utf-8
+"""Sprite renderer test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+import numpy as np
+from qgis.PyQt.QtCore import QSize
+from qgis.PyQt.QtGui import QColor
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
+    QgsMapSettings,
+    QgsPalLayerSettings,
+    QgsPointXY,
+    QgsProject,
+    QgsProperty,
+    QgsRectangle,
+    QgsSymbolLayer,
+    QgsVectorLayer,
+    QgsVectorLayerSimpleLabeling,
+)
+
+from animation_workbench.core.sprite_renderer import (
+    SpriteCompositor,
+    frame_dependencies,
+    transform_points,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class SpriteCompositorTest(unittest.TestCase):
+    """Test SpriteCompositor works."""
+
+    def setUp(self):
+        self.points = QgsVectorLayer(
+            "Point?crs=EPSG:3857&field=name:string", "points", "memory"
+        )
+        self.background = QgsVectorLayer(
+            "Polygon?crs=EPSG:3857&field=name:string", "background", "memory"
+        )
+        self.map_settings = QgsMapSettings()
+        self.map_settings.setDestinationCrs(QgsCoordinateReferenceSystem("EPSG:3857"))
+        self.map_settings.setOutputSize(QSize(100, 100))
+        self.map_settings.setExtent(QgsRectangle(0, 0, 100, 100))
+        self.map_settings.setBackgroundColor(QColor(255, 255, 255))
+        self.map_settings.setLayers([self.background])
+        # three points moving right over two frames, the last one hidden
+        self.positions = np.array(
+            [
+                [[10, 90], [50, 50], [np.nan, np.nan]],
+                [[20, 90], [60, 50], [np.nan, np.nan]],
+            ],
+            dtype=np.float32,
+        )
+        self.compositor = SpriteCompositor(
+            self.points, self.positions, [["a"], ["b"], ["c"]]
+        )
+
+    def test_frame_dependencies(self):
+        """
+        Test frame variables referenced by layer styles are found
+        """
+        self.assertEqual(frame_dependencies(self.background), set())
+        symbol_layer = self.background.renderer().symbol().symbolLayer(0)
+        symbol_layer.setDataDefinedProperty(
+            QgsSymbolLayer.PropertyFillColor,
+            QgsProperty.fromExpression(
+                "if(@frame_number > 10 and @layer_name = 'x', 'red', 'blue')"
+            ),
+        )
+        self.assertEqual(frame_dependencies(self.background), {"frame_number"})
+
+    def test_unsupported_reasons(self):
+        """
+        Test frames are only drawn as sprites when nothing else changes
+        """
+        self.assertEqual(self.compositor.unsupported_reasons(self.map_settings), [])
+
+        self.points.setLabeling(QgsVectorLayerSimpleLabeling(QgsPalLayerSettings()))
+        self.points.setLabelsEnabled(True)
+        self.assertEqual(
+            self.compositor.unsupported_reasons(self.map_settings),
+            ["the moving points are labeled"],
+        )
+        self.points.setLabelsEnabled(False)
+
+        self.points.renderer().symbol().symbolLayer(0).setDataDefinedProperty(
+            QgsSymbolLayer.PropertySize, QgsProperty.fromField("size")
+        )
+        self.assertEqual(
+            self.compositor.unsupported_reasons(self.map_settings),
+            ["the moving points have data defined symbols"],
+        )
+
+    def test_placements(self):
+        """
+        Test sprites are placed at the pixel positions of the points
+        """
+        self.compositor.prepare(self.map_settings)
+        self.assertEqual(len(self.compositor.sprites), 1)
+        self.assertEqual(self.compositor.point_sprites.tolist(), [0, 0, 0])
+        anchor_x, anchor_y = self.compositor.anchors[0]
+
+        sprites, lefts, tops = self.compositor.placements(1, self.map_settings)
+        self.assertEqual(sprites.tolist(), [0, 0])
+        self.assertEqual(lefts.tolist(), [round(20 - anchor_x), round(60 - anchor_x)])
+        self.assertEqual(tops.tolist(), [round(10 - anchor_y), round(50 - anchor_y)])
+
+        image = self.compositor.frame(1).render_to_image(self.map_settings)
+        self.assertEqual(image.size(), QSize(100, 100))
+        # the marker is drawn where the point is, and the background elsewhere
+        self.assertNotEqual(image.pixelColor(60, 50), QColor(255, 255, 255))
+        self.assertEqual(image.pixelColor(95, 95), QColor(255, 255, 255))
+
+    def test_transform_points(self):
+        """
+        Test arrays of points are transformed at once, with NaN for points
+        which cannot be transformed
+        """
+        transform = QgsCoordinateTransform(
+            QgsCoordinateReferenceSystem("EPSG:4326"),
+            QgsCoordinateReferenceSystem("EPSG:3857"),
+            QgsProject.instance(),
+        )
+        xs, ys = transform_points(
+            np.array([10.0, -20.5]), np.array([5.0, 45.0]), transform
+        )
+        for x, y, expected in zip(xs, ys, [QgsPointXY(10, 5), QgsPointXY(-20.5, 45)]):
+            expected = transform.transform(expected)
+            self.assertAlmostEqual(x, expected.x(), places=6)
+            self.assertAlmostEqual(y, expected.y(), places=6)
+
+        xs, ys = transform_points(
+            np.array([10.0, 10.0]), np.array([5.0, 95.0]), transform
+        )
+        self.assertAlmostEqual(
+            xs[0], transform.transform(QgsPointXY(10, 5)).x(), places=6
+        )
+        self.assertTrue(np.isnan(xs[1]) and np.isnan(ys[1]))
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(SpriteCompositorTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
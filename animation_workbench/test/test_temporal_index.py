@@ -0,0 +1,163 @@
+# coding=utf-8
+"""Temporal feature index test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import unittest
+
+from qgis.PyQt.QtCore import QDate, QDateTime, QTime, Qt
+from qgis.core import (
+    QgsFeature,
+    QgsVectorLayer,
+    QgsVectorLayerTemporalProperties,
+)
+
+from animation_workbench.core.temporal_index import (
+    TemporalFeatureIndex,
+    to_seconds,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+DAY = 24 * 60 * 60
+
+
+def day(number: int) -> QDateTime:
+    """
+    Returns the start of a day in January 2020
+    """
+    return QDateTime(QDate(2020, 1, number), QTime(0, 0), Qt.UTC)
+
+
+class TemporalFeatureIndexTest(unittest.TestCase):
+    """Test TemporalFeatureIndex works."""
+
+    def setUp(self):
+        self.layer = QgsVectorLayer(
+            "Point?crs=EPSG:4326&field=id:integer"
+            "&field=start:datetime&field=end:datetime",
+            "events",
+            "memory",
+        )
+        features = []
+        # (start day, end day), None for open ended
+        for i, (start, end) in enumerate(
+            [(1, 2), (2, 4), (5, 6), (1, 31), (10, None), (None, None)]
+        ):
+            feature = QgsFeature(self.layer.fields())
+            feature.setAttributes(
+                [
+                    i,
+                    day(start) if start else None,
+                    day(end) if end else None,
+                ]
+            )
+            features.append(feature)
+        self.layer.dataProvider().addFeatures(features)
+        self.id_for_attribute = {
+            feature["id"]: feature.id() for feature in self.layer.getFeatures()
+        }
+
+    def visible(self, index: TemporalFeatureIndex, start: int, end: int):
+        """
+        Returns the id attribute of the features visible between two days
+        """
+        ids = index.feature_ids(to_seconds(day(start)), to_seconds(day(end)))
+        attribute_for_id = {v: k for k, v in self.id_for_attribute.items()}
+        return [attribute_for_id[feature_id] for feature_id in ids]
+
+    def test_start_and_end_fields(self):
+        """
+        Test looking up features by time window
+        """
+        properties = self.layer.temporalProperties()
+        properties.setIsActive(True)
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromFields
+        )
+        properties.setStartField("start")
+        properties.setEndField("end")
+
+        index = TemporalFeatureIndex.from_layer(self.layer)
+        self.assertEqual(index.begin, to_seconds(day(1)))
+        self.assertEqual(index.end, to_seconds(day(31)))
+        self.assertEqual(self.visible(index, 1, 2), [0, 3])
+        self.assertEqual(self.visible(index, 3, 4), [1, 3])
+        self.assertEqual(self.visible(index, 7, 8), [3])
+        self.assertEqual(self.visible(index, 20, 21), [3, 4])
+        # long lived features are not added to every bucket
+        self.assertEqual(list(index.long_features), [3, 4])
+
+    def test_instants(self):
+        """
+        Test looking up features with a single date time and a duration
+        """
+        properties = self.layer.temporalProperties()
+        properties.setIsActive(True)
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeInstantFromField
+        )
+        properties.setStartField("start")
+        properties.setFixedDuration(0)
+
+        index = TemporalFeatureIndex.from_layer(self.layer)
+        self.assertEqual(self.visible(index, 1, 2), [0, 3])
+        self.assertEqual(self.visible(index, 2, 5), [1])
+        self.assertEqual(self.visible(index, 11, 12), [])
+
+        # the last instant is only in windows which include their end
+        self.assertEqual(index.end, to_seconds(day(10)))
+        self.assertEqual(self.visible(index, 5, 10), [2])
+        ids = index.feature_ids(to_seconds(day(5)), index.end, include_end=True)
+        self.assertEqual(
+            list(ids), [self.id_for_attribute[2], self.id_for_attribute[4]]
+        )
+
+    def test_accumulate(self):
+        """
+        Test features stay visible once they have started if the index
+        accumulates features
+        """
+        properties = self.layer.temporalProperties()
+        properties.setIsActive(True)
+        properties.setMode(
+            QgsVectorLayerTemporalProperties.ModeFeatureDateTimeStartAndEndFromFields
+        )
+        properties.setStartField("start")
+        properties.setEndField("end")
+
+        index = TemporalFeatureIndex(self.layer, '"start"', '"end"', accumulate=True)
+        self.assertEqual(self.visible(index, 1, 2), [0, 3])
+        self.assertEqual(self.visible(index, 7, 8), [0, 1, 2, 3])
+        self.assertEqual(self.visible(index, 20, 21), [0, 1, 2, 3, 4])
+
+        if hasattr(properties, "setAccumulateFeatures"):
+            index = TemporalFeatureIndex.from_layer(self.layer)
+            self.assertFalse(index.accumulate)
+            properties.setAccumulateFeatures(True)
+            # the index is rebuilt when the setting changes
+            self.assertFalse(index.is_current())
+            self.assertTrue(TemporalFeatureIndex.from_layer(self.layer).accumulate)
+
+    def test_unsupported(self):
+        """
+        Test layers without temporal settings are rejected
+        """
+        with self.assertRaises(ValueError):
+            TemporalFeatureIndex.from_layer(self.layer)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TemporalFeatureIndexTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""Tour optimizer test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import random
+import unittest
+
+from qgis.core import QgsPointXY
+
+from animation_workbench.core.tour_optimizer import (
+    TourOptimizer,
+    distance_scaled_travel_frames,
+)
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class TourOptimizerTest(unittest.TestCase):
+    """Test TourOptimizer works."""
+
+    def test_line(self):
+        """
+        Test points along a line are visited in order
+        """
+        points = [QgsPointXY(x, 0) for x in (0, 5, 1, 4, 2, 3)]
+        optimizer = TourOptimizer(points)
+        order = optimizer.optimize()
+        self.assertEqual([points[i].x() for i in order], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(optimizer.length(order), 5)
+
+    def test_optimize(self):
+        """
+        Test optimized tours visit every point once and are shorter
+        """
+        random.seed(1)
+        points = [QgsPointXY(random.random(), random.random()) for _ in range(300)]
+        for loop in (False, True):
+            optimizer = TourOptimizer(points, loop=loop)
+            nearest_neighbour = optimizer.nearest_neighbour_order()
+            order = optimizer.optimize()
+            self.assertEqual(order[0], 0)
+            self.assertEqual(sorted(order), list(range(300)))
+            self.assertLessEqual(
+                optimizer.length(order), optimizer.length(nearest_neighbour)
+            )
+            self.assertLess(
+                optimizer.length(order), optimizer.length(list(range(300))) / 5
+            )
+
+    def test_segment_lengths(self):
+        """
+        Test segment lengths include the loop back to the start
+        """
+        points = [QgsPointXY(0, 0), QgsPointXY(3, 0), QgsPointXY(3, 4)]
+        self.assertEqual(TourOptimizer(points).segment_lengths([0, 1, 2]), [3, 4])
+        self.assertEqual(
+            TourOptimizer(points, loop=True).segment_lengths([0, 1, 2]), [3, 4, 5]
+        )
+
+    def test_distance_scaled_travel_frames(self):
+        """
+        Test travel frames are spread in proportion to distance
+        """
+        self.assertEqual(distance_scaled_travel_frames([1, 2, 3], 10), [5, 10, 15])
+        self.assertEqual(distance_scaled_travel_frames([0, 0], 10), [10, 10])
+        self.assertEqual(distance_scaled_travel_frames([0, 100], 10), [2, 20])
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TourOptimizerTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,97 @@
+# coding=utf-8
+"""Trace recorder test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import json
+import os
+import tempfile
+import unittest
+
+from animation_workbench.core import RenderMetrics, TraceRecorder
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+class TraceRecorderTest(unittest.TestCase):
+    """Test TraceRecorder works."""
+
+    def test_disabled(self):
+        """
+        Test that a disabled recorder records and writes nothing
+        """
+        trace = TraceRecorder(enabled=False)
+        with trace.span("job_generation", "controller"):
+            pass
+        self.assertEqual(trace.events, [])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.assertEqual(trace.write(temp_dir, "test"), [])
+            self.assertEqual(os.listdir(temp_dir), [])
+
+    def test_frame_timings(self):
+        """
+        Test recording render tasks from frame timings
+        """
+        trace = TraceRecorder(enabled=True)
+        trace.origin = 100
+        metrics = RenderMetrics()
+        timing = metrics.frame("/tmp/frame-0.png")
+        timing.queued = 100
+        timing.started = 101
+        timing.rendered = 103
+        timing.worker = 2
+        metrics.frame_written(timing.file_name, 103.5, 1000)
+        # never started, so only appears in the trace if canceled later
+        metrics.frame("/tmp/frame-1.png").queued = 100
+
+        trace.add_frame_timings(metrics)
+        spans = [e for e in trace.events if e["ph"] == "X"]
+        self.assertEqual([e["name"] for e in spans], ["frame-0.png", "write"])
+        self.assertEqual(spans[0]["ts"], 1000000)
+        self.assertEqual(spans[0]["dur"], 2000000)
+        self.assertEqual(spans[1]["dur"], 500000)
+        self.assertEqual(trace.lanes, {"main": 1, "render worker 2": 2})
+        self.assertEqual(
+            [(e["ph"], e["ts"]) for e in trace.events if e["cat"] == "queue"],
+            [("b", 0), ("e", 1000000)],
+        )
+
+    def test_write(self):
+        """
+        Test writing a trace event file
+        """
+        trace = TraceRecorder(enabled=True)
+        with trace.span("job_generation", "controller", args={"frames": 3}):
+            pass
+        trace.add_span("ffmpeg", "encode", 1, 2, TraceRecorder.ENCODER_LANE)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = trace.write(temp_dir, "test")
+            self.assertEqual(files, [os.path.join(temp_dir, "test-trace.json")])
+            with open(files[0], encoding="utf-8") as trace_file:
+                events = json.load(trace_file)["traceEvents"]
+
+        lane_names = {
+            e["tid"]: e["args"]["name"] for e in events if e["name"] == "thread_name"
+        }
+        self.assertEqual(lane_names, {1: "main", 2: "movie encoder"})
+        spans = [e for e in events if e["ph"] == "X"]
+        self.assertEqual(spans[0]["name"], "job_generation")
+        self.assertEqual(spans[0]["args"], {"frames": 3})
+        self.assertEqual(spans[1]["tid"], 2)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TraceRecorderTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,128 @@
+# coding=utf-8
+"""Trajectory interpolation test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__copyright__ = "Copyright 2022, Tim Sutton"
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = "$Format:%H$"
+
+import math
+import tempfile
+import unittest
+
+from qgis.core import QgsFeature, QgsGeometry, QgsVectorLayer
+
+from animation_workbench.core.trajectory import TrajectoryInterpolator
+from .utilities import get_qgis_app
+
+QGIS_APP = get_qgis_app()
+
+
+def track_layer(geometry_type: str, tracks) -> QgsVectorLayer:
+    """
+    Returns a memory layer with a feature for each WKT track
+    """
+    layer = QgsVectorLayer(
+        f"{geometry_type}?crs=EPSG:3857&field=name:string", "tracks", "memory"
+    )
+    features = []
+    for i, wkt in enumerate(tracks):
+        feature = QgsFeature(layer.fields())
+        feature.setAttributes([f"track {i}"])
+        feature.setGeometry(QgsGeometry.fromWkt(wkt))
+        features.append(feature)
+    layer.dataProvider().addFeatures(features)
+    return layer
+
+
+class TrajectoryInterpolatorTest(unittest.TestCase):
+    """Test TrajectoryInterpolator works."""
+
+    def test_linear_referencing(self):
+        """
+        Test tracks without M values are travelled at a constant speed
+        """
+        layer = track_layer(
+            "LineString",
+            ["LineString(0 0, 10 0, 10 30)", "LineString(0 0, 0 -4)"],
+        )
+        trajectories = TrajectoryInterpolator(layer)
+        self.assertFalse(trajectories.uses_time)
+        self.assertEqual(trajectories.track_count, 2)
+
+        positions = trajectories.interpolate([0, 0.25, 1])
+        self.assertEqual(positions.shape, (3, 2, 2))
+        self.assertEqual(positions[0].tolist(), [[0, 0], [0, 0]])
+        self.assertEqual(positions[1].tolist(), [[10, 0], [0, -1]])
+        self.assertEqual(positions[2].tolist(), [[10, 30], [0, -4]])
+
+    def test_times(self):
+        """
+        Test M values are used as the time at each vertex
+        """
+        layer = track_layer(
+            "LineStringM",
+            [
+                "LineStringM(0 0 10, 10 0 20, 10 10 40)",
+                "LineStringM(0 0 30, 0 10 50)",
+            ],
+        )
+        trajectories = TrajectoryInterpolator(layer)
+        self.assertTrue(trajectories.uses_time)
+        self.assertEqual(trajectories.time_range(), (10, 50))
+
+        positions = trajectories.interpolate([10, 15, 30, 40, 50])
+        self.assertEqual(positions[0, 0].tolist(), [0, 0])
+        self.assertEqual(positions[1, 0].tolist(), [5, 0])
+        self.assertEqual(positions[2, 0].tolist(), [10, 5])
+        self.assertEqual(positions[3, 0].tolist(), [10, 10])
+        # tracks are hidden outside of their time range
+        self.assertTrue(math.isnan(positions[4, 0, 0]))
+        self.assertTrue(math.isnan(positions[0, 1, 0]))
+        self.assertEqual(positions[2, 1].tolist(), [0, 0])
+        self.assertEqual(positions[3, 1].tolist(), [0, 5])
+        self.assertEqual(positions[4, 1].tolist(), [0, 10])
+
+    def test_positions_layer(self):
+        """
+        Test the layer of points for a frame only has the active tracks
+        """
+        layer = track_layer(
+            "LineStringM",
+            ["LineStringM(0 0 0, 10 0 10)", "LineStringM(0 0 5, 0 10 10)"],
+        )
+        trajectories = TrajectoryInterpolator(layer)
+        self.assertFalse(trajectories.is_current(11))
+        with tempfile.TemporaryDirectory() as directory:
+            trajectories.precompute(11, directory)
+            self.assertTrue(trajectories.is_current(11))
+            self.assertFalse(trajectories.is_current(12))
+
+            points = trajectories.create_positions_layer(2)
+            self.assertEqual(points.featureCount(), 1)
+            feature = next(points.getFeatures())
+            self.assertEqual(feature["name"], "track 0")
+            self.assertEqual(feature.geometry().asWkt(), "Point (2 0)")
+
+            points = trajectories.create_positions_layer(10)
+            self.assertEqual(points.featureCount(), 2)
+            self.assertEqual(
+                sorted(
+                    (feature["name"], feature.geometry().asWkt())
+                    for feature in points.getFeatures()
+                ),
+                [("track 0", "Point (10 0)"), ("track 1", "Point (0 10)")],
+            )
+            trajectories.positions = None
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(TrajectoryInterpolatorTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)